@@ -30,14 +30,32 @@
 
 
 import os
+import json
 import threading
 
+from uuid import UUID
+
 from hsm_tools.cryptech.cryptech.libhal import HALDigestAlgorithm, HALKeyType, HALCurve
+from hsm_tools.pkcs11_attr import CKA
 
 from hsm_cache_db.alpha import CacheTableAlpha, AlphaCacheRow
 from hsm_cache_db.master import CacheTableMaster, MasterKeyListRow
 from hsm_cache_db.cache import CacheDB
 
+# the attribute types the synchronizer reads from the alphas. The index
+# can't answer a search on any other attribute
+INDEXED_ATTRIBUTES = frozenset(CKA.cached_attributes())
+
+
+class UnassignedKeyRow(object):
+    """A key in the keygen pool"""
+    def __init__(self, profile, keytype, flags, curve):
+        self.profile = profile
+        self.keytype = keytype
+        self.flags = flags
+        self.curve = curve
+
+
 class HSMCache(CacheDB):
     """ Root cache object that uses dictionaries to store key information"""
     def __init__(self, rpc_count, cache_folder):
@@ -52,6 +70,20 @@ class HSMCache(CacheDB):
         except OSError:
             pass
 
+        # secondary index of (attribute type, value) to master uuids so
+        # PKEY_MATCH can be answered without asking the alphas. The index
+        # is warm once the cache has been built with the key attributes
+        self.index_lock = threading.Lock()
+        self.attribute_index = {}
+        self.unindexed_keys = set()
+        self.index_warm = False
+
+        # keys from the keygen pool that haven't been given to a client.
+        # They're kept out of the tables so PKEY_MATCH can't find them
+        self.unassigned_lock = threading.Lock()
+        self.unassigned_keys = {}
+        self.__load_unassigned_keys()
+
         # create cache tables        
         super(HSMCache, self).__init__(rpc_count)
 
@@ -94,12 +126,13 @@ class HSMCache(CacheDB):
 
         index = None
         for key in full_list.iterkeys():
-            if (index is None or index < key):
+            if (index is None or key < index):
                 index = key
 
         return index
 
-    def add_key_to_alpha(self, rpc_index, uuid, keytype = 0, flags = 0, param_masterListID = None, auto_backup = True):
+    def add_key_to_alpha(self, rpc_index, uuid, keytype = 0, flags = 0, param_masterListID = None, auto_backup = True,
+                         curve = 0, attributes = None):
         masterTable = self.masterTable
         alphaTable = self.alphaTables[rpc_index]
 
@@ -126,7 +159,10 @@ class HSMCache(CacheDB):
             # this is being reloaded from saved data. if
             # param_masterListID is None, add_row will
             # generate a new UUID
-            masterListID = masterTable.add_row(param_masterListID, MasterKeyListRow(rpc_index, uuid, keytype, flags))
+            row = MasterKeyListRow(rpc_index, uuid, keytype, flags, curve, attributes)
+            masterListID = masterTable.add_row(param_masterListID, row)
+
+            self.__index_key(masterListID, row)
 
         alphaTable.add_row(uuid, AlphaCacheRow(masterListID))
 
@@ -148,6 +184,11 @@ class HSMCache(CacheDB):
         # remove from the master list. later the synchronizer will
         # clean up uuids on alphas that don't have a master list reference
         masterTable = self.masterTable
+
+        row = masterTable.fetch_row(masterListID)
+        if (row is not None):
+            self.__unindex_key(masterListID, row)
+
         masterTable.delete_row(masterListID)
 
         # updates to the mapping must be made right away
@@ -162,7 +203,7 @@ class HSMCache(CacheDB):
 
         result = None
         for key, val in full_list.iteritems():
-            if (result is None or result[0] < key):
+            if (result is None or key < result[0]):
                 result = (key, val)
 
         return result
@@ -177,7 +218,197 @@ class HSMCache(CacheDB):
         else:
             return {}
 
+    def get_key_type(self, master_uuid):
+        """Returns the key type of the master_uuid or None if the key isn't
+        in the cache"""
+        if (master_uuid is None):
+            return None
+
+        row = self.masterTable.fetch_row(master_uuid)
+        if (row is not None):
+            return row.keytype
+        else:
+            return None
+
+    def __index_key(self, master_uuid, row):
+        with self.index_lock:
+            if (row.attributes is None):
+                self.unindexed_keys.add(master_uuid)
+                return
+
+            for attr_type, value in row.attributes.iteritems():
+                self.attribute_index.setdefault((attr_type, value), set()).add(master_uuid)
+
+    def __unindex_key(self, master_uuid, row):
+        with self.index_lock:
+            self.unindexed_keys.discard(master_uuid)
+
+            if (row.attributes is None):
+                return
+
+            for attr_type, value in row.attributes.iteritems():
+                master_uuids = self.attribute_index.get((attr_type, value))
+                if (master_uuids is not None):
+                    master_uuids.discard(master_uuid)
+                    if (not master_uuids):
+                        del self.attribute_index[(attr_type, value)]
+
+    def set_key_attributes(self, master_uuid, attributes):
+        """Update the cached attributes of a key. attributes is a list of
+        (type, value) pairs. A value of None removes the attribute"""
+        row = self.masterTable.fetch_row(master_uuid)
+        if (row is None or row.attributes is None):
+            return
+
+        self.__unindex_key(master_uuid, row)
+
+        with self.index_lock:
+            for attr_type, value in attributes:
+                if (value is None):
+                    row.attributes.pop(attr_type, None)
+                else:
+                    row.attributes[attr_type] = value
+
+        self.__index_key(master_uuid, row)
+
+    def set_index_warm(self, warm):
+        with self.index_lock:
+            self.index_warm = warm
+
+    def is_index_warm(self):
+        with self.index_lock:
+            return self.index_warm
+
+    def __match_order(self, row):
+        """Keys are matched in the order the alphas return them: by the
+        lowest alpha with the key and then by its uuid on that alpha"""
+        rpc_index = min(row.uuid_dict)
+        return (rpc_index, row.uuid_dict[rpc_index])
+
+    def match_keys(self, keytype, curve, mask, flags, attributes, result_max, previous_uuid):
+        """Find keys the same way an alpha does for PKEY_MATCH. Returns a
+        list of up to result_max master uuids in order, starting after
+        previous_uuid. Returns None if the cache can't answer and the
+        alphas must be searched"""
+        with self.index_lock:
+            if (not self.index_warm):
+                return None
+
+            previous_order = None
+            if (previous_uuid.int != 0):
+                previous_row = self.masterTable.fetch_row(previous_uuid)
+                if (previous_row is None or not previous_row.uuid_dict):
+                    return None
+
+                previous_order = self.__match_order(previous_row)
+
+            if (len(attributes) > 0):
+                if (any(value is None or attr_type not in INDEXED_ATTRIBUTES
+                        for attr_type, value in attributes)):
+                    return None
+
+                # start with the smallest set of keys that have one of the
+                # attributes and also check keys that haven't been indexed
+                candidates = min((self.attribute_index.get(attr, set()) for attr in attributes), key = len)
+                candidates = candidates | self.unindexed_keys
+
+                rows = {}
+                for master_uuid in candidates:
+                    row = self.masterTable.fetch_row(master_uuid)
+                    if (row is not None):
+                        rows[master_uuid] = row
+            else:
+                rows = self.masterTable.get_rows()
+
+            results = []
+            for master_uuid, row in rows.iteritems():
+                # the key isn't on any alpha
+                if (not row.uuid_dict):
+                    continue
+
+                if (keytype != 0 and row.keytype != keytype):
+                    continue
+
+                if (((row.flags ^ flags) & mask) != 0):
+                    continue
+
+                if (curve != 0):
+                    if (row.curve is None):
+                        return None
+                    if (row.curve != curve):
+                        continue
+
+                if (len(attributes) > 0):
+                    if (row.attributes is None):
+                        return None
+                    if (any(row.attributes.get(attr_type) != value for attr_type, value in attributes)):
+                        continue
+
+                order = self.__match_order(row)
+                if (previous_order is not None and order <= previous_order):
+                    continue
+
+                results.append((order, master_uuid))
+
+        results.sort()
+
+        return [master_uuid for _, master_uuid in results[:result_max]]
+
+    def __load_unassigned_keys(self):
+        try:
+            with open('%s/cache_unassigned.db'%self.cache_folder, 'r') as fh:
+                for rpc_index, uuid, profile, keytype, flags, curve in json.load(fh):
+                    self.unassigned_keys[(rpc_index, UUID(uuid))] = UnassignedKeyRow(profile, keytype, flags, curve)
+        except (IOError, ValueError):
+            pass
+
+    def __save_unassigned_keys(self):
+        """Must be called with unassigned_lock held"""
+        with open('%s/cache_unassigned.db'%self.cache_folder, 'w') as fh:
+            json.dump([[rpc_index, str(uuid), row.profile, row.keytype, row.flags, row.curve]
+                       for (rpc_index, uuid), row in self.unassigned_keys.iteritems()], fh)
+
+    def add_unassigned_key(self, rpc_index, uuid, profile, keytype, flags, curve):
+        """A key has been made for the keygen pool"""
+        with self.unassigned_lock:
+            self.unassigned_keys[(rpc_index, uuid)] = UnassignedKeyRow(profile, keytype, flags, curve)
+            self.__save_unassigned_keys()
+
+    def remove_unassigned_key(self, rpc_index, uuid):
+        """Returns the UnassignedKeyRow or None"""
+        with self.unassigned_lock:
+            row = self.unassigned_keys.pop((rpc_index, uuid), None)
+            if (row is not None):
+                self.__save_unassigned_keys()
+
+            return row
+
+    def is_unassigned_key(self, rpc_index, uuid):
+        with self.unassigned_lock:
+            return (rpc_index, uuid) in self.unassigned_keys
+
+    def get_unassigned_keys(self):
+        """Returns a list of (rpc_index, uuid, UnassignedKeyRow)"""
+        with self.unassigned_lock:
+            return [(rpc_index, uuid, row) for (rpc_index, uuid), row in self.unassigned_keys.iteritems()]
+
+    def assign_key(self, rpc_index, uuid):
+        """Move a key from the keygen pool to the cache tables. Returns
+        the master uuid or None if the key wasn't in the pool"""
+        row = self.remove_unassigned_key(rpc_index, uuid)
+        if (row is None):
+            return None
+
+        # new keys don't have any attributes until they are set
+        return self.add_key_to_alpha(rpc_index, uuid, row.keytype, row.flags,
+                                     curve = row.curve, attributes = {})
+
     def clear(self):
+        with self.index_lock:
+            self.attribute_index.clear()
+            self.unindexed_keys.clear()
+            self.index_warm = False
+
         super(HSMCache, self).clear()
 
         if (self.is_initialized()):
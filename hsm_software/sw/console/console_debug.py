@@ -30,6 +30,8 @@
 
 import logging
 
+from hsm_tools import diagnostics
+
 def dks_debug_flash_led(console_object, args):
     if (console_object.led is not None):
         console_object.led.system_led.flash_red()
@@ -41,6 +43,16 @@ def dks_debug_verbose(console_object, args):
     logging.getLogger().setLevel(logging.DEBUG)
     return 'HSM set to verbose debugging'
 
+def dks_debug_diagnostics(console_object, args):
+    if (args[0].lower() == 'on'):
+        diagnostics.set_enabled(True)
+    elif (args[0].lower() == 'off'):
+        diagnostics.set_enabled(False)
+    else:
+        return "Expected 'on' or 'off'"
+
+    return 'RPC diagnostics %s' % ('on' if diagnostics.enabled else 'off')
+
 def dks_reboot_cryptech(console_object, args):
     console_object.cty_direct_call("Rebooting the Cryptech STMs")
 
@@ -59,6 +71,10 @@ def add_debug_commands(console_object):
                                 usage=' - Reboots the CrypTech devices.',
                                 callback=dks_reboot_cryptech)
 
+    debug_node.add_child('diagnostics', num_args=1,
+                            usage=" - <'on' or 'off'> - Hex dump RPC frames and check replies for errors.",
+                            callback=dks_debug_diagnostics)
+
     debug_node.add_child('verbose', num_args=0,
                             usage=' - Add verbose debugging to log.',
                             callback=dks_debug_verbose)
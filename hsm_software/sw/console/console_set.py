@@ -30,6 +30,9 @@
 
 from settings import HSMSettings
 
+from device_scheduler import POLICIES, RPCClass
+from keygen_pool import KeygenProfile
+
 from hsm_tools.cryptech_port import DKS_HALUser
 
 from scripts.masterkey import MasterKeySetScriptModule
@@ -187,6 +190,227 @@ def dks_set_enable_zeroconf(console_object, args):
 
     return 'ZERO_CONFIG_ENABLED set to %s'%str(result)
 
+def dks_set_host_hashing(console_object, args):
+    result = toggle_settings(console_object, HSMSettings.HOST_HASHING, args[0])
+    return 'HOST_HASHING set to %s'%str(result)
+
+def dks_set_hash_update_coalesce_size(console_object, args):
+    try:
+        size = int(args[0])
+    except ValueError:
+        return 'invalid argument "%s"' % args[0]
+
+    if (size < 0):
+        return 'HASH_UPDATE_COALESCE_SIZE must be 0 or greater'
+
+    console_object.settings.set_setting(HSMSettings.HASH_UPDATE_COALESCE_SIZE, size)
+
+    return 'HASH_UPDATE_COALESCE_SIZE set to %i'%size
+
+def dks_set_host_verify_processes(console_object, args):
+    try:
+        processes = int(args[0])
+    except ValueError:
+        return 'invalid argument "%s"' % args[0]
+
+    if (processes < 0):
+        return 'HOST_VERIFY_PROCESSES must be 0 or greater'
+
+    console_object.settings.set_setting(HSMSettings.HOST_VERIFY_PROCESSES, processes)
+    console_object.rpc_preprocessor.set_host_verify_processes(processes)
+
+    return 'HOST_VERIFY_PROCESSES set to %i'%processes
+
+def dks_set_keygen_pool_profiles(console_object, args):
+    if (args[0].lower() == 'none'):
+        profile_list = []
+    else:
+        profile_list = args[0].split(',')
+
+    try:
+        profiles = [KeygenProfile.parse(text) for text in profile_list]
+    except ValueError as e:
+        return str(e)
+
+    console_object.settings.set_setting(HSMSettings.KEYGEN_POOL_PROFILES, [str(profile) for profile in profiles])
+    console_object.rpc_preprocessor.set_keygen_pool_settings(*console_object.rpc_preprocessor.get_keygen_pool_settings())
+
+    return 'KEYGEN_POOL_PROFILES set to %s'%(', '.join(str(profile) for profile in profiles) or 'none')
+
+def set_non_negative_setting(console_object, setting, args, value_type):
+    """Set a setting that can't be negative from the first argument.
+    Returns the message to show and if the setting was changed"""
+    try:
+        value = value_type(args[0])
+    except ValueError:
+        return ('invalid argument "%s"' % args[0], False)
+
+    if (value < 0):
+        return ('%s must be 0 or greater' % setting.name, False)
+
+    console_object.settings.set_setting(setting, value)
+
+    return ('%s set to %s'%(setting.name, str(value)), True)
+
+def dks_set_keygen_pool_depth(console_object, args):
+    message, changed = set_non_negative_setting(console_object, HSMSettings.KEYGEN_POOL_DEPTH, args, int)
+    if (changed):
+        console_object.rpc_preprocessor.set_keygen_pool_settings(*console_object.rpc_preprocessor.get_keygen_pool_settings())
+
+    return message
+
+def dks_set_keygen_pool_refill_interval(console_object, args):
+    return set_non_negative_setting(console_object, HSMSettings.KEYGEN_POOL_REFILL_INTERVAL, args, float)[0]
+
+def dks_set_keygen_pool_idle_time(console_object, args):
+    return set_non_negative_setting(console_object, HSMSettings.KEYGEN_POOL_IDLE_TIME, args, float)[0]
+
+def dks_set_rpc_pipeline_depth(console_object, args):
+    try:
+        depth = int(args[0])
+    except ValueError:
+        return 'invalid argument "%s"' % args[0]
+
+    if (depth < 1):
+        return 'RPC_PIPELINE_DEPTH must be 1 or greater'
+
+    console_object.settings.set_setting(HSMSettings.RPC_PIPELINE_DEPTH, depth)
+
+    return 'RPC_PIPELINE_DEPTH set to %i. This will be used by new connections.'%depth
+
+def dks_set_rpc_device_window(console_object, args):
+    try:
+        window = int(args[0])
+    except ValueError:
+        return 'invalid argument "%s"' % args[0]
+
+    if (window < 1):
+        return 'RPC_DEVICE_WINDOW must be 1 or greater'
+
+    console_object.settings.set_setting(HSMSettings.RPC_DEVICE_WINDOW, window)
+    console_object.rpc_preprocessor.set_device_window(window)
+
+    return 'RPC_DEVICE_WINDOW set to %i'%window
+
+def dks_set_rpc_device_queue_setting(console_object, setting, args):
+    message, changed = set_non_negative_setting(console_object, setting, args, int)
+    if (changed):
+        console_object.rpc_preprocessor.set_device_queue_limits(*console_object.rpc_preprocessor.get_device_queue_limits())
+
+    return message
+
+def dks_set_rpc_device_queue_limit(console_object, args):
+    return dks_set_rpc_device_queue_setting(console_object, HSMSettings.RPC_DEVICE_QUEUE_LIMIT, args)
+
+def dks_set_rpc_device_queue_bytes(console_object, args):
+    return dks_set_rpc_device_queue_setting(console_object, HSMSettings.RPC_DEVICE_QUEUE_BYTES, args)
+
+def dks_set_rpc_timeout(console_object, args):
+    try:
+        rpc_class = RPCClass(args[0].lower())
+    except ValueError:
+        return 'RPC class must be one of %s' % ', '.join(c.value for c in RPCClass)
+
+    try:
+        timeout = float(args[1])
+    except ValueError:
+        return 'invalid argument "%s"' % args[1]
+
+    if (timeout < 0):
+        return 'RPC_TIMEOUT must be 0 or greater'
+
+    timeouts = dict(console_object.settings.get_setting(HSMSettings.RPC_TIMEOUTS) or {})
+    timeouts[rpc_class.value] = timeout
+
+    console_object.settings.set_setting(HSMSettings.RPC_TIMEOUTS, timeouts)
+
+    return 'RPC_TIMEOUT for %s set to %s'%(rpc_class.value, str(timeout))
+
+def dks_set_rpc_hedging(console_object, args):
+    result = toggle_settings(console_object, HSMSettings.RPC_HEDGING, args[0])
+    return 'RPC_HEDGING set to %s'%str(result)
+
+def dks_set_device_probe_interval(console_object, args):
+    return set_non_negative_setting(console_object, HSMSettings.DEVICE_PROBE_INTERVAL, args, float)[0]
+
+def dks_set_device_probe_timeout(console_object, args):
+    return set_non_negative_setting(console_object, HSMSettings.DEVICE_PROBE_TIMEOUT, args, float)[0]
+
+def dks_set_device_reconnect_max_delay(console_object, args):
+    return set_non_negative_setting(console_object, HSMSettings.DEVICE_RECONNECT_MAX_DELAY, args, float)[0]
+
+def dks_set_rpc_priority_aging(console_object, args):
+    try:
+        aging = float(args[0])
+    except ValueError:
+        return 'invalid argument "%s"' % args[0]
+
+    if (aging < 0):
+        return 'RPC_PRIORITY_AGING must be 0 or greater'
+
+    console_object.settings.set_setting(HSMSettings.RPC_PRIORITY_AGING, aging)
+    console_object.rpc_preprocessor.set_priority_aging(aging)
+
+    return 'RPC_PRIORITY_AGING set to %s'%str(aging)
+
+def dks_set_rpc_scheduler_policy(console_object, args):
+    policy_name = args[0].lower()
+
+    if (not console_object.rpc_preprocessor.set_scheduler_policy(policy_name)):
+        return 'Unknown policy "%s". Expected %s' % (args[0], ', '.join(sorted(POLICIES)))
+
+    console_object.settings.set_setting(HSMSettings.RPC_SCHEDULER_POLICY, policy_name)
+
+    return 'RPC_SCHEDULER_POLICY set to %s'%policy_name
+
+def dks_set_key_metadata_cache_size(console_object, args):
+    try:
+        size = int(args[0])
+    except ValueError:
+        return 'invalid argument "%s"' % args[0]
+
+    if (size < 0):
+        return 'KEY_METADATA_CACHE_SIZE must be 0 or greater'
+
+    console_object.settings.set_setting(HSMSettings.KEY_METADATA_CACHE_SIZE, size)
+    console_object.rpc_preprocessor.set_key_metadata_cache_size(size)
+
+    return 'KEY_METADATA_CACHE_SIZE set to %i'%size
+
+def dks_set_key_attribute_cache_size(console_object, args):
+    try:
+        size = int(args[0])
+    except ValueError:
+        return 'invalid argument "%s"' % args[0]
+
+    if (size < 0):
+        return 'KEY_ATTRIBUTE_CACHE_SIZE must be 0 or greater'
+
+    console_object.settings.set_setting(HSMSettings.KEY_ATTRIBUTE_CACHE_SIZE, size)
+    console_object.rpc_preprocessor.set_key_attribute_cache_size(size)
+
+    return 'KEY_ATTRIBUTE_CACHE_SIZE set to %i'%size
+
+def dks_set_random_pool_setting(console_object, setting, args):
+    try:
+        value = int(args[0])
+    except ValueError:
+        return 'invalid argument "%s"' % args[0]
+
+    if (value < 0):
+        return '%s must be 0 or greater' % setting
+
+    console_object.settings.set_setting(setting, value)
+    console_object.rpc_preprocessor.set_random_pool_size(*console_object.rpc_preprocessor.get_random_pool_size())
+
+    return '%s set to %i'%(setting, value)
+
+def dks_set_random_pool_size(console_object, args):
+    return dks_set_random_pool_setting(console_object, HSMSettings.RANDOM_POOL_SIZE, args)
+
+def dks_set_random_pool_low_water(console_object, args):
+    return dks_set_random_pool_setting(console_object, HSMSettings.RANDOM_POOL_LOW_WATER, args)
+
 def add_set_commands(console_object):
     set_node = console_object.add_child('set')
 
@@ -209,6 +433,94 @@ def add_set_commands(console_object):
                         usage=" - <'true' or 'false'>",
                         callback=dks_set_enable_zeroconf)
 
+    set_node.add_child(name="HOST_HASHING", num_args=1,
+                        usage=" - <'true' or 'false'>",
+                        callback=dks_set_host_hashing)
+
+    set_node.add_child(name="HASH_UPDATE_COALESCE_SIZE", num_args=1,
+                        usage=" - <number of bytes to collect before a hash update is sent, 0 = off>",
+                        callback=dks_set_hash_update_coalesce_size)
+
+    set_node.add_child(name="HOST_VERIFY_PROCESSES", num_args=1,
+                        usage=" - <number of processes used to verify signatures on the HSM, 0 = use the CrypTech devices>",
+                        callback=dks_set_host_verify_processes)
+
+    set_node.add_child(name="KEYGEN_POOL_PROFILES", num_args=1,
+                        usage=" - <comma separated 'rsa:<bits>:<flags>' or 'ec:<P-256, P-384, or P-521>:<flags>', or 'none'>",
+                        callback=dks_set_keygen_pool_profiles)
+
+    set_node.add_child(name="KEYGEN_POOL_DEPTH", num_args=1,
+                        usage=" - <number of keys of each profile to keep ready, 0 = off>",
+                        callback=dks_set_keygen_pool_depth)
+
+    set_node.add_child(name="KEYGEN_POOL_REFILL_INTERVAL", num_args=1,
+                        usage=" - <seconds between keys made for the keygen pool>",
+                        callback=dks_set_keygen_pool_refill_interval)
+
+    set_node.add_child(name="KEYGEN_POOL_IDLE_TIME", num_args=1,
+                        usage=" - <seconds a CrypTech device must be idle before a key is made on it>",
+                        callback=dks_set_keygen_pool_idle_time)
+
+    set_node.add_child(name="RPC_PIPELINE_DEPTH", num_args=1,
+                        usage=" - <number of requests per connection, 1 = off>",
+                        callback=dks_set_rpc_pipeline_depth)
+
+    set_node.add_child(name="RPC_DEVICE_WINDOW", num_args=1,
+                        usage=" - <number of requests that can be sent to an alpha at once>",
+                        callback=dks_set_rpc_device_window)
+
+    set_node.add_child(name="RPC_DEVICE_QUEUE_LIMIT", num_args=1,
+                        usage=" - <number of requests that can wait for an alpha, 0 = no limit>",
+                        callback=dks_set_rpc_device_queue_limit)
+
+    set_node.add_child(name="RPC_DEVICE_QUEUE_BYTES", num_args=1,
+                        usage=" - <number of bytes that can wait for an alpha, 0 = no limit>",
+                        callback=dks_set_rpc_device_queue_bytes)
+
+    set_node.add_child(name="RPC_TIMEOUT", num_args=2,
+                        usage=" - <'rsa_sign', 'ec_sign', 'keygen', 'match', or 'other'> <seconds to wait for a reply, 0 = no limit>",
+                        callback=dks_set_rpc_timeout)
+
+    set_node.add_child(name="RPC_HEDGING", num_args=1,
+                        usage=" - <'true' or 'false'> - repeat slow signing requests on another alpha with the key",
+                        callback=dks_set_rpc_hedging)
+
+    set_node.add_child(name="DEVICE_PROBE_INTERVAL", num_args=1,
+                        usage=" - <seconds between health checks of each alpha, 0 = off>",
+                        callback=dks_set_device_probe_interval)
+
+    set_node.add_child(name="DEVICE_PROBE_TIMEOUT", num_args=1,
+                        usage=" - <seconds an alpha has to answer a health check, 0 = no limit>",
+                        callback=dks_set_device_probe_timeout)
+
+    set_node.add_child(name="DEVICE_RECONNECT_MAX_DELAY", num_args=1,
+                        usage=" - <longest wait in seconds between attempts to reconnect an alpha>",
+                        callback=dks_set_device_reconnect_max_delay)
+
+    set_node.add_child(name="RPC_PRIORITY_AGING", num_args=1,
+                        usage=" - <seconds a waiting request must wait to move up one priority, 0 = off>",
+                        callback=dks_set_rpc_priority_aging)
+
+    set_node.add_child(name="RPC_SCHEDULER_POLICY", num_args=1,
+                        usage=" - <'least-expected-completion', 'least-outstanding', 'round-robin', or 'power-of-two'>",
+                        callback=dks_set_rpc_scheduler_policy)
+
+    set_node.add_child(name="KEY_METADATA_CACHE_SIZE", num_args=1,
+                        usage=" - <number of bytes used to cache key information, 0 = off>",
+                        callback=dks_set_key_metadata_cache_size)
+
+    set_node.add_child(name="KEY_ATTRIBUTE_CACHE_SIZE", num_args=1,
+                        usage=" - <number of bytes used to cache key attributes, 0 = off>",
+                        callback=dks_set_key_attribute_cache_size)
+
+    set_node.add_child(name="RANDOM_POOL_SIZE", num_args=1,
+                        usage=" - <number of random bytes to keep ready, 0 = off>",
+                        callback=dks_set_random_pool_size)
+
+    set_node.add_child(name="RANDOM_POOL_LOW_WATER", num_args=1,
+                        usage=" - <number of random bytes left when the pool is refilled>",
+                        callback=dks_set_random_pool_low_water)
+
     set_node.add_child_tree(token_list=['firewall', 'settings'], num_args=1,
                             usage=' - <mgmt, data, web> - Sets the firewall settings for a connection type.',
                             callback=dks_set_firewall_settings)
\ No newline at end of file
@@ -84,8 +84,10 @@ def dks_show_devices(console_object, args):
 
     rpc_result = console_object.check_has_rpc()
     if (rpc_result is True):
-        for d in console_object.rpc_preprocessor.rpc_list:
-            message += "\r\n > " + d.name
+        for rpc_index, d in enumerate(console_object.rpc_preprocessor.rpc_list):
+            message += "\r\n > %s - %s" % (d.name, d.state.value)
+            for line in console_object.rpc_preprocessor.get_device_status(rpc_index):
+                message += "\r\n     " + line
     else:
         message += rpc_result
 
@@ -153,6 +155,40 @@ def dks_show_key_count(console_object, args):
 
     return '--------'
 
+def dks_show_scheduler(console_object, args):
+    # make sure a rpc has been connected
+    rpc_result = console_object.check_has_rpc()
+    if (rpc_result is not True):
+        return rpc_result
+
+    return console_object.rpc_preprocessor.scheduler.get_status()
+
+def dks_show_key_cache(console_object, args):
+    # make sure a rpc has been connected
+    rpc_result = console_object.check_has_rpc()
+    if (rpc_result is not True):
+        return rpc_result
+
+    metadata, attributes = console_object.rpc_preprocessor.get_key_cache_status()
+
+    return ('Key metadata: %s\r\nKey attributes: %s' % (metadata, attributes))
+
+def dks_show_random_pool(console_object, args):
+    # make sure a rpc has been connected
+    rpc_result = console_object.check_has_rpc()
+    if (rpc_result is not True):
+        return rpc_result
+
+    return console_object.rpc_preprocessor.random_pool.get_status()
+
+def dks_show_keygen_pool(console_object, args):
+    # make sure a rpc has been connected
+    rpc_result = console_object.check_has_rpc()
+    if (rpc_result is not True):
+        return rpc_result
+
+    return console_object.rpc_preprocessor.keygen_pool.get_status()
+
 def add_show_commands(console_object):
     show_node = console_object.add_child('show')
 
@@ -160,6 +196,22 @@ def add_show_commands(console_object):
                         usage=' - Displays the current CrypTech device'
                                 ' RPC selection mode.',
                         callback=dks_show_rpc)
+    show_node.add_child(name="scheduler", num_args=0,
+                        usage=' - Shows the work in progress and measured'
+                                ' response times of each CrypTech device.',
+                        callback=dks_show_scheduler)
+    show_node.add_child(name="key-cache", num_args=0,
+                        usage=' - Shows the size and hit rate of the'
+                                ' key metadata and attribute caches.',
+                        callback=dks_show_key_cache)
+    show_node.add_child(name="random-pool", num_args=0,
+                        usage=' - Shows the number of random bytes that'
+                                ' are ready to use.',
+                        callback=dks_show_random_pool)
+    show_node.add_child(name="keygen-pool", num_args=0,
+                        usage=' - Shows the keys that are ready to be'
+                                ' given to clients.',
+                        callback=dks_show_keygen_pool)
     show_node.add_child(name="time", num_args=0,
                         usage=' - Shows the current HSM system time.',
                         callback=dks_show_time)
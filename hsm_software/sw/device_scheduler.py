@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import math
+import random
+import threading
+import time
+import collections
+
+from abc import abstractmethod, ABCMeta
+from enum import Enum
+
+from hsm_tools.cryptech_port import DKS_RPCFunc, DKS_HALKeyType
+
+
+class RPCClass(str, Enum):
+    """Groups of RPCs that take a similar amount of time on an alpha"""
+    RSA_SIGN = 'rsa_sign'
+    EC_SIGN  = 'ec_sign'
+    KEYGEN   = 'keygen'
+    MATCH    = 'match'
+    OTHER    = 'other'
+
+# starting estimate of how long each class of RPC takes in seconds.
+# these are replaced by measurements as soon as replies come back
+DEFAULT_SERVICE_TIMES = {
+    RPCClass.RSA_SIGN : 0.2,
+    RPCClass.EC_SIGN  : 0.02,
+    RPCClass.KEYGEN   : 5.0,
+    RPCClass.MATCH    : 0.01,
+    RPCClass.OTHER    : 0.005
+}
+
+# weight of a new measurement in the moving average
+EWMA_ALPHA = 0.2
+
+# number of recent reply times kept to find latency percentiles and
+# how many are needed before the percentiles are used
+LATENCY_SAMPLES = 100
+MIN_LATENCY_SAMPLES = 20
+
+KEYGEN_CODES = (DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_RSA,
+                DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_EC,
+                DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_HASHSIG)
+
+SIGN_CODES = (DKS_RPCFunc.RPC_FUNC_PKEY_SIGN,
+              DKS_RPCFunc.RPC_FUNC_PKEY_VERIFY)
+
+def get_rpc_class(code, keytype = None):
+    """Returns the RPCClass for a request. keytype is the type of the
+    key that a sign or verify request uses, if it's known"""
+    if (code in SIGN_CODES):
+        if (keytype in (DKS_HALKeyType.HAL_KEY_TYPE_RSA_PRIVATE,
+                        DKS_HALKeyType.HAL_KEY_TYPE_RSA_PUBLIC)):
+            return RPCClass.RSA_SIGN
+        elif (keytype in (DKS_HALKeyType.HAL_KEY_TYPE_EC_PRIVATE,
+                          DKS_HALKeyType.HAL_KEY_TYPE_EC_PUBLIC)):
+            return RPCClass.EC_SIGN
+    elif (code in KEYGEN_CODES):
+        return RPCClass.KEYGEN
+    elif (code == DKS_RPCFunc.RPC_FUNC_PKEY_MATCH):
+        return RPCClass.MATCH
+
+    return RPCClass.OTHER
+
+
+class DeviceStats(object):
+    """Work in progress and measured service times for one alpha"""
+    def __init__(self):
+        self.outstanding = dict((rpc_class, 0) for rpc_class in RPCClass)
+        self.service_time = DEFAULT_SERVICE_TIMES.copy()
+        self.completed = 0
+        self.last_active = 0.0
+
+        # requests that were rejected or sent to another alpha
+        # because this alpha's queue was full
+        self.busy_rejects = 0
+        self.busy_reroutes = 0
+
+        # requests that didn't get a reply in time
+        self.timeouts = 0
+
+        # requests that were repeated on another alpha because this
+        # alpha was slow and how often the other alpha answered first
+        self.hedged = 0
+        self.hedge_wins = 0
+
+        self.latencies = dict((rpc_class, collections.deque(maxlen = LATENCY_SAMPLES))
+                              for rpc_class in RPCClass)
+
+    def outstanding_count(self):
+        return sum(self.outstanding.itervalues())
+
+    def expected_completion(self, rpc_class):
+        """Estimated time until a new request of rpc_class would be
+        answered if it was sent to this alpha now"""
+        queued = sum(count * self.service_time[c]
+                     for c, count in self.outstanding.iteritems())
+
+        return queued + self.service_time[rpc_class]
+
+    def latency_percentile(self, rpc_class, fraction):
+        """Returns the time that fraction of recent rpc_class requests
+        were answered within or None if there aren't enough samples"""
+        samples = self.latencies[rpc_class]
+        if (len(samples) < MIN_LATENCY_SAMPLES):
+            return None
+
+        ordered = sorted(samples)
+
+        return ordered[max(int(math.ceil(fraction * len(ordered))) - 1, 0)]
+
+
+class SchedulerPolicy(object):
+    """Decides which alpha should get a request"""
+    __metaclass__ = ABCMeta
+
+    name = None
+
+    @abstractmethod
+    def choose(self, stats, candidates, rpc_class):
+        """Returns one of the device indexes in candidates. stats is the
+        list of DeviceStats for every device"""
+        pass
+
+
+class RotatingPolicy(SchedulerPolicy):
+    """Base for policies that pick the lowest cost device. Ties are
+    broken by rotating through the devices so idle alphas share the
+    work evenly"""
+    def __init__(self):
+        self.next_device = 0
+
+    @abstractmethod
+    def cost(self, device_stats, rpc_class):
+        pass
+
+    def choose(self, stats, candidates, rpc_class):
+        device_count = len(stats)
+        start = self.next_device
+
+        result = None
+        result_cost = None
+        for device_index in sorted(candidates, key = lambda d: (d - start) % device_count):
+            cost = self.cost(stats[device_index], rpc_class)
+            if (result is None or cost < result_cost):
+                result = device_index
+                result_cost = cost
+
+        self.next_device = (result + 1) % device_count
+
+        return result
+
+
+class LeastExpectedCompletionPolicy(RotatingPolicy):
+    """Use the alpha that should finish the request first"""
+    name = 'least-expected-completion'
+
+    def cost(self, device_stats, rpc_class):
+        return device_stats.expected_completion(rpc_class)
+
+
+class LeastOutstandingPolicy(RotatingPolicy):
+    """Use the alpha with the fewest requests in progress"""
+    name = 'least-outstanding'
+
+    def cost(self, device_stats, rpc_class):
+        return device_stats.outstanding_count()
+
+
+class RoundRobinPolicy(RotatingPolicy):
+    """Use every alpha in turn"""
+    name = 'round-robin'
+
+    def cost(self, device_stats, rpc_class):
+        return 0
+
+
+class PowerOfTwoChoicesPolicy(SchedulerPolicy):
+    """Pick two alphas at random and use the one with the fewest
+    requests in progress"""
+    name = 'power-of-two'
+
+    def choose(self, stats, candidates, rpc_class):
+        if (len(candidates) < 3):
+            choices = candidates
+        else:
+            choices = random.sample(candidates, 2)
+
+        return min(choices, key = lambda d: stats[d].outstanding_count())
+
+
+POLICIES = dict((policy.name, policy) for policy in (LeastExpectedCompletionPolicy,
+                                                    LeastOutstandingPolicy,
+                                                    RoundRobinPolicy,
+                                                    PowerOfTwoChoicesPolicy))
+
+DEFAULT_POLICY = LeastExpectedCompletionPolicy.name
+
+
+class DeviceScheduler(object):
+    """Thread-safe class that tracks the requests running on each alpha
+    and chooses where new requests should go"""
+
+    def __init__(self, device_count, policy_name = DEFAULT_POLICY):
+        self.lock = threading.Lock()
+        self.stats = [DeviceStats() for _ in xrange(device_count)]
+
+        if (not self.set_policy(policy_name)):
+            self.set_policy(DEFAULT_POLICY)
+
+    def set_policy(self, policy_name):
+        """Returns False if policy_name isn't a known policy"""
+        if (policy_name not in POLICIES):
+            return False
+
+        with self.lock:
+            self.policy = POLICIES[policy_name]()
+
+        return True
+
+    def get_policy_name(self):
+        return self.policy.name
+
+    def choose(self, candidates, rpc_class = RPCClass.OTHER):
+        """Returns the index of the device from candidates that should
+        be used or None if there aren't any candidates"""
+        candidates = list(candidates)
+        if (len(candidates) == 0):
+            return None
+
+        with self.lock:
+            return self.policy.choose(self.stats, candidates, rpc_class)
+
+    def get_idle_devices(self, idle_time = 0, now = None):
+        """Returns the indexes of the devices that haven't worked on
+        anything for idle_time seconds"""
+        if (now is None):
+            now = time.time()
+
+        with self.lock:
+            return [device_index for device_index, device_stats in enumerate(self.stats)
+                    if (device_stats.outstanding_count() == 0 and
+                        now - device_stats.last_active >= idle_time)]
+
+    def count_busy(self, device_index, rerouted):
+        """A request couldn't use a device because its queue was full"""
+        with self.lock:
+            if (rerouted):
+                self.stats[device_index].busy_reroutes += 1
+            else:
+                self.stats[device_index].busy_rejects += 1
+
+    def count_timeout(self, device_index):
+        """A device didn't reply to a request in time"""
+        with self.lock:
+            self.stats[device_index].timeouts += 1
+
+    def count_hedge(self, device_index, won = False):
+        """A request to a device was repeated on another device. won is
+        True if the other device answered first"""
+        with self.lock:
+            if (won):
+                self.stats[device_index].hedge_wins += 1
+            else:
+                self.stats[device_index].hedged += 1
+
+    def get_latency_percentile(self, device_index, rpc_class, fraction):
+        with self.lock:
+            return self.stats[device_index].latency_percentile(rpc_class, fraction)
+
+    def reset_device(self, device_index):
+        """The requests that were on a device were lost when it was
+        reconnected"""
+        with self.lock:
+            device_stats = self.stats[device_index]
+            for rpc_class in RPCClass:
+                device_stats.outstanding[rpc_class] = 0
+
+    def start(self, device_index, rpc_class, now = None):
+        """A request has been sent to an alpha. Returns the start time
+        that must be passed to finish"""
+        if (now is None):
+            now = time.time()
+
+        with self.lock:
+            self.stats[device_index].outstanding[rpc_class] += 1
+            self.stats[device_index].last_active = now
+
+        return now
+
+    def finish(self, device_index, rpc_class, start_time, success = True, now = None):
+        """A reply has been received from an alpha. Failed requests
+        don't update the service time"""
+        if (now is None):
+            now = time.time()
+
+        with self.lock:
+            device_stats = self.stats[device_index]
+            if (device_stats.outstanding[rpc_class] > 0):
+                device_stats.outstanding[rpc_class] -= 1
+            device_stats.last_active = now
+
+            if (success):
+                elapsed = max(now - start_time, 0)
+                average = device_stats.service_time[rpc_class]
+                device_stats.service_time[rpc_class] = average + EWMA_ALPHA * (elapsed - average)
+                device_stats.latencies[rpc_class].append(elapsed)
+                device_stats.completed += 1
+
+    def get_status(self):
+        """Returns a readable summary of every device"""
+        with self.lock:
+            lines = ['Policy: %s' % self.policy.name]
+            for device_index, device_stats in enumerate(self.stats):
+                times = ', '.join('%s %.4fs' % (rpc_class.value, device_stats.service_time[rpc_class])
+                                  for rpc_class in RPCClass)
+                lines.append('RPC%i: outstanding %i, completed %i, queue full %i rejected %i rerouted, '
+                             'timeouts %i, hedged %i (%i won), %s' %
+                             (device_index,
+                              device_stats.outstanding_count(),
+                              device_stats.completed,
+                              device_stats.busy_rejects,
+                              device_stats.busy_reroutes,
+                              device_stats.timeouts,
+                              device_stats.hedged,
+                              device_stats.hedge_wins,
+                              times))
+
+        return '\r\n'.join(lines)
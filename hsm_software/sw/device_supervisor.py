@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import collections
+import threading
+import time
+
+# probes that must fail in a row before an alpha is taken out of service
+PROBE_FAILURE_LIMIT = 3
+
+# seconds before the first reconnect attempt. Doubles after every failure
+RECONNECT_BASE_DELAY = 0.5
+
+# weight of a new result in the moving averages
+HEALTH_EWMA_ALPHA = 0.2
+
+# number of state changes kept for 'show devices'
+MAX_TRANSITIONS = 8
+
+
+class DeviceHealth(object):
+    """Probe results, errors, and state changes for one alpha"""
+    def __init__(self):
+        self.state = None
+        self.transitions = collections.deque(maxlen = MAX_TRANSITIONS)
+
+        self.probes = 0
+        self.consecutive_failures = 0
+        self.latency = None
+        self.error_rate = 0.0
+
+        self.reconnects = 0
+        self.reconnect_attempts = 0
+
+    def add_result(self, success):
+        self.error_rate += HEALTH_EWMA_ALPHA * ((0.0 if success else 1.0) - self.error_rate)
+
+
+class DeviceHealthMonitor(object):
+    """Thread-safe class that tracks how well each alpha is working"""
+
+    def __init__(self, device_count):
+        self.lock = threading.Lock()
+        self.health = [DeviceHealth() for _ in xrange(device_count)]
+
+    def observe(self, device_index, state, reason = None, now = None):
+        """Record the alpha's state if it has changed"""
+        if (now is None):
+            now = time.time()
+
+        with self.lock:
+            health = self.health[device_index]
+            if (health.state != state):
+                health.state = state
+                health.transitions.append((now, state, reason))
+
+    def probe_finished(self, device_index, latency):
+        """latency is None if the probe failed. Returns True if the
+        alpha has failed too many probes in a row"""
+        with self.lock:
+            health = self.health[device_index]
+            health.probes += 1
+            health.add_result(latency is not None)
+
+            if (latency is None):
+                health.consecutive_failures += 1
+                return health.consecutive_failures >= PROBE_FAILURE_LIMIT
+
+            health.consecutive_failures = 0
+            if (health.latency is None):
+                health.latency = latency
+            else:
+                health.latency += HEALTH_EWMA_ALPHA * (latency - health.latency)
+
+            return False
+
+    def request_finished(self, device_index, success):
+        """A client request was answered or the alpha didn't answer it"""
+        with self.lock:
+            self.health[device_index].add_result(success)
+
+    def reconnect_delay(self, device_index, max_delay):
+        """Seconds to wait before the next reconnect attempt"""
+        with self.lock:
+            attempts = self.health[device_index].reconnect_attempts
+
+        return min(RECONNECT_BASE_DELAY * (2 ** min(attempts, 16)), max_delay)
+
+    def reconnect_failed(self, device_index):
+        with self.lock:
+            self.health[device_index].reconnect_attempts += 1
+
+    def reconnected(self, device_index):
+        with self.lock:
+            health = self.health[device_index]
+            health.reconnect_attempts = 0
+            health.consecutive_failures = 0
+            health.reconnects += 1
+
+    def get_status(self, device_index):
+        """Returns a readable summary of one alpha"""
+        with self.lock:
+            health = self.health[device_index]
+
+            latency = 'none' if (health.latency is None) else '%.1fms' % (health.latency * 1000)
+            lines = ['probe %s, errors %.1f%%, reconnects %i' % (latency,
+                                                                 health.error_rate * 100,
+                                                                 health.reconnects)]
+
+            for when, state, reason in health.transitions:
+                line = '%s %s' % (time.strftime('%c', time.localtime(when)), state.value)
+                if (reason is not None):
+                    line += ' (%s)' % reason
+                lines.append(line)
+
+        return lines
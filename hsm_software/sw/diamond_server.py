@@ -341,6 +341,7 @@ def main():
     rpc_server = RPCTCPServer(rpc_preprocessor, RPC_IP_PORT, ssl_options)
     # set the futures for all of our devices
     rpc_preprocessor.append_futures(futures)
+    rpc_server.append_futures(futures)
 
     # create a secondary listener to handle PF_UNIX request from subprocesses
     rpc_secondary_listener = SecondaryPFUnixListener(rpc_server,
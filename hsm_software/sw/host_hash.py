@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import hashlib
+
+from hsm_tools.cryptech_port import DKS_HALDigestAlgorithm
+
+# hash handles for hashes on the host have the high bit set so they
+# can't be confused with the handles from an alpha
+HOST_HASH_HANDLE_FLAG = 0x80000000
+
+# hashlib names and DER encoded AlgorithmIdentifiers for the digests that
+# can be done on the host. The AlgorithmIdentifier is needed when an RSA
+# signature uses a hash
+_ALGORITHMS = {
+    DKS_HALDigestAlgorithm.HAL_DIGEST_ALGORITHM_SHA1       : ('sha1',       '3021300906052b0e03021a05000414'),
+    DKS_HALDigestAlgorithm.HAL_DIGEST_ALGORITHM_SHA224     : ('sha224',     '302d300d06096086480165030402040500041c'),
+    DKS_HALDigestAlgorithm.HAL_DIGEST_ALGORITHM_SHA256     : ('sha256',     '3031300d060960864801650304020105000420'),
+    DKS_HALDigestAlgorithm.HAL_DIGEST_ALGORITHM_SHA512_224 : ('sha512_224', '302d300d06096086480165030402050500041c'),
+    DKS_HALDigestAlgorithm.HAL_DIGEST_ALGORITHM_SHA512_256 : ('sha512_256', '3031300d060960864801650304020605000420'),
+    DKS_HALDigestAlgorithm.HAL_DIGEST_ALGORITHM_SHA384     : ('sha384',     '3041300d060960864801650304020205000430'),
+    DKS_HALDigestAlgorithm.HAL_DIGEST_ALGORITHM_SHA512     : ('sha512',     '3051300d060960864801650304020305000440'),
+}
+
+
+def _supported_algorithms():
+    """The truncated SHA-512 digests depend on the OpenSSL that hashlib
+    was built with"""
+    supported = {}
+    for algorithm, (name, prefix) in _ALGORITHMS.iteritems():
+        try:
+            hashlib.new(name)
+        except ValueError:
+            continue
+
+        supported[algorithm] = (name, prefix.decode('hex'))
+
+    return supported
+
+HOST_HASH_ALGORITHMS = _supported_algorithms()
+
+
+def is_host_hash_handle(handle):
+    return (handle & HOST_HASH_HANDLE_FLAG) != 0
+
+
+class HostHash(object):
+    """An un-keyed digest that is calculated on the host instead of
+    on an alpha"""
+
+    def __init__(self, algorithm):
+        name, self.prefix = HOST_HASH_ALGORITHMS[algorithm]
+        self.algorithm = algorithm
+        self.hash = hashlib.new(name)
+
+    @property
+    def digest_length(self):
+        return self.hash.digest_size
+
+    def update(self, data):
+        self.hash.update(data)
+
+    def digest(self):
+        return self.hash.digest()
+
+    def digest_info(self):
+        """Returns the DER encoded DigestInfo that an RSA signature uses"""
+        return self.prefix + self.hash.digest()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import collections
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+    process_pool_available = True
+except ImportError:
+    process_pool_available = False
+
+# DER encoded object identifiers
+_OID_RSA_ENCRYPTION = '2a864886f70d010101'.decode('hex')
+_OID_EC_PUBLIC_KEY  = '2a8648ce3d0201'.decode('hex')
+
+_DER_SEQUENCE   = 0x30
+_DER_INTEGER    = 0x02
+_DER_BIT_STRING = 0x03
+_DER_OID        = 0x06
+
+
+class ECCurve(collections.namedtuple('ECCurve', ['name', 'p', 'b', 'gx', 'gy', 'n'])):
+    """A NIST prime curve. a is always -3"""
+    @property
+    def length(self):
+        return (self.p.bit_length() + 7) // 8
+
+# curves by the DER encoded object identifier of the curve
+EC_CURVES = {
+    '2a8648ce3d030107'.decode('hex') : ECCurve(
+        'P-256',
+        0xffffffff00000001000000000000000000000000ffffffffffffffffffffffff,
+        0x5ac635d8aa3a93e7b3ebbd55769886bc651d06b0cc53b0f63bce3c3e27d2604b,
+        0x6b17d1f2e12c4247f8bce6e563a440f277037d812deb33a0f4a13945d898c296,
+        0x4fe342e2fe1a7f9b8ee7eb4a7c0f9e162bce33576b315ececbb6406837bf51f5,
+        0xffffffff00000000ffffffffffffffffbce6faada7179e84f3b9cac2fc632551),
+    '2b81040022'.decode('hex') : ECCurve(
+        'P-384',
+        0xfffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffeffffffff0000000000000000ffffffff,
+        0xb3312fa7e23ee7e4988e056be3f82d19181d9c6efe8141120314088f5013875ac656398d8a2ed19d2a85c8edd3ec2aef,
+        0xaa87ca22be8b05378eb1c71ef320ad746e1d3b628ba79b9859f741e082542a385502f25dbf55296c3a545e3872760ab7,
+        0x3617de4a96262c6f5d9e98bf9292dc29f8f41dbd289a147ce9da3113b5f0b8c00a60b1ce1d7e819d7a431d7c90ea0e5f,
+        0xffffffffffffffffffffffffffffffffffffffffffffffffc7634d81f4372ddf581a0db248b0a77aecec196accc52973),
+    '2b81040023'.decode('hex') : ECCurve(
+        'P-521',
+        (1 << 521) - 1,
+        0x0051953eb9618e1c9a1f929a21a0b68540eea2da725b99b315f3b8b489918ef109e156193951ec7e937b1652c0bd3bb1bf073573df883d2c34f1ef451fd46b503f00,
+        0x00c6858e06b70404e9cd9e3ecb662395b4429c648139053fb521f828af606b4d3dbaa14b5e77efe75928fe1dc127a2ffa8de3348b3c1856a429bf97e7e31c2e5bd66,
+        0x011839296a789a3bc0045c8a5fb42c7d1bd998f54449579b446817afbd17273e662c97ee72995ef42640c550b9013fad0761353c7086a272c24088be94769fd16650,
+        0x01fffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffa51868783bf2f966b7fcc0148f709a5d03bb5c9b8899c47aebb6fb71e91386409),
+}
+
+RSAPublicKey = collections.namedtuple('RSAPublicKey', ['n', 'e'])
+ECPublicKey = collections.namedtuple('ECPublicKey', ['curve', 'x', 'y'])
+
+
+def _read_der(data, offset, expected_tag):
+    """Returns the contents of the DER element at offset and the offset
+    of the next element"""
+    if (offset + 2 > len(data) or ord(data[offset]) != expected_tag):
+        raise ValueError('unexpected DER tag')
+
+    length = ord(data[offset + 1])
+    offset += 2
+    if (length & 0x80):
+        count = length & 0x7f
+        if (count == 0 or count > 4 or offset + count > len(data)):
+            raise ValueError('bad DER length')
+
+        length = int(data[offset:offset + count].encode('hex'), 16)
+        offset += count
+
+    if (offset + length > len(data)):
+        raise ValueError('DER element is too long')
+
+    return data[offset:offset + length], offset + length
+
+def _to_int(data):
+    return int(data.encode('hex'), 16) if data else 0
+
+def parse_public_key(der):
+    """Returns an RSAPublicKey or ECPublicKey from a DER encoded
+    SubjectPublicKeyInfo or None if it can't be used"""
+    try:
+        spki, _ = _read_der(der, 0, _DER_SEQUENCE)
+        algorithm, offset = _read_der(spki, 0, _DER_SEQUENCE)
+        bits, _ = _read_der(spki, offset, _DER_BIT_STRING)
+
+        oid, parameter_offset = _read_der(algorithm, 0, _DER_OID)
+
+        # the first byte of a BIT STRING is the number of unused bits
+        if (len(bits) < 1 or bits[0] != '\x00'):
+            return None
+        bits = bits[1:]
+
+        if (oid == _OID_RSA_ENCRYPTION):
+            rsa_key, _ = _read_der(bits, 0, _DER_SEQUENCE)
+            n, offset = _read_der(rsa_key, 0, _DER_INTEGER)
+            e, _ = _read_der(rsa_key, offset, _DER_INTEGER)
+
+            return RSAPublicKey(_to_int(n), _to_int(e))
+
+        if (oid == _OID_EC_PUBLIC_KEY):
+            curve_oid, _ = _read_der(algorithm, parameter_offset, _DER_OID)
+            curve = EC_CURVES.get(curve_oid)
+
+            # only uncompressed points are used
+            if (curve is None or len(bits) != 1 + 2 * curve.length or bits[0] != '\x04'):
+                return None
+
+            key = ECPublicKey(curve, _to_int(bits[1:1 + curve.length]), _to_int(bits[1 + curve.length:]))
+            if (not _on_curve(curve, key.x, key.y)):
+                return None
+
+            return key
+    except ValueError:
+        pass
+
+    return None
+
+def can_verify(key, data, signature):
+    """Returns True if the host gives the same answer as the alpha. Other
+    requests are left to the alpha so it can return its own errors"""
+    if (isinstance(key, RSAPublicKey)):
+        length = (key.n.bit_length() + 7) // 8
+
+        # data is the DigestInfo that PKCS#1 v1.5 pads
+        return (len(signature) == length and
+                len(data) <= length - 11 and
+                _to_int(signature) < key.n)
+
+    if (isinstance(key, ECPublicKey)):
+        order_length = (key.curve.n.bit_length() + 7) // 8
+
+        # the signature is r and s. A digest that's longer than the
+        # order would need to be truncated
+        return (len(signature) == 2 * order_length and len(data) <= order_length)
+
+    return False
+
+def verify(key, data, signature):
+    """Returns True if signature is valid. Run in a worker process"""
+    if (isinstance(key, RSAPublicKey)):
+        return _verify_rsa(key, data, signature)
+
+    return _verify_ecdsa(key, data, signature)
+
+def _verify_rsa(key, data, signature):
+    length = (key.n.bit_length() + 7) // 8
+    decrypted = pow(_to_int(signature), key.e, key.n)
+
+    expected = '\x00\x01' + '\xff' * (length - len(data) - 3) + '\x00' + data
+
+    return ('%0*x' % (2 * length, decrypted)).decode('hex') == expected
+
+def _on_curve(curve, x, y):
+    p = curve.p
+    return (0 <= x < p and 0 <= y < p and
+            (y * y - (x * x * x - 3 * x + curve.b)) % p == 0)
+
+def _double(curve, point):
+    """Jacobian point doubling for a = -3. None is the point at
+    infinity"""
+    if (point is None):
+        return None
+
+    x, y, z = point
+    p = curve.p
+    if (y == 0):
+        return None
+
+    delta = z * z % p
+    gamma = y * y % p
+    beta = x * gamma % p
+    alpha = 3 * (x - delta) * (x + delta) % p
+
+    x3 = (alpha * alpha - 8 * beta) % p
+    z3 = ((y + z) * (y + z) - gamma - delta) % p
+    y3 = (alpha * (4 * beta - x3) - 8 * gamma * gamma) % p
+
+    return (x3, y3, z3)
+
+def _add(curve, point1, point2):
+    """Jacobian point addition"""
+    if (point1 is None):
+        return point2
+    if (point2 is None):
+        return point1
+
+    x1, y1, z1 = point1
+    x2, y2, z2 = point2
+    p = curve.p
+
+    z1z1 = z1 * z1 % p
+    z2z2 = z2 * z2 % p
+    u1 = x1 * z2z2 % p
+    u2 = x2 * z1z1 % p
+    s1 = y1 * z2 * z2z2 % p
+    s2 = y2 * z1 * z1z1 % p
+
+    if (u1 == u2):
+        if (s1 != s2):
+            return None
+        return _double(curve, point1)
+
+    h = (u2 - u1) % p
+    r = (s2 - s1) % p
+    h2 = h * h % p
+    h3 = h * h2 % p
+    u1h2 = u1 * h2 % p
+
+    x3 = (r * r - h3 - 2 * u1h2) % p
+    y3 = (r * (u1h2 - x3) - s1 * h3) % p
+    z3 = h * z1 * z2 % p
+
+    return (x3, y3, z3)
+
+def _verify_ecdsa(key, data, signature):
+    curve = key.curve
+    n = curve.n
+    half = len(signature) // 2
+
+    r = _to_int(signature[:half])
+    s = _to_int(signature[half:])
+    if (not (0 < r < n and 0 < s < n)):
+        return False
+
+    w = pow(s, n - 2, n)
+    u1 = _to_int(data) * w % n
+    u2 = r * w % n
+
+    # u1 * G + u2 * Q using Shamir's trick
+    g = (curve.gx, curve.gy, 1)
+    q = (key.x, key.y, 1)
+    table = [None, g, q, _add(curve, g, q)]
+
+    point = None
+    for bit in xrange(max(u1.bit_length(), u2.bit_length()) - 1, -1, -1):
+        point = _double(curve, point)
+        index = ((u1 >> bit) & 1) | (((u2 >> bit) & 1) << 1)
+        if (index):
+            point = _add(curve, point, table[index])
+
+    if (point is None):
+        return False
+
+    x, _, z = point
+    zinv = pow(z, curve.p - 2, curve.p)
+    affine_x = x * zinv * zinv % curve.p
+
+    return affine_x % n == r
+
+
+class VerifyEngine(object):
+    """Verifies signatures in a pool of processes so the work isn't
+    limited by the GIL"""
+
+    def __init__(self, processes):
+        self.pool = None
+        self.processes = 0
+        self.set_processes(processes)
+
+    @property
+    def enabled(self):
+        return self.pool is not None
+
+    def set_processes(self, processes):
+        """0 turns the engine off"""
+        if (processes == self.processes):
+            return
+
+        if (self.pool is not None):
+            self.pool.shutdown(wait = False)
+            self.pool = None
+
+        self.processes = processes
+        if (processes > 0 and process_pool_available):
+            self.pool = ProcessPoolExecutor(max_workers = processes)
+
+    def submit(self, key, data, signature):
+        """Returns a future for the result of verify"""
+        return self.pool.submit(verify, key, data, signature)
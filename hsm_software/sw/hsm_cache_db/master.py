@@ -40,15 +40,19 @@ from hsm_tools.cryptech.muxd import logger
 
 class MasterKeyListRow(object):
     """Represents a row in the cache's master key list"""
-    def __init__(self, key_rpc_index, key_uuid, keytype = 0, flags = 0):
+    def __init__(self, key_rpc_index, key_uuid, keytype = 0, flags = 0, curve = 0, attributes = None):
         """Initialize the rows data
         key_rpc_index - index of the CrypTech device that the key with the associated key_uuid is on
         key_uuid      - uuid of the key on the CrypTech deviced defined by key_rpc_index
         keytype       - the key's type (eg. HALKeyType.HAL_KEY_TYPE_RSA_PRIVATE)
         flags         - the flags set in the alpha
+        curve         - the key's curve (eg. HALCurve.HAL_CURVE_P256) or None if it's not known
+        attributes    - dictionary of the key's PKCS#11 attributes or None if they're not known
         """
         self.keytype = keytype
         self.flags = flags
+        self.curve = curve
+        self.attributes = attributes
         self.uuid_dict = { key_rpc_index : key_uuid }
 
     def __str__(self):
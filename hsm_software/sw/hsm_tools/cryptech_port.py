@@ -36,11 +36,14 @@ to be updated if the CrypTech libhal.py interface changes.
 """
 
 import xdrlib
+import collections
 
 
 from enum import IntEnum
 from cryptech.cryptech.libhal import *
 
+from slip import slip_encode, SLIPDecoder
+
 class DKS_HALError(IntEnum):
     HAL_OK                              = 0
     HAL_ERROR_BAD_ARGUMENTS             = 1
@@ -96,6 +99,10 @@ class DKS_HALError(IntEnum):
     # non-standard tamper error
     HAL_ERROR_TAMPER                    = 50
 
+    # libhal refuses requests from clients that aren't logged in with
+    # HAL_ERROR_FORBIDDEN so clients already know what this means
+    HAL_ERROR_NOT_LOGGED_IN             = HAL_ERROR_FORBIDDEN
+
     @classmethod
     def to_mkm_string(cls, error):
         if (error == cls.HAL_OK):
@@ -151,6 +158,16 @@ class DKS_RPCFunc(IntEnum):
     RPC_FUNC_ENABLE_CACHE_KEYGEN          = 1983
     RPC_FUNC_USE_INCOMING_DEVICE_UUIDS    = 1984
     RPC_FUNC_USE_INCOMING_MASTER_UUIDS    = 1985
+    RPC_FUNC_KEYGEN_JOB_SUBMIT            = 1986
+    RPC_FUNC_KEYGEN_JOB_STATUS            = 1987
+    RPC_FUNC_KEYGEN_JOB_RESULT            = 1988
+    RPC_FUNC_PKEY_SIGN_BATCH              = 1989
+    RPC_FUNC_SET_PRIORITY                 = 1990
+
+class DKS_KeygenJobState(IntEnum):
+    KEYGEN_JOB_RUNNING = 0
+    KEYGEN_JOB_DONE    = 1
+    KEYGEN_JOB_FAILED  = 2
 
 class DKS_HALDigestAlgorithm(IntEnum):
     HAL_DIGEST_ALGORITHM_NONE       = 0
@@ -242,6 +259,36 @@ class ContextManagedObject(object):
 #  * of the client-side MUX daemon.
 #  */
 class DKS_HSM(HSM):
+    # largest amount of data to take from the socket in one read
+    recv_chunk_size = 4096
+
+    def __init__(self, *args, **kwargs):
+        super(DKS_HSM, self).__init__(*args, **kwargs)
+        self.decoder = SLIPDecoder()
+        self.frames = collections.deque()
+
+    def _send(self, msg):       # Expects an xdrlib.Packer
+        msg = slip_encode(msg.get_buffer())
+        if self.debug_io:
+            logger.debug("send: %s", ":".join("{:02x}".format(ord(c)) for c in msg))
+        self.socket.sendall(msg)
+
+    def _recv(self, code):      # Returns a ContextManagedUnpacker
+        while True:
+            while not self.frames:
+                data = self.socket.recv(self.recv_chunk_size)
+                if not data:
+                    raise HAL_ERROR_RPC_TRANSPORT()
+                self.frames.extend(self.decoder.feed(data))
+
+            msg = self.frames.popleft()
+            if self.debug_io:
+                logger.debug("recv: %s", ":".join("{:02x}".format(ord(c)) for c in msg))
+            msg = ContextManagedUnpacker(msg)
+            if msg.unpack_uint() != code:
+                continue
+            return msg
+
     def __enter__(self):
         return self
 
@@ -302,6 +349,39 @@ class DKS_HSM(HSM):
         with self.rpc(DKS_RPCFunc.RPC_FUNC_USE_INCOMING_MASTER_UUIDS, client = client):
             return            
 
+    def rpc_keygen_job_submit(self, code, *args, **kwargs):
+        """Start generating a key without waiting for it. args are the
+        parameters of the PKEY_GENERATE request. Returns the job id"""
+        with self.rpc(DKS_RPCFunc.RPC_FUNC_KEYGEN_JOB_SUBMIT, code, *args, **kwargs) as r:
+            return r.unpack_uint()
+
+    def rpc_keygen_job_status(self, job, wait = False, client = 0):
+        """Returns the DKS_KeygenJobState of a job. If wait is True, this
+        waits until the job isn't running"""
+        with self.rpc(DKS_RPCFunc.RPC_FUNC_KEYGEN_JOB_STATUS, job, 1 if wait else 0, client = client) as r:
+            return DKS_KeygenJobState(r.unpack_uint())
+
+    def rpc_keygen_job_result(self, job, client = 0):
+        """Returns the key from a finished job. Raises the job's error
+        if the key wasn't generated"""
+        with self.rpc(DKS_RPCFunc.RPC_FUNC_KEYGEN_JOB_RESULT, job, client = client) as r:
+            pkey = PKey(self, r.unpack_uint(), UUID(bytes = r.unpack_bytes()))
+            logger.debug("Generated pkey %s", pkey.uuid)
+            return pkey
+
+    def rpc_pkey_sign_batch(self, uuid, digests, length = 1024, client = 0, session = 0):
+        """Sign a list of digests with the key and return the signatures in
+        the same order. The digests are signed on every alpha with the key"""
+        with self.rpc(DKS_RPCFunc.RPC_FUNC_PKEY_SIGN_BATCH, session, uuid, length, digests, client = client) as r:
+            return [r.unpack_bytes() for _ in xrange(r.unpack_uint())]
+
+    def rpc_set_priority(self, priority, deadline = 0, client = 0):
+        """Set the priority of this connection's requests. If deadline is
+        not 0, requests that haven't been sent to an alpha after deadline
+        milliseconds fail with HAL_ERROR_IO_TIMEOUT"""
+        with self.rpc(DKS_RPCFunc.RPC_FUNC_SET_PRIORITY, priority, deadline, client = client):
+            return
+
     def start_disable_cache_block(self):
         """Returns a ContextManagedObject that can be used with the 'with' keyword to only
          disable caching of a key generation in the 'with' block"""
@@ -27,39 +27,48 @@
 # LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
 # NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
-import threading
 
-class load_slot(object):
-    def __init__(self):
-        self.thread_lock = threading.Lock()
-        self.__setval(0)
+"""
+Runtime switchable diagnostics for the RPC data path. When diagnostics are
+off, the data path only checks 'enabled' and does no other work. When on,
+every frame is hex dumped to the log and every reply from an alpha is
+checked for HAL errors.
+"""
 
-    def __setval(self, value):
-        with(self.thread_lock):
-            self.__value = value
-    
-    def __getval(self):
-        with(self.thread_lock):
-            return self.__value
+import logging
+import binascii
 
-    def inc(self, val):
-        with(self.thread_lock):
-            self.__value += val
-            if (self.__value < 0):
-                self.__value = 0
+import rpc_schema
 
-    value = property(__getval, __setval)
+# uses the same logger as cryptech.muxd
+logger = logging.getLogger("cryptech_muxd")
 
+# checked by the data path before doing any diagnostic work
+enabled = False
 
-class LoadDistribution(object):
-    """Simple thread-safe class for storing how work
-       has been distributed across objects."""
+def set_enabled(value):
+    global enabled
+    enabled = bool(value)
 
-    def __init__(self, count):
-        self.array = [load_slot() for _ in range(count)]
+    logger.info("RPC diagnostics %s", "enabled" if enabled else "disabled")
 
-    def inc(self, slot, amount):
-        self.array[slot].inc(amount)
+class HexDump(object):
+    """Formats a frame as colon separated hex, but only if the log
+    message is actually written"""
+    def __init__(self, data):
+        self.data = data
 
-    def get(self, slot):
-        return self.array[slot].value
+    def __str__(self):
+        h = binascii.hexlify(self.data)
+        return ":".join(h[i:i+2] for i in xrange(0, len(h), 2))
+
+def log_frame(label, frame):
+    """Hex dump a frame to the log"""
+    logger.debug("%s: %s", label, HexDump(frame))
+
+def verify_reply(decoded_reply):
+    """Report replies from an alpha that have a HAL error"""
+    code, client, hal_error = rpc_schema.get_response_header(decoded_reply)
+
+    if(hal_error != 0):
+        logger.info("RPC reply error: code %d, client 0x%x, HAL error %d", code, client, hal_error)
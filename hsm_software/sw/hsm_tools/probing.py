@@ -45,6 +45,8 @@ from cryptech.upload import ManagementPortSerial
 
 from hsm import HSMPortInfo, CtyArg
 
+from rpciostream import DKSRPCIOStream
+
 class ProbeMultiIOStream(cryptech.muxd.ProbeIOStream):
     """
     Tornado IOStream for probing a serial port.
@@ -78,7 +80,7 @@ class ProbeMultiIOStream(cryptech.muxd.ProbeIOStream):
             if result == "rpc":
                 cryptech.muxd.logger.info("Found %s as RPC device", dev)
                 # send data directly to the alpha using SerialIOStream
-                rpc_stream = cryptech.muxd.RPCIOStream(device = dev)                
+                rpc_stream = DKSRPCIOStream(device = dev)
                 rpc_list.append(HSMPortInfo("RPC"+str(rpc_index), dev, rpc_stream))
                 rpc_index += 1
 
@@ -31,15 +31,60 @@
 
 import enum
 
+class RPCPriority(enum.IntEnum):
+    """Requests with lower values are sent to the alphas first"""
+    HIGH   = 0
+    NORMAL = 1
+    BULK   = 2
+
 class RPCAction(object):
     """After an RPC has been preprocessed by the load balancer, this class is the
     result of that operation and tells RPCTCPServer what action to perform"""
-    def __init__(self, result, rpc_list, callback, request = None):
+    def __init__(self, result, rpc_list, callback, request = None, op_data = None, rpc_class = None,
+                 session = None, work = None, background = None, done = None, parallel = None,
+                 priority = None, deadline = None, hedge = None):
         """result - buffer to immediately send back to the caller
            rpc_list - if result is None, this is the list of alpha's to send the message to
-           callback - after the rpcs have been sent, this is the callback so the loadbalancer can see the result
+           callback - after the rpcs have been sent, this is the callback so the loadbalancer can see the result.
+                      It is called as callback(action, reply_list)
+           request - if not None, the request to send instead of the previous request. This
+                     may also be a list with a separate request for each alpha in rpc_list
+           op_data - state that belongs to this request and not to the session. Overlapping
+                     requests on the same session must not share this data
+           rpc_class - the kind of work the alphas will do. Used by the scheduler to
+                       measure how long requests take
+           session - the MuxSession of the connection that sent the request. Callbacks
+                     use this instead of looking the session up by client handle
+           work - if not None, a future for work that's done on the host instead of
+                  an alpha. callback is called as callback(action, [result]) and the
+                  result is None if the work failed
+           background - if not None, an action that's run without holding up the
+                        connection or the result
+           done - for a background action, called as done(result) with the final
+                  result or None if the action failed. For a hedge, called as
+                  done(None) if the first alpha's reply was used
+           parallel - if not None, a list of actions that are run at the same time.
+                      callback is called as callback(action, results) with the final
+                      result of each action, or None if the action failed
+           priority - the RPCPriority of the request. Requests that are waiting
+                      for an alpha are sent in priority order
+           deadline - if not None, the time.time() when the request is failed with
+                      HAL_ERROR_IO_TIMEOUT if it hasn't been sent to an alpha
+           hedge - if not None, an action that's run on another alpha if the
+                   alpha in rpc_list is slower than usual. The first successful
+                   reply is used
         """
         self.result = result
         self.rpc_list = rpc_list
         self.callback = callback
-        self.request = request
\ No newline at end of file
+        self.request = request
+        self.op_data = op_data
+        self.rpc_class = rpc_class
+        self.session = session
+        self.work = work
+        self.background = background
+        self.done = done
+        self.parallel = parallel
+        self.priority = priority
+        self.deadline = deadline
+        self.hedge = hedge
\ No newline at end of file
@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Declarative description of the RPC messages that pass through the mux.
+The schema tables are compiled into struct based encoders and decoders so
+that the mux can read the header of a message, or read and rewrite a single
+field like a handle, uuid or flags, without unpacking the whole message.
+"""
+
+import struct
+
+from uuid import UUID
+
+from cryptech_port import DKS_RPCFunc
+
+# field types
+UINT       = 'uint'          # 32-bit unsigned int
+BYTES      = 'bytes'         # variable length opaque
+UUID_FIELD = 'uuid'          # opaque that is always 16 bytes
+ATTRIBUTES = 'attributes'    # count followed by (uint type, opaque value) pairs
+UINT_LIST  = 'uint_list'     # count followed by uints
+UUID_LIST  = 'uuid_list'     # count followed by uuids
+BYTES_LIST = 'bytes_list'    # count followed by opaques
+REMAINDER  = 'remainder'     # the rest of the message, not decoded
+
+# value that is used instead of an opaque to remove an attribute
+ATTRIBUTE_NIL = 0xFFFFFFFF
+
+HEADER          = struct.Struct('>LL')     # code, client
+RESPONSE_HEADER = struct.Struct('>LLL')    # code, client, status
+
+_UINT = struct.Struct('>L')
+_UUID = struct.Struct('>L16s')
+
+# struct format for the field types that always have the same size
+_FIXED_FORMATS = {
+    UINT       : 'L',
+    UUID_FIELD : 'L16s'
+}
+
+
+def _read_uint(msg, offset):
+    return _UINT.unpack_from(msg, offset)[0], offset + 4
+
+def _read_bytes(msg, offset):
+    length = _UINT.unpack_from(msg, offset)[0]
+    start = offset + 4
+    end = start + length
+    if (end > len(msg)):
+        raise ValueError('opaque runs past the end of the message')
+    return msg[start:end], end + ((4 - length % 4) % 4)
+
+def _read_uuid(msg, offset):
+    length, uuid_bytes = _UUID.unpack_from(msg, offset)
+    if (length != 16):
+        raise ValueError('uuid must be 16 bytes')
+    return UUID(bytes = uuid_bytes), offset + 20
+
+def _read_attributes(msg, offset):
+    count, offset = _read_uint(msg, offset)
+    attributes = []
+    for _ in xrange(count):
+        attr_type, offset = _read_uint(msg, offset)
+        if (_UINT.unpack_from(msg, offset)[0] == ATTRIBUTE_NIL):
+            value, offset = None, offset + 4
+        else:
+            value, offset = _read_bytes(msg, offset)
+        attributes.append((attr_type, value))
+    return attributes, offset
+
+def _read_list(read_item):
+    def read_list(msg, offset):
+        count, offset = _read_uint(msg, offset)
+        items = []
+        for _ in xrange(count):
+            item, offset = read_item(msg, offset)
+            items.append(item)
+        return items, offset
+    return read_list
+
+def _read_remainder(msg, offset):
+    return msg[offset:], len(msg)
+
+
+def _write_uint(value):
+    return _UINT.pack(value)
+
+def _write_bytes(value):
+    length = len(value)
+    return ''.join((_UINT.pack(length), value, '\0' * ((4 - length % 4) % 4)))
+
+def _write_uuid(value):
+    return _UUID.pack(16, value.bytes)
+
+def _write_attributes(attributes):
+    parts = [_UINT.pack(len(attributes))]
+    for attr_type, value in attributes:
+        parts.append(_UINT.pack(attr_type))
+        parts.append(_UINT.pack(ATTRIBUTE_NIL) if value is None else _write_bytes(value))
+    return ''.join(parts)
+
+def _write_list(write_item):
+    def write_list(items):
+        return _UINT.pack(len(items)) + ''.join([write_item(item) for item in items])
+    return write_list
+
+def _write_remainder(value):
+    return value
+
+
+_READERS = {
+    UINT       : _read_uint,
+    BYTES      : _read_bytes,
+    UUID_FIELD : _read_uuid,
+    ATTRIBUTES : _read_attributes,
+    UINT_LIST  : _read_list(_read_uint),
+    UUID_LIST  : _read_list(_read_uuid),
+    BYTES_LIST : _read_list(_read_bytes),
+    REMAINDER  : _read_remainder
+}
+
+_WRITERS = {
+    UINT       : _write_uint,
+    BYTES      : _write_bytes,
+    UUID_FIELD : _write_uuid,
+    ATTRIBUTES : _write_attributes,
+    UINT_LIST  : _write_list(_write_uint),
+    UUID_LIST  : _write_list(_write_uuid),
+    BYTES_LIST : _write_list(_write_bytes),
+    REMAINDER  : _write_remainder
+}
+
+
+class MessageSchema(object):
+    """Compiled layout of the fields that follow the header of one message"""
+
+    def __init__(self, code, fields, header):
+        self.code = code
+        self.fields = fields
+        self.header = header
+
+        self.header_count = header.size // 4
+
+        self.types = dict(fields)
+        self.index = dict((name, i) for i, (name, _) in enumerate(fields))
+
+        # offsets of the fields that can be found without reading the message
+        self.fixed_offsets = {}
+
+        offset = header.size
+        for name, field_type in fields:
+            self.fixed_offsets[name] = offset
+            if (field_type not in _FIXED_FORMATS):
+                break
+            offset += struct.calcsize('>' + _FIXED_FORMATS[field_type])
+
+        # a single struct can encode and decode messages with only fixed fields
+        if all(field_type in _FIXED_FORMATS for _, field_type in fields):
+            self.struct = struct.Struct(header.format +
+                                        ''.join(_FIXED_FORMATS[field_type] for _, field_type in fields))
+        else:
+            self.struct = None
+
+    def offset(self, msg, name):
+        """Returns the location of a field in a message"""
+        offset = self.fixed_offsets.get(name)
+        if (offset is not None):
+            return offset
+
+        # start from the last field that has a known location
+        i = len(self.fixed_offsets) - 1
+        offset = self.fixed_offsets[self.fields[i][0]]
+
+        target = self.index[name]
+        while (i < target):
+            offset = _READERS[self.fields[i][1]](msg, offset)[1]
+            i += 1
+
+        return offset
+
+    def get(self, msg, name):
+        """Returns the value of a single field"""
+        return _READERS[self.types[name]](msg, self.offset(msg, name))[0]
+
+    def set(self, buf, name, value):
+        """Rewrite a uint or uuid field in place. buf must be a bytearray"""
+        field_type = self.types[name]
+        offset = self.offset(buf, name)
+
+        if (field_type == UINT):
+            _UINT.pack_into(buf, offset, value)
+        elif (field_type == UUID_FIELD):
+            _UUID.pack_into(buf, offset, 16, value.bytes)
+        else:
+            raise ValueError('%s can not be changed in place' % name)
+
+    def replace(self, msg, name, value):
+        """Returns a copy of msg with a uint or uuid field changed"""
+        buf = bytearray(msg)
+        self.set(buf, name, value)
+        return bytes(buf)
+
+    def decode(self, msg):
+        """Returns a dictionary with every field after the header"""
+        result = {}
+        offset = self.header.size
+        for name, field_type in self.fields:
+            result[name], offset = _READERS[field_type](msg, offset)
+
+        return result
+
+    def encode(self, *values):
+        """Builds a message. values are the header followed by the fields
+        in the order that they are in the schema"""
+        if (self.struct is not None):
+            args = list(values[:self.header_count])
+            for (_, field_type), value in zip(self.fields, values[len(args):]):
+                if (field_type == UUID_FIELD):
+                    args.append(16)
+                    args.append(value.bytes)
+                else:
+                    args.append(value)
+
+            return self.struct.pack(*args)
+
+        header_values = values[:self.header_count]
+        parts = [self.header.pack(*header_values)]
+        for (_, field_type), value in zip(self.fields, values[len(header_values):]):
+            parts.append(_WRITERS[field_type](value))
+
+        return ''.join(parts)
+
+
+_HANDLE = (('handle', UINT),)
+
+# fields that follow the code and client in a request
+REQUEST_FIELDS = {
+    DKS_RPCFunc.RPC_FUNC_GET_VERSION                  : (),
+    DKS_RPCFunc.RPC_FUNC_GET_RANDOM                   : (('length', UINT),),
+    DKS_RPCFunc.RPC_FUNC_SET_PIN                      : (('user', UINT), ('pin', BYTES)),
+    DKS_RPCFunc.RPC_FUNC_LOGIN                        : (('user', UINT), ('pin', BYTES)),
+    DKS_RPCFunc.RPC_FUNC_LOGOUT                       : (),
+    DKS_RPCFunc.RPC_FUNC_LOGOUT_ALL                   : (),
+    DKS_RPCFunc.RPC_FUNC_IS_LOGGED_IN                 : (('user', UINT),),
+    DKS_RPCFunc.RPC_FUNC_HASH_GET_DIGEST_LEN          : (('algorithm', UINT),),
+    DKS_RPCFunc.RPC_FUNC_HASH_GET_DIGEST_ALGORITHM_ID : (('algorithm', UINT), ('max_len', UINT)),
+    DKS_RPCFunc.RPC_FUNC_HASH_GET_ALGORITHM           : _HANDLE,
+    DKS_RPCFunc.RPC_FUNC_HASH_INITIALIZE              : (('session', UINT), ('algorithm', UINT), ('key', BYTES)),
+    DKS_RPCFunc.RPC_FUNC_HASH_UPDATE                  : (('handle', UINT), ('data', BYTES)),
+    DKS_RPCFunc.RPC_FUNC_HASH_FINALIZE                : (('handle', UINT), ('length', UINT)),
+    DKS_RPCFunc.RPC_FUNC_PKEY_LOAD                    : (('session', UINT), ('der', BYTES), ('flags', UINT)),
+    DKS_RPCFunc.RPC_FUNC_PKEY_OPEN                    : (('session', UINT), ('uuid', UUID_FIELD)),
+    DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_RSA            : (('session', UINT), ('keylen', UINT),
+                                                         ('exponent', BYTES), ('flags', UINT)),
+    DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_EC             : (('session', UINT), ('curve', UINT), ('flags', UINT)),
+    DKS_RPCFunc.RPC_FUNC_PKEY_CLOSE                   : _HANDLE,
+    DKS_RPCFunc.RPC_FUNC_PKEY_DELETE                  : _HANDLE,
+    DKS_RPCFunc.RPC_FUNC_PKEY_GET_KEY_TYPE            : _HANDLE,
+    DKS_RPCFunc.RPC_FUNC_PKEY_GET_KEY_FLAGS           : _HANDLE,
+    DKS_RPCFunc.RPC_FUNC_PKEY_GET_PUBLIC_KEY_LEN      : _HANDLE,
+    DKS_RPCFunc.RPC_FUNC_PKEY_GET_PUBLIC_KEY          : (('handle', UINT), ('length', UINT)),
+    DKS_RPCFunc.RPC_FUNC_PKEY_SIGN                    : (('handle', UINT), ('hash', UINT),
+                                                         ('data', BYTES), ('length', UINT)),
+    DKS_RPCFunc.RPC_FUNC_PKEY_VERIFY                  : (('handle', UINT), ('hash', UINT),
+                                                         ('data', BYTES), ('signature', BYTES)),
+    DKS_RPCFunc.RPC_FUNC_PKEY_MATCH                   : (('session', UINT), ('type', UINT), ('curve', UINT),
+                                                         ('mask', UINT), ('flags', UINT),
+                                                         ('attributes', ATTRIBUTES), ('state', UINT),
+                                                         ('result_max', UINT), ('uuid', UUID_FIELD)),
+    DKS_RPCFunc.RPC_FUNC_PKEY_GET_KEY_CURVE           : _HANDLE,
+    DKS_RPCFunc.RPC_FUNC_PKEY_SET_ATTRIBUTES          : (('handle', UINT), ('attributes', ATTRIBUTES)),
+    DKS_RPCFunc.RPC_FUNC_PKEY_GET_ATTRIBUTES          : (('handle', UINT), ('types', UINT_LIST),
+                                                         ('buffer_len', UINT)),
+    DKS_RPCFunc.RPC_FUNC_PKEY_EXPORT                  : (('handle', UINT), ('kekek', UINT),
+                                                         ('pkcs8_max', UINT), ('kek_max', UINT)),
+    DKS_RPCFunc.RPC_FUNC_PKEY_IMPORT                  : (('session', UINT), ('kekek', UINT),
+                                                         ('pkcs8', BYTES), ('kek', BYTES), ('flags', UINT)),
+    DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_HASHSIG        : (('session', UINT), ('hss_levels', UINT),
+                                                         ('lms_type', UINT), ('lmots_type', UINT),
+                                                         ('flags', UINT)),
+    DKS_RPCFunc.RPC_FUNC_CHECK_TAMPER                 : (),
+    DKS_RPCFunc.RPC_FUNC_GET_HSM_STATE                : (),
+    DKS_RPCFunc.RPC_FUNC_GET_IP                       : (),
+    DKS_RPCFunc.RPC_FUNC_SET_RPC_DEVICE               : (('rpc_index', UINT),),
+    DKS_RPCFunc.RPC_FUNC_DISABLE_CACHE_KEYGEN         : (),
+    DKS_RPCFunc.RPC_FUNC_ENABLE_CACHE_KEYGEN          : (),
+    DKS_RPCFunc.RPC_FUNC_USE_INCOMING_DEVICE_UUIDS    : (),
+    DKS_RPCFunc.RPC_FUNC_USE_INCOMING_MASTER_UUIDS    : (),
+    # the parameters of the PKEY_GENERATE request follow the code
+    DKS_RPCFunc.RPC_FUNC_KEYGEN_JOB_SUBMIT            : (('code', UINT), ('params', REMAINDER)),
+    DKS_RPCFunc.RPC_FUNC_KEYGEN_JOB_STATUS            : (('job', UINT), ('wait', UINT)),
+    DKS_RPCFunc.RPC_FUNC_KEYGEN_JOB_RESULT            : (('job', UINT),),
+    DKS_RPCFunc.RPC_FUNC_PKEY_SIGN_BATCH              : (('session', UINT), ('uuid', UUID_FIELD),
+                                                         ('length', UINT), ('digests', BYTES_LIST)),
+    # deadline is in milliseconds. 0 = no deadline
+    DKS_RPCFunc.RPC_FUNC_SET_PRIORITY                 : (('priority', UINT), ('deadline', UINT))
+}
+
+_NEW_KEY = (('handle', UINT), ('uuid', UUID_FIELD))
+
+# fields that follow the code, client, and status in a successful response
+RESPONSE_FIELDS = {
+    DKS_RPCFunc.RPC_FUNC_GET_VERSION                  : (('version', UINT),),
+    DKS_RPCFunc.RPC_FUNC_GET_RANDOM                   : (('data', BYTES),),
+    DKS_RPCFunc.RPC_FUNC_SET_PIN                      : (),
+    DKS_RPCFunc.RPC_FUNC_LOGIN                        : (),
+    DKS_RPCFunc.RPC_FUNC_LOGOUT                       : (),
+    DKS_RPCFunc.RPC_FUNC_LOGOUT_ALL                   : (),
+    DKS_RPCFunc.RPC_FUNC_IS_LOGGED_IN                 : (),
+    DKS_RPCFunc.RPC_FUNC_HASH_GET_DIGEST_LEN          : (('length', UINT),),
+    DKS_RPCFunc.RPC_FUNC_HASH_GET_DIGEST_ALGORITHM_ID : (('id', BYTES),),
+    DKS_RPCFunc.RPC_FUNC_HASH_GET_ALGORITHM           : (('algorithm', UINT),),
+    DKS_RPCFunc.RPC_FUNC_HASH_INITIALIZE              : _HANDLE,
+    DKS_RPCFunc.RPC_FUNC_HASH_UPDATE                  : (),
+    DKS_RPCFunc.RPC_FUNC_HASH_FINALIZE                : (('digest', BYTES),),
+    DKS_RPCFunc.RPC_FUNC_PKEY_LOAD                    : _NEW_KEY,
+    DKS_RPCFunc.RPC_FUNC_PKEY_OPEN                    : _HANDLE,
+    DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_RSA            : _NEW_KEY,
+    DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_EC             : _NEW_KEY,
+    DKS_RPCFunc.RPC_FUNC_PKEY_CLOSE                   : (),
+    DKS_RPCFunc.RPC_FUNC_PKEY_DELETE                  : (),
+    DKS_RPCFunc.RPC_FUNC_PKEY_GET_KEY_TYPE            : (('type', UINT),),
+    DKS_RPCFunc.RPC_FUNC_PKEY_GET_KEY_FLAGS           : (('flags', UINT),),
+    DKS_RPCFunc.RPC_FUNC_PKEY_GET_PUBLIC_KEY_LEN      : (('length', UINT),),
+    DKS_RPCFunc.RPC_FUNC_PKEY_GET_PUBLIC_KEY          : (('der', BYTES),),
+    DKS_RPCFunc.RPC_FUNC_PKEY_SIGN                    : (('signature', BYTES),),
+    DKS_RPCFunc.RPC_FUNC_PKEY_VERIFY                  : (),
+    DKS_RPCFunc.RPC_FUNC_PKEY_MATCH                   : (('state', UINT), ('uuids', UUID_LIST)),
+    DKS_RPCFunc.RPC_FUNC_PKEY_GET_KEY_CURVE           : (('curve', UINT),),
+    DKS_RPCFunc.RPC_FUNC_PKEY_SET_ATTRIBUTES          : (),
+    # the values are lengths or opaques depending on the buffer_len of the request
+    DKS_RPCFunc.RPC_FUNC_PKEY_GET_ATTRIBUTES          : (('attributes', REMAINDER),),
+    DKS_RPCFunc.RPC_FUNC_PKEY_EXPORT                  : (('pkcs8', BYTES), ('kek', BYTES)),
+    DKS_RPCFunc.RPC_FUNC_PKEY_IMPORT                  : _NEW_KEY,
+    DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_HASHSIG        : _NEW_KEY,
+    DKS_RPCFunc.RPC_FUNC_CHECK_TAMPER                 : (),
+    DKS_RPCFunc.RPC_FUNC_GET_HSM_STATE                : (('states', BYTES_LIST),),
+    DKS_RPCFunc.RPC_FUNC_GET_IP                       : (('ip', BYTES),),
+    DKS_RPCFunc.RPC_FUNC_SET_RPC_DEVICE               : (),
+    DKS_RPCFunc.RPC_FUNC_DISABLE_CACHE_KEYGEN         : (),
+    DKS_RPCFunc.RPC_FUNC_ENABLE_CACHE_KEYGEN          : (),
+    DKS_RPCFunc.RPC_FUNC_USE_INCOMING_DEVICE_UUIDS    : (),
+    DKS_RPCFunc.RPC_FUNC_USE_INCOMING_MASTER_UUIDS    : (),
+    DKS_RPCFunc.RPC_FUNC_KEYGEN_JOB_SUBMIT            : (('job', UINT),),
+    DKS_RPCFunc.RPC_FUNC_KEYGEN_JOB_STATUS            : (('state', UINT),),
+    DKS_RPCFunc.RPC_FUNC_KEYGEN_JOB_RESULT            : _NEW_KEY,
+    DKS_RPCFunc.RPC_FUNC_PKEY_SIGN_BATCH              : (('signatures', BYTES_LIST),),
+    DKS_RPCFunc.RPC_FUNC_SET_PRIORITY                 : ()
+}
+
+REQUESTS = dict((code, MessageSchema(code, fields, HEADER))
+                for code, fields in REQUEST_FIELDS.iteritems())
+
+RESPONSES = dict((code, MessageSchema(code, fields, RESPONSE_HEADER))
+                 for code, fields in RESPONSE_FIELDS.iteritems())
+
+
+def get_header(msg):
+    "Returns the code and client of a message"
+    return HEADER.unpack_from(msg)
+
+def get_response_header(msg):
+    "Returns the code, client, and status of a response"
+    return RESPONSE_HEADER.unpack_from(msg)
+
+def set_client(buf, client):
+    "Change the client of a message in place. buf must be a bytearray"
+    _UINT.pack_into(buf, 4, client)
+
+def error_response(code, client, status):
+    "Returns a response that only has a status"
+    return RESPONSE_HEADER.pack(code, client, status)
+
+def get_response_payload(msg):
+    "Returns the fields of a response without the header"
+    return msg[RESPONSE_HEADER.size:]
+
+def payload_response(code, client, payload):
+    "Returns a successful response built from the fields of another response"
+    return RESPONSE_HEADER.pack(code, client, 0) + payload
+
+def encode_attributes(attributes):
+    "Returns the XDR for a list of (type, value) pairs. None is sent as NIL"
+    return _write_attributes(attributes)
+
+def decode_attributes(data):
+    "Returns the list of (type, value) pairs in XDR data. NIL is returned as None"
+    return _read_attributes(data, 0)[0]
+
+def encode_attribute_lengths(lengths):
+    "Returns the XDR for a list of (type, length) pairs. None is sent as NIL"
+    parts = [_UINT.pack(len(lengths))]
+    for attr_type, length in lengths:
+        parts.append(_UINT.pack(attr_type))
+        parts.append(_UINT.pack(ATTRIBUTE_NIL if length is None else length))
+    return ''.join(parts)
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+RPCIOStream that frames the replies from an alpha using the incremental
+SLIP decoder.
+"""
+import time
+import itertools
+
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.locks
+import tornado.concurrent
+
+import cryptech.muxd
+
+import diagnostics
+
+from slip import SLIPDecoder
+
+from rpc_action import RPCPriority
+
+# largest amount of data to take from the serial port in one read
+READ_CHUNK_SIZE = 65536
+
+# default number of requests that can be waiting on an alpha at once
+DEFAULT_DEVICE_WINDOW = 8
+
+# default seconds a waiting request must wait to move up one priority
+DEFAULT_PRIORITY_AGING = 1.0
+
+class DeadlineExpired(Exception):
+    "The request's deadline passed before it could be sent to the device."
+    pass
+
+class DeviceBusy(Exception):
+    "The device already has as many queued requests as it's allowed."
+    pass
+
+class InFlightWindow(object):
+    """
+    Counts the requests that have been written to a device, but not yet
+    answered. Unlike a Semaphore, the size can be changed and the count
+    can be cleared when the device is restarted.
+
+    When the window is full, the waiting request with the highest
+    priority goes next. Requests move up one priority for every 'aging'
+    seconds they wait so low priority requests can't be starved.
+
+    A request that has been given up on gives its slot back right away.
+    The late reply for its client handle is then ignored.
+    """
+
+    def __init__(self, size, aging = DEFAULT_PRIORITY_AGING):
+        self.size = size
+        self.aging = aging
+        self.count = 0
+
+        # number of late replies to ignore by the client handle
+        self.abandoned = {}
+
+        # [priority, time queued, sequence, future]
+        self.waiters = []
+        self.sequence = itertools.count()
+
+    @tornado.gen.coroutine
+    def acquire(self, priority = RPCPriority.NORMAL, deadline = None):
+        """Wait until another request can be sent to the device. Raises
+        DeadlineExpired if deadline, a time.time(), passes first"""
+        if (deadline is not None and time.time() >= deadline):
+            raise DeadlineExpired()
+
+        if (not self.waiters and self.count < self.size):
+            self.count += 1
+            return
+
+        future = tornado.concurrent.Future()
+        waiter = [priority, time.time(), next(self.sequence), future]
+        self.waiters.append(waiter)
+
+        timeout = None
+        if (deadline is not None):
+            timeout = tornado.ioloop.IOLoop.current().call_later(max(deadline - time.time(), 0),
+                                                                 self.__expire, waiter)
+
+        try:
+            yield future
+        finally:
+            if (timeout is not None):
+                tornado.ioloop.IOLoop.current().remove_timeout(timeout)
+
+    def __expire(self, waiter):
+        if (waiter in self.waiters):
+            self.waiters.remove(waiter)
+            waiter[3].set_exception(DeadlineExpired())
+
+    def __wake(self):
+        "Let waiting requests go while there's room in the window."
+        now = time.time()
+        aging = self.aging if (self.aging > 0) else float('inf')
+
+        while (self.waiters and self.count < self.size):
+            waiter = min(self.waiters, key = lambda w: (w[0] - (now - w[1]) / aging, w[2]))
+            self.waiters.remove(waiter)
+
+            self.count += 1
+            waiter[3].set_result(None)
+
+    def release(self, handle = None):
+        "A reply for the client handle has been received from the device."
+        abandoned = self.abandoned.get(handle, 0)
+        if (abandoned > 0):
+            # the slot was given back when the request was abandoned
+            if (abandoned == 1):
+                del self.abandoned[handle]
+            else:
+                self.abandoned[handle] = abandoned - 1
+            return
+
+        if (self.count > 0):
+            self.count -= 1
+        self.__wake()
+
+    def abandon(self, handle):
+        "The reply to a request from the client handle won't be waited for."
+        self.abandoned[handle] = self.abandoned.get(handle, 0) + 1
+
+        if (self.count > 0):
+            self.count -= 1
+        self.__wake()
+
+    def resize(self, size):
+        self.size = size
+        self.__wake()
+
+    def set_aging(self, aging):
+        self.aging = aging
+
+    def reset(self):
+        "Requests to the device have been lost."
+        self.count = 0
+        self.abandoned.clear()
+        self.__wake()
+
+class DKSRPCIOStream(cryptech.muxd.RPCIOStream):
+    """
+    Tornado IOStream for a serial RPC channel. Replies are passed to the
+    queues already SLIP decoded.
+
+    Requests from different clients are written to the alpha without
+    waiting for the previous reply, up to the size of the in-flight
+    window. Queries that arrive while a write is in progress are
+    combined into a single write.
+    """
+
+    def __init__(self, device, window = DEFAULT_DEVICE_WINDOW):
+        super(DKSRPCIOStream, self).__init__(device)
+        self.decoder = SLIPDecoder()
+        self.window = InFlightWindow(window)
+        self.pending_writes = []
+
+        # requests waiting for room in the window. 0 = no limit
+        self.queued = 0
+        self.queued_bytes = 0
+        self.queue_limit = 0
+        self.queue_byte_limit = 0
+
+    @property
+    def in_flight(self):
+        "The number of requests waiting for a reply from the alpha."
+        return self.window.count
+
+    def set_window(self, window):
+        self.window.resize(window)
+
+    def set_priority_aging(self, aging):
+        self.window.set_aging(aging)
+
+    def set_queue_limits(self, limit, byte_limit):
+        self.queue_limit = limit
+        self.queue_byte_limit = byte_limit
+
+    def is_queue_full(self):
+        "True if a new request that has to wait would be rejected."
+        return ((self.queue_limit > 0 and self.queued >= self.queue_limit) or
+                (self.queue_byte_limit > 0 and self.queued_bytes >= self.queue_byte_limit))
+
+    def abandon_request(self, handle):
+        "Stop counting a request that timed out against the window."
+        self.window.abandon(handle)
+
+    def reset(self):
+        "Drop everything from before a restart of the serial port."
+        self.decoder.reset()
+        self.window.reset()
+        del self.pending_writes[:]
+
+    @tornado.gen.coroutine
+    def rpc_input(self, query, handle = 0, queue = None, priority = RPCPriority.NORMAL, deadline = None):
+        """Send a query to the HSM. Raises DeadlineExpired if the query
+        couldn't be sent before deadline or DeviceBusy if too many
+        queries are already waiting"""
+        if (diagnostics.enabled):
+            diagnostics.log_frame("RPC send", query)
+
+        if (self.is_queue_full()):
+            raise DeviceBusy()
+
+        if queue is not None:
+            self.queues[handle] = queue
+
+        self.queued += 1
+        self.queued_bytes += len(query)
+        try:
+            yield self.window.acquire(priority, deadline)
+        finally:
+            self.queued -= 1
+            self.queued_bytes -= len(query)
+
+        self.pending_writes.append(query)
+        with (yield self.rpc_input_lock.acquire()):
+            # a previous writer may have already sent our query
+            if (self.pending_writes):
+                data = b''.join(self.pending_writes)
+                del self.pending_writes[:]
+
+                yield self.write(data)
+
+    @tornado.gen.coroutine
+    def rpc_output_loop(self):
+        "Handle reply stream HSM -> network."
+        logger = cryptech.muxd.logger
+        while True:
+            try:
+                data = yield self.read_bytes(READ_CHUNK_SIZE, partial = True)
+            except tornado.iostream.StreamClosedError:
+                logger.info("RPC UART closed")
+                self.window.reset()
+                for q in self.queues.itervalues():
+                    q.put_nowait(None)
+                return
+
+            for reply in self.decoder.feed(data):
+                if (diagnostics.enabled):
+                    diagnostics.log_frame("RPC recv", reply)
+
+                # every frame from the alpha answers one request
+                if (len(reply) < 8):
+                    self.window.release()
+                    logger.debug("RPC skipping bad packet")
+                    continue
+
+                handle = cryptech.muxd.client_handle_get(reply)
+                self.window.release(handle)
+
+                queue = self.queues.get(handle)
+                if queue is None:
+                    logger.debug("RPC ignoring response: handle 0x%x", handle)
+                    continue
+
+                queue.put_nowait(reply)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Incremental SLIP framing for the RPC streams. Compatible with
+slip_encode/slip_decode in cryptech.muxd and cryptech.libhal, but frames
+are found with a single scan of the data as it arrives and escaped bytes
+are only processed when a frame actually contains them.
+"""
+
+SLIP_END     = chr(0300)        # Indicates end of SLIP packet
+SLIP_ESC     = chr(0333)        # Indicates byte stuffing
+SLIP_ESC_END = chr(0334)        # ESC ESC_END means END data byte
+SLIP_ESC_ESC = chr(0335)        # ESC ESC_ESC means ESC data byte
+
+_ESCAPED_END = SLIP_ESC + SLIP_ESC_END
+_ESCAPED_ESC = SLIP_ESC + SLIP_ESC_ESC
+
+
+def slip_encode(buffer):
+    "Encode a buffer using SLIP encapsulation."
+    # replace() returns the same string when there's nothing to escape
+    buffer = buffer.replace(SLIP_ESC, _ESCAPED_ESC).replace(SLIP_END, _ESCAPED_END)
+
+    return SLIP_END + buffer + SLIP_END
+
+def slip_unescape(frame):
+    "Decode the contents of a SLIP frame that no longer has SLIP_END bytes."
+    if (SLIP_ESC in frame):
+        return frame.replace(_ESCAPED_END, SLIP_END).replace(_ESCAPED_ESC, SLIP_ESC)
+
+    return frame
+
+def slip_decode(buffer):
+    "Decode a SLIP-encapsulated buffer."
+    return slip_unescape(buffer.strip(SLIP_END))
+
+
+class SLIPDecoder(object):
+    """Splits a byte stream into decoded SLIP frames. Data can be fed in
+    chunks of any size and each byte is only scanned once."""
+
+    def __init__(self):
+        # data from a frame that hasn't been completed yet
+        self.partial = bytearray()
+
+    def reset(self):
+        del self.partial[:]
+
+    def feed(self, data):
+        """Add data from the stream and return a list of every frame that
+        has been completed. Empty frames are dropped."""
+        frames = []
+        start = 0
+
+        if (self.partial):
+            end = data.find(SLIP_END)
+            if (end < 0):
+                self.partial.extend(data)
+                return frames
+
+            self.partial.extend(data[:end])
+            frames.append(slip_unescape(bytes(self.partial)))
+            del self.partial[:]
+            start = end + 1
+
+        find = data.find
+        end = find(SLIP_END, start)
+        while (end >= 0):
+            if (end > start):
+                frames.append(slip_unescape(data[start:end]))
+            start = end + 1
+            end = find(SLIP_END, start)
+
+        if (start < len(data)):
+            self.partial.extend(data[start:])
+
+        return frames
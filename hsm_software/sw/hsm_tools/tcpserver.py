@@ -48,9 +48,11 @@ import time
 import struct
 import atexit
 import weakref
+import datetime
 import logging
 import logging.handlers
 import threading
+import collections
 
 import serial
 
@@ -66,13 +68,42 @@ import tornado.gen
 # cryptech_muxd has been renamed to cryptech/muxd.py
 import cryptech.muxd
 
-from rpc_action import RPCAction
+from rpc_action import RPCAction, RPCPriority
+from rpciostream import DeadlineExpired, DeviceBusy
 
-from cryptech_port import DKS_HALError
-from cryptech.cryptech.libhal import ContextManagedUnpacker, xdrlib
+from slip import slip_encode, slip_decode, SLIPDecoder
+
+import rpc_schema
+import diagnostics
+
+from cryptech_port import DKS_HALError, DKS_RPCFunc
 
 from hsm import CrypTechDeviceState
 
+# largest amount of data to take from a connection in one read
+READ_CHUNK_SIZE = 65536
+
+# seconds between checks for idle alphas to do background work like
+# refilling the random pool
+BACKGROUND_INTERVAL = 0.05
+
+# health probes sent to a reconnected alpha before it's used again
+WARMUP_PROBES = 3
+
+class DeviceReplyQueue(tornado.queues.Queue):
+    """Replies from one alpha to one connection"""
+    def __init__(self):
+        super(DeviceReplyQueue, self).__init__()
+
+        # future reading the reply to a request that timed out. The
+        # next request can't be sent until it arrives or it would be
+        # taken as the reply to the next request
+        self.late_reply = None
+
+class DeviceUnavailable(Exception):
+    "The alpha's serial port has failed and is waiting to be reconnected."
+    pass
+
 def rpc_code_get(msg):
     "Extract rpc code field from a Cryptech RPC message."
     return struct.unpack(">L", msg[0:4])[0]
@@ -101,44 +132,156 @@ class RPCTCPServer(TCPServer):
 
     def __init__(self, rpc_preprocessor, port, ssl):
         self.rpc_preprocessor = rpc_preprocessor
+
         super(RPCTCPServer, self).__init__(port, ssl)
 
-    def error_from_request(self, unencoded_request, hal_error):
-        unpacker = ContextManagedUnpacker(unencoded_request)
-        
-        # get the code of the RPC request
-        code = unpacker.unpack_uint()
+    def append_futures(self, futures):
+        futures.append(self.background_loop(self.rpc_preprocessor.get_random_refill_action))
 
-        # get the handle which identifies the TCP connection that the request came from
-        client = unpacker.unpack_uint()
+        for rpc in self.rpc_preprocessor.rpc_list:
+            futures.append(self.supervise_device(rpc))
 
-        # generate complete response
-        response = xdrlib.Packer()
-        response.pack_uint(code)
-        response.pack_uint(client)
-        response.pack_uint(hal_error)
+    @tornado.gen.coroutine
+    def supervise_device(self, rpc):
+        """Check an alpha's health with GET_VERSION and reconnect it when
+        it stops working. Reconnects wait longer after every failure"""
+        while True:
+            interval, timeout, _ = self.rpc_preprocessor.get_device_supervisor_timing()
+
+            if (not self.rpc_preprocessor.can_supervise_devices()):
+                yield tornado.gen.sleep(BACKGROUND_INTERVAL)
+                continue
+
+            # changes made by anything else are shown in 'show devices'
+            self.rpc_preprocessor.observe_device(rpc)
+
+            if (rpc.state == CrypTechDeviceState.HSMNotReady):
+                yield tornado.gen.sleep(self.rpc_preprocessor.get_reconnect_delay(rpc))
+                yield self.__reconnect_device(rpc, timeout)
+                continue
+
+            if (interval <= 0 or rpc.get_busy_factor() < 0):
+                yield tornado.gen.sleep(max(interval, BACKGROUND_INTERVAL))
+                continue
+
+            yield tornado.gen.sleep(interval)
+
+            if (rpc.state != CrypTechDeviceState.HSMNotReady):
+                latency = yield self.__probe_device(rpc, timeout)
+                self.rpc_preprocessor.probe_finished(rpc, latency)
+
+    @tornado.gen.coroutine
+    def __probe_device(self, rpc, timeout):
+        """Returns the seconds a GET_VERSION took or None if it failed.
+        Each probe uses its own reply queue so a probe that timed out
+        can't hold up the next one"""
+        handle = self.next_client_handle()
+        code = DKS_RPCFunc.RPC_FUNC_GET_VERSION
+        request = slip_encode(rpc_schema.REQUESTS[code].encode(code, handle))
+
+        start_time = time.time()
+        try:
+            reply = yield self.__send_with_timeout(rpc, request, handle, {}, {}, timeout)
+        except Exception:
+            raise tornado.gen.Return(None)
+
+        if (rpc_schema.get_response_header(reply)[2] != DKS_HALError.HAL_OK):
+            raise tornado.gen.Return(None)
+
+        raise tornado.gen.Return(time.time() - start_time)
+
+    @tornado.gen.coroutine
+    def __send_with_timeout(self, rpc, encoded_request, handle, queues, locks, timeout):
+        """Send supervisor work ahead of client requests and return the
+        reply. Raises tornado.gen.TimeoutError if it takes too long"""
+        future = self.__send_to_devices([rpc], encoded_request, handle, queues, locks,
+                                        None, RPCPriority.HIGH)
+        if (timeout > 0):
+            future = tornado.gen.with_timeout(datetime.timedelta(seconds = timeout), future,
+                                              quiet_exceptions = Exception)
+
+        reply_list = yield future
+        raise tornado.gen.Return(reply_list[0])
+
+    @tornado.gen.coroutine
+    def __reconnect_device(self, rpc, timeout):
+        """Reopen an alpha's serial port and warm it up before the
+        scheduler can use it again. Logged in sessions have to log in
+        again because the PIN isn't kept"""
+        error = self.reopen_serial(rpc)
+        if (error is not None):
+            self.rpc_preprocessor.reconnect_failed(rpc, error)
+            return
+
+        latency = yield self.__probe_device(rpc, timeout)
+        if (latency is None):
+            self.rpc_preprocessor.reconnect_failed(rpc, 'no reply to GET_VERSION')
+            return
+
+        for _ in xrange(WARMUP_PROBES):
+            latency = yield self.__probe_device(rpc, timeout)
+            self.rpc_preprocessor.probe_finished(rpc, latency)
+
+        if (rpc.state == CrypTechDeviceState.HSMNotReady):
+            self.rpc_preprocessor.device_reconnected(rpc)
+
+    def reopen_serial(self, rpc):
+        """Reopen an alpha's serial port. Returns None or the error"""
+        serial_obj = rpc.serial
 
-        return response.get_buffer()
+        try:
+            serial_obj.serial = serial.Serial(serial_obj.serial_device, 921600, timeout = 0, write_timeout = 0.1)
+
+            # anything left from before the restart can't be completed
+            serial_obj.reset()
+        except Exception as e:
+            return str(e)
 
-    def verify_result(self, result):
-        decoded_request = cryptech.muxd.slip_decode(result)
+        cryptech.muxd.logger.info('Reopened serial %s', str(serial_obj.serial_device))
 
-        # handle the message normally
-        unpacker = ContextManagedUnpacker(decoded_request)
+        return None
 
-        # get the code of the RPC request
-        code = unpacker.unpack_uint()
+    @tornado.gen.coroutine
+    def background_loop(self, get_action):
+        """Run the work from get_action on the alphas that aren't busy.
+        get_action is called with the loop's client handle and returns
+        None when there's nothing to do"""
+        handle = self.next_client_handle()
+        queues = {}
+        locks = {}
+
+        while True:
+            action = get_action(handle)
+            if (action is None):
+                yield tornado.gen.sleep(BACKGROUND_INTERVAL)
+                continue
 
-        # get the handle which identifies the TCP connection that the request came from
-        client = unpacker.unpack_uint()
+            try:
+                while (action.rpc_list is not None):
+                    request = action.request
+                    if (isinstance(request, list)):
+                        encoded_request = [slip_encode(r) for r in request]
+                    else:
+                        encoded_request = slip_encode(request)
 
-        # hal error
-        hal_error = unpacker.unpack_uint()
+                    reply_list = yield self.__send_to_devices(action.rpc_list,
+                                                              encoded_request,
+                                                              handle, queues, locks,
+                                                              action.rpc_class,
+                                                              RPCPriority.BULK)
 
-        if(hal_error is not 0):
-            print 'HALERROR:%X - CODE:%X'%(hal_error, code)
+                    action = action.callback(action, reply_list)
+            except Exception as e:
+                cryptech.muxd.logger.info("Background work failed: %s", e)
+                yield tornado.gen.sleep(BACKGROUND_INTERVAL)
 
+    def error_from_request(self, unencoded_request, hal_error):
+        # get the code of the RPC request and the handle which
+        # identifies the TCP connection that the request came from
+        code, client = rpc_schema.get_header(unencoded_request)
 
+        # generate complete response
+        return rpc_schema.error_response(code, client, hal_error)
 
     @tornado.gen.coroutine
     def handle_stream(self, stream, address):
@@ -155,7 +298,7 @@ class RPCTCPServer(TCPServer):
                         continue
 
                     # get the old handle
-                    decoded_query = cryptech.muxd.slip_decode(query)
+                    decoded_query = slip_decode(query)
 
                     if (not self.rpc_preprocessor.is_mkm_set):
                         reply = self.error_from_request(decoded_query, DKS_HALError.HAL_ERROR_MASTERKEY_NOT_SET)
@@ -165,7 +308,7 @@ class RPCTCPServer(TCPServer):
                     reply = self.error_from_request(decoded_query, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS)
 
                 #encode
-                reply_encoded = cryptech.muxd.slip_encode(reply)
+                reply_encoded = slip_encode(reply)
 
                 try:
                     yield stream.write(cryptech.muxd.SLIP_END + reply_encoded)
@@ -183,99 +326,444 @@ class RPCTCPServer(TCPServer):
         """Start processing a stream from an intenal PF_UNIX connection"""
         self.__handle_stream(stream, address, from_ethernet = False)
 
+    def __get_device_queue(self, queues, rpc):
+        """Each connection uses a separate reply queue for every device so
+        replies from different alphas can be told apart"""
+        queue = queues.get(rpc)
+        if queue is None:
+            queue = DeviceReplyQueue()
+            queues[rpc] = queue
+
+        return queue
+
     @tornado.gen.coroutine
-    def try_restart_serial(self, rpc, encoded_request, handle, queue, e):
-        serial_obj = rpc.serial
+    def __write_to_device(self, rpc, encoded_request, handle, queue, priority, deadline):
+        serial = rpc.serial
+        try:
+            yield serial.rpc_input(encoded_request, handle, queue, priority, deadline)
+        except (DeadlineExpired, DeviceBusy):
+            raise
+        except Exception as e:
+            # the alpha's supervisor reconnects it
+            self.rpc_preprocessor.device_failed(rpc, 'serial error: %s' % e)
+            raise DeviceUnavailable()
 
-        message = 'Restarting serial %s because of %s'%(str(serial_obj.serial_device), e.message)
+    @tornado.gen.coroutine
+    def __read_from_device(self, queue, handle):
+        reply = yield queue.get()
+        if reply is None:
+            raise cryptech.muxd.QueuedStreamClosedError()
+
+        if (diagnostics.enabled):
+            diagnostics.verify_reply(reply)
+
+        raise tornado.gen.Return(reply)
 
-        cryptech.muxd.logger.debug(message)
-        print message
+    @tornado.gen.coroutine
+    def __wait_for_late_reply(self, queue, timeout):
+        """Wait for the reply to an earlier request that timed out.
+        Raises tornado.gen.TimeoutError if it still hasn't arrived"""
+        if (queue.late_reply is None):
+            return
 
         try:
-            # try to reopen the serial device
-            serial_obj.serial = serial.Serial(serial_obj.serial_device, 921600, timeout = 0, write_timeout = 0.1)
+            if (timeout > 0):
+                yield tornado.gen.with_timeout(datetime.timedelta(seconds = timeout), queue.late_reply)
+            else:
+                yield queue.late_reply
+        except tornado.gen.TimeoutError:
+            raise
+        except Exception:
+            # the serial port was reset so the reply won't come
+            pass
 
-            yield serial_obj.rpc_input(encoded_request, handle, queue)
-        except Exception as e:
-            message = 'Unable to restarting serial %s because of %s'%(str(serial_obj.serial_device), e.message)
-            rpc.change_state(CrypTechDeviceState.HSMNotReady)
+        queue.late_reply = None
+
+    def __get_device_lock(self, locks, rpc):
+        """Each connection may only have one outstanding request on a
+        device so replies can be matched with their requests"""
+        lock = locks.get(rpc)
+        if lock is None:
+            lock = tornado.locks.Lock()
+            locks[rpc] = lock
+
+        return lock
 
     @tornado.gen.coroutine
-    def __handle_stream(self, stream, address, from_ethernet):
-        "Handle one network connection."
-        handle = self.next_client_handle()
-        queue  = tornado.queues.Queue()
-        cryptech.muxd.logger.info("RPC connected %r, handle 0x%x", stream, handle)
+    def __exchange_with_device(self, rpc, encoded_request, handle, queue, rpc_class,
+                               priority = RPCPriority.NORMAL, deadline = None):
+        """Send a request to an alpha and return its decoded reply. The
+        scheduler is told how long the alpha took. If the request can't
+        be sent before its deadline or the alpha doesn't reply in time,
+        the reply is a HAL_ERROR_IO_TIMEOUT. If the alpha's queue is
+        full, the reply is a HAL_ERROR_CORE_BUSY. If the alpha has stopped
+        working, the reply is a HAL_ERROR_RPC_TRANSPORT"""
+        timeout = self.rpc_preprocessor.get_rpc_timeout(rpc_class)
+        start_time = self.rpc_preprocessor.start_request(rpc, rpc_class)
+        success = False
+        try:
+            yield self.__wait_for_late_reply(queue, timeout)
 
-        self.rpc_preprocessor.create_session(handle, from_ethernet)
+            yield self.__write_to_device(rpc, encoded_request, handle, queue, priority, deadline)
 
-        while True:
+            read = self.__read_from_device(queue, handle)
+            if (timeout > 0):
+                try:
+                    reply = yield tornado.gen.with_timeout(datetime.timedelta(seconds = timeout), read,
+                                                           quiet_exceptions = cryptech.muxd.QueuedStreamClosedError)
+                except tornado.gen.TimeoutError:
+                    # the alpha may never answer so its slot in the
+                    # window can't wait for the reply
+                    rpc.serial.abandon_request(handle)
+                    queue.late_reply = read
+                    raise
+            else:
+                reply = yield read
+
+            success = True
+        except tornado.gen.TimeoutError:
+            cryptech.muxd.logger.info("Request to %s failed because the reply took too long", rpc.name)
+            self.rpc_preprocessor.device_timeout(rpc)
+            reply = self.error_from_request(slip_decode(encoded_request), DKS_HALError.HAL_ERROR_IO_TIMEOUT)
+        except DeadlineExpired:
+            cryptech.muxd.logger.info("Request to %s failed because its deadline passed", rpc.name)
+            reply = self.error_from_request(slip_decode(encoded_request), DKS_HALError.HAL_ERROR_IO_TIMEOUT)
+        except DeviceBusy:
+            self.rpc_preprocessor.device_busy(rpc)
+            reply = self.error_from_request(slip_decode(encoded_request), DKS_HALError.HAL_ERROR_CORE_BUSY)
+        except DeviceUnavailable:
+            # keys that are open on the alpha move to another alpha
+            # when the request is repeated
+            reply = self.error_from_request(slip_decode(encoded_request), DKS_HALError.HAL_ERROR_RPC_TRANSPORT)
+        finally:
+            self.rpc_preprocessor.finish_request(rpc, rpc_class, start_time, success)
+
+        raise tornado.gen.Return(reply)
+
+    @tornado.gen.coroutine
+    def __send_to_devices(self, rpc_list, encoded_request, handle, queues, locks, rpc_class,
+                          priority = RPCPriority.NORMAL, deadline = None):
+        """Send a request to every alpha in rpc_list and return the
+        decoded replies in the same order as rpc_list. encoded_request
+        may be a list with a different request for each alpha"""
+        if (not isinstance(encoded_request, list)):
+            encoded_request = [encoded_request] * len(rpc_list)
+
+        # always acquire in rpc_list order so pipelined requests on the
+        # same connection can't deadlock each other
+        device_locks = [self.__get_device_lock(locks, rpc) for rpc in rpc_list]
+        for lock in device_locks:
+            yield lock.acquire()
+
+        try:
+            if (len(rpc_list) == 1):
+                rpc = rpc_list[0]
+                queue = self.__get_device_queue(queues, rpc)
+
+                reply = yield self.__exchange_with_device(rpc, encoded_request[0], handle, queue, rpc_class,
+                                                          priority, deadline)
+
+                raise tornado.gen.Return([reply])
+
+            # scatter the request to all of the alphas at the same time so
+            # we only have to wait for the slowest alpha. The replies are
+            # keyed by their position in rpc_list so the callback always
+            # sees the replies in a deterministic order
+            replies = yield dict((device_index, self.__exchange_with_device(rpc, encoded_request[device_index],
+                                                                            handle,
+                                                                            self.__get_device_queue(queues, rpc),
+                                                                            rpc_class, priority, deadline))
+                                 for device_index, rpc in enumerate(rpc_list))
+
+            raise tornado.gen.Return([replies[device_index]
+                                      for device_index in xrange(len(rpc_list))])
+        finally:
+            for lock in device_locks:
+                lock.release()
+
+    @tornado.gen.coroutine
+    def __send_hedged(self, action, encoded_request, handle, queues, locks, priority, deadline):
+        """Send a request to its alpha and, if the reply is slower than
+        usual, run action.hedge on another alpha. Returns the first
+        successful reply in a list like __send_to_devices"""
+        rpc = action.rpc_list[0]
+        primary = self.__send_to_devices(action.rpc_list, encoded_request, handle, queues, locks,
+                                         action.rpc_class, priority, deadline)
+
+        delay = self.rpc_preprocessor.get_hedge_delay(rpc, action.rpc_class)
+        if (delay is None):
+            reply_list = yield primary
+            raise tornado.gen.Return(reply_list)
+
+        try:
+            reply_list = yield tornado.gen.with_timeout(datetime.timedelta(seconds = delay), primary,
+                                                        quiet_exceptions = Exception)
+        except tornado.gen.TimeoutError:
+            pass
+        else:
+            raise tornado.gen.Return(reply_list)
+
+        if (action.hedge.priority is None):
+            action.hedge.priority = priority
+            action.hedge.deadline = deadline
+
+        self.rpc_preprocessor.hedge_started(rpc)
+        hedge = self.__run_detached_action(action.hedge, handle, queues, locks)
+
+        waiter = tornado.gen.WaitIterator(primary, hedge)
+        while not waiter.done():
             try:
-                cryptech.muxd.logger.debug("RPC socket read, handle 0x%x", handle)
-                query = yield stream.read_until(cryptech.muxd.SLIP_END)
-                if len(query) < 9:
-                    continue
+                result = yield waiter.next()
+            except Exception as e:
+                cryptech.muxd.logger.info("Hedged request failed: %s", e)
+                continue
+
+            from_primary = (waiter.current_index == 0)
+            reply = result[0] if from_primary else result
+
+            if (reply is not None and rpc_schema.get_response_header(reply)[2] == DKS_HALError.HAL_OK):
+                if (from_primary):
+                    action.hedge.done(None)
+                else:
+                    self.rpc_preprocessor.hedge_won(rpc)
 
-                # get the old handle
-                decoded_query = cryptech.muxd.slip_decode(query)
-                old_handle = cryptech.muxd.client_handle_get(decoded_query)
+                raise tornado.gen.Return([reply])
 
-                # set the handle to be the handle of this stream handler
-                request = cryptech.muxd.client_handle_set(decoded_query, handle)
+        # neither alpha succeeded so use the first alpha's error
+        reply_list = yield primary
+        raise tornado.gen.Return(reply_list)
 
-                # the serial we use is decided on by the query(request), send non-slip encoded
-                action = self.rpc_preprocessor.process_incoming_rpc(request)
+    @tornado.gen.coroutine
+    def __read_query(self, stream, decoder, queries):
+        """Return the next decoded query from a connection. A single read
+        may complete several queries so the extra ones are kept in queries"""
+        while not queries:
+            data = yield stream.read_bytes(READ_CHUNK_SIZE, partial = True)
+            queries.extend(decoder.feed(data))
+
+        raise tornado.gen.Return(queries.popleft())
+
+    @tornado.gen.coroutine
+    def __run_action(self, action, request, handle, queues, locks):
+        """Send the requests from action to the alphas and pass the replies
+        to its callbacks until there's a result. Returns the final action
+        and the last request that was sent"""
+        # every request in the chain has the priority and deadline of the first
+        priority = action.priority if (action.priority is not None) else RPCPriority.NORMAL
+        deadline = action.deadline
+
+        # do we actually have a def
+        while ((self.rpc_preprocessor.device_count() > 0) and
+               (action.result is None) and
+               (action.rpc_list is not None or action.work is not None or
+                action.parallel is not None)):
+            if (action.parallel is not None):
+                for parallel_action in action.parallel:
+                    if (parallel_action.priority is None):
+                        parallel_action.priority = priority
+                        parallel_action.deadline = deadline
+
+                results = yield [self.__run_detached_action(parallel_action, handle, queues, locks)
+                                 for parallel_action in action.parallel]
+
+                action = action.callback(action, results)
+                continue
+
+            if (action.work is not None):
+                try:
+                    work_result = yield action.work
+                except Exception as e:
+                    cryptech.muxd.logger.info("Host work failed: %s", e)
+                    work_result = None
 
-                # the request may have been updated
+                action = action.callback(action, [work_result])
+                continue
+
+            # the request may have been updated
+            if (action.request is not None):
                 request = action.request
 
-                # do we actually have a def
-                while ((self.rpc_preprocessor.device_count() > 0) and
-                       (action.result is None) and
-                       (action.rpc_list is not None)):
-                    # slip encode a request to send to the HSM
-                    encoded_request = cryptech.muxd.slip_encode(request)
-
-                    # because we may send to multiple alphas, we need to save every reply
-                    reply_list = []
-
-                    for rpc in action.rpc_list:
-                        serial = rpc.serial
-                        # if the load balancer returns a serial to write to, then it wasn't able to handle te request with cached data
-                        try:
-                            yield serial.rpc_input(encoded_request, handle, queue)
-                        except Exception as e:
-                            yield self.try_restart_serial(rpc, encoded_request, handle, queue, e)
-
-                        cryptech.muxd.logger.debug("RPC queue wait, handle 0x%x", handle)
-                        reply = yield queue.get()
-                        if reply is None:
-                            raise cryptech.muxd.QueuedStreamClosedError()
+            # slip encode a request to send to the HSM
+            if (isinstance(request, list)):
+                encoded_request = [slip_encode(r) for r in request]
+                request = request[0]
+            else:
+                encoded_request = slip_encode(request)
+
+            # because we may send to multiple alphas, we need to save every reply
+            if (action.hedge is not None):
+                reply_list = yield self.__send_hedged(action, encoded_request,
+                                                      handle, queues, locks,
+                                                      priority, deadline)
+            else:
+                reply_list = yield self.__send_to_devices(action.rpc_list,
+                                                          encoded_request,
+                                                          handle, queues, locks,
+                                                          action.rpc_class,
+                                                          priority, deadline)
+
+            if(action.callback is not None):
+                # use the action callback to respond to data from multiple alphas
+                action = action.callback(action, reply_list)
+
+                self.__spawn_background_action(action, handle, queues, locks)
+            else:
+                # just use the first response
+                action = RPCAction(reply_list[0], None, None)
+
+        raise tornado.gen.Return((action, request))
+
+    @tornado.gen.coroutine
+    def __run_detached_action(self, action, handle, queues, locks):
+        """Run an action that doesn't belong to a query. Returns the
+        final result or None if there isn't one"""
+        try:
+            final_action, _ = yield self.__run_action(action, action.request, handle, queues, locks)
+            raise tornado.gen.Return(final_action.result)
+        except tornado.gen.Return:
+            raise
+        except Exception as e:
+            cryptech.muxd.logger.info("Detached action failed: %s", e)
+            raise tornado.gen.Return(None)
+
+    @tornado.gen.coroutine
+    def __run_background_action(self, action, handle, queues, locks):
+        """Run an action without holding up the connection. Its done
+        callback gets the result or None if there isn't one"""
+        result = yield self.__run_detached_action(action, handle, queues, locks)
+
+        if (action.done is not None):
+            action.done(result)
+
+    def __spawn_background_action(self, action, handle, queues, locks):
+        """Start the background work that belongs to action"""
+        if (action.background is not None):
+            tornado.ioloop.IOLoop.current().spawn_callback(self.__run_background_action,
+                                                           action.background,
+                                                           handle, queues, locks)
+
+    @tornado.gen.coroutine
+    def __process_query(self, decoded_query, handle, session, queues, locks):
+        """Process a single decoded query from a connection and return the
+        SLIP encoded reply"""
+        # get the old handle
+        old_handle = cryptech.muxd.client_handle_get(decoded_query)
+
+        # set the handle to be the handle of this stream handler
+        request = cryptech.muxd.client_handle_set(decoded_query, handle)
+
+        # the serial we use is decided on by the query(request), send non-slip encoded
+        action = self.rpc_preprocessor.process_incoming_rpc(request, session)
+
+        # work that continues after the reply has been sent
+        self.__spawn_background_action(action, handle, queues, locks)
+
+        action, request = yield self.__run_action(action, request, handle, queues, locks)
+
+        if(action.result is not None):
+            reply = action.result
+        else:
+            reply = self.error_from_request(request, DKS_HALError.HAL_ERROR_FORBIDDEN)
+
+        #set old handle in reply
+        raise tornado.gen.Return(slip_encode(cryptech.muxd.client_handle_set(reply, old_handle)))
+
+    @tornado.gen.coroutine
+    def __write_pipelined_replies(self, stream, handle, pending, slots):
+        """Write the replies for a pipelined connection in the order that
+        the requests were received"""
+        stream_open = True
+        while True:
+            item = yield pending.get()
+            if item is None:
+                return
+
+            query, future = item
+            try:
+                try:
+                    reply = yield future
+                except Exception as e:
+                    # the client still gets a reply so the order isn't lost
+                    cryptech.muxd.logger.info("RPC request failed, handle 0x%x: %s", handle, e)
+                    reply = slip_encode(self.error_from_request(query, DKS_HALError.HAL_ERROR_RPC_TRANSPORT))
+
+                if (stream_open):
+                    if (diagnostics.enabled):
                         cryptech.muxd.logger.debug("RPC socket write, handle 0x%x", handle)
+                    yield stream.write(reply)
+            except tornado.iostream.StreamClosedError:
+                # let the reader see that the connection is gone, but
+                # keep waiting on requests that are still on the alphas
+                stream.close()
+                stream_open = False
+            except Exception as e:
+                cryptech.muxd.logger.info("RPC write failed, handle 0x%x: %s", handle, e)
+                stream.close()
+                stream_open = False
+            finally:
+                slots.release()
 
-                        # TODO: remove - debugging only
-                        self.verify_result(reply)
+    @tornado.gen.coroutine
+    def __read_pipelined_queries(self, stream, handle, session, decoder, queries, queues, locks, depth):
+        """Read ahead up to 'depth' queries from a connection and process
+        them at the same time"""
+        slots = tornado.locks.Semaphore(depth)
+        pending = tornado.queues.Queue()
 
-                        # save the replies for the callback
-                        reply_list.append(cryptech.muxd.slip_decode(reply))
+        writer = self.__write_pipelined_replies(stream, handle, pending, slots)
 
-                    if(action.callback is not None):
-                        # use the action callback to respond to data from multiple alphas
-                        action = action.callback(reply_list)
-                    else:
-                        # just use the first response
-                        action = RPCAction(reply_list[0], None, None)
+        try:
+            while True:
+                yield slots.acquire()
 
-                if(action.result is not None):
-                    reply = action.result
-                else:
-                    reply = self.error_from_request(request, DKS_HALError.HAL_ERROR_FORBIDDEN)
+                if (diagnostics.enabled):
+                    cryptech.muxd.logger.debug("RPC socket read, handle 0x%x", handle)
+                query = yield self.__read_query(stream, decoder, queries)
+                if len(query) < 8:
+                    slots.release()
+                    continue
+
+                # queries are preprocessed in order before the first yield
+                # so the session always sees them in the order they arrived
+                pending.put((query, self.__process_query(query, handle, session, queues, locks)))
+        finally:
+            pending.put(None)
+            yield writer
+
+    @tornado.gen.coroutine
+    def __handle_stream(self, stream, address, from_ethernet):
+        "Handle one network connection."
+        handle = self.next_client_handle()
+        queues = {}
+        locks = {}
+        decoder = SLIPDecoder()
+        queries = collections.deque()
+        cryptech.muxd.logger.info("RPC connected %r, handle 0x%x", stream, handle)
+
+        # the session is passed with every query so the preprocessor
+        # doesn't have to look it up
+        session = self.rpc_preprocessor.create_session(handle, from_ethernet)
+
+        depth = self.rpc_preprocessor.get_pipeline_depth()
+
+        while True:
+            try:
+                if (depth > 1):
+                    # runs until the connection is closed
+                    yield self.__read_pipelined_queries(stream, handle, session, decoder,
+                                                        queries, queues, locks, depth)
+                    continue
+
+                if (diagnostics.enabled):
+                    cryptech.muxd.logger.debug("RPC socket read, handle 0x%x", handle)
+                query = yield self.__read_query(stream, decoder, queries)
+                if len(query) < 8:
+                    continue
 
-                #set old handle in reply
-                reply_old_handle_encoded = cryptech.muxd.slip_encode(cryptech.muxd.client_handle_set(reply, old_handle))
+                reply_old_handle_encoded = yield self.__process_query(query, handle, session,
+                                                                      queues, locks)
 
-                yield stream.write(cryptech.muxd.SLIP_END + reply_old_handle_encoded)
+                yield stream.write(reply_old_handle_encoded)
 
             except tornado.iostream.StreamClosedError:
                 cryptech.muxd.logger.info("RPC closing %r, handle 0x%x", stream, handle)
@@ -283,12 +771,18 @@ class RPCTCPServer(TCPServer):
                 self.rpc_preprocessor.delete_session(handle)
 
                 # log out
-                query = cryptech.muxd.slip_encode(cryptech.muxd.client_handle_set(cryptech.muxd.logout_msg, handle))
+                query = slip_encode(cryptech.muxd.client_handle_set(cryptech.muxd.logout_msg, handle))
 
                 rpc_serials = self.rpc_preprocessor.make_all_rpc_list()
                 for rpc in rpc_serials:
                     serial = rpc.serial
-                    yield serial.rpc_input(query, handle)
+                    try:
+                        yield serial.rpc_input(query, handle)
+                    except DeviceBusy:
+                        cryptech.muxd.logger.info("Unable to log out handle 0x%x on busy %s", handle, rpc.name)
+                    except Exception as e:
+                        # the alpha's supervisor will reconnect it
+                        self.rpc_preprocessor.device_failed(rpc, 'serial error: %s' % e)
                     
                 return
 
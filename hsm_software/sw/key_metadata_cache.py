@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import collections
+import threading
+
+from hsm_tools import rpc_schema
+from hsm_tools.cryptech_port import DKS_RPCFunc, DKS_HALError
+
+# estimate of the memory used by an entry, not counting the value
+ENTRY_OVERHEAD = 128
+
+
+class LRUCache(object):
+    """Thread-safe least recently used cache that is limited to a
+    number of bytes. Keys are (group, item) pairs so every item in a
+    group can be removed at once"""
+    def __init__(self, budget):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.groups = {}
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, group, item):
+        """Returns the value or None if it's not in the cache"""
+        key = (group, item)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if (entry is None):
+                self.misses += 1
+                return None
+
+            # move to the most recently used end
+            self.entries[key] = entry
+            self.hits += 1
+
+            return entry[0]
+
+    def put(self, group, item, value, size):
+        key = (group, item)
+        size += ENTRY_OVERHEAD
+        with self.lock:
+            self.__remove(key)
+
+            if (size > self.budget):
+                return
+
+            self.entries[key] = (value, size)
+            self.groups.setdefault(group, set()).add(item)
+            self.size += size
+
+            while (self.size > self.budget):
+                self.__remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, group, item):
+        with self.lock:
+            self.__remove((group, item))
+
+    def remove_group(self, group):
+        with self.lock:
+            for item in list(self.groups.get(group, ())):
+                self.__remove((group, item))
+
+    def set_budget(self, budget):
+        with self.lock:
+            self.budget = budget
+
+            while (self.size > self.budget):
+                self.__remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.groups.clear()
+            self.size = 0
+
+    def get_status(self):
+        with self.lock:
+            return ('%i entries, %i of %i bytes, %i hits, %i misses, %i evictions' %
+                    (len(self.entries), self.size, self.budget,
+                     self.hits, self.misses, self.evictions))
+
+    def __remove(self, key):
+        """Must be called with the lock held"""
+        entry = self.entries.pop(key, None)
+        if (entry is None):
+            return
+
+        self.size -= entry[1]
+
+        group, item = key
+        items = self.groups[group]
+        items.discard(item)
+        if (not items):
+            del self.groups[group]
+
+
+class KeyMetadataCache(object):
+    """Replies to the RPCs that return information about a key that
+    never changes. Entries are filled from the first reply from the
+    alpha and are kept by device uuid until the key is deleted"""
+
+    CACHED_CODES = (DKS_RPCFunc.RPC_FUNC_PKEY_GET_KEY_TYPE,
+                    DKS_RPCFunc.RPC_FUNC_PKEY_GET_KEY_CURVE,
+                    DKS_RPCFunc.RPC_FUNC_PKEY_GET_KEY_FLAGS,
+                    DKS_RPCFunc.RPC_FUNC_PKEY_GET_PUBLIC_KEY_LEN,
+                    DKS_RPCFunc.RPC_FUNC_PKEY_GET_PUBLIC_KEY)
+
+    def __init__(self, budget):
+        self.cache = LRUCache(budget)
+
+    def get_reply(self, rpc_index, device_uuid, request):
+        """Returns the reply to the request or None if the alpha must be
+        asked"""
+        code, client = rpc_schema.get_header(request)
+
+        payload = self.cache.get((rpc_index, device_uuid), code)
+        if (payload is None):
+            return None
+
+        reply = rpc_schema.payload_response(code, client, payload)
+
+        # the alpha will return an error if the buffer is too small
+        if (code == DKS_RPCFunc.RPC_FUNC_PKEY_GET_PUBLIC_KEY):
+            length = rpc_schema.REQUESTS[code].get(request, 'length')
+            if (len(rpc_schema.RESPONSES[code].get(reply, 'der')) > length):
+                return None
+
+        return reply
+
+    def get_public_key(self, rpc_index, device_uuid):
+        """Returns the DER encoded public key or None if it isn't cached"""
+        code = DKS_RPCFunc.RPC_FUNC_PKEY_GET_PUBLIC_KEY
+
+        payload = self.cache.get((rpc_index, device_uuid), code)
+        if (payload is None):
+            return None
+
+        return rpc_schema.RESPONSES[code].get(rpc_schema.payload_response(code, 0, payload), 'der')
+
+    def add_reply(self, rpc_index, device_uuid, reply):
+        code, _, status = rpc_schema.get_response_header(reply)
+        if (status != DKS_HALError.HAL_OK or code not in self.CACHED_CODES):
+            return
+
+        payload = rpc_schema.get_response_payload(reply)
+        self.cache.put((rpc_index, device_uuid), code, payload, len(payload))
+
+    def remove_key(self, rpc_index, device_uuid):
+        self.cache.remove_group((rpc_index, device_uuid))
+
+    def set_budget(self, budget):
+        self.cache.set_budget(budget)
+
+    def clear(self):
+        self.cache.clear()
+
+    def get_status(self):
+        return self.cache.get_status()
+
+
+# markers for attributes that a key doesn't have. The alpha either
+# fails the request or sends NIL in place of the value
+NOT_FOUND_ERROR = object()
+NOT_FOUND_NIL = object()
+
+
+class AttributeCache(object):
+    """Write-through cache of PKEY_GET_ATTRIBUTES results by device uuid
+    and attribute type. Attributes that a key doesn't have are also
+    cached"""
+
+    def __init__(self, budget):
+        self.cache = LRUCache(budget)
+
+    def get_reply(self, rpc_index, device_uuid, request):
+        """Returns the reply to a GET_ATTRIBUTES request or None if any
+        of the attributes aren't cached"""
+        code, client = rpc_schema.get_header(request)
+        fields = rpc_schema.REQUESTS[code].decode(request)
+        group = (rpc_index, device_uuid)
+
+        values = []
+        for attr_type in fields['types']:
+            value = self.cache.get(group, attr_type)
+            if (value is None):
+                return None
+            values.append(value)
+
+        if (any(value is NOT_FOUND_ERROR for value in values)):
+            return rpc_schema.error_response(code, client, DKS_HALError.HAL_ERROR_ATTRIBUTE_NOT_FOUND)
+
+        if (fields['buffer_len'] == 0):
+            # the client only wants the length of each attribute
+            payload = rpc_schema.encode_attribute_lengths([(attr_type, None if value is NOT_FOUND_NIL else len(value))
+                                                           for attr_type, value in zip(fields['types'], values)])
+        else:
+            found = [value for value in values if value is not NOT_FOUND_NIL]
+            if (sum(len(value) for value in found) > fields['buffer_len']):
+                # let the alpha report that the buffer is too small
+                return None
+
+            payload = rpc_schema.encode_attributes([(attr_type, None if value is NOT_FOUND_NIL else value)
+                                                    for attr_type, value in zip(fields['types'], values)])
+
+        return rpc_schema.payload_response(code, client, payload)
+
+    def add_reply(self, rpc_index, device_uuid, request, reply):
+        """Save the attributes from a GET_ATTRIBUTES reply"""
+        code, _, status = rpc_schema.get_response_header(reply)
+        fields = rpc_schema.REQUESTS[code].decode(request)
+        group = (rpc_index, device_uuid)
+
+        if (status == DKS_HALError.HAL_ERROR_ATTRIBUTE_NOT_FOUND):
+            # only a single attribute tells us which one is missing
+            if (len(fields['types']) == 1):
+                self.cache.put(group, fields['types'][0], NOT_FOUND_ERROR, 0)
+            return
+
+        # when buffer_len is 0 the reply only has the lengths
+        if (status != DKS_HALError.HAL_OK or fields['buffer_len'] == 0):
+            return
+
+        attributes = rpc_schema.decode_attributes(rpc_schema.get_response_payload(reply))
+        for attr_type, value in attributes:
+            if (value is None):
+                self.cache.put(group, attr_type, NOT_FOUND_NIL, 0)
+            else:
+                self.cache.put(group, attr_type, value, len(value))
+
+    def set_attributes(self, rpc_index, device_uuid, attributes, success):
+        """Update the cache after PKEY_SET_ATTRIBUTES. A value of None
+        deletes the attribute"""
+        group = (rpc_index, device_uuid)
+        for attr_type, value in attributes:
+            if (success and value is not None):
+                self.cache.put(group, attr_type, value, len(value))
+            else:
+                self.cache.remove(group, attr_type)
+
+    def remove_key(self, rpc_index, device_uuid):
+        self.cache.remove_group((rpc_index, device_uuid))
+
+    def set_budget(self, budget):
+        self.cache.set_budget(budget)
+
+    def clear(self):
+        self.cache.clear()
+
+    def get_status(self):
+        return self.cache.get_status()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import collections
+import threading
+import time
+
+from hsm_tools import rpc_schema
+from hsm_tools.cryptech_port import DKS_RPCFunc, DKS_HALKeyType, DKS_HALCurve, DKS_HALKeyFlag
+
+# libhal clients always use F4
+RSA_EXPONENT = '\x01\x00\x01'
+
+_CURVE_NAMES = {
+    'P-256' : DKS_HALCurve.HAL_CURVE_P256,
+    'P-384' : DKS_HALCurve.HAL_CURVE_P384,
+    'P-521' : DKS_HALCurve.HAL_CURVE_P521,
+}
+
+
+class KeygenProfile(collections.namedtuple('KeygenProfile', ['code', 'size', 'flags'])):
+    """A kind of key that the pool keeps ready. size is the RSA key
+    length in bits or the EC curve"""
+
+    @staticmethod
+    def parse(text):
+        """Returns the profile for 'rsa:<bits>:<flags>' or
+        'ec:<curve>:<flags>'. Raises ValueError if text is invalid"""
+        parts = text.strip().split(':')
+        if (len(parts) != 3):
+            raise ValueError('"%s" is not <type>:<size or curve>:<flags>' % text)
+
+        keytype, size, flags = parts
+        flags = int(flags, 0)
+
+        # session keys belong to the client that made them
+        if ((flags & DKS_HALKeyFlag.HAL_KEY_FLAG_TOKEN) == 0):
+            raise ValueError('Keys in the keygen pool must have the token flag (0x%x)' %
+                             DKS_HALKeyFlag.HAL_KEY_FLAG_TOKEN)
+
+        if (keytype.lower() == 'rsa'):
+            return KeygenProfile(DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_RSA, int(size), flags)
+        elif (keytype.lower() == 'ec'):
+            curve = _CURVE_NAMES.get(size.upper())
+            if (curve is None):
+                raise ValueError('Unknown curve "%s". Expected %s' % (size, ', '.join(sorted(_CURVE_NAMES))))
+
+            return KeygenProfile(DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_EC, int(curve), flags)
+
+        raise ValueError('Unknown key type "%s". Expected rsa or ec' % keytype)
+
+    @staticmethod
+    def from_request(code, request):
+        """Returns the profile of a keygen request or None if the pool
+        can't be used for it"""
+        fields = rpc_schema.REQUESTS[code].decode(request)
+
+        if (code == DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_RSA):
+            if (fields['exponent'] != RSA_EXPONENT):
+                return None
+
+            return KeygenProfile(code, fields['keylen'], fields['flags'])
+        elif (code == DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_EC):
+            return KeygenProfile(code, fields['curve'], fields['flags'])
+
+        return None
+
+    @property
+    def keytype(self):
+        if (self.code == DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_RSA):
+            return DKS_HALKeyType.HAL_KEY_TYPE_RSA_PRIVATE
+
+        return DKS_HALKeyType.HAL_KEY_TYPE_EC_PRIVATE
+
+    @property
+    def curve(self):
+        return self.size if (self.code == DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_EC) else 0
+
+    def generate_request(self, client):
+        """Returns a request that makes a key for this profile"""
+        if (self.code == DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_RSA):
+            return rpc_schema.REQUESTS[self.code].encode(self.code, client, 0, self.size, RSA_EXPONENT, self.flags)
+
+        return rpc_schema.REQUESTS[self.code].encode(self.code, client, 0, self.size, self.flags)
+
+    def __str__(self):
+        if (self.code == DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_RSA):
+            return 'rsa:%i:0x%x' % (self.size, self.flags)
+
+        names = dict((curve, name) for name, curve in _CURVE_NAMES.iteritems())
+        return 'ec:%s:0x%x' % (names.get(self.size, str(self.size)), self.flags)
+
+
+class KeygenPool(object):
+    """Thread-safe list of keys that were made on the alphas before a
+    client asked for them"""
+
+    def __init__(self, profiles, depth):
+        self.lock = threading.Lock()
+        self.profiles = profiles
+        self.depth = depth
+        self.keys = collections.defaultdict(list)
+        self.last_refill = 0.0
+        self.handed_out = 0
+        self.misses = 0
+
+    def set_profiles(self, profiles, depth):
+        with self.lock:
+            self.profiles = profiles
+            self.depth = depth
+
+    def is_enabled(self):
+        with self.lock:
+            return len(self.profiles) > 0 and self.depth > 0
+
+    def add_key(self, profile, rpc_index, uuid):
+        with self.lock:
+            self.keys[profile].append((rpc_index, uuid))
+
+    def take(self, profile):
+        """Returns the (rpc_index, uuid) of a key for profile or None"""
+        with self.lock:
+            keys = self.keys.get(profile)
+            if (not keys):
+                self.misses += 1
+                return None
+
+            self.handed_out += 1
+            return keys.pop(0)
+
+    def next_refill(self, idle_devices, interval, now = None):
+        """Returns the (profile, rpc_index) of the next key to make or
+        None. Keys are spread over the alphas"""
+        if (now is None):
+            now = time.time()
+
+        with self.lock:
+            if (not idle_devices or now - self.last_refill < interval):
+                return None
+
+            needed = [profile for profile in self.profiles if len(self.keys[profile]) < self.depth]
+            if (not needed):
+                return None
+
+            profile = min(needed, key = lambda p: len(self.keys[p]))
+
+            counts = collections.Counter(rpc_index for rpc_index, _ in self.keys[profile])
+            rpc_index = min(idle_devices, key = lambda i: counts[i])
+
+            self.last_refill = now
+
+            return (profile, rpc_index)
+
+    def get_status(self):
+        with self.lock:
+            lines = ['%i keys handed out, %i misses' % (self.handed_out, self.misses)]
+
+            for profile in sorted(set(self.profiles) | set(self.keys), key = str):
+                counts = collections.Counter(rpc_index for rpc_index, _ in self.keys[profile])
+                devices = ', '.join('RPC%i: %i' % (rpc_index, count) for rpc_index, count in sorted(counts.items()))
+                lines.append('%s - %i of %i ready%s' % (str(profile), len(self.keys[profile]),
+                                                        self.depth if profile in self.profiles else 0,
+                                                        ' (%s)' % devices if devices else ''))
+
+        return '\r\n'.join(lines)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import threading
+
+# largest GET_RANDOM request that is sent to a single alpha
+RANDOM_CHUNK_SIZE = 4096
+
+
+class RandomPool(object):
+    """Thread-safe ring buffer of random bytes from the alphas. Bytes
+    are zeroed as soon as they are taken so each byte is only given
+    out once"""
+
+    def __init__(self, size, low_water):
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.refilling = True
+        self.served = 0
+        self.misses = 0
+        self.__allocate(size, low_water)
+
+    def __allocate(self, size, low_water):
+        """Must be called with the lock held or from __init__"""
+        self.buffer = bytearray(size)
+        self.start = 0
+        self.count = 0
+        self.low_water = min(low_water, size)
+
+    def __zero(self, start, length):
+        """Must be called with the lock held"""
+        for offset, part_length in self.__parts(start, length):
+            self.buffer[offset:offset + part_length] = bytearray(part_length)
+
+    def __parts(self, start, length):
+        """Splits a section of the ring into (offset, length) pieces
+        that don't wrap"""
+        size = len(self.buffer)
+        first = min(length, size - start)
+        parts = [(start, first)]
+        if (first < length):
+            parts.append((0, length - first))
+
+        return parts
+
+    def resize(self, size, low_water):
+        with self.lock:
+            self.__zero(0, len(self.buffer))
+            self.__allocate(size, low_water)
+            self.generation += 1
+
+    def get_generation(self):
+        """Returned with a refill so bytes requested before a wipe are
+        never added"""
+        with self.lock:
+            return self.generation
+
+    def space(self):
+        with self.lock:
+            return len(self.buffer) - self.count
+
+    def needs_refill(self):
+        """The pool is refilled once it drops below the low-water mark
+        and stays that way until it's full"""
+        with self.lock:
+            if (self.count < self.low_water):
+                self.refilling = True
+            elif (self.count >= len(self.buffer)):
+                self.refilling = False
+
+            return self.refilling and len(self.buffer) > 0
+
+    def add(self, data, generation):
+        """Add random bytes. Returns the number of bytes used"""
+        with self.lock:
+            if (generation != self.generation or len(self.buffer) == 0):
+                return 0
+
+            size = len(self.buffer)
+            length = min(len(data), size - self.count)
+
+            position = 0
+            for offset, part_length in self.__parts((self.start + self.count) % size, length):
+                self.buffer[offset:offset + part_length] = data[position:position + part_length]
+                position += part_length
+
+            self.count += length
+
+            return length
+
+    def take(self, length):
+        """Returns length random bytes or None if the pool doesn't have
+        enough"""
+        with self.lock:
+            if (length > self.count or length == 0):
+                self.misses += 1
+                return None
+
+            parts = self.__parts(self.start, length)
+            data = b''.join(bytes(self.buffer[offset:offset + part_length])
+                            for offset, part_length in parts)
+
+            self.__zero(self.start, length)
+            self.start = (self.start + length) % len(self.buffer)
+            self.count -= length
+            self.served += length
+
+            return data
+
+    def wipe(self):
+        """Zero every byte in the pool. Refills that were already
+        requested are dropped"""
+        with self.lock:
+            self.__zero(0, len(self.buffer))
+            self.start = 0
+            self.count = 0
+            self.generation += 1
+
+    def get_status(self):
+        with self.lock:
+            return ('%i of %i bytes, low-water %i, %i bytes served, %i misses' %
+                    (self.count, len(self.buffer), self.low_water,
+                     self.served, self.misses))
@@ -28,7 +28,6 @@
 # NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import xdrlib
 from uuid import UUID
 
 import enum
@@ -37,6 +36,9 @@ import enum
 # cryptech_muxd has been renamed to cryptech/muxd.py
 import hsm_tools.cryptech.muxd
 
+from hsm_tools import rpc_schema
+from hsm_tools.cryptech_port import DKS_RPCFunc
+
 
 class KeyMatchResult:
     def __init__(self):
@@ -47,129 +49,74 @@ class KeyMatchResult:
         self.uuid_list = []
 
     def build_result_packet(self, result_max):
-        # generate complete response
-        response = xdrlib.Packer()
-        response.pack_uint(self.code)
-        response.pack_uint(self.client)
-        response.pack_uint(self.result)
-        response.pack_uint(self.session)
-
-        # don't return more than the max
-        count = len(self.uuid_list)
-        if(count > result_max): count = result_max
-    
-        response.pack_uint(count)
-        for i in xrange(count):
-            response.pack_bytes(self.uuid_list[i].bytes)
-
-        return response.get_buffer()
+        # generate complete response, but don't return more than the max
+        return rpc_schema.RESPONSES[DKS_RPCFunc.RPC_FUNC_PKEY_MATCH].encode(self.code,
+                                                                          self.client,
+                                                                          self.result,
+                                                                          self.session,
+                                                                          self.uuid_list[:result_max])
 
 
 class KeyMatchDetails:
     none_uuid = UUID(int = 0)
 
+    schema = rpc_schema.REQUESTS[DKS_RPCFunc.RPC_FUNC_PKEY_MATCH]
+
+    # number of uuids to request from an alpha at a time
+    page_size = 64
+
     def __init__(self):
         self.result_max = 0
         self.uuid = KeyMatchDetails.none_uuid
         self.result = KeyMatchResult()
-        self.rpc_index = 0
-
-    def unpack(self, unpacker):
-        # consume pkcs11 session id
-        self.session = unpacker.unpack_uint()
+        self.rpc_indexes = []
 
-        # consume type
-        self.type = unpacker.unpack_uint()
+        # state of the search on each alpha. cursors has the last device
+        # uuid seen on each alpha and found_uuids has the master uuids
+        # found on each alpha in the order the alpha returned them
+        self.cursors = {}
+        self.found_uuids = {}
 
-        # consume curve
-        self.curve = unpacker.unpack_uint()
+    def unpack(self, request):
+        # keep the original request so only the uuid needs to be rewritten
+        self.request = bytearray(request)
 
-        # consume mask
-        self.mask = unpacker.unpack_uint()
+        fields = self.schema.decode(request)
 
-        # consume flags
-        self.flags = unpacker.unpack_uint()
-
-        # consume attributes
-        self.attr_len = unpacker.unpack_uint()
-        self.attr = []
-        for i in xrange(self.attr_len):
-            self.attr.append((unpacker.unpack_uint(), unpacker.unpack_bytes()))
-
-        # consume status
-        self.status = unpacker.unpack_uint()
+        self.session = fields['session']
+        self.type = fields['type']
+        self.curve = fields['curve']
+        self.mask = fields['mask']
+        self.flags = fields['flags']
+        self.attr = fields['attributes']
+        self.attr_len = len(self.attr)
+        self.status = fields['state']
 
         # max uuid's requested
-        self.result_max = unpacker.unpack_uint()
+        self.result_max = fields['result_max']
 
         #get the new uuid
-        self.uuid = UUID(bytes = unpacker.unpack_bytes())
-
-    def repack(self, code, client):
-        # generate complete response
-        response = xdrlib.Packer()
-        response.pack_uint(code)
-        response.pack_uint(client)
-
-        # repack altered data
-        response.pack_uint(self.session)
-
-        # consume type
-        response.pack_uint(self.type)
+        self.uuid = fields['uuid']
 
-        # consume curve
-        response.pack_uint(self.curve)
+    def repack(self, code, client, uuid = None, result_max = None):
+        # only the client, uuid, and result_max can change
+        rpc_schema.set_client(self.request, client)
+        self.schema.set(self.request, 'uuid', self.uuid if uuid is None else uuid)
 
-        # consume mask
-        response.pack_uint(self.mask)
-
-        # consume flags
-        response.pack_uint(self.flags)
-
-        # consume attributes
-        response.pack_uint(self.attr_len)
-        for i in xrange(self.attr_len):
-            response.pack_uint(self.attr[i][0])
-            response.pack_bytes(self.attr[i][1])
-
-        # consume status
-        response.pack_uint(self.status)
-
-        # max uuid's requested
-        response.pack_uint(self.result_max)
-
-        #get the new uuid
-        response.pack_bytes(self.uuid.bytes)
+        if (result_max is not None):
+            self.schema.set(self.request, 'result_max', result_max)
 
         # return the buffer
-        return response.get_buffer()
+        return bytes(self.request)
 
 class RPCpkey_open:
     @staticmethod
     def create(code, client, session, uuid):
         # generate complete response
-        response = xdrlib.Packer()
-        response.pack_uint(code)
-        response.pack_uint(client)
-
-        # repack altered data
-        response.pack_uint(session)
-
-        response.pack_bytes(uuid.bytes)
-
-        # return the buffer
-        return response.get_buffer()
+        return rpc_schema.REQUESTS[code].encode(code, client, session, uuid)
 
 class RPCKeygen_result:
     @staticmethod
     def create(code, client, result, handle, uuid):
         # generate complete response
-        response = xdrlib.Packer()
-        response.pack_uint(code)
-        response.pack_uint(client)
-        response.pack_uint(result)
-        response.pack_uint(handle)
-        response.pack_bytes(uuid.bytes)
-
-        # return the buffer
-        return response.get_buffer()
+        return rpc_schema.RESPONSES[code].encode(code, client, result, handle, uuid)
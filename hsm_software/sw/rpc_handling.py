@@ -28,12 +28,13 @@
 # NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import struct
-
+import time
 import threading
 
 from uuid import UUID
 
+from concurrent.futures import Future
+
 # import classes from the original cryptech.muxd
 # cryptech_muxd has been renamed to cryptech/muxd.py
 from hsm_tools.cryptech.muxd import logger
@@ -42,39 +43,251 @@ from hsm_tools.hsm import CrypTechDeviceState
 
 from settings import HSMSettings
 
-from hsm_tools.cryptech.cryptech.libhal import ContextManagedUnpacker, xdrlib
-from hsm_tools.rpc_action import RPCAction
+from hsm_tools.cryptech.cryptech.libhal import ContextManagedUnpacker
+from hsm_tools.rpc_action import RPCAction, RPCPriority
+from hsm_tools import rpc_schema
 from hsm_tools.cryptech_port import DKS_RPCFunc, DKS_HALKeyType,\
-                                    DKS_HALKeyFlag, DKS_HALError
+                                    DKS_HALKeyFlag, DKS_HALError, DKS_HALUser,\
+                                    DKS_KeygenJobState
 from hsm_tools.threadsafevar import ThreadSafeVariable
 
 from rpc_builder import KeyMatchDetails, RPCpkey_open, RPCKeygen_result
 
-from load_distribution import LoadDistribution
+from device_scheduler import DeviceScheduler, RPCClass, get_rpc_class
+from device_supervisor import DeviceHealthMonitor
+from key_metadata_cache import KeyMetadataCache, AttributeCache
+from random_pool import RandomPool, RANDOM_CHUNK_SIZE
+from host_hash import HostHash, HOST_HASH_ALGORITHMS, HOST_HASH_HANDLE_FLAG, is_host_hash_handle
+from host_verify import VerifyEngine, parse_public_key, can_verify
+from keygen_pool import KeygenPool, KeygenProfile
+
+# largest HASH_UPDATE an alpha can take. HAL_RPC_MAX_PKT_SIZE less the
+# code, client, handle, and data length
+MAX_HASH_UPDATE_SIZE = 16384 - 16
+
+# priority of new sessions. Internal connections are from the synchronizer
+# and other bulk work
+ETHERNET_SESSION_PRIORITY = RPCPriority.NORMAL
+INTERNAL_SESSION_PRIORITY = RPCPriority.BULK
 
+# number of keygen jobs a session can have at once
+MAX_KEYGEN_JOBS = 64
 
-def rpc_get_int(msg, location):
-    "Get an int from a location in an RPC message"
-    return struct.unpack(">L", msg[location:location+4])[0]
+KEYGEN_JOB_CODES = (DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_RSA,
+                    DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_EC,
+                    DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_HASHSIG)
 
+# requests that get a valid answer from any alpha with a copy of the key
+# and may be repeated on another alpha when the first one is slow. The
+# request is repeated once it's taken longer than HEDGE_PERCENTILE of
+# the recent requests to the alpha
+HEDGE_CODES = (DKS_RPCFunc.RPC_FUNC_PKEY_SIGN,
+               DKS_RPCFunc.RPC_FUNC_PKEY_VERIFY)
 
-def rpc_set_int(msg, data, location):
-    "Set an int from a location in an RPC message"
-    return msg[:location] + struct.pack(">L", data) + msg[location+4:]
+HEDGE_PERCENTILE = 0.95
+
+# longest wait between attempts to reconnect an alpha if the setting is invalid
+RECONNECT_MAX_DELAY = 60.0
+
+# requests a session can still make after an alpha has forgotten its login
+LOGIN_CODES = (DKS_RPCFunc.RPC_FUNC_LOGIN,
+               DKS_RPCFunc.RPC_FUNC_LOGOUT,
+               DKS_RPCFunc.RPC_FUNC_LOGOUT_ALL,
+               DKS_RPCFunc.RPC_FUNC_IS_LOGGED_IN)
+
+# key and hash handles given to clients. Handles with the high bit set
+# are hashes on the host and 0 means no handle
+MAX_SESSION_HANDLE = HOST_HASH_HANDLE_FLAG - 1
 
 
 class KeyHandleDetails:
     """Information on the key that a handle points to"""
-    def __init__(self, rpc_index, uuid):
+    def __init__(self, rpc_index, uuid, device_handle, keytype = None, session_param = None, master_uuid = None):
         self.rpc_index = rpc_index
         self.uuid = uuid
+        self.keytype = keytype
+
+        # the key's handle on the alpha. The client is given a handle
+        # from the session instead
+        self.device_handle = device_handle
+
+        # the pkcs11 session and master uuid the key was opened with.
+        # Needed to open the key on another alpha
+        self.session_param = session_param
+        self.master_uuid = master_uuid
+
+
+class HashHandleDetails:
+    """The alpha and alpha handle that a hash handle points to"""
+    def __init__(self, rpc_index, device_handle):
+        self.rpc_index = rpc_index
+        self.device_handle = device_handle
 
 
 class KeyOperationData:
-    def __init__(self, rpc_index, handle, uuid):
+    def __init__(self, rpc_index, handle, uuid, pkey_type = None, flags = None, curve = None,
+                 session_param = None, master_uuid = None):
         self.rpc_index = rpc_index
         self.handle = handle
         self.device_uuid = uuid
+        self.pkey_type = pkey_type
+        self.flags = flags
+        self.curve = curve
+        self.session_param = session_param
+        self.master_uuid = master_uuid
+
+
+class RandomOperationData:
+    """Random bytes that are being collected from several alphas"""
+    def __init__(self, length, generation = None):
+        self.remaining = length
+        self.generation = generation
+        self.data = []
+
+
+class HashUpdateBuffer:
+    """Small HASH_UPDATEs that haven't been sent to the alpha yet"""
+    def __init__(self):
+        self.data = []
+        self.length = 0
+
+    def append(self, data):
+        self.data.append(data)
+        self.length += len(data)
+
+    def take(self):
+        data = b''.join(self.data)
+        self.data = []
+        self.length = 0
+
+        return data
+
+
+class HashFlushData:
+    """A request that must wait for buffered HASH_UPDATEs to be sent"""
+    def __init__(self, rpc_index, request, rpc_class = None):
+        self.rpc_index = rpc_index
+        self.request = request
+        self.rpc_class = rpc_class
+        self.error = None
+
+
+class HostVerifyData:
+    """A PKEY_VERIFY that is being checked on the host"""
+    def __init__(self, rpc_index, request):
+        self.rpc_index = rpc_index
+        self.request = request
+
+
+class KeygenPoolData:
+    """A key that is being made for the keygen pool"""
+    def __init__(self, rpc_index, profile):
+        self.rpc_index = rpc_index
+        self.profile = profile
+        self.handle = None
+        self.device_uuid = None
+
+
+class KeygenJob:
+    """A key that's being generated while the client does other work"""
+    def __init__(self, rpc_index):
+        self.rpc_index = rpc_index
+        self.state = DKS_KeygenJobState.KEYGEN_JOB_RUNNING
+
+        # the PKEY_GENERATE reply or error response
+        self.reply = None
+
+        # resolved with the job when it's finished
+        self.future = Future()
+
+    def is_running(self):
+        return self.state == DKS_KeygenJobState.KEYGEN_JOB_RUNNING
+
+    def finish(self, reply):
+        """reply is None if the key couldn't be generated"""
+        if (reply is not None and rpc_schema.get_response_header(reply)[2] == DKS_HALError.HAL_OK):
+            self.state = DKS_KeygenJobState.KEYGEN_JOB_DONE
+        else:
+            self.state = DKS_KeygenJobState.KEYGEN_JOB_FAILED
+
+        self.reply = reply
+        self.future.set_result(self)
+
+
+class SignBatchData:
+    """A PKEY_SIGN_BATCH that's shared by the alphas with the key"""
+    def __init__(self, code, client, length, digests, keytype):
+        self.code = code
+        self.client = client
+        self.length = length
+        self.digests = digests
+        self.keytype = keytype
+        self.signatures = [None] * len(digests)
+        self.next_digest = 0
+        self.status = DKS_HALError.HAL_OK
+
+        # alphas that were asked to open the key and the
+        # (rpc_index, handle) of the ones that did
+        self.rpc_indexes = []
+        self.handles = []
+
+    def take(self):
+        """Returns the index of the next digest to sign or None"""
+        if (self.status != DKS_HALError.HAL_OK or self.next_digest >= len(self.digests)):
+            return None
+
+        self.next_digest += 1
+        return self.next_digest - 1
+
+
+class SignBatchSlot:
+    """A digest from a SignBatchData that an alpha is signing"""
+    def __init__(self, batch, rpc_index, handle, index):
+        self.batch = batch
+        self.rpc_index = rpc_index
+        self.handle = handle
+        self.index = index
+
+
+class HedgeData:
+    """A key operation that's repeated on another alpha with a copy of
+    the key because the first alpha is slow"""
+    def __init__(self, code, client, rpc_index, request, rpc_class):
+        self.code = code
+        self.client = client
+        self.rpc_index = rpc_index
+        self.request = request
+        self.rpc_class = rpc_class
+
+        # handle of the key on the other alpha
+        self.handle = None
+
+        # True when the first alpha answered before the other alpha
+        # started on the request
+        self.cancelled = False
+
+    def cancel(self, result):
+        self.cancelled = True
+
+
+class FailoverData:
+    """A key handle that's being moved to another alpha because its
+    alpha has stopped working"""
+    def __init__(self, handle, key_details, rpc_index, device_uuid, request):
+        self.handle = handle
+        self.key_details = key_details
+        self.old_rpc_index = key_details.rpc_index
+        self.rpc_index = rpc_index
+        self.device_uuid = device_uuid
+
+        # the request that's repeated once the key is open
+        self.request = request
+
+
+class HashOperationData:
+    """Information on a hash operation that is being started"""
+    def __init__(self, rpc_index):
+        self.rpc_index = rpc_index
 
 
 class MuxSession:
@@ -100,17 +313,42 @@ class MuxSession:
         # the current rpc_index to use for this session
         self.rpc_index = rpc_index
 
-        # the index of the rpc that is being used for the
-        # initializing hash op
-        self.cur_hashing_index = 0
+        # requests wait for the alphas in priority order and fail if
+        # they haven't been sent after deadline seconds. None = no deadline
+        self.priority = ETHERNET_SESSION_PRIORITY if from_ethernet else INTERNAL_SESSION_PRIORITY
+        self.deadline = None
+
+        # true after a successful login on all of the alphas. A
+        # reconnected alpha has forgotten the login and the PIN isn't
+        # kept, so login_lost is set until the client logs in again
+        self.logged_in = False
+        self.login_lost = False
+
+        # the DKS_HALUser the session logged in as
+        self.login_user = None
 
-        # dictionary mapping of hash rpc indexes by the hash handle
+        # HashHandleDetails by the hash handle given to the client
         self.hash_rpcs = {}
 
-        # dictionary mapping of key rpc indexes by the key handle
+        # HASH_UPDATE data waiting to be sent to the alpha by the hash handle
+        self.hash_updates = {}
+
+        # un-keyed hashes that are done on the host by the hash handle
+        self.host_hashes = {}
+        self.next_host_hash = 0
+
+        # KeyHandleDetails by the key handle given to the client. Alphas
+        # can use the same handle values so the client gets its own
         self.key_rpcs = {}
+        self.next_handle = 0
+
+        # keys being generated in the background by the job id
+        self.keygen_jobs = {}
+        self.next_keygen_job = 0
 
-        # parameters for the current key operation
+        # parameters for the most recent key operation. Callbacks must
+        # use the KeyOperationData passed with their RPCAction because
+        # pipelined requests may replace this before the reply arrives
         self.key_op_data = KeyOperationData(None, None, None)
 
         # should exportable private keys be used for this session?
@@ -118,6 +356,13 @@ class MuxSession:
         s = settings.get_setting(HSMSettings.ENABLE_EXPORTABLE_PRIVATE_KEYS)
         self.enable_exportable_private_keys = s
 
+    def new_handle(self):
+        """Returns a key or hash handle that isn't being used by the session"""
+        while True:
+            self.next_handle = (self.next_handle % MAX_SESSION_HANDLE) + 1
+            if (self.next_handle not in self.key_rpcs and self.next_handle not in self.hash_rpcs):
+                return self.next_handle
+
 
 class RPCPreprocessor:
     """Able to load balance between multiple rpcs"""
@@ -138,18 +383,37 @@ class RPCPreprocessor:
         self.debug = False
         self.tamper_detected = ThreadSafeVariable(False)
 
-        # used by load balancing heuristic
-        self.load_dist = LoadDistribution(len(rpc_list))
-        self.large_weight = 2**31
-        self.pkey_op_weight = 1
-        self.pkey_gen_weight = 100
+        # tracks the work on each alpha and chooses where requests go
+        self.scheduler = DeviceScheduler(len(rpc_list), self.get_scheduler_policy())
+
+        # probe results and state changes of each alpha
+        self.device_health = DeviceHealthMonitor(len(rpc_list))
+        for rpc_index, rpc in enumerate(rpc_list):
+            self.device_health.observe(rpc_index, rpc.state)
+
+        # replies about keys that never change, by device uuid
+        self.key_metadata = KeyMetadataCache(self.get_key_metadata_cache_size())
+
+        # key attributes by device uuid. kept up to date by SET_ATTRIBUTES
+        self.key_attributes = AttributeCache(self.get_key_attribute_cache_size())
 
-        # used when selecting any rpc, attempts to evenly
-        # distribute keys across all devices, even when
-        # only one thread is being used
-        self.next_any_device = 0
-        self.next_any_device_uses = 0
-        self.choose_any_thread_lock = threading.Lock()
+        # checks signatures from public keys on the host's cores
+        self.verify_engine = VerifyEngine(self.get_host_verify_processes())
+
+        # random bytes that are collected when the alphas aren't busy
+        self.random_pool = RandomPool(*self.get_random_pool_size())
+
+        # keys that were made before a client asked for them
+        self.keygen_pool = KeygenPool(*self.get_keygen_pool_settings())
+        for rpc_index, uuid, row in cache.get_unassigned_keys():
+            try:
+                self.keygen_pool.add_key(KeygenProfile.parse(row.profile), rpc_index, uuid)
+            except ValueError:
+                logger.info("Unable to use key %s from the keygen pool", uuid)
+
+        self.set_device_window(self.get_device_window())
+        self.set_priority_aging(self.get_priority_aging())
+        self.set_device_queue_limits(*self.get_device_queue_limits())
 
     def device_count(self):
         return len(self.rpc_list)
@@ -172,6 +436,8 @@ class RPCPreprocessor:
             return "RPC is now: " + self.get_current_rpc()
 
     def create_session(self, client, from_ethernet):
+        """Returns the session for this handle. The connection should keep
+        the session and pass it to process_incoming_rpc"""
         # make sure we have a session for this handle
         with (self.sessions_lock):
             if(client not in self.sessions):
@@ -181,6 +447,8 @@ class RPCPreprocessor:
                                         from_ethernet)
                 self.sessions[client] = new_session
 
+            return self.sessions[client]
+
     def delete_session(self, client):
         with (self.sessions_lock):
             if(client in self.sessions):
@@ -195,80 +463,339 @@ class RPCPreprocessor:
         return rpc_list
 
     def get_session(self, client):
+        """Look up a session by client handle. Requests carry their session
+        so this is only needed outside of the RPC path"""
         with (self.sessions_lock):
             return self.sessions[client]
 
-    def update_device_weight(self, cryptech_device, amount):
-        try:
-            self.load_dist.inc(cryptech_device, amount)
-        except:
-            pass
+    def is_device_available(self, rpc_index):
+        """False if the alpha has stopped working"""
+        return self.rpc_list[rpc_index].get_busy_factor() >= 0
 
-    def get_cryptech_device_weight(self, cryptech_device):
-        try:
-            return self.load_dist.get(cryptech_device)
-        except:
-            return self.large_weight
+    def available_devices(self, candidates):
+        """Returns the candidates that are working and don't have full
+        queues. If none of them can be used, they're all returned and the
+        request will fail"""
+        candidates = list(candidates)
+        candidates = [device_index for device_index in candidates
+                      if self.is_device_available(device_index)] or candidates
+
+        available = [device_index for device_index in candidates
+                     if not self.rpc_list[device_index].serial.is_queue_full()]
+
+        if (len(available) == 0 or len(available) == len(candidates)):
+            return candidates
+
+        for device_index in candidates:
+            if (device_index not in available):
+                self.scheduler.count_busy(device_index, rerouted = True)
+
+        return available
+
+    def device_busy(self, rpc):
+        """A request was rejected because the alpha's queue was full"""
+        self.scheduler.count_busy(self.rpc_list.index(rpc), rerouted = False)
 
-    def choose_rpc_from_master_uuid(self, master_uuid):
+    def choose_rpc_from_master_uuid(self, master_uuid, rpc_class = RPCClass.OTHER):
         uuid_dict = self.cache.get_alphas(master_uuid)
 
-        result = None
+        device_index = self.scheduler.choose(self.available_devices(uuid_dict.iterkeys()), rpc_class)
+        if (device_index is None):
+            return None
+
+        return (device_index, uuid_dict[device_index])
+
+    def choose_rpc(self, rpc_class = RPCClass.OTHER):
+        """Select an alpha RPC channel to use"""
+        return self.scheduler.choose(self.available_devices(xrange(len(self.rpc_list))), rpc_class)
+
+    def choose_keygen_rpc(self, session):
+        """Select an alpha for a new key. A session that has set its alpha
+        always uses it. Alphas that are already working on one of the
+        session's keygen jobs are only used if all are"""
+        if (session.rpc_index >= 0):
+            return session.rpc_index
+
+        busy = set(job.rpc_index for job in session.keygen_jobs.itervalues() if job.is_running())
+        candidates = [device_index for device_index in xrange(len(self.rpc_list)) if device_index not in busy]
+
+        return self.scheduler.choose(self.available_devices(candidates or xrange(len(self.rpc_list))),
+                                     RPCClass.KEYGEN)
+
+    def get_scheduler_policy(self):
+        return self.settings.get_setting(HSMSettings.RPC_SCHEDULER_POLICY)
+
+    def set_scheduler_policy(self, policy_name):
+        return self.scheduler.set_policy(policy_name)
 
-        # initialize to a high weight
-        device_weight = self.large_weight
+    def start_request(self, rpc, rpc_class):
+        """A request has been sent to an alpha. Returns the value
+        to pass to finish_request"""
+        return self.scheduler.start(self.rpc_list.index(rpc), rpc_class or RPCClass.OTHER)
 
-        for key, val in uuid_dict.iteritems():
-            # for now choose the device with the lowest weight
-            new_device_weight = self.get_cryptech_device_weight(key)
-            if (new_device_weight < device_weight):
-                device_weight = new_device_weight
-                result = (key, val)
+    def finish_request(self, rpc, rpc_class, start_time, success = True):
+        """The alpha has replied to a request"""
+        rpc_index = self.rpc_list.index(rpc)
+        self.scheduler.finish(rpc_index, rpc_class or RPCClass.OTHER, start_time, success)
 
-        return result
+        if (success):
+            self.device_health.request_finished(rpc_index, True)
 
-    def choose_rpc(self):
-        """Simple Heuristic for selecting an alpha RPC channel to use"""
-        DEVICE_USES_BEFORE_NEXT = 2
-        device_count = len(self.rpc_list)
+    def can_supervise_devices(self):
+        """False while the alphas can't be used"""
+        return not (self.is_rpc_locked() or self.tamper_detected.value)
 
-        with(self.choose_any_thread_lock):
-            # first try to evenly distribute
-            self.next_any_device_uses += 1
-            if(self.next_any_device_uses > DEVICE_USES_BEFORE_NEXT):
-                self.next_any_device_uses = 0
+    def get_device_supervisor_timing(self):
+        """Returns the seconds between health probes (0 = off), the
+        seconds a probe can take, and the longest wait between
+        reconnect attempts"""
+        timing = []
+        for setting, default in ((HSMSettings.DEVICE_PROBE_INTERVAL, 0),
+                                 (HSMSettings.DEVICE_PROBE_TIMEOUT, 0),
+                                 (HSMSettings.DEVICE_RECONNECT_MAX_DELAY, RECONNECT_MAX_DELAY)):
+            value = self.settings.get_setting(setting)
+            if (not isinstance(value, (int, float)) or value < 0):
+                value = default
 
-                self.next_any_device += 1
-                if(self.next_any_device >= device_count):
-                    self.next_any_device = 0
+            timing.append(value)
 
-            # make sure this has the smallest weight
-            # If only one process is using the HSM, next_rpc
-            # will probably be ok, but if multiple processes
-            # are using the HSM, it's possible that the call
-            # may try to use a device that's busy
+        return tuple(timing)
 
-            # initialize to weight of device
-            device_weight = self.get_cryptech_device_weight(self.next_any_device)
+    def observe_device(self, rpc, reason = None):
+        """Record a change in an alpha's state"""
+        self.device_health.observe(self.rpc_list.index(rpc), rpc.state, reason)
 
-            for device_index in xrange(device_count):
-                # if we find a device with a lower weight, use it
-                if (self.next_any_device != device_index):
-                    new_device_weight = self.get_cryptech_device_weight(device_index)
-                    if (new_device_weight < device_weight):
-                        device_weight = new_device_weight
-                        self.next_any_device = device_index
+    def device_failed(self, rpc, reason):
+        """Take an alpha out of service until it's reconnected"""
+        if (rpc.get_busy_factor() < 0):
+            # already out of service, locked, or tampered
+            return
 
-                        # reset uses
-                        self.next_any_device_uses = 0
+        logger.info("%s has stopped working: %s", rpc.name, reason)
 
-            return self.next_any_device
+        rpc.change_state(CrypTechDeviceState.HSMNotReady)
+        self.observe_device(rpc, reason)
+
+        self.device_health.request_finished(self.rpc_list.index(rpc), False)
+
+    def probe_finished(self, rpc, latency):
+        """latency is None if the probe failed"""
+        if (self.device_health.probe_finished(self.rpc_list.index(rpc), latency)):
+            self.device_failed(rpc, 'health probes failed')
+
+    def get_reconnect_delay(self, rpc):
+        max_delay = self.get_device_supervisor_timing()[2]
+        return self.device_health.reconnect_delay(self.rpc_list.index(rpc), max_delay)
+
+    def reconnect_failed(self, rpc, reason):
+        logger.info("Unable to reconnect %s: %s", rpc.name, reason)
+        self.device_health.reconnect_failed(self.rpc_list.index(rpc))
+
+    def device_reconnected(self, rpc):
+        """An alpha has been reconnected and warmed up and can be given
+        work again. Logged in sessions must log in again"""
+        rpc_index = self.rpc_list.index(rpc)
+
+        with (self.sessions_lock):
+            for session in self.sessions.itervalues():
+                if (session.logged_in):
+                    session.logged_in = False
+                    session.login_lost = True
+
+        self.device_health.reconnected(rpc_index)
+        self.scheduler.reset_device(rpc_index)
+
+        rpc.change_state(CrypTechDeviceState.HSMReady)
+        self.observe_device(rpc, 'reconnected')
+
+        logger.info("%s has been reconnected", rpc.name)
+
+    def get_device_status(self, rpc_index):
+        """Returns lines describing the health of an alpha"""
+        return self.device_health.get_status(rpc_index)
 
     def append_futures(self, futures):
         for rpc in self.rpc_list:
             futures.append(rpc.serial.rpc_output_loop())
             futures.append(rpc.serial.logout_all())
 
+    def get_device_window(self):
+        """Number of requests that can be waiting on an alpha at once"""
+        window = self.settings.get_setting(HSMSettings.RPC_DEVICE_WINDOW)
+        if (not isinstance(window, int) or window < 1):
+            return 1
+
+        return window
+
+    def set_device_window(self, window):
+        for rpc in self.rpc_list:
+            rpc.serial.set_window(window)
+
+    def get_device_queue_limits(self):
+        """Returns the number of requests and bytes that can be waiting
+        for an alpha. 0 = no limit"""
+        limits = []
+        for setting in (HSMSettings.RPC_DEVICE_QUEUE_LIMIT, HSMSettings.RPC_DEVICE_QUEUE_BYTES):
+            value = self.settings.get_setting(setting)
+            if (not isinstance(value, int) or value < 0):
+                value = 0
+
+            limits.append(value)
+
+        return tuple(limits)
+
+    def set_device_queue_limits(self, limit, byte_limit):
+        for rpc in self.rpc_list:
+            rpc.serial.set_queue_limits(limit, byte_limit)
+
+    def get_rpc_timeout(self, rpc_class):
+        """Seconds to wait for a reply to a request of rpc_class.
+        0 = wait forever"""
+        timeouts = self.settings.get_setting(HSMSettings.RPC_TIMEOUTS) or {}
+        timeout = timeouts.get((rpc_class or RPCClass.OTHER).value, 0)
+        if (not isinstance(timeout, (int, float)) or timeout < 0):
+            return 0
+
+        return timeout
+
+    def device_timeout(self, rpc):
+        """An alpha didn't reply to a request in time"""
+        rpc_index = self.rpc_list.index(rpc)
+        self.scheduler.count_timeout(rpc_index)
+        self.device_health.request_finished(rpc_index, False)
+
+    def is_hedging_enabled(self):
+        return self.settings.get_setting(HSMSettings.RPC_HEDGING) is True
+
+    def get_hedge_delay(self, rpc, rpc_class):
+        """Seconds to wait for an alpha before a request is repeated on
+        another alpha or None if there aren't enough measurements"""
+        return self.scheduler.get_latency_percentile(self.rpc_list.index(rpc),
+                                                     rpc_class or RPCClass.OTHER,
+                                                     HEDGE_PERCENTILE)
+
+    def hedge_started(self, rpc):
+        self.scheduler.count_hedge(self.rpc_list.index(rpc))
+
+    def hedge_won(self, rpc):
+        """The other alpha answered before rpc"""
+        self.scheduler.count_hedge(self.rpc_list.index(rpc), won = True)
+
+    def get_priority_aging(self):
+        """Seconds a waiting request must wait to move up one priority"""
+        aging = self.settings.get_setting(HSMSettings.RPC_PRIORITY_AGING)
+        if (not isinstance(aging, (int, float)) or aging < 0):
+            return 0
+
+        return aging
+
+    def set_priority_aging(self, aging):
+        for rpc in self.rpc_list:
+            rpc.serial.set_priority_aging(aging)
+
+    def get_key_metadata_cache_size(self):
+        """Number of bytes the key metadata cache can use"""
+        size = self.settings.get_setting(HSMSettings.KEY_METADATA_CACHE_SIZE)
+        if (not isinstance(size, int) or size < 0):
+            return 0
+
+        return size
+
+    def set_key_metadata_cache_size(self, size):
+        self.key_metadata.set_budget(size)
+
+    def get_key_attribute_cache_size(self):
+        """Number of bytes the key attribute cache can use"""
+        size = self.settings.get_setting(HSMSettings.KEY_ATTRIBUTE_CACHE_SIZE)
+        if (not isinstance(size, int) or size < 0):
+            return 0
+
+        return size
+
+    def set_key_attribute_cache_size(self, size):
+        self.key_attributes.set_budget(size)
+
+    def get_key_cache_status(self):
+        """Returns the status of the key metadata and attribute caches"""
+        return (self.key_metadata.get_status(), self.key_attributes.get_status())
+
+    def get_random_pool_size(self):
+        """Returns the size and low-water mark of the random pool"""
+        size = self.settings.get_setting(HSMSettings.RANDOM_POOL_SIZE)
+        if (not isinstance(size, int) or size < 0):
+            size = 0
+
+        low_water = self.settings.get_setting(HSMSettings.RANDOM_POOL_LOW_WATER)
+        if (not isinstance(low_water, int) or low_water < 0):
+            low_water = 0
+
+        return (size, low_water)
+
+    def set_random_pool_size(self, size, low_water):
+        self.random_pool.resize(size, low_water)
+
+    def get_keygen_pool_settings(self):
+        """Returns the profiles and depth of the keygen pool"""
+        profiles = []
+        for text in self.settings.get_setting(HSMSettings.KEYGEN_POOL_PROFILES) or []:
+            try:
+                profiles.append(KeygenProfile.parse(text))
+            except ValueError as e:
+                logger.info("Invalid keygen pool profile: %s", e)
+
+        depth = self.settings.get_setting(HSMSettings.KEYGEN_POOL_DEPTH)
+        if (not isinstance(depth, int) or depth < 0):
+            depth = 0
+
+        return (profiles, depth)
+
+    def set_keygen_pool_settings(self, profiles, depth):
+        self.keygen_pool.set_profiles(profiles, depth)
+
+    def get_keygen_pool_timing(self):
+        """Returns the seconds between keys and how long an alpha must
+        be idle before a key is made on it"""
+        timing = []
+        for setting in (HSMSettings.KEYGEN_POOL_REFILL_INTERVAL, HSMSettings.KEYGEN_POOL_IDLE_TIME):
+            value = self.settings.get_setting(setting)
+            if (not isinstance(value, (int, float)) or value < 0):
+                value = 0
+
+            timing.append(value)
+
+        return tuple(timing)
+
+    def get_hash_update_size(self):
+        """HASH_UPDATEs are merged until they reach this many bytes"""
+        size = self.settings.get_setting(HSMSettings.HASH_UPDATE_COALESCE_SIZE)
+        if (not isinstance(size, int) or size < 0):
+            return 0
+
+        return min(size, MAX_HASH_UPDATE_SIZE)
+
+    def get_host_verify_processes(self):
+        """Number of processes used to verify signatures on the host"""
+        processes = self.settings.get_setting(HSMSettings.HOST_VERIFY_PROCESSES)
+        if (not isinstance(processes, int) or processes < 0):
+            return 0
+
+        return processes
+
+    def set_host_verify_processes(self, processes):
+        self.verify_engine.set_processes(processes)
+
+    def get_host_hashing(self):
+        """Should un-keyed digests be calculated on the host"""
+        return self.settings.get_setting(HSMSettings.HOST_HASHING) is True
+
+    def get_pipeline_depth(self):
+        """Number of requests from a connection that can be processed at once"""
+        depth = self.settings.get_setting(HSMSettings.RPC_PIPELINE_DEPTH)
+        if (not isinstance(depth, int) or depth < 1):
+            return 1
+
+        return depth
+
     @property
     def is_mkm_set(self):
         return self.settings.get_setting(HSMSettings.MASTERKEY_SET) == True
@@ -283,6 +810,7 @@ class RPCPreprocessor:
 
     def lock_hsm(self):
         self.hsm_locked = True
+        self.random_pool.wipe()
         for rpc in self.rpc_list:
             rpc.change_state(CrypTechDeviceState.HSMLocked)
 
@@ -293,6 +821,8 @@ class RPCPreprocessor:
         if(new_tamper_state != old_tamper_state):
             self.tamper_detected.value = new_tamper_state
 
+            self.random_pool.wipe()
+
             if(new_tamper_state is True):
                 self.hsm_locked = True
                 for rpc in self.rpc_list:
@@ -302,47 +832,63 @@ class RPCPreprocessor:
                 for rpc in self.rpc_list:
                     rpc.clear_tamper(CrypTechDeviceState.TAMPER_RESET)
     
-    def process_incoming_rpc(self, decoded_request):
-        # handle the message normally
+    def process_incoming_rpc(self, decoded_request, session):
+        """Preprocess a request from the connection that owns session. The
+        session is returned with the action so callbacks can use it"""
+        # get the code of the RPC request and the handle which
+        # identifies the TCP connection that the request came from
+        code, client = rpc_schema.get_header(decoded_request)
+
+        # handlers read the parameters that follow the header
         unpacker = ContextManagedUnpacker(decoded_request)
-
-        # get the code of the RPC request
-        code = unpacker.unpack_uint()
-
-        # get the handle which identifies the TCP connection that the
-        # request came from
-        client = unpacker.unpack_uint()
-
-        # get the session so we know where to put the response and
-        # which rpc to use
-        session = self.get_session(client)
+        unpacker.set_position(rpc_schema.HEADER.size)
 
         # save the current request in the session
         session.current_request = decoded_request
 
         # check to see if there's an ongoing tamper event
         if (self.tamper_detected.value and session.from_ethernet):
-            return self.create_error_response(code, client,
-                                              DKS_HALError.HAL_ERROR_TAMPER)
+            action = self.create_error_response(code, client,
+                                                DKS_HALError.HAL_ERROR_TAMPER)
+            action.session = session
+            return action
+
+        # an alpha forgot the login when it was reconnected
+        if (session.login_lost and code not in LOGIN_CODES):
+            action = self.create_error_response(code, client,
+                                                DKS_HALError.HAL_ERROR_NOT_LOGGED_IN)
+            action.session = session
+            return action
 
         # process the RPC request
         action = self.function_table[code](code, client, unpacker, session)
 
         # it's possible that the request has been altered so return it
-        action.request = session.current_request
+        if (action.request is None):
+            action.request = session.current_request
+
+        if (action.rpc_class is None):
+            action.rpc_class = get_rpc_class(code)
+
+        if (action.priority is None):
+            action.priority = session.priority
+
+            if (session.deadline is not None):
+                action.deadline = time.time() + session.deadline
+
+        # logged in clients fill the keygen pool using their own login
+        if (action.background is None):
+            action.background = self.get_keygen_refill_action(client, session)
+
+        action.session = session
 
         return action
 
     def create_error_response(self, code, client, hal_error):
         # generate complete response
-        response = xdrlib.Packer()
-        response.pack_uint(code)
-        response.pack_uint(client)
-        response.pack_uint(hal_error)
-
         # TODO log error
 
-        return RPCAction(response.get_buffer(), None, None)
+        return RPCAction(rpc_schema.error_response(code, client, hal_error), None, None)
 
     def handle_set_rpc(self, code, client, unpacker, session):
         """Special DKS RPC to set the RPC to use for all calls"""
@@ -352,43 +898,56 @@ class RPCPreprocessor:
         # get the serial to switch to
         rpc_index = unpacker.unpack_uint()
 
-        response = xdrlib.Packer()
-        response.pack_uint(code)
-        response.pack_uint(client)
-
         if (session.from_ethernet):
             # the RPC can not be explicitly set from an outside
             # ethernet connection
-            response.pack_uint(DKS_HALError.HAL_ERROR_FORBIDDEN)
+            status = DKS_HALError.HAL_ERROR_FORBIDDEN
         elif (rpc_index < len(self.rpc_list)):
             # set the rpc to use for this session
             session.rpc_index = rpc_index
 
-            response.pack_uint(DKS_HALError.HAL_OK)
+            status = DKS_HALError.HAL_OK
         else:
-            response.pack_uint(DKS_HALError.HAL_ERROR_BAD_ARGUMENTS)
+            status = DKS_HALError.HAL_ERROR_BAD_ARGUMENTS
 
-        unencoded_response = response.get_buffer()
+        unencoded_response = rpc_schema.error_response(code, client, status)
 
         return RPCAction(unencoded_response, None, None)
 
+    def handle_set_priority(self, code, client, unpacker, session):
+        """Set the priority of the session's requests and how many
+        milliseconds they can wait for an alpha. 0 = no deadline"""
+        priority = unpacker.unpack_uint()
+        deadline = unpacker.unpack_uint()
+
+        try:
+            priority = RPCPriority(priority)
+        except ValueError:
+            return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS)
+
+        if (session.from_ethernet):
+            # outside connections can lower their priority and set a
+            # deadline but can't go ahead of the mux's own requests
+            priority = max(priority, ETHERNET_SESSION_PRIORITY)
+
+        session.priority = priority
+        session.deadline = (deadline / 1000.0) if (deadline > 0) else None
+
+        return RPCAction(rpc_schema.RESPONSES[code].encode(code, client, DKS_HALError.HAL_OK), None, None)
+
     def handle_enable_cache_keygen(self, code, client, unpacker, session):
         """Special DKS RPC to enable caching of generated keys"""
         logger.info("RPC code received %s, handle 0x%x",
                     DKS_RPCFunc.RPC_FUNC_ENABLE_CACHE_KEYGEN.name, client)
 
-        response = xdrlib.Packer()
-        response.pack_uint(code)
-        response.pack_uint(client)
-
         if (session.from_ethernet):
             # keygen caching can not be explicitly set from
             # an ethernet connection
-            response.pack_uint(DKS_HALError.HAL_ERROR_FORBIDDEN)
+            status = DKS_HALError.HAL_ERROR_FORBIDDEN
         else:
-            response.pack_uint(DKS_HALError.HAL_OK)
+            status = DKS_HALError.HAL_OK
 
-        unencoded_response = response.get_buffer()
+        unencoded_response = rpc_schema.error_response(code, client, status)
 
         session.cache_generated_keys = True
         print('caching enabled')
@@ -400,18 +959,14 @@ class RPCPreprocessor:
         logger.info("RPC code received %s, handle 0x%x",
                     DKS_RPCFunc.RPC_FUNC_DISABLE_CACHE_KEYGEN.name, client)
 
-        response = xdrlib.Packer()
-        response.pack_uint(code)
-        response.pack_uint(client)
-
         if (session.from_ethernet):
             # keygen caching can not be explicitly set from
             # an ethernet connection
-            response.pack_uint(DKS_HALError.HAL_ERROR_FORBIDDEN)
+            status = DKS_HALError.HAL_ERROR_FORBIDDEN
         else:
-            response.pack_uint(DKS_HALError.HAL_OK)
+            status = DKS_HALError.HAL_OK
 
-        unencoded_response = response.get_buffer()
+        unencoded_response = rpc_schema.error_response(code, client, status)
 
         session.cache_generated_keys = False
         print('caching disabled')
@@ -423,18 +978,14 @@ class RPCPreprocessor:
         logger.info("RPC code received %s, handle 0x%x",
                     DKS_RPCFunc.RPC_FUNC_USE_INCOMING_DEVICE_UUIDS.name, client)
 
-        response = xdrlib.Packer()
-        response.pack_uint(code)
-        response.pack_uint(client)
-
         if (session.from_ethernet):
             # using device uuids can not be set fom
             # an ethernet connection
-            response.pack_uint(DKS_HALError.HAL_ERROR_FORBIDDEN)
+            status = DKS_HALError.HAL_ERROR_FORBIDDEN
         else:
-            response.pack_uint(DKS_HALError.HAL_OK)
+            status = DKS_HALError.HAL_OK
 
-        unencoded_response = response.get_buffer()
+        unencoded_response = rpc_schema.error_response(code, client, status)
 
         session.incoming_uuids_are_device_uuids = True
         print('accepting incoming device uuids')
@@ -446,34 +997,20 @@ class RPCPreprocessor:
         logger.info("RPC code received %s, handle 0x%x",
                     DKS_RPCFunc.RPC_FUNC_USE_INCOMING_MASTER_UUIDS.name, client)
 
-        response = xdrlib.Packer()
-        response.pack_uint(code)
-        response.pack_uint(client)
-
         if (session.from_ethernet):
             # using device uuids can not be set fom
             # an ethernet connection
-            response.pack_uint(DKS_HALError.HAL_ERROR_FORBIDDEN)
+            status = DKS_HALError.HAL_ERROR_FORBIDDEN
         else:
-            response.pack_uint(DKS_HALError.HAL_OK)
+            status = DKS_HALError.HAL_OK
 
-        unencoded_response = response.get_buffer()
+        unencoded_response = rpc_schema.error_response(code, client, status)
 
         session.incoming_uuids_are_device_uuids = False
         print('accepting incoming master uuids')
 
         return RPCAction(unencoded_response, None, None)
 
-    def get_response_unpacker(self, unencoded_response):
-        msg = "".join(unencoded_response)
-        if not msg:
-            return None
-        msg = ContextManagedUnpacker(msg)
-
-        # return the unpacker. the first uint is the code followed
-        # by the client
-        return msg
-
     def handle_rpc_any(self, code, client, unpacker, session):
         """Can run on any available alpha because this is not alpha specific"""
         rpc_index = session.rpc_index if(session.rpc_index >= 0) else self.choose_rpc()
@@ -482,6 +1019,97 @@ class RPCPreprocessor:
 
         return RPCAction(None, [self.rpc_list[rpc_index]], None)
 
+    def __random_requests(self, code, client, length, device_count):
+        """Split a request for random bytes into GET_RANDOM requests for
+        up to device_count alphas"""
+        sizes = []
+        while (length > 0 and len(sizes) < device_count):
+            sizes.append(min(length, RANDOM_CHUNK_SIZE))
+            length -= sizes[-1]
+
+        return [rpc_schema.REQUESTS[code].encode(code, client, size) for size in sizes]
+
+    def handle_rpc_random(self, code, client, unpacker, session):
+        """Use the random pool or split the request over the alphas"""
+        length = unpacker.unpack_uint()
+
+        # a session that has selected an alpha wants its random bytes
+        if (session.rpc_index >= 0 or length == 0):
+            return self.handle_rpc_any(code, client, unpacker, session)
+
+        data = self.random_pool.take(length)
+        if (data is not None):
+            return RPCAction(rpc_schema.RESPONSES[code].encode(code, client, DKS_HALError.HAL_OK, data), None, None)
+
+        if (length <= RANDOM_CHUNK_SIZE):
+            return self.handle_rpc_any(code, client, unpacker, session)
+
+        return self.__next_random_action(code, client, RandomOperationData(length))
+
+    def __next_random_action(self, code, client, op_data):
+        candidates = self.available_devices(xrange(len(self.rpc_list)))
+        requests = self.__random_requests(code, client, op_data.remaining, len(candidates))
+
+        # let the scheduler pick a different alpha for each request
+        rpc_list = []
+        for _ in requests:
+            device_index = self.scheduler.choose(candidates, RPCClass.OTHER)
+            candidates.remove(device_index)
+            rpc_list.append(self.rpc_list[device_index])
+
+        return RPCAction(None, rpc_list, self.callback_rpc_random,
+                         request = requests, op_data = op_data)
+
+    def callback_rpc_random(self, action, reply_list):
+        op_data = action.op_data
+
+        for reply in reply_list:
+            code, client, status = rpc_schema.get_response_header(reply)
+            if (status != DKS_HALError.HAL_OK):
+                return self.create_error_response(code, client, status)
+
+            data = rpc_schema.RESPONSES[code].get(reply, 'data')
+            op_data.data.append(data[:op_data.remaining])
+            op_data.remaining -= len(op_data.data[-1])
+
+        if (op_data.remaining > 0):
+            return self.__next_random_action(code, client, op_data)
+
+        return RPCAction(rpc_schema.RESPONSES[code].encode(code, client, DKS_HALError.HAL_OK,
+                                                           b''.join(op_data.data)),
+                         None, None)
+
+    def get_random_refill_action(self, client):
+        """Returns an action that gets random bytes from the alphas that
+        aren't busy or None if the pool doesn't need to be refilled"""
+        if (self.is_rpc_locked() or self.tamper_detected.value or
+            not self.random_pool.needs_refill()):
+            return None
+
+        idle = self.scheduler.get_idle_devices()
+        if (len(idle) == 0):
+            return None
+
+        code = DKS_RPCFunc.RPC_FUNC_GET_RANDOM
+        space = self.random_pool.space()
+        length = min(RANDOM_CHUNK_SIZE, (space + len(idle) - 1) // len(idle))
+
+        op_data = RandomOperationData(space, self.random_pool.get_generation())
+
+        return RPCAction(None, [self.rpc_list[device_index] for device_index in idle],
+                         self.callback_random_refill,
+                         request = [rpc_schema.REQUESTS[code].encode(code, client, length)] * len(idle),
+                         op_data = op_data)
+
+    def callback_random_refill(self, action, reply_list):
+        for reply in reply_list:
+            code, _, status = rpc_schema.get_response_header(reply)
+            if (status == DKS_HALError.HAL_OK):
+                self.random_pool.add(rpc_schema.RESPONSES[code].get(reply, 'data'),
+                                     action.op_data.generation)
+
+        return RPCAction(None, None, None)
+
     def handle_rpc_all(self, code, client, unpacker, session):
         """Must run on all alphas to either to keep PINs synchronized
            or because we don't know which alpha we'll need later"""
@@ -494,16 +1122,11 @@ class RPCPreprocessor:
 
         return RPCAction(None, rpc_list, self.callback_rpc_all)
 
-    def callback_rpc_all(self, reply_list):
+    def callback_rpc_all(self, action, reply_list):
         code = None
 
         for reply in reply_list:
-            unpacker = self.get_response_unpacker(reply)
-
-            new_code = unpacker.unpack_int()
-
-            # get the client
-            client = unpacker.unpack_uint()
+            new_code, client, status = rpc_schema.get_response_header(reply)
 
             if(code is not None and new_code != code):
                 # error, the codes don't match
@@ -511,55 +1134,100 @@ class RPCPreprocessor:
 
             code = new_code
 
-            status = unpacker.unpack_uint()
             if(status != 0):
                 # one of the alpha's returned an error so return that error
                 # TODO log error
                 return self.create_error_response(code, client, status)
 
+        # remember if the client can see private keys
+        if (code == DKS_RPCFunc.RPC_FUNC_LOGIN):
+            action.session.logged_in = True
+            action.session.login_lost = False
+            action.session.login_user = rpc_schema.REQUESTS[code].get(action.request, 'user')
+        elif (code == DKS_RPCFunc.RPC_FUNC_LOGOUT):
+            action.session.logged_in = False
+            action.session.login_lost = False
+        elif (code == DKS_RPCFunc.RPC_FUNC_LOGOUT_ALL):
+            with (self.sessions_lock):
+                for session in self.sessions.itervalues():
+                    session.logged_in = False
+                    session.login_lost = False
+
         #all of the replies are the same so just return the first one
         return RPCAction(reply_list[0], None, None)
 
     def handle_rpc_starthash(self, code, client, unpacker, session):
         """This is the begining of a hash operation. Any RPC can be used."""
 
-        # select an RPC to use for this hashing operation
-        session.cur_hashing_index = session.rpc_index if(session.rpc_index >= 0) else self.choose_rpc()
+        # HMAC needs the key so only un-keyed digests can use the host
+        if (self.get_host_hashing()):
+            fields = rpc_schema.REQUESTS[code].decode(session.current_request)
+            if (len(fields['key']) == 0 and fields['algorithm'] in HOST_HASH_ALGORITHMS):
+                return self.start_host_hash(code, client, fields['algorithm'], session)
 
-        logger.info("hashing on RPC: %i", session.cur_hashing_index)
+        # select an RPC to use for this hashing operation
+        op_data = HashOperationData(session.rpc_index if(session.rpc_index >= 0) else self.choose_rpc())
 
-        return RPCAction(None, [self.rpc_list[session.cur_hashing_index]], self.callback_rpc_starthash)
+        logger.info("hashing on RPC: %i", op_data.rpc_index)
 
-    def callback_rpc_starthash(self, reply_list):
-        unpacker = self.get_response_unpacker(reply_list[0])
+        return RPCAction(None, [self.rpc_list[op_data.rpc_index]], self.callback_rpc_starthash, op_data = op_data)
 
-        code = unpacker.unpack_uint()
-        client = unpacker.unpack_uint()
+    def callback_rpc_starthash(self, action, reply_list):
+        code, client, result = rpc_schema.get_response_header(reply_list[0])
 
         # hashing only happens on one alpha
         if(len(reply_list) != 1):
             logger.info("callback_rpc_starthash: len(reply_list) != 1")
             return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_RPC_TRANSPORT)
 
-        result = unpacker.unpack_uint()
-
         if(code != DKS_RPCFunc.RPC_FUNC_HASH_INITIALIZE):
             logger.info("callback_rpc_starthash: code != RPCFunc.RPC_FUNC_HASH_INITIALIZE")
             return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_RPC_TRANSPORT)
 
         # get the session
-        session = self.get_session(client)        
+        session = action.session
 
         if(result != DKS_HALError.HAL_OK):
             logger.info("callback_rpc_starthash: result != 0")
             return self.create_error_response(code, client, result)
 
-        handle = unpacker.unpack_uint()
+        device_handle = rpc_schema.RESPONSES[code].get(reply_list[0], 'handle')
 
         # save the RPC to use for this handle
-        session.hash_rpcs[handle] = session.cur_hashing_index
+        handle = session.new_handle()
+        session.hash_rpcs[handle] = HashHandleDetails(action.op_data.rpc_index, device_handle)
 
-        return RPCAction(reply_list[0], None, None)
+        return RPCAction(rpc_schema.RESPONSES[code].replace(reply_list[0], 'handle', handle), None, None)
+
+    def start_host_hash(self, code, client, algorithm, session):
+        handle = HOST_HASH_HANDLE_FLAG | (session.next_host_hash & ~HOST_HASH_HANDLE_FLAG)
+        session.next_host_hash += 1
+
+        session.host_hashes[handle] = HostHash(algorithm)
+
+        return RPCAction(rpc_schema.RESPONSES[code].encode(code, client, DKS_HALError.HAL_OK, handle), None, None)
+
+    def handle_host_hash(self, code, client, handle, session):
+        """HASH_UPDATE, HASH_GET_ALGORITHM, and HASH_FINALIZE for a hash
+        on the host"""
+        host_hash = session.host_hashes[handle]
+
+        if (code == DKS_RPCFunc.RPC_FUNC_HASH_UPDATE):
+            host_hash.update(rpc_schema.REQUESTS[code].get(session.current_request, 'data'))
+            return RPCAction(rpc_schema.error_response(code, client, DKS_HALError.HAL_OK), None, None)
+        elif (code == DKS_RPCFunc.RPC_FUNC_HASH_GET_ALGORITHM):
+            return RPCAction(rpc_schema.RESPONSES[code].encode(code, client, DKS_HALError.HAL_OK,
+                                                               host_hash.algorithm), None, None)
+
+        # the handle can't be used after finalize, even if it fails
+        session.host_hashes.pop(handle, None)
+
+        length = rpc_schema.REQUESTS[code].get(session.current_request, 'length')
+        if (length < host_hash.digest_length):
+            return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS)
+
+        return RPCAction(rpc_schema.RESPONSES[code].encode(code, client, DKS_HALError.HAL_OK,
+                                                           host_hash.digest()), None, None)
 
     def handle_rpc_hash(self, code, client, unpacker, session):
         """Once a hash has started, we have to continue with it the same RPC"""
@@ -567,12 +1235,87 @@ class RPCPreprocessor:
         # get the handle of the hash operation
         handle = unpacker.unpack_uint()
 
+        if (handle in session.host_hashes):
+            return self.handle_host_hash(code, client, handle, session)
+
         # this handle must be a key
         if(handle not in session.hash_rpcs):
             logger.info("handle_rpc_hash: handle not in session.hash_rpcs")
             return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS)
 
-        return RPCAction(None, [self.rpc_list[session.hash_rpcs[handle]]], None)
+        hash_details = session.hash_rpcs[handle]
+
+        # the alpha only knows its own handle
+        session.current_request = rpc_schema.REQUESTS[code].replace(session.current_request, 'handle',
+                                                                    hash_details.device_handle)
+
+        if (code == DKS_RPCFunc.RPC_FUNC_HASH_UPDATE):
+            return self.handle_hash_update(code, client, handle, hash_details, session)
+
+        return self.flush_hash_updates(client, handle, hash_details, session)
+
+    def handle_hash_update(self, code, client, handle, hash_details, session):
+        """Small updates are acknowledged now and sent to the alpha in
+        one update when enough data has been collected"""
+        data = rpc_schema.REQUESTS[code].get(session.current_request, 'data')
+        buffer = session.hash_updates.setdefault(handle, HashUpdateBuffer())
+
+        if (buffer.length + len(data) < self.get_hash_update_size()):
+            buffer.append(data)
+            return RPCAction(rpc_schema.error_response(code, client, DKS_HALError.HAL_OK), None, None)
+
+        rpc_index = hash_details.rpc_index
+
+        if (buffer.length == 0):
+            return RPCAction(None, [self.rpc_list[rpc_index]], None)
+
+        # send as much as the alpha can take. Whatever is left over is
+        # smaller than the coalesce size so it stays in the buffer
+        buffer.append(data)
+        data = buffer.take()
+        buffer.append(data[MAX_HASH_UPDATE_SIZE:])
+
+        request = rpc_schema.REQUESTS[code].encode(code, client, hash_details.device_handle,
+                                                   data[:MAX_HASH_UPDATE_SIZE])
+
+        return RPCAction(None, [self.rpc_list[rpc_index]], None, request = request)
+
+    def flush_hash_updates(self, client, handle, hash_details, session, rpc_class = None):
+        """Send any buffered updates before the current request. An error
+        from the buffered updates is returned instead of the reply to
+        the current request"""
+        rpc_index = hash_details.rpc_index
+
+        buffer = session.hash_updates.get(handle)
+        if (buffer is None or buffer.length == 0):
+            return RPCAction(None, [self.rpc_list[rpc_index]], None, rpc_class = rpc_class)
+
+        code = DKS_RPCFunc.RPC_FUNC_HASH_UPDATE
+        request = rpc_schema.REQUESTS[code].encode(code, client, hash_details.device_handle, buffer.take())
+
+        op_data = HashFlushData(rpc_index, session.current_request, rpc_class)
+
+        return RPCAction(None, [self.rpc_list[rpc_index]], self.callback_hash_flush,
+                         request = request, op_data = op_data)
+
+    def callback_hash_flush(self, action, reply_list):
+        op_data = action.op_data
+
+        _, _, result = rpc_schema.get_response_header(reply_list[0])
+        if (result != DKS_HALError.HAL_OK):
+            op_data.error = result
+
+        # the request is still sent so the alpha frees the hash
+        return RPCAction(None, [self.rpc_list[op_data.rpc_index]], self.callback_hash_flushed,
+                         request = op_data.request, op_data = op_data, rpc_class = op_data.rpc_class)
+
+    def callback_hash_flushed(self, action, reply_list):
+        error = action.op_data.error
+        if (error is not None):
+            code, client, _ = rpc_schema.get_response_header(reply_list[0])
+            return self.create_error_response(code, client, error)
+
+        return RPCAction(reply_list[0], None, None)
 
     def handle_rpc_endhash(self, code, client, unpacker, session):
         """we've finished a hash operation"""
@@ -580,17 +1323,25 @@ class RPCPreprocessor:
         # get the handle of the hash operation
         handle = unpacker.unpack_uint()
 
+        if (handle in session.host_hashes):
+            return self.handle_host_hash(code, client, handle, session)
+
         # this handle must be a key
         if(handle not in session.hash_rpcs):
             logger.info("handle_rpc_hash: handle not in session.hash_rpcs")
             return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS)
 
-        rpc_index = session.hash_rpcs[handle]
-
         # the handle no longer needs to be in the dictionary
-        del session.hash_rpcs.pop[handle]
+        hash_details = session.hash_rpcs.pop(handle)
 
-        return RPCAction(None, [self.rpc_list[rpc_index]], None)
+        session.current_request = rpc_schema.REQUESTS[code].replace(session.current_request, 'handle',
+                                                                    hash_details.device_handle)
+
+        action = self.flush_hash_updates(client, handle, hash_details, session)
+
+        session.hash_updates.pop(handle, None)
+
+        return action
 
     def handle_rpc_usecurrent(self, code, client, unpacker, session):
         """The manually selected RPC must be used"""
@@ -606,12 +1357,22 @@ class RPCPreprocessor:
             self.settings.get_setting(HSMSettings.ENABLE_KEY_EXPORT) is False):
            return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_FORBIDDEN)
 
-        """The manually selected RPC must be used"""
-        rpc_index = session.rpc_index
-        if(rpc_index < 0):
-            rpc_index = session.key_op_data.rpc_index
+        """The key and the KEKEK must be open on the same alpha"""
+        handle = unpacker.unpack_uint()
+        kekek = unpacker.unpack_uint()
 
-        return RPCAction(None, [self.rpc_list[rpc_index]], None)
+        key_details = session.key_rpcs.get(handle)
+        kekek_details = session.key_rpcs.get(kekek)
+        if (key_details is None or kekek_details is None or
+            key_details.rpc_index != kekek_details.rpc_index):
+            logger.info("handle_rpc_pkeyexport: the key and kekek are not open on the same alpha")
+            return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS)
+
+        schema = rpc_schema.REQUESTS[code]
+        request = schema.replace(session.current_request, 'handle', key_details.device_handle)
+        session.current_request = schema.replace(request, 'kekek', kekek_details.device_handle)
+
+        return RPCAction(None, [self.rpc_list[key_details.rpc_index]], None)
 
     def handle_rpc_pkeyopen(self, code, client, unpacker, session):
         # pkcs11 session
@@ -620,8 +1381,8 @@ class RPCPreprocessor:
         # uuid
         incoming_uuid = UUID(bytes = unpacker.unpack_bytes())
 
-        # get the session to use
-        session = self.get_session(client)
+        # data about the key we are opening
+        op_data = KeyOperationData(None, None, None)
 
         # what type of uuid are we getting?
         if(session.incoming_uuids_are_device_uuids):
@@ -631,14 +1392,17 @@ class RPCPreprocessor:
 
             device_uuid = incoming_uuid
 
-            session.key_op_data.rpc_index = session.rpc_index
+            op_data.rpc_index = session.rpc_index
+            op_data.pkey_type = self.cache.get_key_type(self.cache.get_master_uuid(op_data.rpc_index,
+                                                                                    device_uuid))
         else:
             # find the device uuid from the master uuid
             master_uuid = incoming_uuid
+            op_data.pkey_type = self.cache.get_key_type(master_uuid)
 
             if(session.rpc_index >= 0):
                 # just use the set rpc_index
-                session.key_op_data.rpc_index = session.rpc_index
+                op_data.rpc_index = session.rpc_index
 
                 # see if this uuid is on the alpha we are requesting
                 device_list = self.cache.get_alphas(master_uuid)
@@ -649,56 +1413,58 @@ class RPCPreprocessor:
 
                 device_uuid = device_list[session.rpc_index]
             else:
-                rpc_uuid_pair = self.choose_rpc_from_master_uuid(master_uuid)
+                op_data.master_uuid = master_uuid
+
+                # the key will be used for signing on the alpha we choose
+                rpc_class = get_rpc_class(DKS_RPCFunc.RPC_FUNC_PKEY_SIGN, op_data.pkey_type)
+                rpc_uuid_pair = self.choose_rpc_from_master_uuid(master_uuid, rpc_class)
                 if(rpc_uuid_pair is None):
                     logger.info("handle_rpc_pkeyopen: rpc_uuid_pair is None")
                     return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_KEY_NOT_FOUND)
 
-                session.key_op_data.rpc_index = rpc_uuid_pair[0]
+                op_data.rpc_index = rpc_uuid_pair[0]
                 device_uuid = rpc_uuid_pair[1]
 
         # recreate with the actual uuid
         session.current_request = RPCpkey_open.create(code, client, session_param, device_uuid)
 
         # save data about the key we are opening
-        session.key_op_data.device_uuid = device_uuid
+        op_data.device_uuid = device_uuid
+        op_data.session_param = session_param
+        session.key_op_data = op_data
 
         """uuid is used to select the RPC with the key and the handle is returned"""
-        return RPCAction(None, [self.rpc_list[session.key_op_data.rpc_index]], self.callback_rpc_pkeyopen)
+        return RPCAction(None, [self.rpc_list[op_data.rpc_index]], self.callback_rpc_pkeyopen, op_data = op_data)
 
-    def callback_rpc_pkeyopen(self, reply_list):
-        unpacker = self.get_response_unpacker(reply_list[0])
-
-        code = unpacker.unpack_uint()
-        client = unpacker.unpack_uint()
+    def callback_rpc_pkeyopen(self, action, reply_list):
+        code, client, result = rpc_schema.get_response_header(reply_list[0])
 
         # hashing only happens on one alpha
         if(len(reply_list) != 1):
             logger.info("callback_rpc_pkeyopen: len(reply_list) != 1")
             return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_RPC_TRANSPORT)
 
-        result = unpacker.unpack_uint()
-
         if(code != DKS_RPCFunc.RPC_FUNC_PKEY_OPEN):
             logger.info("callback_rpc_pkeyopen: code != RPCFunc.RPC_FUNC_PKEY_OPEN")
             return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_RPC_TRANSPORT)
 
         # get the session
-        session = self.get_session(client)        
+        session = action.session
 
         if(result != 0):
             logger.info("callback_rpc_pkeyopen: result != 0")
             return self.create_error_response(code, client, result)
 
-        session.key_op_data.handle = unpacker.unpack_uint()
+        op_data = action.op_data
+        device_handle = rpc_schema.RESPONSES[code].get(reply_list[0], 'handle')
 
         # save the RPC to use for this handle
-        session.key_rpcs[session.key_op_data.handle] = KeyHandleDetails(session.key_op_data.rpc_index, session.key_op_data.device_uuid)
+        op_data.handle = session.new_handle()
+        session.key_rpcs[op_data.handle] = KeyHandleDetails(op_data.rpc_index, op_data.device_uuid, device_handle,
+                                                            op_data.pkey_type, op_data.session_param,
+                                                            op_data.master_uuid)
 
-        # inform the load balancer that we have an open pkey
-        self.update_device_weight(session.key_op_data.rpc_index, self.pkey_op_weight)
-
-        return RPCAction(reply_list[0], None, None)
+        return RPCAction(rpc_schema.RESPONSES[code].replace(reply_list[0], 'handle', op_data.handle), None, None)
 
     def handle_rpc_pkey(self, code, client, unpacker, session):
         """use handle to select RPC"""
@@ -711,18 +1477,450 @@ class RPCPreprocessor:
             logger.info("handle_rpc_pkey: handle not in session.key_rpcs")
             return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS)
 
+        key_details = session.key_rpcs[handle]
+        if (not self.is_device_available(key_details.rpc_index)):
+            action = self.failover_action(code, client, handle, key_details, session)
+            if (action is not None):
+                return action
+
+        # the alpha only knows its own handle
+        session.current_request = rpc_schema.REQUESTS[code].replace(session.current_request, 'handle',
+                                                                    key_details.device_handle)
+
         rpc_index = session.key_rpcs[handle].rpc_index
         device_uuid = session.key_rpcs[handle].uuid
+        rpc_class = get_rpc_class(code, session.key_rpcs[handle].keytype)
 
         # logger.info("Using pkey handle:%i RPC:%i", handle, rpc_index)
 
-        session.key_op_data = KeyOperationData(rpc_index, handle, device_uuid)
+        op_data = KeyOperationData(rpc_index, handle, device_uuid)
+        session.key_op_data = op_data
 
         if (code == DKS_RPCFunc.RPC_FUNC_PKEY_DELETE or 
             code == DKS_RPCFunc.RPC_FUNC_PKEY_CLOSE):
-            return RPCAction(None, [self.rpc_list[rpc_index]], self.callback_rpc_close_deletekey)
+            return RPCAction(None, [self.rpc_list[rpc_index]], self.callback_rpc_close_deletekey, op_data = op_data)
+        elif (code == DKS_RPCFunc.RPC_FUNC_PKEY_SET_ATTRIBUTES):
+            return RPCAction(None, [self.rpc_list[rpc_index]], self.callback_rpc_setattributes, op_data = op_data)
+        elif (code == DKS_RPCFunc.RPC_FUNC_PKEY_GET_ATTRIBUTES):
+            reply = self.key_attributes.get_reply(rpc_index, device_uuid, session.current_request)
+            if (reply is not None):
+                return RPCAction(reply, None, None)
+
+            return RPCAction(None, [self.rpc_list[rpc_index]], self.callback_rpc_getattributes, op_data = op_data)
+        elif (code in KeyMetadataCache.CACHED_CODES):
+            # these never change so the alpha only needs to be asked once
+            reply = self.key_metadata.get_reply(rpc_index, device_uuid, session.current_request)
+            if (reply is not None):
+                return RPCAction(reply, None, None)
+
+            return RPCAction(None, [self.rpc_list[rpc_index]], self.callback_rpc_pkey_metadata, op_data = op_data)
+        elif ((code == DKS_RPCFunc.RPC_FUNC_PKEY_SIGN or
+               code == DKS_RPCFunc.RPC_FUNC_PKEY_VERIFY) and
+              is_host_hash_handle(rpc_schema.REQUESTS[code].get(session.current_request, 'hash'))):
+            return self.sign_with_host_hash(code, client, op_data, session, rpc_class)
+        elif ((code == DKS_RPCFunc.RPC_FUNC_PKEY_SIGN or
+               code == DKS_RPCFunc.RPC_FUNC_PKEY_VERIFY) and
+              rpc_schema.REQUESTS[code].get(session.current_request, 'hash') != 0):
+            return self.sign_with_device_hash(code, client, op_data, session, rpc_class)
         else:
-            return RPCAction(None, [self.rpc_list[rpc_index]], None)
+            if (code == DKS_RPCFunc.RPC_FUNC_PKEY_VERIFY):
+                action = self.host_verify(rpc_index, device_uuid, session.current_request)
+                if (action is not None):
+                    return action
+
+            return RPCAction(None, [self.rpc_list[rpc_index]], None, rpc_class = rpc_class,
+                             hedge = self.hedge_action(code, client, session.key_rpcs[handle],
+                                                       session, rpc_class))
+
+    def hedge_action(self, code, client, key_details, session, rpc_class):
+        """Returns an action that opens the key on another alpha and
+        repeats the request there or None if the request can't be hedged"""
+        if (not self.is_hedging_enabled() or
+            code not in HEDGE_CODES or
+            key_details.session_param is None or
+            session.rpc_index >= 0 or
+            session.incoming_uuids_are_device_uuids):
+            return None
+
+        # hash handles only exist on the alpha that started the hash
+        if (rpc_schema.REQUESTS[code].get(session.current_request, 'hash') != 0):
+            return None
+
+        rpc_index, device_uuid = self.__choose_key_copy(key_details, rpc_class)
+        if (rpc_index is None):
+            return None
+
+        open_code = DKS_RPCFunc.RPC_FUNC_PKEY_OPEN
+        op_data = HedgeData(code, client, rpc_index, session.current_request, rpc_class)
+
+        return RPCAction(None, [self.rpc_list[rpc_index]], self.callback_hedge_open,
+                         request = RPCpkey_open.create(open_code, client, key_details.session_param,
+                                                       device_uuid),
+                         op_data = op_data, rpc_class = get_rpc_class(open_code),
+                         done = op_data.cancel)
+
+    def __choose_key_copy(self, key_details, rpc_class):
+        """Returns the (rpc_index, device_uuid) of a working alpha with
+        another copy of an open key or (None, None)"""
+        master_uuid = key_details.master_uuid
+        if (master_uuid is None):
+            master_uuid = self.cache.get_master_uuid(key_details.rpc_index, key_details.uuid)
+            if (master_uuid is None):
+                return (None, None)
+
+        device_uuids = self.cache.get_alphas(master_uuid)
+        candidates = [rpc_index for rpc_index in device_uuids
+                      if (rpc_index != key_details.rpc_index and self.is_device_available(rpc_index))]
+
+        rpc_index = self.scheduler.choose(self.available_devices(candidates), rpc_class)
+        if (rpc_index is None):
+            return (None, None)
+
+        return (rpc_index, device_uuids[rpc_index])
+
+    def failover_action(self, code, client, handle, key_details, session):
+        """Returns an action that opens a key on another alpha because its
+        alpha has stopped working, or None if there isn't another copy"""
+        if (key_details.session_param is None or
+            session.rpc_index >= 0 or
+            session.incoming_uuids_are_device_uuids):
+            return None
+
+        rpc_index, device_uuid = self.__choose_key_copy(key_details, get_rpc_class(code, key_details.keytype))
+        if (rpc_index is None):
+            return None
+
+        logger.info("Moving key handle %i from RPC:%i to RPC:%i", handle, key_details.rpc_index, rpc_index)
+
+        open_code = DKS_RPCFunc.RPC_FUNC_PKEY_OPEN
+        op_data = FailoverData(handle, key_details, rpc_index, device_uuid, session.current_request)
+
+        return RPCAction(None, [self.rpc_list[rpc_index]], self.callback_failover_open,
+                         request = RPCpkey_open.create(open_code, client, key_details.session_param, device_uuid),
+                         op_data = op_data, rpc_class = get_rpc_class(open_code))
+
+    def callback_failover_open(self, action, reply_list):
+        op_data = action.op_data
+        session = action.session
+
+        code, client = rpc_schema.get_header(op_data.request)
+
+        open_code, _, status = rpc_schema.get_response_header(reply_list[0])
+        if (status != DKS_HALError.HAL_OK):
+            logger.info("callback_failover_open: unable to open the key on RPC:%i", op_data.rpc_index)
+            return self.create_error_response(code, client, status)
+
+        device_handle = rpc_schema.RESPONSES[open_code].get(reply_list[0], 'handle')
+
+        key_details = session.key_rpcs.get(op_data.handle)
+        if (key_details is not op_data.key_details or key_details.rpc_index != op_data.old_rpc_index):
+            # the handle was closed or already moved by another request
+            # so the new handle isn't needed
+            close_code = DKS_RPCFunc.RPC_FUNC_PKEY_CLOSE
+            close_action = RPCAction(None, [self.rpc_list[op_data.rpc_index]], None,
+                                     request = rpc_schema.REQUESTS[close_code].encode(close_code, client,
+                                                                                      device_handle))
+
+            if (key_details is not op_data.key_details):
+                action = self.create_error_response(code, client, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS)
+            else:
+                action = self.process_incoming_rpc(op_data.request, session)
+
+            action.background = close_action
+            return action
+
+        key_details.rpc_index = op_data.rpc_index
+        key_details.uuid = op_data.device_uuid
+        key_details.device_handle = device_handle
+
+        # send the request again now that the handle points to the new alpha
+        return self.process_incoming_rpc(op_data.request, session)
+
+    def __hedge_close_action(self, op_data):
+        close_code = DKS_RPCFunc.RPC_FUNC_PKEY_CLOSE
+
+        return RPCAction(None, [self.rpc_list[op_data.rpc_index]], None,
+                         request = rpc_schema.REQUESTS[close_code].encode(close_code, op_data.client,
+                                                                          op_data.handle),
+                         done = self.callback_hedge_closed)
+
+    def callback_hedge_open(self, action, reply_list):
+        op_data = action.op_data
+
+        code, _, status = rpc_schema.get_response_header(reply_list[0])
+        if (status != DKS_HALError.HAL_OK):
+            logger.info("callback_hedge_open: unable to open the key on RPC:%i", op_data.rpc_index)
+            return RPCAction(None, None, None)
+
+        op_data.handle = rpc_schema.RESPONSES[code].get(reply_list[0], 'handle')
+
+        if (op_data.cancelled):
+            # the first alpha already answered
+            return self.__hedge_close_action(op_data)
+
+        return RPCAction(None, [self.rpc_list[op_data.rpc_index]], self.callback_hedge_request,
+                         request = rpc_schema.REQUESTS[op_data.code].replace(op_data.request, 'handle',
+                                                                             op_data.handle),
+                         op_data = op_data, rpc_class = op_data.rpc_class)
+
+    def callback_hedge_request(self, action, reply_list):
+        # the key is closed after the reply has been used
+        return RPCAction(reply_list[0], None, None, background = self.__hedge_close_action(action.op_data))
+
+    def callback_hedge_closed(self, result):
+        if (result is None or rpc_schema.get_response_header(result)[2] != DKS_HALError.HAL_OK):
+            logger.info("callback_hedge_closed: unable to close a hedged key handle")
+
+    def host_verify(self, rpc_index, device_uuid, request):
+        """Returns an action that verifies the signature on the host or
+        None if the alpha must be used"""
+        if (not self.verify_engine.enabled):
+            return None
+
+        code = DKS_RPCFunc.RPC_FUNC_PKEY_VERIFY
+        fields = rpc_schema.REQUESTS[code].decode(request)
+
+        # the digest is in a hash on the alpha
+        if (fields['hash'] != 0):
+            return None
+
+        der = self.key_metadata.get_public_key(rpc_index, device_uuid)
+        if (der is None):
+            return None
+
+        key = parse_public_key(der)
+        if (key is None or not can_verify(key, fields['data'], fields['signature'])):
+            return None
+
+        return RPCAction(None, None, self.callback_host_verify,
+                         op_data = HostVerifyData(rpc_index, request),
+                         work = self.verify_engine.submit(key, fields['data'], fields['signature']))
+
+    def callback_host_verify(self, action, result_list):
+        op_data = action.op_data
+
+        if (result_list[0] is None):
+            # something went wrong on the host so let the alpha do it
+            return RPCAction(None, [self.rpc_list[op_data.rpc_index]], None,
+                             request = op_data.request, rpc_class = RPCClass.OTHER)
+
+        code, client = rpc_schema.get_header(op_data.request)
+        status = DKS_HALError.HAL_OK if result_list[0] else DKS_HALError.HAL_ERROR_INVALID_SIGNATURE
+
+        return RPCAction(rpc_schema.error_response(code, client, status), None, None)
+
+    def sign_with_device_hash(self, code, client, op_data, session, rpc_class):
+        """The hash must be on the key's alpha. Buffered updates are sent
+        before the request"""
+        handle = rpc_schema.REQUESTS[code].get(session.current_request, 'hash')
+
+        hash_details = session.hash_rpcs.get(handle)
+        if (hash_details is None or hash_details.rpc_index != op_data.rpc_index):
+            logger.info("sign_with_device_hash: the hash is not on the key's alpha")
+            return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS)
+
+        # the alpha uses up the hash handle so we do the same
+        session.hash_rpcs.pop(handle, None)
+
+        session.current_request = rpc_schema.REQUESTS[code].replace(session.current_request, 'hash',
+                                                                    hash_details.device_handle)
+
+        action = self.flush_hash_updates(client, handle, hash_details, session, rpc_class)
+
+        session.hash_updates.pop(handle, None)
+
+        return action
+
+    def sign_with_host_hash(self, code, client, op_data, session, rpc_class):
+        """The alpha doesn't know about hashes on the host so the digest
+        is sent with the request instead. RSA keys need a DigestInfo and
+        other keys use the digest"""
+        fields = rpc_schema.REQUESTS[code].decode(session.current_request)
+
+        # the alpha would use up the hash handle so we do the same
+        host_hash = session.host_hashes.pop(fields['hash'], None)
+        if (host_hash is None):
+            return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS)
+
+        op_data.host_hash = host_hash
+        op_data.request_code = code
+        op_data.request_fields = fields
+
+        keytype = session.key_rpcs[op_data.handle].keytype
+        if (keytype is None):
+            # find out what kind of key this is first
+            type_code = DKS_RPCFunc.RPC_FUNC_PKEY_GET_KEY_TYPE
+            type_request = rpc_schema.REQUESTS[type_code].encode(type_code, client, fields['handle'])
+
+            reply = self.key_metadata.get_reply(op_data.rpc_index, op_data.device_uuid, type_request)
+            if (reply is None):
+                return RPCAction(None, [self.rpc_list[op_data.rpc_index]], self.callback_rpc_host_hash_keytype,
+                                 request = type_request, op_data = op_data)
+
+            keytype = rpc_schema.RESPONSES[type_code].get(reply, 'type')
+
+        return self.__host_hash_sign_action(code, client, op_data, keytype, rpc_class)
+
+    def __host_hash_sign_action(self, code, client, op_data, keytype, rpc_class):
+        fields = op_data.request_fields
+
+        if (keytype in (DKS_HALKeyType.HAL_KEY_TYPE_RSA_PRIVATE, DKS_HALKeyType.HAL_KEY_TYPE_RSA_PUBLIC)):
+            data = op_data.host_hash.digest_info()
+        else:
+            data = op_data.host_hash.digest()
+
+        # hash handle 0 tells the alpha to use data
+        if (code == DKS_RPCFunc.RPC_FUNC_PKEY_SIGN):
+            request = rpc_schema.REQUESTS[code].encode(code, client, fields['handle'], 0, data, fields['length'])
+        else:
+            request = rpc_schema.REQUESTS[code].encode(code, client, fields['handle'], 0, data, fields['signature'])
+
+            action = self.host_verify(op_data.rpc_index, op_data.device_uuid, request)
+            if (action is not None):
+                return action
+
+        return RPCAction(None, [self.rpc_list[op_data.rpc_index]], None,
+                         request = request, rpc_class = rpc_class)
+
+    def callback_rpc_host_hash_keytype(self, action, reply_list):
+        type_code, client, result = rpc_schema.get_response_header(reply_list[0])
+
+        op_data = action.op_data
+        code = op_data.request_code
+
+        if (result != DKS_HALError.HAL_OK):
+            return self.create_error_response(code, client, result)
+
+        self.key_metadata.add_reply(op_data.rpc_index, op_data.device_uuid, reply_list[0])
+
+        keytype = rpc_schema.RESPONSES[type_code].get(reply_list[0], 'type')
+
+        key_details = action.session.key_rpcs.get(op_data.handle)
+        if (key_details is not None):
+            key_details.keytype = keytype
+
+        return self.__host_hash_sign_action(code, client, op_data, keytype, get_rpc_class(code, keytype))
+
+    def handle_rpc_pkeysignbatch(self, code, client, unpacker, session):
+        """Sign a list of digests using every alpha that has the key"""
+        request = rpc_schema.REQUESTS[code].decode(session.current_request)
+        incoming_uuid = request['uuid']
+
+        if (session.incoming_uuids_are_device_uuids):
+            if (session.rpc_index < 0):
+                logger.info("handle_rpc_pkeysignbatch: using device uuid, but device not set")
+                return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_IMPOSSIBLE)
+
+            device_uuids = {session.rpc_index : incoming_uuid}
+            master_uuid = self.cache.get_master_uuid(session.rpc_index, incoming_uuid)
+        else:
+            master_uuid = incoming_uuid
+            device_uuids = self.cache.get_alphas(master_uuid)
+
+            if (session.rpc_index >= 0):
+                device_uuids = dict((rpc_index, device_uuid) for rpc_index, device_uuid in device_uuids.iteritems()
+                                    if rpc_index == session.rpc_index)
+
+        if (len(device_uuids) == 0):
+            return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_KEY_NOT_FOUND)
+
+        if (len(request['digests']) == 0):
+            return RPCAction(rpc_schema.RESPONSES[code].encode(code, client, DKS_HALError.HAL_OK, []),
+                             None, None)
+
+        batch = SignBatchData(code, client, request['length'], request['digests'],
+                              self.cache.get_key_type(master_uuid))
+        batch.rpc_indexes = sorted(device_uuids)
+
+        # open the key on all of the alphas at once
+        open_code = DKS_RPCFunc.RPC_FUNC_PKEY_OPEN
+        open_requests = [RPCpkey_open.create(open_code, client, request['session'], device_uuids[rpc_index])
+                         for rpc_index in batch.rpc_indexes]
+
+        return RPCAction(None, [self.rpc_list[rpc_index] for rpc_index in batch.rpc_indexes],
+                         self.callback_sign_batch_open,
+                         request = open_requests, op_data = batch,
+                         rpc_class = get_rpc_class(open_code))
+
+    def __sign_batch_action(self, batch, rpc_index, handle):
+        """Returns an action that signs the next digest on an alpha or
+        None when there's nothing left for it to do"""
+        index = batch.take()
+        if (index is None):
+            return None
+
+        code = DKS_RPCFunc.RPC_FUNC_PKEY_SIGN
+        request = rpc_schema.REQUESTS[code].encode(code, batch.client, handle, 0,
+                                                   batch.digests[index], batch.length)
+
+        return RPCAction(None, [self.rpc_list[rpc_index]], self.callback_sign_batch_sign,
+                         request = request,
+                         op_data = SignBatchSlot(batch, rpc_index, handle, index),
+                         rpc_class = get_rpc_class(code, batch.keytype))
+
+    def callback_sign_batch_open(self, action, reply_list):
+        batch = action.op_data
+
+        for rpc_index, reply in zip(batch.rpc_indexes, reply_list):
+            code, _, status = rpc_schema.get_response_header(reply)
+            if (status == DKS_HALError.HAL_OK):
+                batch.handles.append((rpc_index, rpc_schema.RESPONSES[code].get(reply, 'handle')))
+            else:
+                logger.info("callback_sign_batch_open: unable to open the key on RPC:%i", rpc_index)
+                batch.status = status
+
+        if (len(batch.handles) == 0):
+            return self.create_error_response(batch.code, batch.client, batch.status)
+
+        batch.status = DKS_HALError.HAL_OK
+
+        # each alpha takes the next digest when it's done with the last one,
+        # so faster alphas sign more of the batch
+        parallel = [self.__sign_batch_action(batch, rpc_index, handle) for rpc_index, handle in batch.handles]
+
+        return RPCAction(None, None, self.callback_sign_batch_signed, op_data = batch,
+                         parallel = [sign_action for sign_action in parallel if sign_action is not None])
+
+    def callback_sign_batch_sign(self, action, reply_list):
+        slot = action.op_data
+        batch = slot.batch
+
+        code, _, status = rpc_schema.get_response_header(reply_list[0])
+        if (status != DKS_HALError.HAL_OK):
+            # stop the other alphas
+            if (batch.status == DKS_HALError.HAL_OK):
+                batch.status = status
+
+            return RPCAction(None, None, None)
+
+        batch.signatures[slot.index] = rpc_schema.RESPONSES[code].get(reply_list[0], 'signature')
+
+        return self.__sign_batch_action(batch, slot.rpc_index, slot.handle) or RPCAction(None, None, None)
+
+    def callback_sign_batch_signed(self, action, result_list):
+        batch = action.op_data
+
+        close_code = DKS_RPCFunc.RPC_FUNC_PKEY_CLOSE
+        close_requests = [rpc_schema.REQUESTS[close_code].encode(close_code, batch.client, handle)
+                          for _, handle in batch.handles]
+
+        return RPCAction(None, [self.rpc_list[rpc_index] for rpc_index, _ in batch.handles],
+                         self.callback_sign_batch_closed,
+                         request = close_requests, op_data = batch)
+
+    def callback_sign_batch_closed(self, action, reply_list):
+        batch = action.op_data
+
+        if (batch.status == DKS_HALError.HAL_OK and None in batch.signatures):
+            # an alpha stopped responding
+            batch.status = DKS_HALError.HAL_ERROR_RPC_TRANSPORT
+
+        if (batch.status != DKS_HALError.HAL_OK):
+            return self.create_error_response(batch.code, batch.client, batch.status)
+
+        return RPCAction(rpc_schema.RESPONSES[batch.code].encode(batch.code, batch.client,
+                                                                 DKS_HALError.HAL_OK, batch.signatures),
+                         None, None)
 
     def handle_rpc_pkeyload(self, code, client, unpacker, session):
         """use manually selected RPC and get returned uuid and handle"""
@@ -733,20 +1931,14 @@ class RPCPreprocessor:
         #     rpc_index = self.choose_rpc() #session.key_op_data.rpc_index
 
         # select an RPC to use for this hashing operation
-        session.key_op_data.rpc_index = session.rpc_index if(session.rpc_index >= 0) else self.choose_rpc()
-
-        logger.info("session.rpc_index == %i  session.key_op_data.rpc_index == %i",
-                                            session.rpc_index, session.key_op_data.rpc_index)
-
-
-        # consume pkcs11 session id
-        unpacker.unpack_uint()
+        op_data = KeyOperationData(session.rpc_index if(session.rpc_index >= 0) else self.choose_rpc(), None, None)
+        session.key_op_data = op_data
 
-        # consume der
-        unpacker.unpack_bytes()
+        logger.info("session.rpc_index == %i  op_data.rpc_index == %i",
+                                            session.rpc_index, op_data.rpc_index)
 
         # get flags
-        session.flags = unpacker.unpack_uint()
+        session.flags = rpc_schema.REQUESTS[code].get(session.current_request, 'flags')
 
         if hasattr(session, 'pkey_type'):
             # treat as the public version of the last privte key generated as this is the standard usage
@@ -763,40 +1955,32 @@ class RPCPreprocessor:
             session.pkey_type = DKS_HALKeyType.HAL_KEY_TYPE_NONE
             session.curve = 0
 
-        # inform the load balancer that we are doing an expensive key operation
-        self.update_device_weight(session.key_op_data.rpc_index, self.pkey_gen_weight)
+        # remember the key settings for the callback
+        op_data.pkey_type = session.pkey_type
+        op_data.flags = session.flags
 
-        return RPCAction(None, [self.rpc_list[session.key_op_data.rpc_index]], self.callback_rpc_keygen)
+        return RPCAction(None, [self.rpc_list[op_data.rpc_index]], self.callback_rpc_keygen, op_data = op_data)
 
     def handle_rpc_pkeyimport(self, code, client, unpacker, session):
-        """use manually selected RPC and get returned uuid and handle"""
+        """use the RPC with the KEKEK and get returned uuid and handle"""
 
-        # if the session rpc_index has not be set, this must getting the public key
-        # rpc_index = session.rpc_index
-        # if(rpc_index < 0):
-        #     rpc_index = self.choose_rpc() #session.key_op_data.rpc_index
-
-        # select an RPC to use for this hashing operation
-        session.key_op_data.rpc_index = session.rpc_index if(session.rpc_index >= 0) else self.choose_rpc()
-
-        logger.info("session.rpc_index == %i  session.key_op_data.rpc_index == %i",
-                                            session.rpc_index, session.key_op_data.rpc_index)
-
-
-        # consume pkcs11 session id
-        unpacker.unpack_uint()
+        kekek_details = session.key_rpcs.get(rpc_schema.REQUESTS[code].get(session.current_request, 'kekek'))
+        if (kekek_details is None):
+            logger.info("handle_rpc_pkeyimport: kekek not in session.key_rpcs")
+            return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS)
 
-        # consume kekek
-        unpacker.unpack_uint()
+        session.current_request = rpc_schema.REQUESTS[code].replace(session.current_request, 'kekek',
+                                                                    kekek_details.device_handle)
 
-        # consume pkcs8
-        unpacker.unpack_bytes()
+        # the key can only be unwrapped by the alpha with the KEKEK
+        op_data = KeyOperationData(kekek_details.rpc_index, None, None)
+        session.key_op_data = op_data
 
-        # consume kek
-        unpacker.unpack_bytes()
+        logger.info("session.rpc_index == %i  op_data.rpc_index == %i",
+                                            session.rpc_index, op_data.rpc_index)
 
         # get flags
-        session.flags = unpacker.unpack_uint()
+        session.flags = rpc_schema.REQUESTS[code].get(session.current_request, 'flags')
 
         if hasattr(session, 'pkey_type'):
             # treat as the public version of the last privte key generated as this is the standard usage
@@ -813,46 +1997,29 @@ class RPCPreprocessor:
             session.pkey_type = DKS_HALKeyType.HAL_KEY_TYPE_NONE
             session.curve = 0
 
-        # inform the load balancer that we are doing an expensive key operation
-        self.update_device_weight(session.key_op_data.rpc_index, self.pkey_gen_weight)
+        # remember the key settings for the callback
+        op_data.pkey_type = session.pkey_type
+        op_data.flags = session.flags
 
-        return RPCAction(None, [self.rpc_list[session.key_op_data.rpc_index]], self.callback_rpc_keygen)
+        return RPCAction(None, [self.rpc_list[op_data.rpc_index]], self.callback_rpc_keygen, op_data = op_data)
 
 
     def handle_rpc_keygen(self, code, client, unpacker, session):
         """A key has been generated. Returns uuid and handle"""
 
-        # consume pkcs11 session id
-        unpacker.unpack_uint()
-
         # save the key settings
         if (code == DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_RSA):
             session.pkey_type = DKS_HALKeyType.HAL_KEY_TYPE_RSA_PRIVATE
-            
-            # consume keylen
-            unpacker.unpack_uint()
-
-            # get the exponent because we need the size
-            exponent = unpacker.unpack_bytes()
-
-            # get the location of the flags so we can change if needed
-            exp_len = len(exponent)
-            exp_padding = (4 - exp_len % 4) % 4
-            flag_location = 20 + exp_len + exp_padding
-
         elif (code == DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_EC):
             session.pkey_type = DKS_HALKeyType.HAL_KEY_TYPE_EC_PRIVATE
-
-            # get the location of the flags so we can change if needed
-            flag_location = 16
         elif (code == DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_HASHSIG):
             session.pkey_type = DKS_HALKeyType.HAL_KEY_TYPE_HASHSIG_PRIVATE
 
-            # get the location of the flags so we can change if needed
-            flag_location = 24
+        # the schema knows where the flags are so we can change them if needed
+        schema = rpc_schema.REQUESTS[code]
 
         # get the flags
-        session.flags = rpc_get_int(session.current_request, flag_location)
+        session.flags = schema.get(session.current_request, 'flags')
 
         # check to see if the rpc has been setup to allow exportable private keys
         if ((session.enable_exportable_private_keys == True) and
@@ -861,43 +2028,273 @@ class RPCPreprocessor:
     
             new_flag = session.flags | DKS_HALKeyFlag.HAL_KEY_FLAG_EXPORTABLE
 
-            session.current_request = rpc_set_int(session.current_request, new_flag, flag_location)
+            session.current_request = schema.replace(session.current_request, 'flags', new_flag)
 
             # sanity check. Make sure we get back what we just set
-            session.flags = rpc_get_int(session.current_request, flag_location)
+            session.flags = schema.get(session.current_request, 'flags')
 
 
         logger.info("Key Gen Flags: 0x%X"%session.flags)
 
+        # use a key from the pool if there's one that matches
+        if (session.rpc_index < 0 and session.cache_generated_keys and session.logged_in):
+            action = self.keygen_from_pool(code, client, session)
+            if (action is not None):
+                return action
+
         # select an RPC to use for this hashing operation
-        session.key_op_data.rpc_index = session.rpc_index if(session.rpc_index >= 0) else self.choose_rpc()
+        op_data = KeyOperationData(self.choose_keygen_rpc(session), None, None)
+        op_data.session_param = schema.get(session.current_request, 'session')
+        session.key_op_data = op_data
+
+        logger.info("session.rpc_index == %i  op_data.rpc_index == %i",
+                                            session.rpc_index, op_data.rpc_index)
+
+        # remember the key settings for the callback
+        op_data.pkey_type = session.pkey_type
+        op_data.flags = session.flags
+
+        if (code == DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_EC):
+            op_data.curve = schema.get(session.current_request, 'curve')
+        else:
+            op_data.curve = 0
+
+        return RPCAction(None, [self.rpc_list[op_data.rpc_index]], self.callback_rpc_keygen, op_data = op_data)
+
+    def keygen_from_pool(self, code, client, session):
+        """Returns an action that opens a key from the keygen pool for the
+        client or None if the pool doesn't have a matching key"""
+        profile = KeygenProfile.from_request(code, session.current_request)
+        if (profile is None):
+            return None
+
+        pool_key = self.keygen_pool.take(profile)
+        if (pool_key is None):
+            return None
+
+        rpc_index, device_uuid = pool_key
+
+        op_data = KeyOperationData(rpc_index, None, device_uuid, profile.keytype, profile.flags, profile.curve,
+                                   rpc_schema.REQUESTS[code].get(session.current_request, 'session'))
+        op_data.request_code = code
+        op_data.request = session.current_request
+        session.key_op_data = op_data
+
+        logger.info("Using key %s on RPC:%i from the keygen pool", device_uuid, rpc_index)
+
+        open_code = DKS_RPCFunc.RPC_FUNC_PKEY_OPEN
+        request = RPCpkey_open.create(open_code, client, op_data.session_param, device_uuid)
+
+        return RPCAction(None, [self.rpc_list[rpc_index]], self.callback_keygen_from_pool,
+                         request = request, op_data = op_data, rpc_class = get_rpc_class(open_code))
+
+    def callback_keygen_from_pool(self, action, reply_list):
+        code, client, result = rpc_schema.get_response_header(reply_list[0])
+
+        session = action.session
+        op_data = action.op_data
+
+        if (result != DKS_HALError.HAL_OK):
+            # the key can't be used so make a new one
+            logger.info("Unable to open key %s from the keygen pool", op_data.device_uuid)
+            self.cache.remove_unassigned_key(op_data.rpc_index, op_data.device_uuid)
+
+            op_data.rpc_index = self.choose_keygen_rpc(session)
+            op_data.device_uuid = None
+
+            return RPCAction(None, [self.rpc_list[op_data.rpc_index]], self.callback_rpc_keygen,
+                             request = op_data.request, op_data = op_data, rpc_class = RPCClass.KEYGEN,
+                             session = session)
+
+        device_handle = rpc_schema.RESPONSES[code].get(reply_list[0], 'handle')
+
+        # the key now belongs to the client
+        master_uuid = self.cache.assign_key(op_data.rpc_index, op_data.device_uuid)
+        if (master_uuid is None):
+            master_uuid = self.cache.add_key_to_alpha(op_data.rpc_index,
+                                                      op_data.device_uuid,
+                                                      op_data.pkey_type,
+                                                      op_data.flags,
+                                                      curve = op_data.curve,
+                                                      attributes = {})
+
+        op_data.handle = session.new_handle()
+        session.key_rpcs[op_data.handle] = KeyHandleDetails(op_data.rpc_index, op_data.device_uuid, device_handle,
+                                                            op_data.pkey_type, op_data.session_param,
+                                                            master_uuid)
+
+        outgoing_uuid = op_data.device_uuid if session.incoming_uuids_are_device_uuids else master_uuid
+
+        # reply as if the key was just generated
+        reply = RPCKeygen_result.create(op_data.request_code, client, result,
+                                        op_data.handle,
+                                        outgoing_uuid)
+
+        return RPCAction(reply, None, None)
+
+    def get_keygen_refill_action(self, client, session):
+        """Returns an action that makes the next key for the keygen pool
+        or None if there's nothing to do. Keys are only made while a
+        client is logged in as a user on every alpha and they're made
+        with that client's handle so the mux never needs the PIN"""
+        if (self.is_rpc_locked() or self.tamper_detected.value or
+            not self.keygen_pool.is_enabled()):
+            return None
+
+        if (not session.logged_in or session.login_user != DKS_HALUser.HAL_USER_NORMAL or
+            session.rpc_index >= 0 or not session.cache_generated_keys):
+            return None
+
+        refill_interval, idle_time = self.get_keygen_pool_timing()
+
+        refill = self.keygen_pool.next_refill(self.scheduler.get_idle_devices(idle_time), refill_interval)
+        if (refill is None):
+            return None
+
+        profile, rpc_index = refill
+
+        return RPCAction(None, [self.rpc_list[rpc_index]], self.callback_keygen_pool_generate,
+                         request = profile.generate_request(client),
+                         op_data = KeygenPoolData(rpc_index, profile),
+                         rpc_class = RPCClass.KEYGEN,
+                         session = session,
+                         priority = RPCPriority.BULK)
+
+    def callback_keygen_pool_done(self, action, reply_list):
+        return RPCAction(None, None, None)
+
+    def callback_keygen_pool_generate(self, action, reply_list):
+        code, client, result = rpc_schema.get_response_header(reply_list[0])
+
+        if (result != DKS_HALError.HAL_OK):
+            logger.info("Unable to make a key for the keygen pool: %i", result)
+            return RPCAction(None, None, None)
+
+        op_data = action.op_data
+        profile = op_data.profile
+
+        reply = rpc_schema.RESPONSES[code].decode(reply_list[0])
+        op_data.handle = reply['handle']
+        op_data.device_uuid = reply['uuid']
+
+        # it's a token key so it stays on the alpha after it's closed
+        self.cache.add_unassigned_key(op_data.rpc_index, op_data.device_uuid, str(profile),
+                                      profile.keytype, profile.flags, profile.curve)
+        self.keygen_pool.add_key(profile, op_data.rpc_index, op_data.device_uuid)
+
+        close_code = DKS_RPCFunc.RPC_FUNC_PKEY_CLOSE
+
+        return RPCAction(None, [self.rpc_list[op_data.rpc_index]], self.callback_keygen_pool_done,
+                         request = rpc_schema.REQUESTS[close_code].encode(close_code, client, op_data.handle),
+                         op_data = op_data)
+
+    def handle_keygen_job_submit(self, code, client, unpacker, session):
+        """Start generating a key and reply with the job id right away"""
+        schema = rpc_schema.REQUESTS[code]
+        keygen_code = schema.get(session.current_request, 'code')
+
+        if (keygen_code not in KEYGEN_JOB_CODES):
+            return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS)
+
+        if (len(session.keygen_jobs) >= MAX_KEYGEN_JOBS):
+            return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_ALLOCATION_FAILURE)
+
+        # the keygen is handled just like a PKEY_GENERATE from the client
+        keygen_request = rpc_schema.HEADER.pack(keygen_code, client) + schema.get(session.current_request, 'params')
+        session.current_request = keygen_request
+
+        keygen_unpacker = ContextManagedUnpacker(keygen_request)
+        keygen_unpacker.set_position(rpc_schema.HEADER.size)
+
+        keygen_action = self.handle_rpc_keygen(keygen_code, client, keygen_unpacker, session)
+        if (keygen_action.result is not None):
+            return keygen_action
 
-        logger.info("session.rpc_index == %i  session.key_op_data.rpc_index == %i",
-                                            session.rpc_index, session.key_op_data.rpc_index)
+        if (keygen_action.request is None):
+            keygen_action.request = session.current_request
 
-        # inform the load balancer that we are doing an expensive key operation
-        self.update_device_weight(session.key_op_data.rpc_index, self.pkey_gen_weight)
+        if (keygen_action.rpc_class is None):
+            keygen_action.rpc_class = get_rpc_class(keygen_code)
 
-        return RPCAction(None, [self.rpc_list[session.key_op_data.rpc_index]], self.callback_rpc_keygen)
+        keygen_action.session = session
 
-    def callback_rpc_close_deletekey(self, reply_list):
-        unpacker = self.get_response_unpacker(reply_list[0])
+        # there's no one waiting on the reply so there's no deadline
+        keygen_action.priority = session.priority
 
-        code = unpacker.unpack_uint()
-        client = unpacker.unpack_uint()
-        result = unpacker.unpack_uint()     
+        job = KeygenJob(keygen_action.op_data.rpc_index)
+        keygen_action.done = job.finish
+
+        job_id = session.next_keygen_job
+        session.next_keygen_job = (job_id + 1) & 0xFFFFFFFF
+        session.keygen_jobs[job_id] = job
+
+        logger.info("Keygen job %i started on RPC:%i", job_id, job.rpc_index)
+
+        return RPCAction(rpc_schema.RESPONSES[code].encode(code, client, DKS_HALError.HAL_OK, job_id),
+                         None, None, background = keygen_action)
+
+    def handle_keygen_job_status(self, code, client, unpacker, session):
+        job = session.keygen_jobs.get(unpacker.unpack_uint())
+        if (job is None):
+            return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS)
+
+        wait = unpacker.unpack_uint()
+
+        if (wait != 0 and job.is_running()):
+            return RPCAction(None, None, self.callback_keygen_job_status,
+                             op_data = job, work = job.future)
+
+        return RPCAction(rpc_schema.RESPONSES[code].encode(code, client, DKS_HALError.HAL_OK, job.state),
+                         None, None)
+
+    def callback_keygen_job_status(self, action, result_list):
+        code, client = rpc_schema.get_header(action.request)
+
+        return RPCAction(rpc_schema.RESPONSES[code].encode(code, client, DKS_HALError.HAL_OK,
+                                                           action.op_data.state),
+                         None, None)
+
+    def handle_keygen_job_result(self, code, client, unpacker, session):
+        """Reply with the handle and uuid of a finished job. The job is
+        forgotten once its result has been returned"""
+        job_id = unpacker.unpack_uint()
+
+        job = session.keygen_jobs.get(job_id)
+        if (job is None):
+            return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS)
+
+        if (job.is_running()):
+            return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_NOT_READY)
+
+        del session.keygen_jobs[job_id]
+
+        if (job.reply is None):
+            return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_RPC_TRANSPORT)
+
+        _, _, status = rpc_schema.get_response_header(job.reply)
+        if (status != DKS_HALError.HAL_OK):
+            return self.create_error_response(code, client, status)
+
+        keygen_code = rpc_schema.get_header(job.reply)[0]
+        reply = rpc_schema.RESPONSES[keygen_code].decode(job.reply)
+
+        return RPCAction(rpc_schema.RESPONSES[code].encode(code, client, DKS_HALError.HAL_OK,
+                                                           reply['handle'], reply['uuid']),
+                         None, None)
+
+    def callback_rpc_close_deletekey(self, action, reply_list):
+        code, client, result = rpc_schema.get_response_header(reply_list[0])
 
         if(result != DKS_HALError.HAL_OK):
             logger.info("callback_rpc_closekey: result != 0")
             return self.create_error_response(code, client, result)
 
         # get the session
-        session = self.get_session(client)
+        session = action.session
 
-        # inform the load balancer that we have closed a key
-        self.update_device_weight(session.key_op_data.rpc_index, -self.pkey_op_weight)
+        op_data = action.op_data
 
-        handle = session.key_op_data.handle
+        handle = op_data.handle
 
         # this handle must be a key
         if(handle not in session.key_rpcs):
@@ -910,27 +2307,56 @@ class RPCPreprocessor:
             uuid = keydetails.uuid
             rpc_index = keydetails.rpc_index
             session.cache.remove_key_from_alpha(rpc_index, uuid)
+            self.key_metadata.remove_key(rpc_index, uuid)
+            self.key_attributes.remove_key(rpc_index, uuid)
 
         # clear data
         session.key_rpcs.pop(handle, None)
 
-        # the key was closed so we are not working on anything now
-        session.key_op_data = KeyOperationData(None, None, None)
+        # the key was closed so we are not working on anything now,
+        # unless a pipelined request has already started a new one
+        if (session.key_op_data is op_data):
+            session.key_op_data = KeyOperationData(None, None, None)
 
         return RPCAction(reply_list[0], None, None)
 
-    def callback_rpc_keygen(self, reply_list):
-        unpacker = self.get_response_unpacker(reply_list[0])
+    def callback_rpc_pkey_metadata(self, action, reply_list):
+        op_data = action.op_data
+        self.key_metadata.add_reply(op_data.rpc_index, op_data.device_uuid, reply_list[0])
+
+        return RPCAction(reply_list[0], None, None)
+
+    def callback_rpc_getattributes(self, action, reply_list):
+        op_data = action.op_data
+        self.key_attributes.add_reply(op_data.rpc_index, op_data.device_uuid, action.request, reply_list[0])
+
+        return RPCAction(reply_list[0], None, None)
+
+    def callback_rpc_setattributes(self, action, reply_list):
+        code, client, result = rpc_schema.get_response_header(reply_list[0])
+
+        op_data = action.op_data
+        attributes = rpc_schema.REQUESTS[code].get(action.request, 'attributes')
+
+        # on failure the alpha may have set some of the attributes
+        self.key_attributes.set_attributes(op_data.rpc_index, op_data.device_uuid,
+                                           attributes, result == DKS_HALError.HAL_OK)
+
+        if(result == DKS_HALError.HAL_OK):
+            # keep the cache's attribute index up to date
+            master_uuid = self.cache.get_master_uuid(op_data.rpc_index, op_data.device_uuid)
+            if (master_uuid is not None):
+                self.cache.set_key_attributes(master_uuid, attributes)
+
+        return RPCAction(reply_list[0], None, None)
 
-        code = unpacker.unpack_uint()
-        client = unpacker.unpack_uint()
-        result = unpacker.unpack_uint()
+    def callback_rpc_keygen(self, action, reply_list):
+        code, client, result = rpc_schema.get_response_header(reply_list[0])
 
         # get the session
-        session = self.get_session(client)        
+        session = action.session
 
-        # inform the load balancer that we are no longer doing an expensive operation
-        self.update_device_weight(session.key_op_data.rpc_index, -self.pkey_gen_weight)
+        op_data = action.op_data
 
         # keygen only happens on one alpha
         if(len(reply_list) != 1):
@@ -949,35 +2375,35 @@ class RPCPreprocessor:
             logger.info("callback_rpc_keygen: result != 0")
             return self.create_error_response(code, client, result)
 
-        # inform the load balancer that we have an open pkey
-        # keygen automatically opens the key
-        self.update_device_weight(session.key_op_data.rpc_index, self.pkey_op_weight)
-
-        # get the handle
-        session.key_op_data.handle = unpacker.unpack_uint()
+        # get the handle and the new uuid
+        reply = rpc_schema.RESPONSES[code].decode(reply_list[0])
+        device_uuid = reply['uuid']
 
-        #get the new uuid
-        device_uuid = UUID(bytes = unpacker.unpack_bytes())
+        # save the device uuid internally
+        op_data.device_uuid = device_uuid
 
         # save the RPC to use for this handle
-        session.key_rpcs[session.key_op_data.handle] = KeyHandleDetails(session.key_op_data.rpc_index, session.key_op_data.device_uuid)
+        op_data.handle = session.new_handle()
+        key_details = KeyHandleDetails(op_data.rpc_index, op_data.device_uuid, reply['handle'],
+                                       op_data.pkey_type, op_data.session_param)
+        session.key_rpcs[op_data.handle] = key_details
 
         # add new key to cache
         logger.info("Key generated and added to cache RPC:%i UUID:%s Type:%i Flags:%i",
-                                            session.key_op_data.rpc_index, session.key_op_data.device_uuid, session.pkey_type, session.flags)
-
-
-        # save the device uuid internally
-        session.key_op_data.device_uuid = device_uuid
+                                            op_data.rpc_index, op_data.device_uuid, op_data.pkey_type, op_data.flags)
 
         # unless we're caching and using master_uuids, return the device uuid
         outgoing_uuid = device_uuid
 
         if (session.cache_generated_keys):
-            master_uuid = session.cache.add_key_to_alpha(session.key_op_data.rpc_index,
+            # new keys don't have any attributes until they are set
+            master_uuid = session.cache.add_key_to_alpha(op_data.rpc_index,
                                                          device_uuid,
-                                                         session.pkey_type,
-                                                         session.flags)
+                                                         op_data.pkey_type,
+                                                         op_data.flags,
+                                                         curve = op_data.curve,
+                                                         attributes = {})
+            key_details.master_uuid = master_uuid
 
             if (not session.incoming_uuids_are_device_uuids):
                 # the master_uuid will always be returned to ethernet connections
@@ -985,7 +2411,7 @@ class RPCPreprocessor:
 
         # generate reply with the outgoing uuid
         reply = RPCKeygen_result.create(code, client, result,
-                                        session.key_op_data.handle,
+                                        op_data.handle,
                                         outgoing_uuid)
     
         return RPCAction(reply, None, None)
@@ -1003,151 +2429,160 @@ class RPCPreprocessor:
                 logger.info("handle_rpc_pkeymatch: using device uuid, but device not set")
                 return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_IMPOSSIBLE)
 
-        session.keymatch_details = KeyMatchDetails()
+        op_data = KeyMatchDetails()
         
         # unpack and store key match attributes
-        session.keymatch_details.unpack(unpacker)
+        op_data.unpack(session.current_request)
 
         logger.info("pkey_match: result_max = %i, uuid = %s",
-                    session.keymatch_details.result_max, session.keymatch_details.uuid)
-
-        # if uuid is none, search RPC 0
-        # else search starting with the RPC that the uuid is on
-
-        if(session.keymatch_details.uuid == KeyMatchDetails.none_uuid):
-            if(session.rpc_index >= 0):
-                session.keymatch_details.rpc_index = session.rpc_index
-            else:
-                session.keymatch_details.rpc_index = 0
-        else:
-            # need to convert master_uuid to device_uuid
-            if(session.rpc_index >= 0):
-                device_list = session.cache.get_alphas(session.keymatch_details.uuid)
+                    op_data.result_max, op_data.uuid)
+
+        # token keys can be found using the cache's index without asking
+        # the alphas. Alphas only show private keys to logged in clients
+        token_search = ((op_data.mask & op_data.flags & DKS_HALKeyFlag.HAL_KEY_FLAG_TOKEN) != 0)
+        if (token_search and session.logged_in and session.rpc_index < 0):
+            uuid_list = session.cache.match_keys(op_data.type, op_data.curve,
+                                                 op_data.mask, op_data.flags,
+                                                 op_data.attr, op_data.result_max,
+                                                 op_data.uuid)
+            if (uuid_list is not None):
+                op_data.result.code = code
+                op_data.result.client = client
+                op_data.result.session = op_data.status
+                op_data.result.uuid_list = uuid_list
+
+                return RPCAction(op_data.result.build_result_packet(op_data.result_max), None, None)
+
+        # keys are returned in alpha order and then in the order the alpha
+        # returns them. The incoming master uuid tells us which alpha to
+        # start from and where to continue on that alpha
+        first_rpc = session.rpc_index if (session.rpc_index >= 0) else 0
+        start_uuid = KeyMatchDetails.none_uuid
+
+        if (op_data.uuid != KeyMatchDetails.none_uuid):
+            if (session.rpc_index >= 0):
+                device_list = session.cache.get_alphas(op_data.uuid)
                 if (session.rpc_index not in device_list):
-                    logger.info("handle_rpc_pkeyopen: session.rpc_index not in device_list")
+                    logger.info("handle_rpc_pkeymatch: session.rpc_index not in device_list")
                     return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_KEY_NOT_FOUND)
 
-                session.keymatch_details.rpc_index = session.rpc_index
-
-                # need to update the command with the new UUID
-                session.keymatch_details.uuid = device_list[session.rpc_index]
+                start_uuid = device_list[session.rpc_index]
             else:
-                # find the rpc that this is on
-                device_to_search = session.cache.get_alpha_lowest_index(session.keymatch_details.uuid)
-                if(device_to_search is None):
+                device_to_search = session.cache.get_alpha_lowest_index(op_data.uuid)
+                if (device_to_search is None):
                     return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_RPC_TRANSPORT)
 
-                session.keymatch_details.rpc_index = device_to_search[0]
-
-                # need to update the command with the new UUID
-                session.keymatch_details.uuid = device_to_search[1]
+                first_rpc, start_uuid = device_to_search
 
-            session.current_request = session.keymatch_details.repack(code, client)
-
-        # make sure the rpc_index was set
-        if(hasattr(session.keymatch_details, 'rpc_index') == False):
-            return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_RPC_TRANSPORT)
+        # search the alphas at the same time
+        op_data.rpc_indexes = range(first_rpc, len(self.rpc_list))
+        op_data.cursors[first_rpc] = start_uuid
 
-        return RPCAction(None, [self.rpc_list[session.keymatch_details.rpc_index]], self.callback_rpc_pkeymatch)
+        requests = [op_data.repack(code, client,
+                                   uuid = op_data.cursors.get(rpc_index, KeyMatchDetails.none_uuid),
+                                   result_max = KeyMatchDetails.page_size)
+                    for rpc_index in op_data.rpc_indexes]
 
-    def callback_rpc_pkeymatch(self, reply_list):
-        reply = reply_list[0]
+        return RPCAction(None, [self.rpc_list[rpc_index] for rpc_index in op_data.rpc_indexes],
+                         self.callback_rpc_pkeymatch, request = requests, op_data = op_data,
+                         rpc_class = RPCClass.MATCH)
 
+    def callback_rpc_pkeymatch(self, action, reply_list):
         logger.info("callback_rpc_pkeymatch")
 
-        unpacker = self.get_response_unpacker(reply)
+        # get the session
+        session = action.session
 
-        code = unpacker.unpack_uint()
-        client = unpacker.unpack_uint()
-        result = unpacker.unpack_uint()
+        op_data = action.op_data
 
-        # this should have been called on exactly one alpha
-        if(len(reply_list) != 1):
-            logger.info("callback_rpc_pkeymatch: len(reply_list) != 1")
-            return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_RPC_TRANSPORT)
+        # alphas that may have more matching keys
+        next_rpc_indexes = []
+        next_uuids = []
 
+        # the replies are in the same order as op_data.rpc_indexes
+        for rpc_index, reply in zip(op_data.rpc_indexes, reply_list):
+            code, client, result = rpc_schema.get_response_header(reply)
 
-        # get the session
-        session = self.get_session(client)        
+            if (code != DKS_RPCFunc.RPC_FUNC_PKEY_MATCH):
+                logger.info("callback_rpc_pkeymatch: code != RPCFunc.RPC_FUNC_PKEY_MATCH")
+                return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_RPC_TRANSPORT)
 
-        if (code != DKS_RPCFunc.RPC_FUNC_PKEY_MATCH):
-            logger.info("callback_rpc_pkeymatch: code != RPCFunc.RPC_FUNC_PKEY_MATCH")
-            return self.create_error_response(code, client, DKS_HALError.HAL_ERROR_RPC_TRANSPORT)
+            if(result != 0):
+                logger.info("callback_rpc_pkeymatch: result != 0")
+                return self.create_error_response(code, client, result)
 
-        if(result != 0):
-            logger.info("callback_rpc_pkeymatch: result != 0")
-            return self.create_error_response(code, client, result)
+            match_reply = rpc_schema.RESPONSES[code].decode(reply)
 
-        session.keymatch_details.result.code = code
-        session.keymatch_details.result.client = client
-        session.keymatch_details.result.result = result
+            # get the pkcs#11 session
+            op_data.result.session = match_reply['state']
 
-        # get the pkcs#11 session
-        session.keymatch_details.result.session = unpacker.unpack_uint()
+            logger.info("Matching found %i keys on RPC:%i", len(match_reply['uuids']), rpc_index)
 
-        # get the count
-        n = unpacker.unpack_uint()
+            found_uuids = op_data.found_uuids.setdefault(rpc_index, [])
 
-        rpc_index = session.keymatch_details.rpc_index
+            complete = len(match_reply['uuids']) < KeyMatchDetails.page_size
+            cursor = op_data.cursors.get(rpc_index, KeyMatchDetails.none_uuid)
+            for u in match_reply['uuids']:
+                # alphas return uuids in order. If there's nothing after
+                # the cursor, the alpha starts again from the beginning
+                if (cursor != KeyMatchDetails.none_uuid and u <= cursor):
+                    complete = True
+                    break
+                cursor = u
 
-        logger.info("Matching found %i keys", n)
+                # convert device UUID to master UUID and if uuid is
+                # also on a device with a lower index, don't add
+                master_uuid = session.cache.get_master_uuid(rpc_index, u)
+                if (master_uuid is not None):
+                    lowest_index = session.cache.get_master_uuid_lowest_index(master_uuid)
+                    if(lowest_index == rpc_index):
+                        found_uuids.append(master_uuid)
 
-        for i in xrange(n):
-            u = UUID(bytes = unpacker.unpack_bytes())
+            # an alpha never has to give more than result_max keys
+            if (not complete and len(found_uuids) < op_data.result_max):
+                op_data.cursors[rpc_index] = cursor
+                next_rpc_indexes.append(rpc_index)
+                next_uuids.append(cursor)
 
-            # convert device UUID to master UUID and if uuid is
-            # also on a device with a lowee index, don't add
-            master_uuid = session.cache.get_master_uuid(rpc_index, u)
-            if (master_uuid is not None):
-                lowest_index = session.cache.get_master_uuid_lowest_index(master_uuid)
-                if(lowest_index == rpc_index):
-                    session.keymatch_details.result.uuid_list.append(master_uuid)
+        if (len(next_rpc_indexes) > 0):
+            # get the next page from the alphas that filled the last one
+            op_data.rpc_indexes = next_rpc_indexes
+            requests = [op_data.repack(code, client, uuid = u) for u in next_uuids]
 
-        next_rpc = rpc_index + 1
+            return RPCAction(None, [self.rpc_list[rpc_index] for rpc_index in next_rpc_indexes],
+                             self.callback_rpc_pkeymatch, request = requests, op_data = op_data,
+                             rpc_class = RPCClass.MATCH, session = session)
 
-        if (len(session.keymatch_details.result.uuid_list) >= session.keymatch_details.result_max or
-            next_rpc >= len(self.rpc_list)):
-            # we've either reach the max or we've searched all devices
-            result_action = RPCAction(session.keymatch_details.result.build_result_packet(session.keymatch_details.result_max), None, None)
-            session.keymatch_details = None
+        # merge in alpha order
+        uuid_list = []
+        for rpc_index in sorted(op_data.found_uuids):
+            uuid_list.extend(op_data.found_uuids[rpc_index])
 
-            return result_action
+        op_data.result.code = code
+        op_data.result.client = client
+        op_data.result.result = result
+        op_data.result.uuid_list = uuid_list
 
-        # we're searching a new alpha so start from 0
-        session.keymatch_details.rpc_index = next_rpc
-        session.keymatch_details.uuid = KeyMatchDetails.none_uuid
-        session.current_request = session.keymatch_details.repack(code, client)
-
-        # there may be more matching keys so generate another command
-        return RPCAction(None, [self.rpc_list[session.keymatch_details.rpc_index]], self.callback_rpc_pkeymatch)
+        return RPCAction(op_data.result.build_result_packet(op_data.result_max), None, None)
 
     def handle_rpc_getdevice_ip(self, code, client, unpacker, session):
         # generate complete response
-        response = xdrlib.Packer()
-        response.pack_uint(code)
-        response.pack_uint(client)
-        response.pack_uint(DKS_HALError.HAL_OK)
-        response.pack_bytes(self.netiface.get_ip())
+        response = rpc_schema.RESPONSES[code].encode(code, client, DKS_HALError.HAL_OK,
+                                                     self.netiface.get_ip())
 
-        return RPCAction(response.get_buffer(), None, None)
+        return RPCAction(response, None, None)
 
     def handle_rpc_getdevice_state(self, code, client, unpacker, session):
         # generate complete response
-        response = xdrlib.Packer()
-        response.pack_uint(code)
-        response.pack_uint(client)
-        response.pack_uint(DKS_HALError.HAL_OK)
-
-        response.pack_uint(len(self.rpc_list))
-        for rpc in self.rpc_list:
-            response.pack_bytes(str(rpc.state.value))
+        response = rpc_schema.RESPONSES[code].encode(code, client, DKS_HALError.HAL_OK,
+                                                     [str(rpc.state.value) for rpc in self.rpc_list])
 
-        return RPCAction(response.get_buffer(), None, None)
+        return RPCAction(response, None, None)
 
     def create_function_table(self):
         """Use a table to quickly select the method to handle each RPC request"""
         self.function_table[DKS_RPCFunc.RPC_FUNC_GET_VERSION] = self.handle_rpc_any
-        self.function_table[DKS_RPCFunc.RPC_FUNC_GET_RANDOM] = self.handle_rpc_any
+        self.function_table[DKS_RPCFunc.RPC_FUNC_GET_RANDOM] = self.handle_rpc_random
         self.function_table[DKS_RPCFunc.RPC_FUNC_SET_PIN] = self.handle_rpc_all
         self.function_table[DKS_RPCFunc.RPC_FUNC_LOGIN] = self.handle_rpc_all
         self.function_table[DKS_RPCFunc.RPC_FUNC_LOGOUT] = self.handle_rpc_all
@@ -1186,3 +2621,8 @@ class RPCPreprocessor:
         self.function_table[DKS_RPCFunc.RPC_FUNC_CHECK_TAMPER] = self.handle_rpc_usecurrent
         self.function_table[DKS_RPCFunc.RPC_FUNC_USE_INCOMING_DEVICE_UUIDS] = self.handle_use_incoming_device_uuids
         self.function_table[DKS_RPCFunc.RPC_FUNC_USE_INCOMING_MASTER_UUIDS] = self.handle_use_incoming_master_uuids
+        self.function_table[DKS_RPCFunc.RPC_FUNC_KEYGEN_JOB_SUBMIT] = self.handle_keygen_job_submit
+        self.function_table[DKS_RPCFunc.RPC_FUNC_KEYGEN_JOB_STATUS] = self.handle_keygen_job_status
+        self.function_table[DKS_RPCFunc.RPC_FUNC_KEYGEN_JOB_RESULT] = self.handle_keygen_job_result
+        self.function_table[DKS_RPCFunc.RPC_FUNC_PKEY_SIGN_BATCH] = self.handle_rpc_pkeysignbatch
+        self.function_table[DKS_RPCFunc.RPC_FUNC_SET_PRIORITY] = self.handle_set_priority
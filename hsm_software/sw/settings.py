@@ -81,6 +81,31 @@ class HSMSettings(str, Enum):
 
     ALLOW_SSH                = 'ALLOW_SSH'
 
+    # number of requests from a single connection that may be
+    # processed at the same time. 1 = no pipelining
+    RPC_PIPELINE_DEPTH       = 'RPC_PIPELINE_DEPTH'
+    RPC_DEVICE_WINDOW        = 'RPC_DEVICE_WINDOW'
+    RPC_SCHEDULER_POLICY     = 'RPC_SCHEDULER_POLICY'
+    KEY_METADATA_CACHE_SIZE  = 'KEY_METADATA_CACHE_SIZE'
+    KEY_ATTRIBUTE_CACHE_SIZE = 'KEY_ATTRIBUTE_CACHE_SIZE'
+    RANDOM_POOL_SIZE         = 'RANDOM_POOL_SIZE'
+    RANDOM_POOL_LOW_WATER    = 'RANDOM_POOL_LOW_WATER'
+    HOST_HASHING             = 'HOST_HASHING'
+    HASH_UPDATE_COALESCE_SIZE = 'HASH_UPDATE_COALESCE_SIZE'
+    HOST_VERIFY_PROCESSES    = 'HOST_VERIFY_PROCESSES'
+    KEYGEN_POOL_PROFILES     = 'KEYGEN_POOL_PROFILES'
+    KEYGEN_POOL_DEPTH        = 'KEYGEN_POOL_DEPTH'
+    KEYGEN_POOL_REFILL_INTERVAL = 'KEYGEN_POOL_REFILL_INTERVAL'
+    KEYGEN_POOL_IDLE_TIME    = 'KEYGEN_POOL_IDLE_TIME'
+    RPC_PRIORITY_AGING       = 'RPC_PRIORITY_AGING'
+    RPC_DEVICE_QUEUE_LIMIT   = 'RPC_DEVICE_QUEUE_LIMIT'
+    RPC_DEVICE_QUEUE_BYTES   = 'RPC_DEVICE_QUEUE_BYTES'
+    RPC_TIMEOUTS             = 'RPC_TIMEOUTS'
+    RPC_HEDGING              = 'RPC_HEDGING'
+    DEVICE_PROBE_INTERVAL    = 'DEVICE_PROBE_INTERVAL'
+    DEVICE_PROBE_TIMEOUT     = 'DEVICE_PROBE_TIMEOUT'
+    DEVICE_RECONNECT_MAX_DELAY = 'DEVICE_RECONNECT_MAX_DELAY'
+
 # Changes to hardware settings to apply after a firmware update
 HARDWARE_MAPPING = {
     HSMSettings.BUILTIN_FIRMWARE_VERSION : BUILTIN_FIRMWARE_VERSION,
@@ -116,6 +141,8 @@ class Settings(object):
 
         self.__check_hardware_settings()
 
+        self.__check_performance_settings()
+
         if (gpio_available is not None):
             if (not gpio_available):
                 self.set_setting(HSMSettings.GPIO_LEDS, False)
@@ -256,6 +283,80 @@ class Settings(object):
             if(not self.hardware_firmware_match() or not self.hardware_tamper_match()):
                 self.set_setting(HSMSettings.FIRMWARE_OUT_OF_DATE, True)
 
+    def __check_performance_settings(self):
+        """Not thread-safe. Should only be called from __init__"""
+        if (HSMSettings.RPC_PIPELINE_DEPTH not in self.dictionary):
+            self.dictionary[HSMSettings.RPC_PIPELINE_DEPTH] = 1
+
+        if (HSMSettings.RPC_DEVICE_WINDOW not in self.dictionary):
+            self.dictionary[HSMSettings.RPC_DEVICE_WINDOW] = 8
+
+        if (HSMSettings.RPC_SCHEDULER_POLICY not in self.dictionary):
+            self.dictionary[HSMSettings.RPC_SCHEDULER_POLICY] = 'least-expected-completion'
+
+        if (HSMSettings.KEY_METADATA_CACHE_SIZE not in self.dictionary):
+            self.dictionary[HSMSettings.KEY_METADATA_CACHE_SIZE] = 1024 * 1024
+
+        if (HSMSettings.KEY_ATTRIBUTE_CACHE_SIZE not in self.dictionary):
+            self.dictionary[HSMSettings.KEY_ATTRIBUTE_CACHE_SIZE] = 1024 * 1024
+
+        if (HSMSettings.RANDOM_POOL_SIZE not in self.dictionary):
+            self.dictionary[HSMSettings.RANDOM_POOL_SIZE] = 64 * 1024
+
+        if (HSMSettings.RANDOM_POOL_LOW_WATER not in self.dictionary):
+            self.dictionary[HSMSettings.RANDOM_POOL_LOW_WATER] = 16 * 1024
+
+        if (HSMSettings.HOST_HASHING not in self.dictionary):
+            self.dictionary[HSMSettings.HOST_HASHING] = True
+
+        if (HSMSettings.HASH_UPDATE_COALESCE_SIZE not in self.dictionary):
+            self.dictionary[HSMSettings.HASH_UPDATE_COALESCE_SIZE] = 8192
+
+        if (HSMSettings.HOST_VERIFY_PROCESSES not in self.dictionary):
+            self.dictionary[HSMSettings.HOST_VERIFY_PROCESSES] = 0
+
+        # list of 'rsa:<bits>:<flags>' or 'ec:<curve>:<flags>'
+        if (HSMSettings.KEYGEN_POOL_PROFILES not in self.dictionary):
+            self.dictionary[HSMSettings.KEYGEN_POOL_PROFILES] = []
+
+        if (HSMSettings.KEYGEN_POOL_DEPTH not in self.dictionary):
+            self.dictionary[HSMSettings.KEYGEN_POOL_DEPTH] = 4
+
+        if (HSMSettings.KEYGEN_POOL_REFILL_INTERVAL not in self.dictionary):
+            self.dictionary[HSMSettings.KEYGEN_POOL_REFILL_INTERVAL] = 10
+
+        if (HSMSettings.KEYGEN_POOL_IDLE_TIME not in self.dictionary):
+            self.dictionary[HSMSettings.KEYGEN_POOL_IDLE_TIME] = 1.0
+
+        if (HSMSettings.RPC_PRIORITY_AGING not in self.dictionary):
+            self.dictionary[HSMSettings.RPC_PRIORITY_AGING] = 1.0
+
+        if (HSMSettings.RPC_DEVICE_QUEUE_LIMIT not in self.dictionary):
+            self.dictionary[HSMSettings.RPC_DEVICE_QUEUE_LIMIT] = 256
+
+        if (HSMSettings.RPC_DEVICE_QUEUE_BYTES not in self.dictionary):
+            self.dictionary[HSMSettings.RPC_DEVICE_QUEUE_BYTES] = 1024 * 1024
+
+        # seconds to wait for a reply for each RPCClass. 0 = wait forever
+        if (HSMSettings.RPC_TIMEOUTS not in self.dictionary):
+            self.dictionary[HSMSettings.RPC_TIMEOUTS] = {'rsa_sign' : 30.0,
+                                                         'ec_sign'  : 10.0,
+                                                         'keygen'   : 600.0,
+                                                         'match'    : 30.0,
+                                                         'other'    : 30.0}
+
+        if (HSMSettings.RPC_HEDGING not in self.dictionary):
+            self.dictionary[HSMSettings.RPC_HEDGING] = False
+
+        if (HSMSettings.DEVICE_PROBE_INTERVAL not in self.dictionary):
+            self.dictionary[HSMSettings.DEVICE_PROBE_INTERVAL] = 5.0
+
+        if (HSMSettings.DEVICE_PROBE_TIMEOUT not in self.dictionary):
+            self.dictionary[HSMSettings.DEVICE_PROBE_TIMEOUT] = 2.0
+
+        if (HSMSettings.DEVICE_RECONNECT_MAX_DELAY not in self.dictionary):
+            self.dictionary[HSMSettings.DEVICE_RECONNECT_MAX_DELAY] = 60.0
+
     def __update_hardware_settings(self):
         """Not thread-safe. Should only be called from __init__"""
         for key, value in HARDWARE_MAPPING.iteritems():
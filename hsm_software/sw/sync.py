@@ -314,6 +314,12 @@ class Synchronizer(PFUNIX_HSM):
                         # the CrypTech device will loop forever
                         break
 
+                    # keys in the keygen pool aren't used until a client asks for one
+                    if (self.cache.is_unassigned_key(rpc_index, uuid)):
+                        prev_uuid = uuid
+                        recv_count = recv_count + 1
+                        continue
+
                     with hsm.pkey_open(uuid) as pkey:
                         new_uuid = uuid
 
@@ -323,11 +329,41 @@ class Synchronizer(PFUNIX_HSM):
                         else:
                             masterListID = self.findMatchingMasterListID(new_uuid, matching_map, master_rows)
 
-                        self.cache.add_key_to_alpha(rpc_index, new_uuid, pkey.key_type, pkey.key_flags, param_masterListID = masterListID, auto_backup=False)
+                        # the first copy of a key creates the master row so
+                        # get the data that PKEY_MATCH searches on
+                        if (masterListID is None or master.fetch_row(masterListID) is None):
+                            curve = int(pkey.key_curve)
+                            attributes = self.getCachedAttributes(pkey)
+                        else:
+                            curve = None
+                            attributes = None
+
+                        self.cache.add_key_to_alpha(rpc_index, new_uuid, pkey.key_type, pkey.key_flags,
+                                                    param_masterListID = masterListID, auto_backup=False,
+                                                    curve = curve, attributes = attributes)
 
                     prev_uuid = uuid
                     recv_count = recv_count + 1
 
+    def getCachedAttributes(self, pkey):
+        """Returns a dictionary with the attributes of a key that the
+        cache indexes"""
+        attr_ids = CKA.cached_attributes()
+        try:
+            attributes = pkey.get_attributes(attr_ids)
+        except HAL_ERROR_ATTRIBUTE_NOT_FOUND:
+            # the alpha failed the whole request because of a missing
+            # attribute so ask for them one at a time
+            attributes = {}
+            for attr_id in attr_ids:
+                try:
+                    attributes.update(pkey.get_attributes([attr_id]))
+                except HAL_ERROR_ATTRIBUTE_NOT_FOUND:
+                    pass
+
+        return dict((attr_id, value) for attr_id, value in attributes.iteritems()
+                    if value is not None)
+
     def findMatchingMasterListID(self, new_uuid, matching_map, master_rows):
         """Uses the matching map to find the masterListID of a matching key"""
         if (new_uuid in matching_map):
@@ -387,6 +423,10 @@ class Synchronizer(PFUNIX_HSM):
         # push changes to cache
         self.cache.initialize_cache()
 
+        # PKEY_MATCH can be answered from the cache if every alpha was added
+        if (rpc_from_index == 0 and rpc_to_index == self.cache.rpc_count):
+            self.cache.set_index_warm(True)
+
         self.do_cmd_callback(cmd, "Cache generated")
 
     def cmd_setup(self, args, hsm):
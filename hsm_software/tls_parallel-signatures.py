@@ -78,6 +78,9 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# Diamond-HSM RPC from hsm_tools/cryptech_port.py
+RPC_FUNC_PKEY_SIGN_BATCH = 1989
+
 
 globals().update((name, getattr(libhal, name))
                  for name in dir(libhal)
@@ -107,6 +110,11 @@ class PKey(libhal.Handle):
         r = yield self.hsm.pkey_sign(self, data = data, length = length)
         raise Return(r)
 
+    @coroutine
+    def sign_batch(self, data, length = 1024):
+        r = yield self.hsm.pkey_sign_batch(self, data = data, length = length)
+        raise Return(r)
+
     @coroutine
     def verify(self, data = "", signature = None):
         yield self.hsm.pkey_verify(self, data = data, signature = signature)
@@ -196,6 +204,11 @@ class HSM(libhal.HSM):
         with (yield self.rpc(RPC_FUNC_PKEY_SIGN, pkey, 0, data, length)) as r:
             raise Return(r.unpack_bytes())
 
+    @coroutine
+    def pkey_sign_batch(self, pkey, data, length = 1024, session = 0):
+        with (yield self.rpc(RPC_FUNC_PKEY_SIGN_BATCH, session, pkey.uuid, length, data)) as r:
+            raise Return([r.unpack_bytes() for _ in xrange(r.unpack_uint())])
+
 
 def pkcs1_hash_and_pad(text):
     return DerSequence([DerSequence([SHA256.oid, DerNull().encode()]).encode(),
@@ -216,6 +229,21 @@ def client(args, k, p, q, r, m, v, h):
         r.add(t0, t1)
 
 
+@coroutine
+def batch_client(args, k, p, q, r, m, v, h):
+    while q:
+        n = q[:args.batch]
+        del q[:args.batch]
+        logger.debug("Signing %s", n)
+        t0 = datetime.datetime.now()
+        sigs = yield p.sign_batch(data = [m] * len(n))
+        t1 = datetime.datetime.now()
+        for s in sigs:
+            if args.verify and not v.verify(h, s):
+                raise RuntimeError("RSA verification failed")
+            r.add(t0, t1)
+
+
 @coroutine
 def main():
     parser = ArgumentParser(description = __doc__, formatter_class = ArgumentDefaultsHelpFormatter)
@@ -228,6 +256,7 @@ def main():
     parser.add_argument("-d", "--debug",        action = "store_true",          help = "bark more")
     parser.add_argument("-t", "--text",         default = "Hamsters'R'Us",      help = "plaintext to sign")
     parser.add_argument("-v", "--verify",       action = "store_true",          help = "verify signatures")
+    parser.add_argument("-b", "--batch",        default = 0, type = int,        help = "digests per PKEY_SIGN_BATCH, 0 = use PKEY_SIGN")
     parser.add_argument("--host",
                         help = "domain or IP address to connect to",
                         default = "127.0.0.1")      
@@ -255,7 +284,11 @@ def main():
 
     pkeys = yield [hsm.pkey_load(d, HAL_KEY_FLAG_USAGE_DIGITALSIGNATURE) for hsm in hsms]
 
-    yield [client(args, k, pkey, q, r, m, v, h) for pkey in pkeys]
+    # a batch is signed by every alpha with a copy of the key
+    if args.batch > 0:
+        yield [batch_client(args, k, pkey, q, r, m, v, h) for pkey in pkeys]
+    else:
+        yield [client(args, k, pkey, q, r, m, v, h) for pkey in pkeys]
 
     yield [pkey.delete() for pkey in pkeys]
 
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Benchmark of the per-RPC CPU cost of the mux diagnostics in
+hsm_tools/diagnostics.py. Each RPC logs the request and the reply and the
+reply is checked for errors. Compares the old always-on code with
+diagnostics on and off.
+
+Run from the testing folder:
+    python bench_diagnostics.py
+"""
+
+import os
+import sys
+import timeit
+import logging
+import xdrlib
+
+sys.path.insert(0, '../hsm_software/sw/hsm_tools')
+
+import slip
+import diagnostics
+
+from cryptech.cryptech.libhal import ContextManagedUnpacker
+
+ITERATIONS = 20000
+
+logger = logging.getLogger("cryptech_muxd")
+
+def make_rpc():
+    request = xdrlib.Packer()
+    for value in (23, 1, 5, 0):
+        request.pack_uint(value)
+    request.pack_bytes(os.urandom(32))
+    request.pack_uint(1024)
+
+    reply = xdrlib.Packer()
+    for value in (23, 1, 0):
+        reply.pack_uint(value)
+    reply.pack_bytes(os.urandom(256))
+
+    return slip.slip_encode(request.get_buffer()), reply.get_buffer()
+
+def old_rpc(request, reply):
+    """The diagnostic work that was always done for each RPC"""
+    logger.debug("RPC send: %s", ":".join("{:02x}".format(ord(c)) for c in request))
+    logger.debug("RPC recv: %s", ":".join("{:02x}".format(ord(c)) for c in slip.slip_encode(reply)))
+
+    # verify_result
+    unpacker = ContextManagedUnpacker(slip.slip_decode(slip.slip_encode(reply)))
+    code = unpacker.unpack_uint()
+    client = unpacker.unpack_uint()
+    hal_error = unpacker.unpack_uint()
+    if(hal_error is not 0):
+        print 'HALERROR:%X - CODE:%X'%(hal_error, code)
+
+def new_rpc(request, reply):
+    if (diagnostics.enabled):
+        diagnostics.log_frame("RPC send", request)
+
+    if (diagnostics.enabled):
+        diagnostics.log_frame("RPC recv", reply)
+
+    if (diagnostics.enabled):
+        diagnostics.verify_reply(reply)
+
+def measure(label, func, request, reply):
+    seconds = min(timeit.repeat(lambda: func(request, reply), number = ITERATIONS, repeat = 3))
+    print '    %-32s %8.0f ns/RPC' % (label, seconds * 1e9 / ITERATIONS)
+
+def main():
+    request, reply = make_rpc()
+
+    # logging is set up like the server, but the output is thrown away
+    logging.getLogger().addHandler(logging.NullHandler())
+
+    for level, level_name in ((logging.INFO, 'INFO'), (logging.DEBUG, 'DEBUG')):
+        logger.setLevel(level)
+        print 'log level %s' % level_name
+
+        measure('old', old_rpc, request, reply)
+
+        diagnostics.enabled = False
+        measure('diagnostics off', new_rpc, request, reply)
+
+        diagnostics.enabled = True
+        measure('diagnostics on', new_rpc, request, reply)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Benchmark for HASH_UPDATE coalescing in rpc_handling.py. A stream is
+hashed on a simulated alpha in small updates, once for each coalesce
+size. The alpha time is modelled from the serial speed and a fixed cost
+per request so the benchmark doesn't need hardware.
+
+Run from the testing folder:
+    python bench_hash_update.py [megabytes]
+"""
+
+import hashlib
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, '../hsm_software/sw')
+
+from rpc_handling import RPCPreprocessor, MAX_HASH_UPDATE_SIZE
+from settings import Settings, HSMSettings
+from cache import HSMCache
+from hsm_tools import rpc_schema
+from hsm_tools.cryptech_port import DKS_RPCFunc, DKS_HALError, DKS_HALDigestAlgorithm
+
+STREAM_MEGABYTES = 100
+UPDATE_SIZE = 64
+
+COALESCE_SIZES = [0, 1024, 8192, MAX_HASH_UPDATE_SIZE]
+
+# the alphas are connected at 921600 baud with 10 bits per byte
+SERIAL_BYTES_PER_SECOND = 921600 / 10.0
+
+# time for the alpha to start working on a request and reply
+REQUEST_OVERHEAD = 0.0005
+
+CLIENT = 1
+
+
+class SimulatedSerial(object):
+    def set_window(self, window):
+        pass
+
+
+class SimulatedAlpha(object):
+    """Hashes on the host and counts how long the requests would take
+    on a real alpha"""
+    def __init__(self):
+        self.serial = SimulatedSerial()
+        self.hashes = {}
+        self.next_handle = 1
+        self.requests = 0
+        self.seconds = 0.0
+
+    def exchange(self, request):
+        code, client = rpc_schema.get_header(request)
+        fields = rpc_schema.REQUESTS[code].decode(request)
+
+        if (code == DKS_RPCFunc.RPC_FUNC_HASH_INITIALIZE):
+            handle = self.next_handle
+            self.next_handle += 1
+            self.hashes[handle] = hashlib.sha256()
+            reply = rpc_schema.RESPONSES[code].encode(code, client, DKS_HALError.HAL_OK, handle)
+        elif (code == DKS_RPCFunc.RPC_FUNC_HASH_UPDATE):
+            self.hashes[fields['handle']].update(fields['data'])
+            reply = rpc_schema.error_response(code, client, DKS_HALError.HAL_OK)
+        elif (code == DKS_RPCFunc.RPC_FUNC_HASH_FINALIZE):
+            digest = self.hashes.pop(fields['handle']).digest()
+            reply = rpc_schema.RESPONSES[code].encode(code, client, DKS_HALError.HAL_OK, digest)
+        else:
+            reply = rpc_schema.error_response(code, client, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS)
+
+        self.requests += 1
+        self.seconds += REQUEST_OVERHEAD + (len(request) + len(reply)) / SERIAL_BYTES_PER_SECOND
+
+        return reply
+
+def send(preprocessor, alpha, session, request):
+    """Process a request the same way the RPC server does"""
+    session.current_request = request
+    action = preprocessor.process_incoming_rpc(request, session)
+
+    while (action.result is None and action.rpc_list is not None):
+        if (action.request is not None):
+            request = action.request
+
+        reply = alpha.exchange(request)
+
+        if (action.callback is not None):
+            action = action.callback(action, [reply])
+        else:
+            return reply
+
+    return action.result
+
+def run(coalesce_size, megabytes, folder):
+    settings = Settings('%s/settings.json' % folder, load_only = True)
+    settings.set_setting(HSMSettings.HOST_HASHING, False)
+    settings.set_setting(HSMSettings.HASH_UPDATE_COALESCE_SIZE, coalesce_size)
+
+    alpha = SimulatedAlpha()
+    preprocessor = RPCPreprocessor([alpha], HSMCache(1, cache_folder = folder), settings, None)
+    session = preprocessor.create_session(CLIENT, False)
+
+    code = DKS_RPCFunc.RPC_FUNC_HASH_INITIALIZE
+    reply = send(preprocessor, alpha, session,
+                 rpc_schema.REQUESTS[code].encode(code, CLIENT, 0,
+                                                  DKS_HALDigestAlgorithm.HAL_DIGEST_ALGORITHM_SHA256, ''))
+    handle = rpc_schema.RESPONSES[code].get(reply, 'handle')
+
+    chunk = ''.join(chr(i % 256) for i in xrange(UPDATE_SIZE))
+    update = rpc_schema.REQUESTS[DKS_RPCFunc.RPC_FUNC_HASH_UPDATE].encode(DKS_RPCFunc.RPC_FUNC_HASH_UPDATE,
+                                                                         CLIENT, handle, chunk)
+    update_count = megabytes * 1024 * 1024 // UPDATE_SIZE
+
+    start = time.time()
+    for _ in xrange(update_count):
+        send(preprocessor, alpha, session, update)
+
+    code = DKS_RPCFunc.RPC_FUNC_HASH_FINALIZE
+    reply = send(preprocessor, alpha, session, rpc_schema.REQUESTS[code].encode(code, CLIENT, handle, 32))
+    host_seconds = time.time() - start
+
+    expected = hashlib.sha256()
+    for _ in xrange(update_count):
+        expected.update(chunk)
+
+    if (rpc_schema.RESPONSES[code].get(reply, 'digest') != expected.digest()):
+        print 'coalesce size %i produced the wrong digest' % coalesce_size
+
+    total = host_seconds + alpha.seconds
+    print('coalesce %5i: %8i alpha requests, %7.1fs on the mux, %8.1fs on the alpha, %7.2f MB/s' %
+          (coalesce_size, alpha.requests, host_seconds, alpha.seconds, megabytes / total))
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else STREAM_MEGABYTES
+
+    print('Hashing %i MB in %i byte updates' % (megabytes, UPDATE_SIZE))
+
+    for coalesce_size in COALESCE_SIZES:
+        folder = tempfile.mkdtemp()
+        try:
+            run(coalesce_size, megabytes, folder)
+        finally:
+            shutil.rmtree(folder)
+
+if __name__ == "__main__":
+    main()
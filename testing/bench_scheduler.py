@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Simulation comparing the device scheduler policies in device_scheduler.py.
+Requests arrive at random and each alpha works on one request at a time.
+One alpha is slower than the others to show how the policies react to
+devices that don't perform the same.
+
+Run from the testing folder:
+    python bench_scheduler.py
+"""
+
+import heapq
+import random
+import sys
+
+sys.path.insert(0, '../hsm_software/sw')
+
+from device_scheduler import DeviceScheduler, RPCClass, POLICIES
+
+# relative speed of each alpha. Larger numbers are slower
+DEVICE_SLOWDOWN = [1.0, 1.0, 1.0, 1.8]
+
+# (class, seconds on a normal alpha, share of the requests)
+WORKLOAD = [
+    (RPCClass.EC_SIGN,  0.02,  0.60),
+    (RPCClass.RSA_SIGN, 0.20,  0.30),
+    (RPCClass.MATCH,    0.01,  0.095),
+    (RPCClass.KEYGEN,   3.00,  0.005),
+]
+
+REQUEST_COUNT = 50000
+
+# how busy the alphas are on average
+LOADS = [0.5, 0.8, 0.9]
+
+def mean_service_time():
+    return sum(seconds * share for _, seconds, share in WORKLOAD)
+
+def capacity():
+    """Requests per second that all of the alphas can handle"""
+    return sum(1.0 / (mean_service_time() * slowdown) for slowdown in DEVICE_SLOWDOWN)
+
+def make_requests(load, seed):
+    """Returns a list of (arrival time, class, seconds on a normal alpha)"""
+    rng = random.Random(seed)
+    rate = load * capacity()
+
+    requests = []
+    now = 0.0
+    for _ in xrange(REQUEST_COUNT):
+        now += rng.expovariate(rate)
+
+        pick = rng.random()
+        for rpc_class, seconds, share in WORKLOAD:
+            pick -= share
+            if (pick <= 0):
+                break
+
+        requests.append((now, rpc_class, rng.expovariate(1.0 / seconds)))
+
+    return requests
+
+def simulate(policy_name, requests):
+    scheduler = DeviceScheduler(len(DEVICE_SLOWDOWN), policy_name)
+    device_free_at = [0.0] * len(DEVICE_SLOWDOWN)
+
+    # replies that haven't been seen by the scheduler yet
+    completions = []
+    latencies = []
+
+    for arrival, rpc_class, seconds in requests:
+        # let the scheduler see everything that finished before now
+        while (completions and completions[0][0] <= arrival):
+            finished, device_index, finished_class, started = heapq.heappop(completions)
+            scheduler.finish(device_index, finished_class, started, now = finished)
+
+        device_index = scheduler.choose(xrange(len(DEVICE_SLOWDOWN)), rpc_class)
+        started = scheduler.start(device_index, rpc_class, now = arrival)
+
+        begin = max(arrival, device_free_at[device_index])
+        finished = begin + seconds * DEVICE_SLOWDOWN[device_index]
+        device_free_at[device_index] = finished
+
+        heapq.heappush(completions, (finished, device_index, rpc_class, started))
+        latencies.append(finished - arrival)
+
+    latencies.sort()
+    count = len(latencies)
+
+    return (sum(latencies) / count,
+            latencies[count / 2],
+            latencies[int(count * 0.99)])
+
+def main():
+    print 'alphas: %s' % ', '.join('%.1fx' % slowdown for slowdown in DEVICE_SLOWDOWN)
+    for load in LOADS:
+        requests = make_requests(load, seed = 1)
+
+        print 'load %.0f%% (%.0f requests/s)' % (load * 100, load * capacity())
+        for policy_name in sorted(POLICIES):
+            mean, p50, p99 = simulate(policy_name, requests)
+            print '    %-26s mean %7.1f ms  p50 %7.1f ms  p99 %8.1f ms' % (policy_name,
+                                                                          mean * 1000,
+                                                                          p50 * 1000,
+                                                                          p99 * 1000)
+
+if __name__ == "__main__":
+    main()
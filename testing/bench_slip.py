@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Micro-benchmark comparing the incremental SLIP codec in hsm_tools/slip.py
+with the slip_encode/slip_decode functions from CrypTech's libhal.py.
+
+Run from the testing folder:
+    python bench_slip.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, '../hsm_software/sw/hsm_tools')
+
+import slip
+from cryptech.cryptech import libhal
+
+# realistic payload sizes for messages that pass through the mux
+PAYLOADS = [
+    ('get_attributes reply', 96),
+    ('ecdsa p256 sign reply', 84),
+    ('rsa 2048 sign request', 300),
+    ('rsa 2048 sign reply', 276),
+    ('rsa 4096 sign reply', 532),
+    ('pkey_match reply 64 uuids', 1304),
+]
+
+ITERATIONS = 20000
+
+# frames per simulated stream and the size of each read from the stream
+STREAM_FRAMES = 64
+READ_SIZE = 4096
+
+def old_stream_decode(chunks):
+    """Emulates read_until(SLIP_END) followed by slip_decode"""
+    data = ''.join(chunks)
+    frames = []
+    start = 0
+    while True:
+        end = data.find(libhal.SLIP_END, start)
+        if (end < 0):
+            break
+        frame = data[start:end + 1]
+        start = end + 1
+        if len(frame) < 9:
+            continue
+        frames.append(libhal.slip_decode(frame))
+    return frames
+
+def old_mux_reply_path(chunks):
+    """Emulates a reply passing through the mux before this change. The
+    reply was decoded by rpc_output_loop to find the handle, by
+    verify_result and again before the callback, then encoded to write it
+    back to the client"""
+    replies = []
+    for frame in old_stream_decode(chunks):
+        encoded = libhal.slip_encode(frame)
+        libhal.slip_decode(encoded)
+        libhal.slip_decode(encoded)
+        replies.append(libhal.slip_encode(libhal.slip_decode(encoded)))
+    return replies
+
+def new_mux_reply_path(chunks):
+    """The reply is framed and decoded once and encoded once"""
+    return [slip.slip_encode(frame) for frame in new_stream_decode(chunks)]
+
+def new_stream_decode(chunks):
+    decoder = slip.SLIPDecoder()
+    frames = []
+    for chunk in chunks:
+        frames.extend(decoder.feed(chunk))
+    return frames
+
+def run_payload(name, size):
+    payload = os.urandom(size)
+    encoded = libhal.slip_encode(payload)
+
+    assert slip.slip_encode(payload) == encoded
+    assert slip.slip_decode(encoded) == payload
+
+    stream = encoded * STREAM_FRAMES
+    chunks = [stream[i:i + READ_SIZE] for i in xrange(0, len(stream), READ_SIZE)]
+
+    assert new_stream_decode(chunks) == old_stream_decode(chunks)
+    assert new_mux_reply_path(chunks) == old_mux_reply_path(chunks)
+
+    results = []
+    for label, func in (('encode old', lambda: libhal.slip_encode(payload)),
+                        ('encode new', lambda: slip.slip_encode(payload)),
+                        ('decode old', lambda: libhal.slip_decode(encoded)),
+                        ('decode new', lambda: slip.slip_decode(encoded)),
+                        ('stream old', lambda: old_stream_decode(chunks)),
+                        ('stream new', lambda: new_stream_decode(chunks)),
+                        ('mux old', lambda: old_mux_reply_path(chunks)),
+                        ('mux new', lambda: new_mux_reply_path(chunks))):
+        count = ITERATIONS
+        if not label.startswith('encode') and not label.startswith('decode'):
+            count = ITERATIONS / STREAM_FRAMES
+            per_frame = STREAM_FRAMES
+        else:
+            per_frame = 1
+
+        seconds = min(timeit.repeat(func, number = count, repeat = 3))
+        results.append((label, seconds * 1e9 / (count * per_frame)))
+
+    print '%s (%i bytes)' % (name, size)
+    for label, ns in results:
+        print '    %-12s %8.0f ns/frame' % (label, ns)
+
+def main():
+    for name, size in PAYLOADS:
+        run_payload(name, size)
+
+if __name__ == "__main__":
+    main()
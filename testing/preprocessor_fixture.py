@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from cache import HSMCache
+from rpc_handling import RPCPreprocessor
+from settings import Settings
+from hsm_tools import rpc_schema
+from hsm_tools.hsm import CrypTechDeviceState
+
+
+class FakeSerial(object):
+    """The parts of DKSRPCIOStream that RPCPreprocessor configures"""
+    def __init__(self):
+        self.window = None
+        self.priority_aging = None
+        self.queue_limits = None
+        self.queue_full = False
+
+    def set_window(self, window):
+        self.window = window
+
+    def set_priority_aging(self, priority_aging):
+        self.priority_aging = priority_aging
+
+    def set_queue_limits(self, limit, bulk_limit):
+        self.queue_limits = (limit, bulk_limit)
+
+    def is_queue_full(self):
+        return self.queue_full
+
+
+class FakeRPC(object):
+    """An alpha that RPCPreprocessor can send requests to. The tests
+    play the part of the alpha by passing replies to the callbacks"""
+    def __init__(self, name):
+        self.name = name
+        self.state = CrypTechDeviceState.HSMReady
+        self.serial = FakeSerial()
+
+    def change_state(self, state):
+        self.state = state
+
+    def get_busy_factor(self):
+        return 0 if self.state == CrypTechDeviceState.HSMReady else -1
+
+
+class PreprocessorTestCase(unittest.TestCase):
+    """Base class for tests of RPCPreprocessor with fake alphas"""
+    device_count = 2
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+        # Settings saves itself when python exits so the folder is
+        # removed after that
+        atexit.register(shutil.rmtree, self.folder, True)
+
+        self.settings = Settings(os.path.join(self.folder, 'settings.json'))
+        self.cache = HSMCache(self.device_count, self.folder)
+        self.rpc_list = [FakeRPC('RPC%i' % i) for i in xrange(self.device_count)]
+        self.preprocessor = RPCPreprocessor(self.rpc_list, self.cache, self.settings, None)
+        self.session = self.preprocessor.create_session(1, False)
+
+    def request(self, code, *fields):
+        return rpc_schema.REQUESTS[code].encode(code, 1, *fields)
+
+    def reply(self, code, *fields):
+        return rpc_schema.RESPONSES[code].encode(code, 1, *fields)
+
+    def process(self, code, *fields):
+        return self.preprocessor.process_incoming_rpc(self.request(code, *fields), self.session)
+
+    def device_index(self, action):
+        return self.rpc_list.index(action.rpc_list[0])
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from uuid import UUID, uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from cache import HSMCache
+from hsm_tools.pkcs11_attr import CKA
+
+
+class TestCacheMatchKeys(unittest.TestCase):
+    """HSMCache.match_keys must agree with an alpha or return None"""
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = HSMCache(2, self.folder)
+
+        self.label_a = self.cache.add_key_to_alpha(0, uuid4(), 1, 0, auto_backup = False,
+                                                   attributes = {CKA.CKA_LABEL.value : 'a'})
+        self.label_b = self.cache.add_key_to_alpha(1, uuid4(), 1, 0, auto_backup = False,
+                                                   attributes = {CKA.CKA_LABEL.value : 'b'})
+        self.issuer = self.cache.add_key_to_alpha(0, uuid4(), 1, 0, auto_backup = False,
+                                                  attributes = {CKA.CKA_LABEL.value : 'a'})
+        self.cache.set_key_attributes(self.issuer, [(CKA.CKA_ISSUER.value, 'ca')])
+
+        self.cache.set_index_warm(True)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors = True)
+
+    def order(self, master_uuid):
+        # the alphas return keys by alpha and then by device uuid
+        alphas = self.cache.get_alphas(master_uuid)
+        return (min(alphas), alphas[min(alphas)])
+
+    def expected(self, *master_uuids):
+        return sorted(master_uuids, key = self.order)
+
+    def match(self, attributes, result_max = 10, previous_uuid = UUID(int = 0)):
+        return self.cache.match_keys(0, 0, 0, 0, attributes, result_max, previous_uuid)
+
+    def test_cold_index(self):
+        self.cache.set_index_warm(False)
+        self.assertIsNone(self.match([]))
+
+    def test_no_attributes(self):
+        self.assertEqual(self.match([]), self.expected(self.label_a, self.label_b, self.issuer))
+
+    def test_indexed_attribute(self):
+        self.assertEqual(self.match([(CKA.CKA_LABEL.value, 'a')]), self.expected(self.label_a, self.issuer))
+        self.assertEqual(self.match([(CKA.CKA_LABEL.value, 'b')]), [self.label_b])
+        self.assertEqual(self.match([(CKA.CKA_LABEL.value, 'c')]), [])
+
+    def test_unindexed_attribute(self):
+        # optional attributes aren't read by the synchronizer, so the alphas must be searched
+        self.assertIsNone(self.match([(CKA.CKA_ISSUER.value, 'ca')]))
+        self.assertIsNone(self.match([(CKA.CKA_LABEL.value, 'a'), (CKA.CKA_SERIAL_NUMBER.value, '1')]))
+
+    def test_paging(self):
+        expected = self.expected(self.label_a, self.label_b, self.issuer)
+
+        # the key on alpha 1 comes after both keys on alpha 0
+        self.assertEqual(expected[2], self.label_b)
+
+        self.assertEqual(self.match([], result_max = 2), expected[:2])
+        self.assertEqual(self.match([], result_max = 2, previous_uuid = expected[1]), expected[2:])
+
+    def test_unknown_previous_uuid(self):
+        self.assertIsNone(self.match([], previous_uuid = uuid4()))
+
+    def test_removed_key(self):
+        self.cache.remove_key_from_alpha(1, self.cache.get_alphas(self.label_b)[1])
+        self.assertEqual(self.match([(CKA.CKA_LABEL.value, 'b')]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from settings import HSMSettings
+from hsm_tools.hsm import CrypTechDeviceState
+
+from preprocessor_fixture import PreprocessorTestCase
+
+
+class TestDeviceQueueLimits(PreprocessorTestCase):
+    """Requests must go to alphas that can take them"""
+    device_count = 3
+
+    def stats(self, device_index):
+        return self.preprocessor.scheduler.stats[device_index]
+
+    def test_settings(self):
+        self.assertEqual(self.rpc_list[0].serial.queue_limits, (256, 1024 * 1024))
+
+        self.settings.set_setting(HSMSettings.RPC_DEVICE_QUEUE_LIMIT, 4)
+        self.settings.set_setting(HSMSettings.RPC_DEVICE_QUEUE_BYTES, -1)
+        self.preprocessor.set_device_queue_limits(*self.preprocessor.get_device_queue_limits())
+
+        for rpc in self.rpc_list:
+            self.assertEqual(rpc.serial.queue_limits, (4, 0))
+
+    def test_reroute(self):
+        self.rpc_list[1].serial.queue_full = True
+
+        self.assertEqual(self.preprocessor.available_devices(xrange(3)), [0, 2])
+        self.assertEqual(self.stats(1).busy_reroutes, 1)
+
+        for _ in xrange(4):
+            self.assertNotEqual(self.preprocessor.choose_rpc(), 1)
+
+    def test_all_full(self):
+        for rpc in self.rpc_list:
+            rpc.serial.queue_full = True
+
+        # the request is sent anyway and the alpha rejects it
+        self.assertEqual(self.preprocessor.available_devices(xrange(3)), [0, 1, 2])
+        self.assertEqual([self.stats(i).busy_reroutes for i in xrange(3)], [0, 0, 0])
+
+    def test_stopped_device(self):
+        self.rpc_list[2].change_state(CrypTechDeviceState.HSMNotReady)
+
+        self.assertEqual(self.preprocessor.available_devices(xrange(3)), [0, 1])
+        self.assertEqual(self.preprocessor.available_devices([2]), [2])
+
+    def test_busy(self):
+        self.preprocessor.device_busy(self.rpc_list[2])
+
+        self.assertEqual(self.stats(2).busy_rejects, 1)
+        self.assertEqual(self.stats(2).busy_reroutes, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from device_scheduler import DeviceScheduler, RPCClass, EWMA_ALPHA, DEFAULT_SERVICE_TIMES, \
+                             DEFAULT_POLICY, MIN_LATENCY_SAMPLES, get_rpc_class
+from hsm_tools.cryptech_port import DKS_RPCFunc, DKS_HALKeyType
+
+
+class TestDeviceScheduler(unittest.TestCase):
+    """DeviceScheduler must send requests to the alphas that will
+    finish them first"""
+    def test_rpc_class(self):
+        self.assertEqual(get_rpc_class(DKS_RPCFunc.RPC_FUNC_PKEY_SIGN, DKS_HALKeyType.HAL_KEY_TYPE_RSA_PRIVATE),
+                         RPCClass.RSA_SIGN)
+        self.assertEqual(get_rpc_class(DKS_RPCFunc.RPC_FUNC_PKEY_SIGN, DKS_HALKeyType.HAL_KEY_TYPE_EC_PRIVATE),
+                         RPCClass.EC_SIGN)
+        self.assertEqual(get_rpc_class(DKS_RPCFunc.RPC_FUNC_PKEY_SIGN), RPCClass.OTHER)
+        self.assertEqual(get_rpc_class(DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_EC), RPCClass.KEYGEN)
+        self.assertEqual(get_rpc_class(DKS_RPCFunc.RPC_FUNC_PKEY_MATCH), RPCClass.MATCH)
+
+    def test_no_candidates(self):
+        self.assertIsNone(DeviceScheduler(2).choose([]))
+
+    def test_unknown_policy(self):
+        scheduler = DeviceScheduler(2, 'unknown')
+        self.assertEqual(scheduler.get_policy_name(), DEFAULT_POLICY)
+        self.assertFalse(scheduler.set_policy('unknown'))
+
+    def test_idle_devices_rotate(self):
+        for policy_name in ('least-expected-completion', 'least-outstanding', 'round-robin'):
+            scheduler = DeviceScheduler(3, policy_name)
+            self.assertEqual([scheduler.choose(xrange(3)) for _ in xrange(6)], [0, 1, 2, 0, 1, 2])
+
+    def test_candidates(self):
+        scheduler = DeviceScheduler(3, 'round-robin')
+        self.assertEqual([scheduler.choose([0, 2]) for _ in xrange(4)], [0, 2, 0, 2])
+
+    def test_least_expected_completion(self):
+        scheduler = DeviceScheduler(2, 'least-expected-completion')
+
+        # one RSA signature takes longer than several EC signatures
+        scheduler.start(0, RPCClass.RSA_SIGN)
+        for _ in xrange(3):
+            scheduler.start(1, RPCClass.EC_SIGN)
+
+        self.assertEqual(scheduler.choose(xrange(2), RPCClass.EC_SIGN), 1)
+
+    def test_least_outstanding(self):
+        for policy_name in ('least-outstanding', 'power-of-two'):
+            scheduler = DeviceScheduler(2, policy_name)
+            scheduler.start(0, RPCClass.EC_SIGN)
+            scheduler.start(1, RPCClass.RSA_SIGN)
+            scheduler.start(1, RPCClass.RSA_SIGN)
+
+            self.assertEqual(scheduler.choose(xrange(2)), 0)
+
+    def test_service_time(self):
+        scheduler = DeviceScheduler(1)
+        start = scheduler.start(0, RPCClass.EC_SIGN, now = 10.0)
+        scheduler.finish(0, RPCClass.EC_SIGN, start, now = 11.0)
+
+        average = DEFAULT_SERVICE_TIMES[RPCClass.EC_SIGN]
+        self.assertAlmostEqual(scheduler.stats[0].service_time[RPCClass.EC_SIGN],
+                               average + EWMA_ALPHA * (1.0 - average))
+        self.assertEqual(scheduler.stats[0].outstanding_count(), 0)
+
+        # failures don't change the measurements
+        start = scheduler.start(0, RPCClass.EC_SIGN, now = 20.0)
+        scheduler.finish(0, RPCClass.EC_SIGN, start, success = False, now = 30.0)
+        self.assertEqual(scheduler.stats[0].completed, 1)
+
+
+    def test_idle_devices(self):
+        scheduler = DeviceScheduler(3)
+        scheduler.start(0, RPCClass.OTHER, now = 100.0)
+        start_time = scheduler.start(1, RPCClass.OTHER, now = 100.0)
+        scheduler.finish(1, RPCClass.OTHER, start_time, now = 101.0)
+
+        self.assertEqual(scheduler.get_idle_devices(now = 101.0), [1, 2])
+        self.assertEqual(scheduler.get_idle_devices(5, now = 103.0), [2])
+        self.assertEqual(scheduler.get_idle_devices(5, now = 106.0), [1, 2])
+
+    def test_latency_percentile(self):
+        scheduler = DeviceScheduler(1)
+        for elapsed in xrange(1, MIN_LATENCY_SAMPLES):
+            scheduler.finish(0, RPCClass.EC_SIGN, 0.0, now = float(elapsed))
+
+        self.assertIsNone(scheduler.get_latency_percentile(0, RPCClass.EC_SIGN, 0.95))
+
+        scheduler.finish(0, RPCClass.EC_SIGN, 0.0, now = float(MIN_LATENCY_SAMPLES))
+        self.assertEqual(scheduler.get_latency_percentile(0, RPCClass.EC_SIGN, 0.95), 19.0)
+        self.assertEqual(scheduler.get_latency_percentile(0, RPCClass.EC_SIGN, 0.5), 10.0)
+        self.assertEqual(scheduler.get_latency_percentile(0, RPCClass.EC_SIGN, 0), 1.0)
+
+        # failed requests aren't measured
+        scheduler.finish(0, RPCClass.RSA_SIGN, 0.0, success = False, now = 100.0)
+        self.assertEqual(len(scheduler.stats[0].latencies[RPCClass.RSA_SIGN]), 0)
+
+    def test_counts(self):
+        scheduler = DeviceScheduler(2)
+        scheduler.count_timeout(1)
+        scheduler.count_hedge(0)
+        scheduler.count_hedge(0, won = True)
+
+        self.assertEqual(scheduler.stats[1].timeouts, 1)
+        self.assertEqual((scheduler.stats[0].hedged, scheduler.stats[0].hedge_wins), (1, 1))
+
+    def test_reset_device(self):
+        scheduler = DeviceScheduler(2)
+        scheduler.start(0, RPCClass.RSA_SIGN)
+        scheduler.start(0, RPCClass.EC_SIGN)
+        scheduler.start(1, RPCClass.EC_SIGN)
+
+        # requests that were lost when the alpha was reconnected don't
+        # count against it
+        scheduler.reset_device(0)
+        self.assertEqual(scheduler.stats[0].outstanding_count(), 0)
+        self.assertEqual(scheduler.stats[1].outstanding_count(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
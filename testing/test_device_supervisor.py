@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from device_supervisor import DeviceHealthMonitor, PROBE_FAILURE_LIMIT, RECONNECT_BASE_DELAY, MAX_TRANSITIONS
+from hsm_tools.hsm import CrypTechDeviceState
+
+
+class TestDeviceHealthMonitor(unittest.TestCase):
+    """DeviceHealthMonitor must notice alphas that stop answering"""
+    def setUp(self):
+        self.monitor = DeviceHealthMonitor(2)
+
+    def test_probe_failures(self):
+        for _ in xrange(PROBE_FAILURE_LIMIT - 1):
+            self.assertFalse(self.monitor.probe_finished(0, None))
+
+        # a good probe starts the count again
+        self.assertFalse(self.monitor.probe_finished(0, 0.01))
+        for _ in xrange(PROBE_FAILURE_LIMIT - 1):
+            self.assertFalse(self.monitor.probe_finished(0, None))
+        self.assertTrue(self.monitor.probe_finished(0, None))
+
+        self.assertEqual(self.monitor.health[1].probes, 0)
+
+    def test_latency(self):
+        self.monitor.probe_finished(0, 0.01)
+        self.assertEqual(self.monitor.health[0].latency, 0.01)
+
+        self.monitor.probe_finished(0, 0.02)
+        self.assertTrue(0.01 < self.monitor.health[0].latency < 0.02)
+
+    def test_error_rate(self):
+        self.monitor.request_finished(0, False)
+        self.assertGreater(self.monitor.health[0].error_rate, 0)
+
+        for _ in xrange(50):
+            self.monitor.request_finished(0, True)
+        self.assertLess(self.monitor.health[0].error_rate, 0.001)
+
+    def test_reconnect_backoff(self):
+        delays = []
+        for _ in xrange(4):
+            delays.append(self.monitor.reconnect_delay(0, 60))
+            self.monitor.reconnect_failed(0)
+
+        self.assertEqual(delays, [RECONNECT_BASE_DELAY * 2 ** i for i in xrange(4)])
+
+        for _ in xrange(20):
+            self.monitor.reconnect_failed(0)
+        self.assertEqual(self.monitor.reconnect_delay(0, 60), 60)
+
+        # a reconnect starts the backoff again
+        self.monitor.reconnected(0)
+        self.assertEqual(self.monitor.reconnect_delay(0, 60), RECONNECT_BASE_DELAY)
+        self.assertEqual(self.monitor.health[0].reconnects, 1)
+
+    def test_transitions(self):
+        self.monitor.observe(0, CrypTechDeviceState.HSMReady, now = 1.0)
+        self.monitor.observe(0, CrypTechDeviceState.HSMReady, now = 2.0)
+        self.monitor.observe(0, CrypTechDeviceState.HSMNotReady, 'probe failed', now = 3.0)
+
+        self.assertEqual(list(self.monitor.health[0].transitions),
+                         [(1.0, CrypTechDeviceState.HSMReady, None),
+                          (3.0, CrypTechDeviceState.HSMNotReady, 'probe failed')])
+
+        for _ in xrange(MAX_TRANSITIONS // 2):
+            self.monitor.observe(0, CrypTechDeviceState.HSMReady)
+            self.monitor.observe(0, CrypTechDeviceState.HSMNotReady)
+        self.assertEqual(len(self.monitor.health[0].transitions), MAX_TRANSITIONS)
+
+    def test_status(self):
+        self.monitor.probe_finished(1, 0.0125)
+        self.monitor.observe(1, CrypTechDeviceState.HSMNotReady, 'probe failed')
+
+        lines = self.monitor.get_status(1)
+        self.assertEqual(lines[0], 'probe 12.5ms, errors 0.0%, reconnects 0')
+        self.assertTrue(lines[1].endswith('%s (probe failed)' % CrypTechDeviceState.HSMNotReady.value))
+
+        self.assertEqual(self.monitor.get_status(0), ['probe none, errors 0.0%, reconnects 0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import unittest
+
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from rpc_handling import KeyHandleDetails
+from hsm_tools import rpc_schema
+from hsm_tools.cryptech_port import DKS_RPCFunc, DKS_HALError, DKS_HALKeyType
+from hsm_tools.hsm import CrypTechDeviceState
+
+from preprocessor_fixture import PreprocessorTestCase
+
+SIGN = DKS_RPCFunc.RPC_FUNC_PKEY_SIGN
+OPEN = DKS_RPCFunc.RPC_FUNC_PKEY_OPEN
+CLOSE = DKS_RPCFunc.RPC_FUNC_PKEY_CLOSE
+
+
+class TestFailover(PreprocessorTestCase):
+    """Open keys must move to another alpha with a copy of the key when
+    their alpha stops working"""
+    device_count = 3
+
+    def setUp(self):
+        PreprocessorTestCase.setUp(self)
+
+        keytype = DKS_HALKeyType.HAL_KEY_TYPE_EC_PRIVATE
+        self.device_uuids = [uuid4(), uuid4()]
+        master_uuid = self.cache.add_key_to_alpha(0, self.device_uuids[0], keytype, auto_backup = False)
+        self.cache.add_key_to_alpha(1, self.device_uuids[1], keytype, param_masterListID = master_uuid,
+                                    auto_backup = False)
+
+        self.key_details = KeyHandleDetails(0, self.device_uuids[0], 9, keytype, 3, master_uuid)
+        self.session.key_rpcs[5] = self.key_details
+
+        self.rpc_list[0].change_state(CrypTechDeviceState.HSMNotReady)
+
+    def sign(self):
+        return self.process(SIGN, 5, 0, 'digest', 64)
+
+    def opened(self, action, device_handle):
+        return action.callback(action, [self.reply(OPEN, DKS_HALError.HAL_OK, device_handle)])
+
+    def test_failover(self):
+        action = self.sign()
+
+        # the key is opened on the alpha with the other copy
+        self.assertEqual(self.device_index(action), 1)
+        fields = rpc_schema.REQUESTS[OPEN].decode(action.request)
+        self.assertEqual((fields['session'], fields['uuid']), (3, self.device_uuids[1]))
+
+        # then the request is sent there
+        action = self.opened(action, 40)
+        self.assertEqual(self.device_index(action), 1)
+        self.assertEqual(rpc_schema.REQUESTS[SIGN].decode(action.request)['handle'], 40)
+
+        key_details = self.session.key_rpcs[5]
+        self.assertEqual((key_details.rpc_index, key_details.uuid, key_details.device_handle),
+                         (1, self.device_uuids[1], 40))
+
+        # later requests go straight to the new alpha
+        action = self.sign()
+        self.assertEqual(self.device_index(action), 1)
+        self.assertEqual(rpc_schema.get_header(action.request)[0], SIGN)
+
+    def test_race(self):
+        first = self.sign()
+        second = self.sign()
+
+        self.opened(first, 40)
+        action = self.opened(second, 41)
+
+        # the extra copy is closed and the request uses the first copy
+        self.assertEqual(rpc_schema.REQUESTS[SIGN].decode(action.request)['handle'], 40)
+        self.assertEqual(rpc_schema.REQUESTS[CLOSE].decode(action.background.request)['handle'], 41)
+        self.assertEqual(self.device_index(action.background), 1)
+
+    def test_closed_handle(self):
+        action = self.sign()
+        del self.session.key_rpcs[5]
+
+        action = self.opened(action, 40)
+        self.assertEqual(action.result, rpc_schema.error_response(SIGN, 1, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS))
+        self.assertEqual(rpc_schema.REQUESTS[CLOSE].decode(action.background.request)['handle'], 40)
+
+    def test_open_failure(self):
+        action = self.sign()
+        action = action.callback(action, [rpc_schema.error_response(OPEN, 1, DKS_HALError.HAL_ERROR_KEY_NOT_FOUND)])
+
+        self.assertEqual(action.result, rpc_schema.error_response(SIGN, 1, DKS_HALError.HAL_ERROR_KEY_NOT_FOUND))
+        self.assertEqual(self.session.key_rpcs[5].rpc_index, 0)
+
+    def test_no_copy(self):
+        self.rpc_list[1].change_state(CrypTechDeviceState.HSMNotReady)
+
+        # the request goes to the alpha that stopped and fails there
+        action = self.sign()
+        self.assertEqual(self.device_index(action), 0)
+        self.assertEqual(rpc_schema.get_header(action.request)[0], SIGN)
+
+    def test_session_alpha(self):
+        self.session.rpc_index = 0
+
+        action = self.sign()
+        self.assertEqual(self.device_index(action), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
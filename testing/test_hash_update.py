@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from rpc_handling import HashHandleDetails, MAX_HASH_UPDATE_SIZE
+from hsm_tools import rpc_schema
+from hsm_tools.cryptech_port import DKS_RPCFunc, DKS_HALError
+from settings import HSMSettings
+
+from preprocessor_fixture import PreprocessorTestCase
+
+UPDATE = DKS_RPCFunc.RPC_FUNC_HASH_UPDATE
+FINALIZE = DKS_RPCFunc.RPC_FUNC_HASH_FINALIZE
+
+
+class TestHashUpdateCoalescing(PreprocessorTestCase):
+    """Small HASH_UPDATEs must reach the alpha in order as fewer,
+    larger updates"""
+    def setUp(self):
+        PreprocessorTestCase.setUp(self)
+        self.settings.set_setting(HSMSettings.HASH_UPDATE_COALESCE_SIZE, 8)
+
+        # a keyed hash on the second alpha
+        self.session.hash_rpcs[3] = HashHandleDetails(1, 77)
+
+    def update(self, data):
+        return self.process(UPDATE, 3, data)
+
+    def sent(self, action):
+        self.assertEqual(self.device_index(action), 1)
+        return rpc_schema.REQUESTS[UPDATE].decode(action.request)
+
+    def test_buffered(self):
+        for data in ('abc', 'def'):
+            action = self.update(data)
+            self.assertEqual(action.result, rpc_schema.error_response(UPDATE, 1, DKS_HALError.HAL_OK))
+            self.assertIsNone(action.rpc_list)
+
+        fields = self.sent(self.update('ghi'))
+        self.assertEqual(fields['handle'], 77)
+        self.assertEqual(fields['data'], 'abcdefghi')
+
+    def test_large_update(self):
+        fields = self.sent(self.update('0123456789'))
+        self.assertEqual(fields['handle'], 77)
+        self.assertEqual(fields['data'], '0123456789')
+
+    def test_max_size(self):
+        self.settings.set_setting(HSMSettings.HASH_UPDATE_COALESCE_SIZE, MAX_HASH_UPDATE_SIZE * 2)
+
+        self.update('a' * (MAX_HASH_UPDATE_SIZE - 1))
+        fields = self.sent(self.update('bcd'))
+
+        # the rest waits for the next update
+        self.assertEqual(fields['data'], 'a' * (MAX_HASH_UPDATE_SIZE - 1) + 'b')
+        self.assertEqual(self.session.hash_updates[3].take(), 'cd')
+
+    def test_disabled(self):
+        self.settings.set_setting(HSMSettings.HASH_UPDATE_COALESCE_SIZE, 0)
+
+        fields = self.sent(self.update('a'))
+        self.assertEqual(fields['data'], 'a')
+
+    def test_finalize_flushes(self):
+        self.update('abc')
+
+        action = self.process(FINALIZE, 3, 32)
+        fields = self.sent(action)
+        self.assertEqual(fields['data'], 'abc')
+        self.assertNotIn(3, self.session.hash_rpcs)
+
+        action = action.callback(action, [rpc_schema.error_response(UPDATE, 1, DKS_HALError.HAL_OK)])
+        self.assertEqual(rpc_schema.REQUESTS[FINALIZE].decode(action.request)['handle'], 77)
+
+        reply = self.reply(FINALIZE, DKS_HALError.HAL_OK, 'digest')
+        self.assertEqual(action.callback(action, [reply]).result, reply)
+
+    def test_flush_error(self):
+        self.update('abc')
+
+        action = self.process(FINALIZE, 3, 32)
+        action = action.callback(action, [rpc_schema.error_response(UPDATE, 1, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS)])
+
+        # finalize is still sent so the alpha frees the hash
+        code, _ = rpc_schema.get_header(action.request)
+        self.assertEqual(code, FINALIZE)
+
+        action = action.callback(action, [self.reply(FINALIZE, DKS_HALError.HAL_OK, 'digest')])
+        self.assertEqual(action.result, rpc_schema.error_response(FINALIZE, 1, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS))
+
+    def test_finalize_without_updates(self):
+        action = self.process(FINALIZE, 3, 32)
+
+        self.assertIsNone(action.callback)
+        self.assertEqual(rpc_schema.REQUESTS[FINALIZE].decode(action.request)['handle'], 77)
+
+
+if __name__ == '__main__':
+    unittest.main()
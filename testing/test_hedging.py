@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import unittest
+
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from device_scheduler import RPCClass, MIN_LATENCY_SAMPLES
+from rpc_handling import KeyHandleDetails
+from settings import HSMSettings
+from hsm_tools import rpc_schema
+from hsm_tools.cryptech_port import DKS_RPCFunc, DKS_HALError, DKS_HALKeyType
+from hsm_tools.hsm import CrypTechDeviceState
+
+from preprocessor_fixture import PreprocessorTestCase
+
+SIGN = DKS_RPCFunc.RPC_FUNC_PKEY_SIGN
+OPEN = DKS_RPCFunc.RPC_FUNC_PKEY_OPEN
+CLOSE = DKS_RPCFunc.RPC_FUNC_PKEY_CLOSE
+
+
+class TestHedging(PreprocessorTestCase):
+    """A slow key operation must be repeated on another alpha with a
+    copy of the key"""
+    def setUp(self):
+        PreprocessorTestCase.setUp(self)
+        self.settings.set_setting(HSMSettings.RPC_HEDGING, True)
+
+        keytype = DKS_HALKeyType.HAL_KEY_TYPE_EC_PRIVATE
+        self.device_uuids = [uuid4(), uuid4()]
+        master_uuid = self.cache.add_key_to_alpha(0, self.device_uuids[0], keytype, auto_backup = False)
+        self.cache.add_key_to_alpha(1, self.device_uuids[1], keytype, param_masterListID = master_uuid,
+                                    auto_backup = False)
+
+        self.session.key_rpcs[5] = KeyHandleDetails(0, self.device_uuids[0], 9, keytype, 3, master_uuid)
+
+    def sign(self):
+        return self.process(SIGN, 5, 0, 'digest', 64)
+
+    def test_hedge(self):
+        action = self.sign()
+        self.assertEqual(self.device_index(action), 0)
+        self.assertEqual(rpc_schema.REQUESTS[SIGN].decode(action.request)['handle'], 9)
+
+        # the key is opened on the other alpha with the same session
+        hedge = action.hedge
+        self.assertEqual(self.device_index(hedge), 1)
+        fields = rpc_schema.REQUESTS[OPEN].decode(hedge.request)
+        self.assertEqual((fields['session'], fields['uuid']), (3, self.device_uuids[1]))
+
+        hedge = hedge.callback(hedge, [self.reply(OPEN, DKS_HALError.HAL_OK, 40)])
+        self.assertEqual(self.device_index(hedge), 1)
+        self.assertEqual(rpc_schema.REQUESTS[SIGN].decode(hedge.request)['handle'], 40)
+
+        # the reply is used and the key is closed afterwards
+        reply = self.reply(SIGN, DKS_HALError.HAL_OK, 'signature')
+        hedge = hedge.callback(hedge, [reply])
+        self.assertEqual(hedge.result, reply)
+        self.assertEqual(rpc_schema.REQUESTS[CLOSE].decode(hedge.background.request)['handle'], 40)
+        self.assertEqual(self.device_index(hedge.background), 1)
+
+    def test_first_alpha_answered(self):
+        hedge = self.sign().hedge
+        hedge.done(None)
+
+        # the key was opened too late so it's closed right away
+        hedge = hedge.callback(hedge, [self.reply(OPEN, DKS_HALError.HAL_OK, 40)])
+        self.assertEqual(rpc_schema.get_header(hedge.request)[0], CLOSE)
+
+    def test_open_failure(self):
+        hedge = self.sign().hedge
+        hedge = hedge.callback(hedge, [rpc_schema.error_response(OPEN, 1, DKS_HALError.HAL_ERROR_KEY_NOT_FOUND)])
+
+        self.assertIsNone(hedge.rpc_list)
+        self.assertIsNone(hedge.result)
+
+    def test_not_hedged(self):
+        self.settings.set_setting(HSMSettings.RPC_HEDGING, False)
+        self.assertIsNone(self.sign().hedge)
+        self.settings.set_setting(HSMSettings.RPC_HEDGING, True)
+
+        # no other working alpha has the key
+        self.rpc_list[1].change_state(CrypTechDeviceState.HSMNotReady)
+        self.assertIsNone(self.sign().hedge)
+        self.rpc_list[1].change_state(CrypTechDeviceState.HSMReady)
+
+        # the session chose its alpha
+        self.session.rpc_index = 0
+        self.assertIsNone(self.sign().hedge)
+
+    def test_hedge_delay(self):
+        rpc = self.rpc_list[0]
+        self.assertIsNone(self.preprocessor.get_hedge_delay(rpc, RPCClass.EC_SIGN))
+
+        for _ in xrange(MIN_LATENCY_SAMPLES):
+            self.preprocessor.scheduler.finish(0, RPCClass.EC_SIGN, 0.0, now = 0.5)
+
+        self.assertEqual(self.preprocessor.get_hedge_delay(rpc, RPCClass.EC_SIGN), 0.5)
+
+    def test_timeout(self):
+        self.preprocessor.device_timeout(self.rpc_list[1])
+
+        self.assertEqual(self.preprocessor.scheduler.stats[1].timeouts, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import hashlib
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from host_hash import HostHash, HOST_HASH_ALGORITHMS, is_host_hash_handle
+from rpc_handling import KeyHandleDetails
+from hsm_tools import rpc_schema
+from hsm_tools.cryptech_port import DKS_RPCFunc, DKS_HALError, DKS_HALDigestAlgorithm, DKS_HALKeyType
+from settings import HSMSettings
+
+from preprocessor_fixture import PreprocessorTestCase
+
+SHA256 = DKS_HALDigestAlgorithm.HAL_DIGEST_ALGORITHM_SHA256
+
+
+class TestHostHash(unittest.TestCase):
+    """HostHash must match hashlib and the digests from an alpha"""
+    def test_digests(self):
+        for algorithm, (name, prefix) in HOST_HASH_ALGORITHMS.iteritems():
+            host_hash = HostHash(algorithm)
+            host_hash.update('abc')
+            host_hash.update('def')
+
+            expected = hashlib.new(name, 'abcdef').digest()
+            self.assertEqual(host_hash.digest(), expected)
+            self.assertEqual(host_hash.digest_length, len(expected))
+            self.assertEqual(host_hash.digest_info(), prefix + expected)
+
+    def test_digest_info(self):
+        host_hash = HostHash(SHA256)
+        host_hash.update('abc')
+
+        # RFC 8017 section 9.2
+        self.assertEqual(host_hash.digest_info()[:19].encode('hex'),
+                         '3031300d060960864801650304020105000420')
+
+    def test_handles(self):
+        self.assertTrue(is_host_hash_handle(0x80000001))
+        self.assertFalse(is_host_hash_handle(1))
+
+
+class TestHostHashing(PreprocessorTestCase):
+    """Un-keyed hashes must be done without an alpha"""
+    def start_hash(self, key = ''):
+        action = self.process(DKS_RPCFunc.RPC_FUNC_HASH_INITIALIZE, 0, SHA256, key)
+        return rpc_schema.RESPONSES[DKS_RPCFunc.RPC_FUNC_HASH_INITIALIZE].get(action.result, 'handle')
+
+    def test_hash(self):
+        handle = self.start_hash()
+        self.assertTrue(is_host_hash_handle(handle))
+
+        for data in ('abc', 'def'):
+            action = self.process(DKS_RPCFunc.RPC_FUNC_HASH_UPDATE, handle, data)
+            self.assertEqual(action.result, rpc_schema.error_response(DKS_RPCFunc.RPC_FUNC_HASH_UPDATE, 1,
+                                                                      DKS_HALError.HAL_OK))
+
+        action = self.process(DKS_RPCFunc.RPC_FUNC_HASH_GET_ALGORITHM, handle)
+        self.assertEqual(action.result, self.reply(DKS_RPCFunc.RPC_FUNC_HASH_GET_ALGORITHM,
+                                                   DKS_HALError.HAL_OK, SHA256))
+
+        action = self.process(DKS_RPCFunc.RPC_FUNC_HASH_FINALIZE, handle, 32)
+        self.assertEqual(action.result, self.reply(DKS_RPCFunc.RPC_FUNC_HASH_FINALIZE, DKS_HALError.HAL_OK,
+                                                   hashlib.sha256('abcdef').digest()))
+        self.assertNotIn(handle, self.session.host_hashes)
+
+    def test_short_digest(self):
+        handle = self.start_hash()
+
+        action = self.process(DKS_RPCFunc.RPC_FUNC_HASH_FINALIZE, handle, 16)
+        self.assertEqual(action.result, rpc_schema.error_response(DKS_RPCFunc.RPC_FUNC_HASH_FINALIZE, 1,
+                                                                  DKS_HALError.HAL_ERROR_BAD_ARGUMENTS))
+        self.assertNotIn(handle, self.session.host_hashes)
+
+    def test_hmac_uses_alpha(self):
+        action = self.process(DKS_RPCFunc.RPC_FUNC_HASH_INITIALIZE, 0, SHA256, 'key')
+        self.assertIsNone(action.result)
+        self.assertEqual(len(action.rpc_list), 1)
+
+    def test_disabled(self):
+        self.settings.set_setting(HSMSettings.HOST_HASHING, False)
+
+        action = self.process(DKS_RPCFunc.RPC_FUNC_HASH_INITIALIZE, 0, SHA256, '')
+        self.assertIsNone(action.result)
+
+    def sign(self, keytype):
+        self.session.key_rpcs[5] = KeyHandleDetails(1, None, 9, keytype)
+
+        handle = self.start_hash()
+        self.process(DKS_RPCFunc.RPC_FUNC_HASH_UPDATE, handle, 'abc')
+
+        action = self.process(DKS_RPCFunc.RPC_FUNC_PKEY_SIGN, 5, handle, '', 512)
+        self.assertNotIn(handle, self.session.host_hashes)
+        self.assertEqual(self.device_index(action), 1)
+
+        return rpc_schema.REQUESTS[DKS_RPCFunc.RPC_FUNC_PKEY_SIGN].decode(action.request)
+
+    def test_sign_ec(self):
+        fields = self.sign(DKS_HALKeyType.HAL_KEY_TYPE_EC_PRIVATE)
+
+        self.assertEqual(fields['handle'], 9)
+        self.assertEqual(fields['hash'], 0)
+        self.assertEqual(fields['data'], hashlib.sha256('abc').digest())
+        self.assertEqual(fields['length'], 512)
+
+    def test_sign_rsa(self):
+        fields = self.sign(DKS_HALKeyType.HAL_KEY_TYPE_RSA_PRIVATE)
+
+        self.assertEqual(fields['hash'], 0)
+        self.assertEqual(fields['data'], HostHash(SHA256).prefix + hashlib.sha256('abc').digest())
+
+    def test_sign_unknown_keytype(self):
+        self.session.key_rpcs[5] = KeyHandleDetails(0, None, 9)
+
+        handle = self.start_hash()
+        action = self.process(DKS_RPCFunc.RPC_FUNC_PKEY_SIGN, 5, handle, '', 512)
+
+        # the key type is asked for first
+        code, _ = rpc_schema.get_header(action.request)
+        self.assertEqual(code, DKS_RPCFunc.RPC_FUNC_PKEY_GET_KEY_TYPE)
+
+        action = action.callback(action, [self.reply(code, DKS_HALError.HAL_OK,
+                                                     DKS_HALKeyType.HAL_KEY_TYPE_EC_PRIVATE)])
+        fields = rpc_schema.REQUESTS[DKS_RPCFunc.RPC_FUNC_PKEY_SIGN].decode(action.request)
+        self.assertEqual(fields['data'], hashlib.sha256('').digest())
+        self.assertEqual(self.session.key_rpcs[5].keytype, DKS_HALKeyType.HAL_KEY_TYPE_EC_PRIVATE)
+
+
+if __name__ == '__main__':
+    unittest.main()
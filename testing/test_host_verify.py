@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import hashlib
+import unittest
+
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from host_verify import parse_public_key, can_verify, verify, RSAPublicKey, ECPublicKey
+from key_metadata_cache import KeyMetadataCache
+from rpc_handling import KeyHandleDetails
+from hsm_tools import rpc_schema
+from hsm_tools.cryptech_port import DKS_RPCFunc, DKS_HALError, DKS_HALKeyType
+
+from preprocessor_fixture import PreprocessorTestCase
+
+SHA256_PREFIX = '3031300d060960864801650304020105000420'.decode('hex')
+
+
+def der(tag, contents):
+    length = len(contents)
+    if (length < 0x80):
+        return chr(tag) + chr(length) + contents
+
+    encoded = ('%x' % length).zfill(4).decode('hex')
+    return chr(tag) + chr(0x80 | len(encoded)) + encoded + contents
+
+def der_integer(value):
+    encoded = ('%x' % value)
+    encoded = ('0' * (len(encoded) % 2) + encoded).decode('hex')
+    if (ord(encoded[0]) & 0x80):
+        encoded = '\x00' + encoded
+
+    return der(0x02, encoded)
+
+def ec_public_key(curve_oid, x, y, length):
+    algorithm = der(0x30, der(0x06, '2a8648ce3d0201'.decode('hex')) + der(0x06, curve_oid.decode('hex')))
+    point = '\x04' + ('%0*x' % (2 * length, x)).decode('hex') + ('%0*x' % (2 * length, y)).decode('hex')
+
+    return der(0x30, algorithm + der(0x03, '\x00' + point))
+
+def rsa_public_key(n, e):
+    algorithm = der(0x30, der(0x06, '2a864886f70d010101'.decode('hex')) + '\x05\x00')
+
+    return der(0x30, algorithm + der(0x03, '\x00' + der(0x30, der_integer(n) + der_integer(e))))
+
+def signature(r, s, length):
+    return ('%0*x%0*x' % (2 * length, r, 2 * length, s)).decode('hex')
+
+# RFC 6979 A.2.5
+P256_KEY = ec_public_key('2a8648ce3d030107',
+                         0x60FED4BA255A9D31C961EB74C6356D68C049B8923B61FA6CE669622E60F29FB6,
+                         0x7903FE1008B8BC99A41AE9E95628BC64F2F1B20C2D7E9F5177A3C294D4462299, 32)
+P256_SAMPLE = signature(0xEFD48B2AACB6A8FD1140DD9CD45E81D69D2C877B56AAF991C34D0EA84EAF3716,
+                        0xF7CB1C942D657C41D436C7A1B6E29F65F3E900DBB9AFF4064DC4AB2F843ACDA8, 32)
+P256_TEST = signature(0xF1ABB023518351CD71D881567B1EA663ED3EFCF6C5132B354F28D3B0B7D38367,
+                      0x019F4113742A2B14BD25926B49C649155F267E60D3814B4C0CC84250E46F0083, 32)
+
+# RFC 6979 A.2.6
+P384_KEY = ec_public_key('2b81040022',
+                         0xEC3A4E415B4E19A4568618029F427FA5DA9A8BC4AE92E02E06AAE5286B300C64DEF8F0EA9055866064A254515480BC13,
+                         0x8015D9B72D7D57244EA8EF9AC0C621896708A59367F9DFB9F54CA84B3F1C9DB1288B231C3AE0D4FE7344FD2533264720,
+                         48)
+P384_SAMPLE = signature(0x94EDBB92A5ECB8AAD4736E56C691916B3F88140666CE9FA73D64C4EA95AD133C81A648152E44ACF96E36DD1E80FABE46,
+                        0x99EF4AEB15F178CEA1FE40DB2603138F130E740A19624526203B6351D0A3A94FA329C145786E679E7B82C71A38628AC8,
+                        48)
+
+# a small RSA key made from two Mersenne primes
+RSA_P = (1 << 127) - 1
+RSA_Q = (1 << 521) - 1
+RSA_E = 65537
+RSA_N = RSA_P * RSA_Q
+RSA_LENGTH = (RSA_N.bit_length() + 7) // 8
+
+def inverse(value, modulus):
+    old_r, r = value, modulus
+    old_s, s = 1, 0
+    while (r):
+        quotient = old_r // r
+        old_r, r = r, old_r - quotient * r
+        old_s, s = s, old_s - quotient * s
+
+    return old_s % modulus
+
+def rsa_sign(digest_info):
+    d = inverse(RSA_E, (RSA_P - 1) * (RSA_Q - 1))
+    padded = '\x00\x01' + '\xff' * (RSA_LENGTH - len(digest_info) - 3) + '\x00' + digest_info
+
+    return ('%0*x' % (2 * RSA_LENGTH, pow(int(padded.encode('hex'), 16), d, RSA_N))).decode('hex')
+
+
+class TestHostVerify(unittest.TestCase):
+    """Signatures must be checked the same way an alpha checks them"""
+    def test_p256(self):
+        key = parse_public_key(P256_KEY)
+        self.assertIsInstance(key, ECPublicKey)
+        self.assertEqual(key.curve.name, 'P-256')
+
+        sample = hashlib.sha256('sample').digest()
+        self.assertTrue(can_verify(key, sample, P256_SAMPLE))
+        self.assertTrue(verify(key, sample, P256_SAMPLE))
+        self.assertTrue(verify(key, hashlib.sha256('test').digest(), P256_TEST))
+
+        self.assertFalse(verify(key, sample, P256_TEST))
+        self.assertFalse(verify(key, hashlib.sha256('samplf').digest(), P256_SAMPLE))
+
+    def test_p384(self):
+        key = parse_public_key(P384_KEY)
+        self.assertEqual(key.curve.name, 'P-384')
+
+        sample = hashlib.sha384('sample').digest()
+        self.assertTrue(verify(key, sample, P384_SAMPLE))
+        self.assertFalse(verify(key, hashlib.sha384('test').digest(), P384_SAMPLE))
+
+    def test_ec_out_of_range(self):
+        key = parse_public_key(P256_KEY)
+        n = key.curve.n
+
+        self.assertFalse(verify(key, hashlib.sha256('sample').digest(), signature(0, 1, 32)))
+        self.assertFalse(verify(key, hashlib.sha256('sample').digest(), signature(n, 1, 32)))
+
+    def test_rsa(self):
+        key = parse_public_key(rsa_public_key(RSA_N, RSA_E))
+        self.assertEqual(key, RSAPublicKey(RSA_N, RSA_E))
+
+        digest_info = SHA256_PREFIX + hashlib.sha256('sample').digest()
+        signed = rsa_sign(digest_info)
+
+        self.assertTrue(can_verify(key, digest_info, signed))
+        self.assertTrue(verify(key, digest_info, signed))
+        self.assertFalse(verify(key, SHA256_PREFIX + hashlib.sha256('test').digest(), signed))
+
+    def test_can_verify(self):
+        key = parse_public_key(P256_KEY)
+
+        # the alpha returns its own errors for these
+        self.assertFalse(can_verify(key, hashlib.sha256('sample').digest(), P256_SAMPLE[:-1]))
+        self.assertFalse(can_verify(key, hashlib.sha384('sample').digest(), P256_SAMPLE))
+        self.assertFalse(can_verify(None, '', ''))
+
+    def test_bad_keys(self):
+        self.assertIsNone(parse_public_key(''))
+        self.assertIsNone(parse_public_key(P256_KEY[:-1]))
+
+        # not on the curve
+        self.assertIsNone(parse_public_key(ec_public_key('2a8648ce3d030107', 1, 2, 32)))
+
+        # unknown curve
+        self.assertIsNone(parse_public_key(ec_public_key('2b81040021', 1, 2, 32)))
+
+
+class TestKeyMetadataPublicKey(unittest.TestCase):
+    """The public key must be available from a cached GET_PUBLIC_KEY"""
+    def test_get_public_key(self):
+        code = DKS_RPCFunc.RPC_FUNC_PKEY_GET_PUBLIC_KEY
+        cache = KeyMetadataCache(1024 * 1024)
+        uuid = uuid4()
+
+        self.assertIsNone(cache.get_public_key(0, uuid))
+
+        cache.add_reply(0, uuid, rpc_schema.RESPONSES[code].encode(code, 1, DKS_HALError.HAL_OK, P256_KEY))
+        self.assertEqual(cache.get_public_key(0, uuid), P256_KEY)
+        self.assertIsNone(cache.get_public_key(1, uuid))
+
+
+class TestHostVerifying(PreprocessorTestCase):
+    """PKEY_VERIFY must be answered by the host when the public key is
+    known"""
+    def setUp(self):
+        PreprocessorTestCase.setUp(self)
+        self.preprocessor.set_host_verify_processes(1)
+
+        self.uuid = uuid4()
+        self.session.key_rpcs[5] = KeyHandleDetails(1, self.uuid, 9, DKS_HALKeyType.HAL_KEY_TYPE_EC_PUBLIC)
+
+    def tearDown(self):
+        self.preprocessor.set_host_verify_processes(0)
+
+    def add_public_key(self):
+        code = DKS_RPCFunc.RPC_FUNC_PKEY_GET_PUBLIC_KEY
+        self.preprocessor.key_metadata.add_reply(1, self.uuid, self.reply(code, DKS_HALError.HAL_OK, P256_KEY))
+
+    def verify(self, message, signed):
+        action = self.process(DKS_RPCFunc.RPC_FUNC_PKEY_VERIFY, 5, 0, hashlib.sha256(message).digest(), signed)
+        if (action.work is None):
+            return action
+
+        return action.callback(action, [action.work.result()])
+
+    def test_verify(self):
+        self.add_public_key()
+
+        action = self.verify('sample', P256_SAMPLE)
+        self.assertEqual(action.result, rpc_schema.error_response(DKS_RPCFunc.RPC_FUNC_PKEY_VERIFY, 1,
+                                                                  DKS_HALError.HAL_OK))
+
+        action = self.verify('test', P256_SAMPLE)
+        self.assertEqual(action.result, rpc_schema.error_response(DKS_RPCFunc.RPC_FUNC_PKEY_VERIFY, 1,
+                                                                  DKS_HALError.HAL_ERROR_INVALID_SIGNATURE))
+
+    def test_unknown_public_key(self):
+        action = self.verify('sample', P256_SAMPLE)
+
+        self.assertIsNone(action.result)
+        self.assertEqual(self.device_index(action), 1)
+
+    def test_disabled(self):
+        self.add_public_key()
+        self.preprocessor.set_host_verify_processes(0)
+
+        action = self.verify('sample', P256_SAMPLE)
+        self.assertIsNone(action.result)
+        self.assertEqual(self.device_index(action), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
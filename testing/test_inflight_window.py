@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import time
+import unittest
+
+import tornado.gen
+import tornado.queues
+from tornado.testing import AsyncTestCase, gen_test
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from hsm_tools import rpc_schema
+from hsm_tools.cryptech_port import DKS_RPCFunc
+from hsm_tools.rpc_action import RPCPriority
+from hsm_tools.rpciostream import InFlightWindow, DKSRPCIOStream, DeadlineExpired, DeviceBusy
+from hsm_tools.slip import slip_encode, SLIPDecoder
+
+
+class TestInFlightWindow(AsyncTestCase):
+    """InFlightWindow must limit the requests sent to an alpha"""
+    @gen_test
+    def test_limit(self):
+        window = InFlightWindow(2)
+        yield window.acquire()
+        yield window.acquire()
+
+        waiting = window.acquire()
+        self.assertFalse(waiting.done())
+
+        window.release()
+        yield waiting
+        self.assertEqual(window.count, 2)
+
+    @gen_test
+    def test_resize(self):
+        window = InFlightWindow(1)
+        yield window.acquire()
+
+        waiting = window.acquire()
+        window.resize(2)
+        yield waiting
+
+        self.assertEqual(window.count, 2)
+
+    @gen_test
+    def test_reset(self):
+        window = InFlightWindow(1)
+        yield window.acquire()
+
+        waiting = window.acquire()
+        window.reset()
+        yield waiting
+
+        self.assertEqual(window.count, 1)
+
+        # a late reply after a reset can't free a slot that isn't in use
+        window.release()
+        window.release()
+        self.assertEqual(window.count, 0)
+
+    @gen_test
+    def test_abandon(self):
+        window = InFlightWindow(1)
+        yield window.acquire()
+
+        # the slot is given back without waiting for the reply
+        waiting = window.acquire()
+        window.abandon(7)
+        yield waiting
+        self.assertEqual(window.count, 1)
+
+        # the late reply doesn't free the slot of the other request
+        window.release(7)
+        self.assertEqual(window.count, 1)
+        self.assertEqual(window.abandoned, {})
+
+        window.release(8)
+        self.assertEqual(window.count, 0)
+
+    def test_reset_abandoned(self):
+        window = InFlightWindow(1)
+        window.abandon(7)
+        window.reset()
+
+        self.assertEqual(window.abandoned, {})
+
+    @gen_test
+    def test_priority(self):
+        window = InFlightWindow(1)
+        yield window.acquire()
+
+        bulk = window.acquire(RPCPriority.BULK)
+        normal = window.acquire(RPCPriority.NORMAL)
+        high = window.acquire(RPCPriority.HIGH)
+
+        window.release()
+        yield high
+        self.assertFalse(normal.done() or bulk.done())
+
+        window.release()
+        yield normal
+        self.assertFalse(bulk.done())
+
+        window.release()
+        yield bulk
+
+    @gen_test
+    def test_aging(self):
+        window = InFlightWindow(1, aging = 0.01)
+        yield window.acquire()
+
+        # a request that has waited long enough goes ahead of new high
+        # priority requests
+        bulk = window.acquire(RPCPriority.BULK)
+        yield tornado.gen.sleep(0.05)
+        high = window.acquire(RPCPriority.HIGH)
+
+        window.release()
+        yield bulk
+        self.assertFalse(high.done())
+
+        window.release()
+        yield high
+
+    @gen_test
+    def test_deadline(self):
+        window = InFlightWindow(1)
+        yield window.acquire()
+
+        with self.assertRaises(DeadlineExpired):
+            yield window.acquire(deadline = time.time() + 0.02)
+
+        # the expired request doesn't take the slot
+        waiting = window.acquire()
+        window.release()
+        yield waiting
+        self.assertEqual(window.count, 1)
+
+    @gen_test
+    def test_deadline_passed(self):
+        window = InFlightWindow(1)
+
+        with self.assertRaises(DeadlineExpired):
+            yield window.acquire(deadline = time.time() - 1)
+
+        self.assertEqual(window.count, 0)
+
+
+class TestDKSRPCIOStream(AsyncTestCase):
+    """Requests from different clients must share the alpha and the
+    replies must go to the client with the handle in the reply"""
+    def setUp(self):
+        super(TestDKSRPCIOStream, self).setUp()
+
+        # the alpha is the other end of a pseudo terminal
+        self.alpha, device = os.openpty()
+        self.stream = DKSRPCIOStream(os.ttyname(device), window = 2)
+        os.close(device)
+
+        self.io_loop.spawn_callback(self.stream.rpc_output_loop)
+        self.decoder = SLIPDecoder()
+
+    def tearDown(self):
+        self.stream.close()
+        os.close(self.alpha)
+        super(TestDKSRPCIOStream, self).tearDown()
+
+    def request(self, client):
+        code = DKS_RPCFunc.RPC_FUNC_GET_VERSION
+        return rpc_schema.REQUESTS[code].encode(code, client)
+
+    def reply(self, client, version):
+        code = DKS_RPCFunc.RPC_FUNC_GET_VERSION
+        return slip_encode(rpc_schema.RESPONSES[code].encode(code, client, 0, version))
+
+    @tornado.gen.coroutine
+    def read_requests(self, count):
+        requests = []
+        while (len(requests) < count):
+            yield tornado.gen.sleep(0.01)
+            requests.extend(self.decoder.feed(os.read(self.alpha, 4096)))
+
+        raise tornado.gen.Return(requests)
+
+    @gen_test
+    def test_reply_demux(self):
+        queues = dict((client, tornado.queues.Queue()) for client in (1, 2))
+        for client, queue in queues.iteritems():
+            yield self.stream.rpc_input(slip_encode(self.request(client)), client, queue)
+
+        # both requests reach the alpha before either is answered
+        requests = yield self.read_requests(2)
+        self.assertEqual(sorted(requests), [self.request(1), self.request(2)])
+        self.assertEqual(self.stream.in_flight, 2)
+
+        # the alpha can answer in any order
+        os.write(self.alpha, self.reply(2, 20) + self.reply(1, 10))
+
+        for client, version in ((1, 10), (2, 20)):
+            reply = yield queues[client].get()
+            self.assertEqual(rpc_schema.RESPONSES[DKS_RPCFunc.RPC_FUNC_GET_VERSION].get(reply, 'version'),
+                             version)
+
+        self.assertEqual(self.stream.in_flight, 0)
+
+    @gen_test
+    def test_window(self):
+        queues = dict((client, tornado.queues.Queue()) for client in (1, 2, 3))
+        yield self.stream.rpc_input(slip_encode(self.request(1)), 1, queues[1])
+        yield self.stream.rpc_input(slip_encode(self.request(2)), 2, queues[2])
+
+        # the third request waits for a reply
+        waiting = self.stream.rpc_input(slip_encode(self.request(3)), 3, queues[3])
+        yield self.read_requests(2)
+        self.assertFalse(waiting.done())
+
+        os.write(self.alpha, self.reply(1, 10))
+        yield waiting
+
+        requests = yield self.read_requests(1)
+        self.assertEqual(requests, [self.request(3)])
+
+    @gen_test
+    def test_queue_limit(self):
+        self.stream.set_queue_limits(1, 0)
+
+        queues = dict((client, tornado.queues.Queue()) for client in (1, 2, 3, 4))
+        yield self.stream.rpc_input(slip_encode(self.request(1)), 1, queues[1])
+        yield self.stream.rpc_input(slip_encode(self.request(2)), 2, queues[2])
+        self.assertFalse(self.stream.is_queue_full())
+
+        # one request can wait for the window
+        waiting = self.stream.rpc_input(slip_encode(self.request(3)), 3, queues[3])
+        self.assertTrue(self.stream.is_queue_full())
+
+        with self.assertRaises(DeviceBusy):
+            yield self.stream.rpc_input(slip_encode(self.request(4)), 4, queues[4])
+
+        yield self.read_requests(2)
+        os.write(self.alpha, self.reply(1, 10))
+        yield waiting
+
+        self.assertFalse(self.stream.is_queue_full())
+
+    @gen_test
+    def test_queue_byte_limit(self):
+        query = slip_encode(self.request(1))
+        self.stream.set_queue_limits(0, len(query) + 1)
+
+        queues = dict((client, tornado.queues.Queue()) for client in (1, 2, 3, 4))
+        yield self.stream.rpc_input(query, 1, queues[1])
+        yield self.stream.rpc_input(slip_encode(self.request(2)), 2, queues[2])
+
+        self.stream.rpc_input(slip_encode(self.request(3)), 3, queues[3])
+        self.assertFalse(self.stream.is_queue_full())
+        self.stream.rpc_input(slip_encode(self.request(4)), 4, queues[4])
+        self.assertTrue(self.stream.is_queue_full())
+
+
+if __name__ == '__main__':
+    unittest.main()
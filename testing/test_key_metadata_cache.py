@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import unittest
+
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from hsm_tools import rpc_schema
+from hsm_tools.cryptech_port import DKS_RPCFunc, DKS_HALError
+from key_metadata_cache import LRUCache, KeyMetadataCache, AttributeCache, ENTRY_OVERHEAD
+
+
+class TestLRUCache(unittest.TestCase):
+    """LRUCache must stay within its budget by removing the least
+    recently used entries"""
+    def test_eviction(self):
+        cache = LRUCache(3 * (ENTRY_OVERHEAD + 10))
+        for item in xrange(3):
+            cache.put('group', item, str(item), 10)
+
+        # using an entry keeps it
+        self.assertEqual(cache.get('group', 0), '0')
+        cache.put('group', 3, '3', 10)
+
+        self.assertIsNone(cache.get('group', 1))
+        self.assertEqual([cache.get('group', item) for item in (0, 2, 3)], ['0', '2', '3'])
+        self.assertEqual(cache.evictions, 1)
+
+    def test_too_large(self):
+        cache = LRUCache(ENTRY_OVERHEAD + 10)
+        cache.put('group', 0, 'x' * 11, 11)
+
+        self.assertIsNone(cache.get('group', 0))
+        self.assertEqual(cache.size, 0)
+
+    def test_replace(self):
+        cache = LRUCache(1000)
+        cache.put('group', 0, 'a', 1)
+        cache.put('group', 0, 'bb', 2)
+
+        self.assertEqual(cache.get('group', 0), 'bb')
+        self.assertEqual(cache.size, ENTRY_OVERHEAD + 2)
+
+    def test_remove_group(self):
+        cache = LRUCache(1000)
+        cache.put('a', 0, 'a0', 2)
+        cache.put('a', 1, 'a1', 2)
+        cache.put('b', 0, 'b0', 2)
+
+        cache.remove_group('a')
+
+        self.assertIsNone(cache.get('a', 0))
+        self.assertIsNone(cache.get('a', 1))
+        self.assertEqual(cache.get('b', 0), 'b0')
+        self.assertEqual(cache.size, ENTRY_OVERHEAD + 2)
+
+    def test_set_budget(self):
+        cache = LRUCache(1000)
+        cache.put('group', 0, 'a', 1)
+        cache.put('group', 1, 'b', 1)
+
+        cache.set_budget(ENTRY_OVERHEAD + 1)
+
+        self.assertIsNone(cache.get('group', 0))
+        self.assertEqual(cache.get('group', 1), 'b')
+
+
+class TestKeyMetadataCache(unittest.TestCase):
+    """Replies from the cache must match the alpha's replies for the
+    client that's asking"""
+    def setUp(self):
+        self.cache = KeyMetadataCache(1024 * 1024)
+        self.uuid = uuid4()
+
+    def request(self, code, client, *fields):
+        return rpc_schema.REQUESTS[code].encode(code, client, *fields)
+
+    def reply(self, code, client, *fields):
+        return rpc_schema.RESPONSES[code].encode(code, client, DKS_HALError.HAL_OK, *fields)
+
+    def test_reply_for_client(self):
+        code = DKS_RPCFunc.RPC_FUNC_PKEY_GET_KEY_TYPE
+        self.assertIsNone(self.cache.get_reply(0, self.uuid, self.request(code, 1, 5)))
+
+        self.cache.add_reply(0, self.uuid, self.reply(code, 1, 7))
+
+        # the handle is different each time the key is opened
+        self.assertEqual(self.cache.get_reply(0, self.uuid, self.request(code, 2, 9)), self.reply(code, 2, 7))
+
+        # the same uuid on another alpha is another key
+        self.assertIsNone(self.cache.get_reply(1, self.uuid, self.request(code, 2, 9)))
+
+    def test_errors_not_cached(self):
+        code = DKS_RPCFunc.RPC_FUNC_PKEY_GET_KEY_FLAGS
+        self.cache.add_reply(0, self.uuid, rpc_schema.error_response(code, 1, DKS_HALError.HAL_ERROR_KEY_NOT_FOUND))
+
+        self.assertIsNone(self.cache.get_reply(0, self.uuid, self.request(code, 1, 5)))
+
+    def test_uncached_codes(self):
+        code = DKS_RPCFunc.RPC_FUNC_GET_VERSION
+        self.cache.add_reply(0, self.uuid, self.reply(code, 1, 3))
+
+        self.assertEqual(self.cache.get_status().split(',')[0], '0 entries')
+
+    def test_public_key_buffer(self):
+        code = DKS_RPCFunc.RPC_FUNC_PKEY_GET_PUBLIC_KEY
+        self.cache.add_reply(0, self.uuid, self.reply(code, 1, 'x' * 100))
+
+        self.assertEqual(self.cache.get_reply(0, self.uuid, self.request(code, 1, 5, 100)),
+                         self.reply(code, 1, 'x' * 100))
+
+        # the alpha reports that the client's buffer is too small
+        self.assertIsNone(self.cache.get_reply(0, self.uuid, self.request(code, 1, 5, 99)))
+
+    def test_remove_key(self):
+        for code, value in ((DKS_RPCFunc.RPC_FUNC_PKEY_GET_KEY_TYPE, 1),
+                            (DKS_RPCFunc.RPC_FUNC_PKEY_GET_KEY_CURVE, 2)):
+            self.cache.add_reply(0, self.uuid, self.reply(code, 1, value))
+
+        self.cache.remove_key(0, self.uuid)
+
+        self.assertIsNone(self.cache.get_reply(0, self.uuid,
+                                               self.request(DKS_RPCFunc.RPC_FUNC_PKEY_GET_KEY_TYPE, 1, 5)))
+        self.assertIsNone(self.cache.get_reply(0, self.uuid,
+                                               self.request(DKS_RPCFunc.RPC_FUNC_PKEY_GET_KEY_CURVE, 1, 5)))
+
+
+class TestAttributeCache(unittest.TestCase):
+    """GET_ATTRIBUTES must only be answered from the cache when every
+    attribute is known"""
+    code = DKS_RPCFunc.RPC_FUNC_PKEY_GET_ATTRIBUTES
+
+    def setUp(self):
+        self.cache = AttributeCache(1024 * 1024)
+        self.uuid = uuid4()
+
+    def request(self, types, buffer_len = 1024, client = 1):
+        return rpc_schema.REQUESTS[self.code].encode(self.code, client, 5, types, buffer_len)
+
+    def reply(self, attributes, client = 1):
+        return rpc_schema.payload_response(self.code, client, rpc_schema.encode_attributes(attributes))
+
+    def test_encoding(self):
+        attributes = [(1, 'label'), (2, None), (3, '')]
+        self.assertEqual(rpc_schema.decode_attributes(rpc_schema.encode_attributes(attributes)), attributes)
+
+    def test_all_attributes_needed(self):
+        self.cache.add_reply(0, self.uuid, self.request([1]), self.reply([(1, 'a')]))
+
+        self.assertEqual(self.cache.get_reply(0, self.uuid, self.request([1], client = 2)),
+                         self.reply([(1, 'a')], client = 2))
+        self.assertIsNone(self.cache.get_reply(0, self.uuid, self.request([1, 2])))
+
+    def test_lengths(self):
+        self.cache.add_reply(0, self.uuid, self.request([1, 2]), self.reply([(1, 'abc'), (2, None)]))
+
+        # a request for the lengths doesn't fill the cache
+        self.cache.add_reply(1, self.uuid, self.request([1], 0),
+                             rpc_schema.payload_response(self.code, 1, rpc_schema.encode_attribute_lengths([(1, 3)])))
+        self.assertIsNone(self.cache.get_reply(1, self.uuid, self.request([1])))
+
+        self.assertEqual(self.cache.get_reply(0, self.uuid, self.request([1, 2], 0)),
+                         rpc_schema.payload_response(self.code, 1,
+                                                     rpc_schema.encode_attribute_lengths([(1, 3), (2, None)])))
+
+    def test_buffer_too_small(self):
+        self.cache.add_reply(0, self.uuid, self.request([1]), self.reply([(1, 'abc')]))
+
+        self.assertIsNone(self.cache.get_reply(0, self.uuid, self.request([1], 2)))
+
+    def test_not_found(self):
+        error = rpc_schema.error_response(self.code, 1, DKS_HALError.HAL_ERROR_ATTRIBUTE_NOT_FOUND)
+
+        # with several attributes the missing one isn't known
+        self.cache.add_reply(0, self.uuid, self.request([1, 2]), error)
+        self.assertIsNone(self.cache.get_reply(0, self.uuid, self.request([1])))
+
+        self.cache.add_reply(0, self.uuid, self.request([2]), error)
+        self.cache.add_reply(0, self.uuid, self.request([1]), self.reply([(1, 'a')]))
+        self.assertEqual(self.cache.get_reply(0, self.uuid, self.request([1, 2])), error)
+
+    def test_set_attributes(self):
+        self.cache.add_reply(0, self.uuid, self.request([1, 2]), self.reply([(1, 'a'), (2, 'b')]))
+
+        self.cache.set_attributes(0, self.uuid, [(1, 'new'), (2, None)], True)
+        self.assertEqual(self.cache.get_reply(0, self.uuid, self.request([1])), self.reply([(1, 'new')]))
+        self.assertIsNone(self.cache.get_reply(0, self.uuid, self.request([2])))
+
+        # after a failure the alpha's values aren't known
+        self.cache.set_attributes(0, self.uuid, [(1, 'other')], False)
+        self.assertIsNone(self.cache.get_reply(0, self.uuid, self.request([1])))
+
+
+if __name__ == '__main__':
+    unittest.main()
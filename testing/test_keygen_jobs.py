@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import unittest
+
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from rpc_handling import MAX_KEYGEN_JOBS
+from keygen_pool import RSA_EXPONENT
+from hsm_tools import rpc_schema
+from hsm_tools.cryptech_port import DKS_RPCFunc, DKS_HALError, DKS_KeygenJobState
+
+from preprocessor_fixture import PreprocessorTestCase
+
+GENERATE_RSA = DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_RSA
+SUBMIT = DKS_RPCFunc.RPC_FUNC_KEYGEN_JOB_SUBMIT
+STATUS = DKS_RPCFunc.RPC_FUNC_KEYGEN_JOB_STATUS
+RESULT = DKS_RPCFunc.RPC_FUNC_KEYGEN_JOB_RESULT
+
+
+class TestKeygenJobs(PreprocessorTestCase):
+    """Keygen jobs must generate keys like PKEY_GENERATE without
+    holding up the connection"""
+    def setUp(self):
+        PreprocessorTestCase.setUp(self)
+        self.session.enable_exportable_private_keys = False
+
+    def submit(self):
+        keygen_request = rpc_schema.REQUESTS[GENERATE_RSA].encode(GENERATE_RSA, 1, 0, 2048, RSA_EXPONENT, 8)
+        action = self.process(SUBMIT, GENERATE_RSA, keygen_request[rpc_schema.HEADER.size:])
+
+        return rpc_schema.RESPONSES[SUBMIT].get(action.result, 'job'), action.background
+
+    def finish(self, background, reply):
+        """Do what the server does with a background action"""
+        action = background.callback(background, [reply])
+        background.done(action.result)
+
+    def status(self, job_id, wait = 0):
+        return self.process(STATUS, job_id, wait)
+
+    def test_job(self):
+        job_id, background = self.submit()
+        self.assertEqual(rpc_schema.get_header(background.request), (GENERATE_RSA, 1))
+
+        action = self.status(job_id)
+        self.assertEqual(action.result, self.reply(STATUS, DKS_HALError.HAL_OK, DKS_KeygenJobState.KEYGEN_JOB_RUNNING))
+        self.assertEqual(self.process(RESULT, job_id).result,
+                         rpc_schema.error_response(RESULT, 1, DKS_HALError.HAL_ERROR_NOT_READY))
+
+        # a waiting status request finishes with the job
+        waiting = self.status(job_id, 1)
+        self.assertFalse(waiting.work.done())
+
+        self.finish(background, self.reply(GENERATE_RSA, DKS_HALError.HAL_OK, 12, uuid4()))
+
+        self.assertTrue(waiting.work.done())
+        action = waiting.callback(waiting, [waiting.work.result()])
+        self.assertEqual(action.result, self.reply(STATUS, DKS_HALError.HAL_OK, DKS_KeygenJobState.KEYGEN_JOB_DONE))
+
+        # the handle is the session's handle for the key
+        reply = rpc_schema.RESPONSES[RESULT].decode(self.process(RESULT, job_id).result)
+        self.assertEqual(self.session.key_rpcs[reply['handle']].device_handle, 12)
+
+        # the job is gone once its result has been returned
+        self.assertEqual(self.process(RESULT, job_id).result,
+                         rpc_schema.error_response(RESULT, 1, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS))
+
+    def test_failed_job(self):
+        job_id, background = self.submit()
+        self.finish(background, rpc_schema.error_response(GENERATE_RSA, 1, DKS_HALError.HAL_ERROR_NO_KEY_INDEX_SLOTS))
+
+        self.assertEqual(self.status(job_id).result,
+                         self.reply(STATUS, DKS_HALError.HAL_OK, DKS_KeygenJobState.KEYGEN_JOB_FAILED))
+        self.assertEqual(self.process(RESULT, job_id).result,
+                         rpc_schema.error_response(RESULT, 1, DKS_HALError.HAL_ERROR_NO_KEY_INDEX_SLOTS))
+
+    def test_lost_job(self):
+        job_id, background = self.submit()
+        background.done(None)
+
+        self.assertEqual(self.process(RESULT, job_id).result,
+                         rpc_schema.error_response(RESULT, 1, DKS_HALError.HAL_ERROR_RPC_TRANSPORT))
+
+    def test_spread_over_alphas(self):
+        _, first = self.submit()
+        _, second = self.submit()
+
+        self.assertNotEqual(self.device_index(first), self.device_index(second))
+
+    def test_bad_code(self):
+        action = self.process(SUBMIT, DKS_RPCFunc.RPC_FUNC_GET_VERSION, '')
+        self.assertEqual(action.result, rpc_schema.error_response(SUBMIT, 1, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS))
+
+    def test_job_limit(self):
+        for _ in xrange(MAX_KEYGEN_JOBS):
+            self.submit()
+
+        keygen_request = rpc_schema.REQUESTS[GENERATE_RSA].encode(GENERATE_RSA, 1, 0, 2048, RSA_EXPONENT, 8)
+        action = self.process(SUBMIT, GENERATE_RSA, keygen_request[rpc_schema.HEADER.size:])
+        self.assertEqual(action.result, rpc_schema.error_response(SUBMIT, 1,
+                                                                  DKS_HALError.HAL_ERROR_ALLOCATION_FAILURE))
+
+    def test_unknown_job(self):
+        self.assertEqual(self.status(5).result, rpc_schema.error_response(STATUS, 1,
+                                                                          DKS_HALError.HAL_ERROR_BAD_ARGUMENTS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import unittest
+
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from keygen_pool import KeygenProfile, KeygenPool, RSA_EXPONENT
+from hsm_tools import rpc_schema
+from hsm_tools.cryptech_port import DKS_RPCFunc, DKS_HALError, DKS_HALUser, DKS_HALCurve, DKS_HALKeyType
+from hsm_tools.rpc_action import RPCPriority
+from settings import HSMSettings
+
+from preprocessor_fixture import PreprocessorTestCase
+
+GENERATE_EC = DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_EC
+GENERATE_RSA = DKS_RPCFunc.RPC_FUNC_PKEY_GENERATE_RSA
+P256 = int(DKS_HALCurve.HAL_CURVE_P256)
+
+
+class TestKeygenProfile(unittest.TestCase):
+    """Profiles must match the keygen requests from libhal clients"""
+    def test_parse(self):
+        self.assertEqual(KeygenProfile.parse('rsa:2048:0x9'), KeygenProfile(GENERATE_RSA, 2048, 9))
+        self.assertEqual(KeygenProfile.parse(' EC:p-256:8 '), KeygenProfile(GENERATE_EC, P256, 8))
+        self.assertEqual(str(KeygenProfile.parse('ec:P-256:0x8')), 'ec:P-256:0x8')
+        self.assertEqual(str(KeygenProfile.parse('rsa:2048:9')), 'rsa:2048:0x9')
+
+    def test_parse_errors(self):
+        for text in ('rsa:2048', 'rsa:2048:0', 'ec:p-999:8', 'dsa:1024:8', 'rsa:big:8'):
+            self.assertRaises(ValueError, KeygenProfile.parse, text)
+
+    def test_from_request(self):
+        request = rpc_schema.REQUESTS[GENERATE_EC].encode(GENERATE_EC, 1, 7, P256, 8)
+        self.assertEqual(KeygenProfile.from_request(GENERATE_EC, request), KeygenProfile(GENERATE_EC, P256, 8))
+
+        request = rpc_schema.REQUESTS[GENERATE_RSA].encode(GENERATE_RSA, 1, 7, 2048, RSA_EXPONENT, 9)
+        self.assertEqual(KeygenProfile.from_request(GENERATE_RSA, request), KeygenProfile(GENERATE_RSA, 2048, 9))
+
+        # only the usual exponent is kept in the pool
+        request = rpc_schema.REQUESTS[GENERATE_RSA].encode(GENERATE_RSA, 1, 7, 2048, '\x03', 9)
+        self.assertIsNone(KeygenProfile.from_request(GENERATE_RSA, request))
+
+    def test_generate_request(self):
+        for profile in (KeygenProfile.parse('rsa:2048:9'), KeygenProfile.parse('ec:p-384:8')):
+            request = profile.generate_request(3)
+
+            self.assertEqual(rpc_schema.get_header(request), (profile.code, 3))
+            self.assertEqual(KeygenProfile.from_request(profile.code, request), profile)
+
+    def test_keytype(self):
+        self.assertEqual(KeygenProfile.parse('rsa:2048:9').keytype, DKS_HALKeyType.HAL_KEY_TYPE_RSA_PRIVATE)
+        self.assertEqual(KeygenProfile.parse('rsa:2048:9').curve, 0)
+        self.assertEqual(KeygenProfile.parse('ec:p-256:8').keytype, DKS_HALKeyType.HAL_KEY_TYPE_EC_PRIVATE)
+        self.assertEqual(KeygenProfile.parse('ec:p-256:8').curve, P256)
+
+
+class TestKeygenPool(unittest.TestCase):
+    """KeygenPool must hand out each key once and spread new keys over
+    the alphas"""
+    def setUp(self):
+        self.rsa = KeygenProfile.parse('rsa:2048:9')
+        self.ec = KeygenProfile.parse('ec:p-256:8')
+        self.pool = KeygenPool([self.rsa, self.ec], 2)
+
+    def test_take(self):
+        uuid = uuid4()
+        self.pool.add_key(self.ec, 1, uuid)
+
+        self.assertIsNone(self.pool.take(self.rsa))
+        self.assertEqual(self.pool.take(self.ec), (1, uuid))
+        self.assertIsNone(self.pool.take(self.ec))
+        self.assertEqual((self.pool.handed_out, self.pool.misses), (1, 2))
+
+    def test_next_refill(self):
+        self.pool.add_key(self.rsa, 0, uuid4())
+
+        # the emptiest profile goes on the alpha with the fewest keys
+        self.assertEqual(self.pool.next_refill([0, 1], 0, now = 10.0), (self.ec, 0))
+        self.pool.add_key(self.ec, 0, uuid4())
+        self.assertEqual(self.pool.next_refill([0, 1], 0, now = 10.0), (self.rsa, 1))
+
+    def test_refill_interval(self):
+        self.assertIsNotNone(self.pool.next_refill([0], 5, now = 10.0))
+        self.assertIsNone(self.pool.next_refill([0], 5, now = 12.0))
+        self.assertIsNotNone(self.pool.next_refill([0], 5, now = 15.0))
+
+    def test_full(self):
+        for profile in (self.rsa, self.ec):
+            for _ in xrange(2):
+                self.pool.add_key(profile, 0, uuid4())
+
+        self.assertIsNone(self.pool.next_refill([0, 1], 0))
+        self.assertIsNone(KeygenPool([self.rsa], 2).next_refill([], 0))
+
+    def test_enabled(self):
+        self.assertTrue(self.pool.is_enabled())
+        self.pool.set_profiles([self.rsa], 0)
+        self.assertFalse(self.pool.is_enabled())
+
+    def test_status(self):
+        self.pool.add_key(self.ec, 1, uuid4())
+
+        self.assertEqual(self.pool.get_status().split('\r\n'),
+                         ['0 keys handed out, 0 misses',
+                          'ec:P-256:0x8 - 1 of 2 ready (RPC1: 1)',
+                          'rsa:2048:0x9 - 0 of 2 ready'])
+
+
+class TestKeygenPoolRefill(PreprocessorTestCase):
+    """The pool must only be refilled through a logged in client and
+    its keys must be handed to the client like new keys"""
+    def setUp(self):
+        PreprocessorTestCase.setUp(self)
+        self.settings.set_setting(HSMSettings.KEYGEN_POOL_PROFILES, ['ec:p-256:8'])
+        self.settings.set_setting(HSMSettings.KEYGEN_POOL_DEPTH, 1)
+        self.settings.set_setting(HSMSettings.KEYGEN_POOL_REFILL_INTERVAL, 0)
+        self.settings.set_setting(HSMSettings.KEYGEN_POOL_IDLE_TIME, 0)
+        self.preprocessor.set_keygen_pool_settings(*self.preprocessor.get_keygen_pool_settings())
+
+        # the pool is only used once the HSM is ready
+        self.settings.set_setting(HSMSettings.MASTERKEY_SET, True)
+        self.cache.initialize_cache()
+        self.preprocessor.hsm_locked = False
+
+        self.session.enable_exportable_private_keys = False
+
+    def login(self, user = DKS_HALUser.HAL_USER_NORMAL):
+        code = DKS_RPCFunc.RPC_FUNC_LOGIN
+        action = self.process(code, user, 'pin')
+        action.callback(action, [self.reply(code, DKS_HALError.HAL_OK)] * self.device_count)
+
+    def refill(self):
+        return self.process(DKS_RPCFunc.RPC_FUNC_GET_VERSION).background
+
+    def test_not_logged_in(self):
+        self.assertIsNone(self.refill())
+
+        self.login(DKS_HALUser.HAL_USER_SO)
+        self.assertIsNone(self.refill())
+
+    def test_refill(self):
+        self.login()
+
+        action = self.refill()
+        self.assertEqual(rpc_schema.get_header(action.request), (GENERATE_EC, 1))
+        self.assertEqual(action.priority, RPCPriority.BULK)
+        self.assertIs(action.session, self.session)
+
+        uuid = uuid4()
+        action = action.callback(action, [self.reply(GENERATE_EC, DKS_HALError.HAL_OK, 12, uuid)])
+
+        # the key is closed but stays on the alpha
+        self.assertEqual(rpc_schema.REQUESTS[DKS_RPCFunc.RPC_FUNC_PKEY_CLOSE].decode(action.request)['handle'], 12)
+        self.assertTrue(self.cache.is_unassigned_key(self.device_index(action), uuid))
+
+        # the pool is full
+        self.assertIsNone(self.refill())
+
+    def test_logout(self):
+        self.login()
+
+        code = DKS_RPCFunc.RPC_FUNC_LOGOUT
+        action = self.process(code)
+        action.callback(action, [self.reply(code, DKS_HALError.HAL_OK)] * self.device_count)
+
+        self.assertIsNone(self.refill())
+
+    def test_locked(self):
+        self.login()
+        self.preprocessor.hsm_locked = True
+
+        self.assertIsNone(self.refill())
+
+    def test_key_from_pool(self):
+        uuid = uuid4()
+        profile = KeygenProfile.parse('ec:p-256:8')
+        self.cache.add_unassigned_key(1, uuid, str(profile), profile.keytype, profile.flags, profile.curve)
+        self.preprocessor.keygen_pool.add_key(profile, 1, uuid)
+        self.login()
+
+        action = self.process(GENERATE_EC, 7, P256, 8)
+        self.assertEqual(self.device_index(action), 1)
+        fields = rpc_schema.REQUESTS[DKS_RPCFunc.RPC_FUNC_PKEY_OPEN].decode(action.request)
+        self.assertEqual((fields['session'], fields['uuid']), (7, uuid))
+
+        action = action.callback(action, [self.reply(DKS_RPCFunc.RPC_FUNC_PKEY_OPEN, DKS_HALError.HAL_OK, 55)])
+        reply = rpc_schema.RESPONSES[GENERATE_EC].decode(action.result)
+
+        key_details = self.session.key_rpcs[reply['handle']]
+        self.assertEqual((key_details.rpc_index, key_details.uuid, key_details.device_handle), (1, uuid, 55))
+        self.assertEqual(key_details.session_param, 7)
+        self.assertEqual(key_details.master_uuid, reply['uuid'])
+        self.assertFalse(self.cache.is_unassigned_key(1, uuid))
+
+    def test_pool_key_missing(self):
+        uuid = uuid4()
+        profile = KeygenProfile.parse('ec:p-256:8')
+        self.preprocessor.keygen_pool.add_key(profile, 1, uuid)
+        self.login()
+
+        request = self.request(GENERATE_EC, 7, P256, 8)
+        action = self.preprocessor.process_incoming_rpc(request, self.session)
+        action = action.callback(action, [rpc_schema.error_response(DKS_RPCFunc.RPC_FUNC_PKEY_OPEN, 1,
+                                                                    DKS_HALError.HAL_ERROR_KEY_NOT_FOUND)])
+
+        # a new key is made instead
+        self.assertEqual(action.request, request)
+        self.assertIs(action.session, self.session)
+
+        new_uuid = uuid4()
+        action = action.callback(action, [self.reply(GENERATE_EC, DKS_HALError.HAL_OK, 77, new_uuid)])
+        reply = rpc_schema.RESPONSES[GENERATE_EC].decode(action.result)
+        self.assertEqual(self.session.key_rpcs[reply['handle']].session_param, 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from random_pool import RandomPool
+
+
+class TestRandomPool(unittest.TestCase):
+    """RandomPool must give out each random byte only once"""
+    def test_take(self):
+        pool = RandomPool(8, 4)
+        self.assertEqual(pool.add(b'abcdef', pool.get_generation()), 6)
+
+        self.assertEqual(pool.take(4), b'abcd')
+        self.assertEqual(pool.take(2), b'ef')
+        self.assertIsNone(pool.take(1))
+        self.assertEqual(pool.space(), 8)
+
+    def test_taken_bytes_zeroed(self):
+        pool = RandomPool(4, 0)
+        pool.add(b'abcd', pool.get_generation())
+        pool.take(2)
+
+        self.assertEqual(bytes(pool.buffer), b'\x00\x00cd')
+
+    def test_wrap(self):
+        pool = RandomPool(6, 0)
+        pool.add(b'abcd', pool.get_generation())
+        pool.take(3)
+
+        # only the free space is used
+        self.assertEqual(pool.add(b'efghij', pool.get_generation()), 5)
+        self.assertEqual(pool.take(6), b'defghi')
+
+    def test_misses(self):
+        pool = RandomPool(4, 0)
+        pool.add(b'ab', pool.get_generation())
+
+        self.assertIsNone(pool.take(3))
+        self.assertIsNone(pool.take(0))
+        self.assertEqual(pool.misses, 2)
+
+    def test_refill_hysteresis(self):
+        pool = RandomPool(4, 2)
+        self.assertTrue(pool.needs_refill())
+
+        pool.add(b'abc', pool.get_generation())
+        self.assertTrue(pool.needs_refill())
+        pool.add(b'd', pool.get_generation())
+        self.assertFalse(pool.needs_refill())
+
+        # above the low-water mark nothing is requested
+        pool.take(2)
+        self.assertFalse(pool.needs_refill())
+        pool.take(1)
+        self.assertTrue(pool.needs_refill())
+
+    def test_wipe(self):
+        pool = RandomPool(4, 0)
+        generation = pool.get_generation()
+        pool.add(b'abcd', generation)
+        pool.wipe()
+
+        self.assertEqual(bytes(pool.buffer), b'\x00' * 4)
+        self.assertIsNone(pool.take(1))
+
+        # a refill requested before the wipe is dropped
+        self.assertEqual(pool.add(b'abcd', generation), 0)
+        self.assertEqual(pool.add(b'abcd', pool.get_generation()), 4)
+
+    def test_resize(self):
+        pool = RandomPool(4, 2)
+        generation = pool.get_generation()
+        pool.add(b'abcd', generation)
+        pool.resize(0, 2)
+
+        self.assertEqual(pool.add(b'abcd', pool.get_generation()), 0)
+        self.assertFalse(pool.needs_refill())
+        self.assertIsNone(pool.take(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
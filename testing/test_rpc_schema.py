@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import unittest
+
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from hsm_tools import rpc_schema
+from hsm_tools.cryptech_port import DKS_RPCFunc, DKS_HALError
+
+
+class TestRPCSchema(unittest.TestCase):
+    """Messages must round trip through the schema without changes"""
+    def test_fixed_fields(self):
+        code = DKS_RPCFunc.RPC_FUNC_PKEY_OPEN
+        uuid = uuid4()
+        msg = rpc_schema.REQUESTS[code].encode(code, 7, 3, uuid)
+
+        self.assertEqual(rpc_schema.get_header(msg), (code, 7))
+        self.assertEqual(rpc_schema.REQUESTS[code].decode(msg), {'session' : 3, 'uuid' : uuid})
+        self.assertEqual(rpc_schema.REQUESTS[code].get(msg, 'uuid'), uuid)
+
+    def test_variable_fields(self):
+        code = DKS_RPCFunc.RPC_FUNC_PKEY_SIGN
+        msg = rpc_schema.REQUESTS[code].encode(code, 1, 5, 0, 'abcde', 256)
+
+        self.assertEqual(rpc_schema.REQUESTS[code].get(msg, 'data'), 'abcde')
+
+        # the field after the padded bytes must still be found
+        self.assertEqual(rpc_schema.REQUESTS[code].get(msg, 'length'), 256)
+        self.assertEqual(len(msg) % 4, 0)
+
+    def test_replace(self):
+        code = DKS_RPCFunc.RPC_FUNC_PKEY_OPEN
+        uuid = uuid4()
+        msg = rpc_schema.REQUESTS[code].encode(code, 7, 3, uuid4())
+
+        changed = rpc_schema.REQUESTS[code].replace(msg, 'uuid', uuid)
+        self.assertEqual(rpc_schema.REQUESTS[code].decode(changed), {'session' : 3, 'uuid' : uuid})
+
+        login = DKS_RPCFunc.RPC_FUNC_LOGIN
+        with self.assertRaises(ValueError):
+            rpc_schema.REQUESTS[login].replace(rpc_schema.REQUESTS[login].encode(login, 0, 1, 'pin'),
+                                               'pin', 'other')
+
+    def test_set_client(self):
+        code = DKS_RPCFunc.RPC_FUNC_GET_VERSION
+        msg = bytearray(rpc_schema.REQUESTS[code].encode(code, 7))
+        rpc_schema.set_client(msg, 9)
+
+        self.assertEqual(rpc_schema.get_header(bytes(msg)), (code, 9))
+
+    def test_uuid_list_response(self):
+        code = DKS_RPCFunc.RPC_FUNC_PKEY_MATCH
+        uuids = [uuid4(), uuid4()]
+        msg = rpc_schema.RESPONSES[code].encode(code, 2, DKS_HALError.HAL_OK, 0, uuids)
+
+        self.assertEqual(rpc_schema.get_response_header(msg), (code, 2, DKS_HALError.HAL_OK))
+        self.assertEqual(rpc_schema.RESPONSES[code].get(msg, 'uuids'), uuids)
+
+    def test_error_response(self):
+        code = DKS_RPCFunc.RPC_FUNC_PKEY_OPEN
+        msg = rpc_schema.error_response(code, 9, DKS_HALError.HAL_ERROR_KEY_NOT_FOUND)
+
+        self.assertEqual(rpc_schema.get_response_header(msg), (code, 9, DKS_HALError.HAL_ERROR_KEY_NOT_FOUND))
+        self.assertEqual(rpc_schema.get_response_payload(msg), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
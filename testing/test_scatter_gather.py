@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import unittest
+
+import tornado.gen
+import tornado.ioloop
+from tornado.testing import AsyncTestCase, gen_test
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from device_scheduler import RPCClass
+from hsm_tools import rpc_schema
+from hsm_tools.cryptech_port import DKS_RPCFunc, DKS_HALError
+from hsm_tools.slip import slip_encode, slip_decode
+from hsm_tools.tcpserver import RPCTCPServer
+
+
+class FakeSerial(object):
+    """Answers each request after a delay with the index of the alpha"""
+    def __init__(self, device_index, delay, received):
+        self.device_index = device_index
+        self.delay = delay
+        self.received = received
+
+    @tornado.gen.coroutine
+    def rpc_input(self, query, handle, queue, priority = None, deadline = None):
+        request = slip_decode(query)
+        self.received.append((self.device_index, request))
+
+        code, client = rpc_schema.get_header(request)
+        reply = rpc_schema.payload_response(code, client, chr(self.device_index))
+        tornado.ioloop.IOLoop.current().call_later(self.delay, queue.put_nowait, reply)
+
+
+class FakeRPC(object):
+    def __init__(self, device_index, delay, received):
+        self.name = 'RPC%i' % device_index
+        self.serial = FakeSerial(device_index, delay, received)
+
+
+class FakePreprocessor(object):
+    def get_rpc_timeout(self, rpc_class):
+        return 0
+
+    def start_request(self, rpc, rpc_class):
+        return 0
+
+    def finish_request(self, rpc, rpc_class, start_time, success):
+        pass
+
+
+class TestScatterGather(AsyncTestCase):
+    """Requests for several alphas must be sent together and the
+    replies returned in the order of the alphas in the list"""
+    def setUp(self):
+        super(TestScatterGather, self).setUp()
+
+        # the server is only used for its exchanges with the alphas
+        self.server = RPCTCPServer.__new__(RPCTCPServer)
+        self.server.rpc_preprocessor = FakePreprocessor()
+
+        self.received = []
+
+    def send(self, rpc_list, encoded_request):
+        return self.server._RPCTCPServer__send_to_devices(rpc_list, encoded_request, 1, {}, {},
+                                                          RPCClass.OTHER)
+
+    def request(self, client = 1):
+        code = DKS_RPCFunc.RPC_FUNC_GET_VERSION
+        return rpc_schema.REQUESTS[code].encode(code, client)
+
+    @gen_test
+    def test_reply_order(self):
+        # the first alpha is the slowest so its reply arrives last
+        rpc_list = [FakeRPC(i, delay, self.received) for i, delay in enumerate([0.03, 0.01, 0.02])]
+
+        replies = yield self.send(rpc_list, slip_encode(self.request()))
+
+        self.assertEqual([rpc_schema.get_response_payload(reply) for reply in replies], ['\x00', '\x01', '\x02'])
+        for reply in replies:
+            self.assertEqual(rpc_schema.get_response_header(reply),
+                             (DKS_RPCFunc.RPC_FUNC_GET_VERSION, 1, DKS_HALError.HAL_OK))
+
+    @gen_test
+    def test_scatter(self):
+        rpc_list = [FakeRPC(i, 0.02, self.received) for i in xrange(4)]
+
+        start = self.io_loop.time()
+        yield self.send(rpc_list, slip_encode(self.request()))
+
+        # every alpha works at the same time instead of one after another
+        self.assertLess(self.io_loop.time() - start, 0.06)
+        self.assertEqual(sorted(device_index for device_index, _ in self.received), [0, 1, 2, 3])
+
+    @gen_test
+    def test_request_for_each_device(self):
+        rpc_list = [FakeRPC(i, 0.01, self.received) for i in xrange(2)]
+        requests = [self.request(10), self.request(11)]
+
+        replies = yield self.send(rpc_list, [slip_encode(request) for request in requests])
+
+        self.assertEqual(sorted(self.received), [(0, requests[0]), (1, requests[1])])
+        self.assertEqual([rpc_schema.get_response_header(reply)[1] for reply in replies], [10, 11])
+
+    @gen_test
+    def test_single_device(self):
+        replies = yield self.send([FakeRPC(3, 0, self.received)], slip_encode(self.request()))
+
+        self.assertEqual([rpc_schema.get_response_payload(reply) for reply in replies], ['\x03'])
+
+
+if __name__ == '__main__':
+    unittest.main()
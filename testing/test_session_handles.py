@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import unittest
+
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from rpc_handling import KeyHandleDetails, HashHandleDetails, MAX_SESSION_HANDLE
+from hsm_tools import rpc_schema
+from hsm_tools.cryptech_port import DKS_RPCFunc, DKS_HALError, DKS_HALKeyType, DKS_HALDigestAlgorithm
+
+from preprocessor_fixture import PreprocessorTestCase
+
+OPEN = DKS_RPCFunc.RPC_FUNC_PKEY_OPEN
+SIGN = DKS_RPCFunc.RPC_FUNC_PKEY_SIGN
+HASH_INITIALIZE = DKS_RPCFunc.RPC_FUNC_HASH_INITIALIZE
+SHA256 = DKS_HALDigestAlgorithm.HAL_DIGEST_ALGORITHM_SHA256
+
+
+class TestSessionHandles(PreprocessorTestCase):
+    """Handles from different alphas must not collide in a session"""
+    def open_key(self, rpc_index, device_handle):
+        master_uuid = self.cache.add_key_to_alpha(rpc_index, uuid4(), DKS_HALKeyType.HAL_KEY_TYPE_EC_PRIVATE,
+                                                  auto_backup = False)
+
+        action = self.process(OPEN, 3, master_uuid)
+        self.assertEqual(self.device_index(action), rpc_index)
+
+        action = action.callback(action, [self.reply(OPEN, DKS_HALError.HAL_OK, device_handle)])
+        return rpc_schema.RESPONSES[OPEN].get(action.result, 'handle')
+
+    def test_new_handle(self):
+        self.session.key_rpcs[2] = KeyHandleDetails(0, None, 2)
+        self.assertEqual([self.session.new_handle() for _ in xrange(3)], [1, 3, 4])
+
+        # handles wrap around before the host hash handles
+        self.session.next_handle = MAX_SESSION_HANDLE - 1
+        self.assertEqual([self.session.new_handle() for _ in xrange(3)], [MAX_SESSION_HANDLE, 1, 3])
+
+    def test_same_device_handle(self):
+        first = self.open_key(0, 7)
+        second = self.open_key(1, 7)
+        self.assertNotEqual(first, second)
+
+        for handle, rpc_index in ((first, 0), (second, 1)):
+            action = self.process(SIGN, handle, 0, 'digest', 64)
+            self.assertEqual(self.device_index(action), rpc_index)
+            self.assertEqual(rpc_schema.REQUESTS[SIGN].decode(action.request)['handle'], 7)
+
+    def test_hash_handle(self):
+        action = self.process(HASH_INITIALIZE, 0, SHA256, 'key')
+        action = action.callback(action, [self.reply(HASH_INITIALIZE, DKS_HALError.HAL_OK, 7)])
+
+        handle = rpc_schema.RESPONSES[HASH_INITIALIZE].get(action.result, 'handle')
+        self.assertEqual(self.session.hash_rpcs[handle].device_handle, 7)
+
+    def test_sign_with_hash(self):
+        self.session.key_rpcs[1] = KeyHandleDetails(1, None, 7, DKS_HALKeyType.HAL_KEY_TYPE_EC_PRIVATE)
+        self.session.hash_rpcs[2] = HashHandleDetails(1, 8)
+
+        action = self.process(SIGN, 1, 2, '', 64)
+        fields = rpc_schema.REQUESTS[SIGN].decode(action.request)
+        self.assertEqual((fields['handle'], fields['hash']), (7, 8))
+        self.assertNotIn(2, self.session.hash_rpcs)
+
+    def test_hash_on_other_alpha(self):
+        self.session.key_rpcs[1] = KeyHandleDetails(1, None, 7, DKS_HALKeyType.HAL_KEY_TYPE_EC_PRIVATE)
+        self.session.hash_rpcs[2] = HashHandleDetails(0, 8)
+
+        action = self.process(SIGN, 1, 2, '', 64)
+        self.assertEqual(action.result, rpc_schema.error_response(SIGN, 1, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS))
+
+    def test_unknown_handle(self):
+        action = self.process(SIGN, 9, 0, 'digest', 64)
+        self.assertEqual(action.result, rpc_schema.error_response(SIGN, 1, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from rpc_handling import ETHERNET_SESSION_PRIORITY
+from hsm_tools import rpc_schema
+from hsm_tools.cryptech_port import DKS_RPCFunc, DKS_HALError
+from hsm_tools.rpc_action import RPCPriority
+
+from preprocessor_fixture import PreprocessorTestCase
+
+SET_PRIORITY = DKS_RPCFunc.RPC_FUNC_SET_PRIORITY
+
+
+class TestSessionPriority(PreprocessorTestCase):
+    """A session's requests must carry its priority and deadline"""
+    def set_priority(self, session, priority, deadline):
+        request = self.request(SET_PRIORITY, priority, deadline)
+        return self.preprocessor.process_incoming_rpc(request, session).result
+
+    def next_action(self, session):
+        request = self.request(DKS_RPCFunc.RPC_FUNC_GET_VERSION)
+        return self.preprocessor.process_incoming_rpc(request, session)
+
+    def test_priority(self):
+        self.assertEqual(self.set_priority(self.session, RPCPriority.HIGH, 250),
+                         rpc_schema.error_response(SET_PRIORITY, 1, DKS_HALError.HAL_OK))
+
+        start = time.time()
+        action = self.next_action(self.session)
+        self.assertEqual(action.priority, RPCPriority.HIGH)
+        self.assertTrue(start + 0.25 <= action.deadline <= time.time() + 0.25)
+
+    def test_no_deadline(self):
+        self.set_priority(self.session, RPCPriority.BULK, 0)
+
+        action = self.next_action(self.session)
+        self.assertEqual(action.priority, RPCPriority.BULK)
+        self.assertIsNone(action.deadline)
+
+    def test_bad_priority(self):
+        self.assertEqual(self.set_priority(self.session, 7, 0),
+                         rpc_schema.error_response(SET_PRIORITY, 1, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS))
+
+    def test_ethernet_session(self):
+        session = self.preprocessor.create_session(2, True)
+        self.assertEqual(self.next_action(session).priority, ETHERNET_SESSION_PRIORITY)
+
+        # outside connections can't go ahead of the mux's own requests
+        self.set_priority(session, RPCPriority.HIGH, 100)
+        action = self.next_action(session)
+        self.assertEqual(action.priority, ETHERNET_SESSION_PRIORITY)
+        self.assertIsNotNone(action.deadline)
+
+        self.set_priority(session, RPCPriority.BULK, 0)
+        self.assertEqual(self.next_action(session).priority, RPCPriority.BULK)
+
+
+if __name__ == '__main__':
+    unittest.main()
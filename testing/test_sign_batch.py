@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import unittest
+
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from hsm_tools import rpc_schema
+from hsm_tools.cryptech_port import DKS_RPCFunc, DKS_HALError, DKS_HALKeyType
+
+from preprocessor_fixture import PreprocessorTestCase
+
+SIGN_BATCH = DKS_RPCFunc.RPC_FUNC_PKEY_SIGN_BATCH
+OPEN = DKS_RPCFunc.RPC_FUNC_PKEY_OPEN
+SIGN = DKS_RPCFunc.RPC_FUNC_PKEY_SIGN
+CLOSE = DKS_RPCFunc.RPC_FUNC_PKEY_CLOSE
+
+
+class TestSignBatch(PreprocessorTestCase):
+    """PKEY_SIGN_BATCH must share the digests between every alpha with
+    the key and return the signatures in order"""
+    def setUp(self):
+        PreprocessorTestCase.setUp(self)
+
+        self.master_uuid = self.cache.add_key_to_alpha(0, uuid4(), DKS_HALKeyType.HAL_KEY_TYPE_EC_PRIVATE,
+                                                       auto_backup = False)
+        self.cache.add_key_to_alpha(1, uuid4(), DKS_HALKeyType.HAL_KEY_TYPE_EC_PRIVATE,
+                                    param_masterListID = self.master_uuid, auto_backup = False)
+
+    def open(self, digests, *statuses):
+        action = self.process(SIGN_BATCH, 0, self.master_uuid, 512, digests)
+        self.assertEqual([self.rpc_list.index(rpc) for rpc in action.rpc_list], [0, 1])
+
+        replies = [self.reply(OPEN, DKS_HALError.HAL_OK, 40 + rpc_index) if status == DKS_HALError.HAL_OK
+                   else rpc_schema.error_response(OPEN, 1, status)
+                   for rpc_index, status in enumerate(statuses)]
+
+        return action, action.callback(action, replies)
+
+    def sign(self, action, status = DKS_HALError.HAL_OK):
+        """Sign as the alpha would and return the alpha's next action"""
+        fields = rpc_schema.REQUESTS[SIGN].decode(action.request)
+        self.assertEqual(fields['handle'], 40 + self.device_index(action))
+
+        if (status != DKS_HALError.HAL_OK):
+            return action.callback(action, [rpc_schema.error_response(SIGN, 1, status)])
+
+        return action.callback(action, [self.reply(SIGN, DKS_HALError.HAL_OK, 'sig-' + fields['data'])])
+
+    def close(self, action):
+        action = action.callback(action, None)
+        self.assertEqual([rpc_schema.get_header(request)[0] for request in action.request], [CLOSE] * len(action.rpc_list))
+
+        return action.callback(action, [self.reply(CLOSE, DKS_HALError.HAL_OK)] * len(action.rpc_list))
+
+    def test_batch(self):
+        digests = ['a', 'b', 'c', 'd', 'e']
+        _, action = self.open(digests, DKS_HALError.HAL_OK, DKS_HALError.HAL_OK)
+        first, second = action.parallel
+
+        # the second alpha is faster and signs more of the digests
+        second = self.sign(second)
+        second = self.sign(second)
+        first = self.sign(first)
+        self.assertIsNone(self.sign(second).rpc_list)
+        self.assertIsNone(self.sign(first).rpc_list)
+
+        result = self.close(action).result
+        self.assertEqual(rpc_schema.RESPONSES[SIGN_BATCH].decode(result)['signatures'],
+                         ['sig-' + digest for digest in digests])
+
+    def test_open_failure(self):
+        _, action = self.open(['a', 'b'], DKS_HALError.HAL_ERROR_KEY_NOT_FOUND, DKS_HALError.HAL_OK)
+
+        # the alpha that opened the key does all of the work
+        sign_action, = action.parallel
+        self.assertEqual(self.device_index(sign_action), 1)
+        self.assertIsNone(self.sign(self.sign(sign_action)).rpc_list)
+
+        result = self.close(action).result
+        self.assertEqual(rpc_schema.RESPONSES[SIGN_BATCH].decode(result)['signatures'], ['sig-a', 'sig-b'])
+
+    def test_not_opened(self):
+        _, action = self.open(['a'], DKS_HALError.HAL_ERROR_KEY_NOT_FOUND, DKS_HALError.HAL_ERROR_KEY_NOT_FOUND)
+
+        self.assertEqual(action.result, rpc_schema.error_response(SIGN_BATCH, 1, DKS_HALError.HAL_ERROR_KEY_NOT_FOUND))
+
+    def test_sign_failure(self):
+        _, action = self.open(['a', 'b', 'c'], DKS_HALError.HAL_OK, DKS_HALError.HAL_OK)
+        first, second = action.parallel
+
+        self.assertIsNone(self.sign(first, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS).rpc_list)
+
+        # the other alpha stops taking digests
+        self.assertIsNone(self.sign(second).rpc_list)
+
+        result = self.close(action).result
+        self.assertEqual(result, rpc_schema.error_response(SIGN_BATCH, 1, DKS_HALError.HAL_ERROR_BAD_ARGUMENTS))
+
+    def test_unknown_key(self):
+        action = self.process(SIGN_BATCH, 0, uuid4(), 512, ['a'])
+        self.assertEqual(action.result, rpc_schema.error_response(SIGN_BATCH, 1, DKS_HALError.HAL_ERROR_KEY_NOT_FOUND))
+
+    def test_empty_batch(self):
+        action = self.process(SIGN_BATCH, 0, self.master_uuid, 512, [])
+        self.assertEqual(action.result, self.reply(SIGN_BATCH, DKS_HALError.HAL_OK, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# Copyright (c) 2019  Diamond Key Security, NFP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# - Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# - Neither the name of the NORDUnet nor the names of its contributors may
+#   be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hsm_software/sw'))
+
+from hsm_tools.slip import slip_encode, slip_decode, SLIPDecoder, SLIP_END, SLIP_ESC
+
+
+class TestSLIP(unittest.TestCase):
+    """The incremental decoder must find the same frames as slip_decode"""
+    frames = ['plain', SLIP_END + 'end' + SLIP_END, SLIP_ESC + 'esc', SLIP_ESC + SLIP_END * 2]
+
+    def test_round_trip(self):
+        for frame in self.frames:
+            self.assertEqual(slip_decode(slip_encode(frame)), frame)
+
+    def test_stream(self):
+        stream = ''.join(slip_encode(frame) for frame in self.frames)
+
+        self.assertEqual(SLIPDecoder().feed(stream), self.frames)
+
+    def test_split_stream(self):
+        stream = ''.join(slip_encode(frame) for frame in self.frames)
+
+        # a frame can be split anywhere, even between an escape and the byte it escapes
+        for chunk_size in (1, 2, 3, 7):
+            decoder = SLIPDecoder()
+            decoded = []
+            for i in xrange(0, len(stream), chunk_size):
+                decoded.extend(decoder.feed(stream[i:i + chunk_size]))
+
+            self.assertEqual(decoded, self.frames)
+
+    def test_empty_frames(self):
+        self.assertEqual(SLIPDecoder().feed(SLIP_END * 3 + 'a' + SLIP_END * 2), ['a'])
+
+    def test_reset(self):
+        decoder = SLIPDecoder()
+        decoder.feed(SLIP_END + 'lost')
+        decoder.reset()
+
+        self.assertEqual(decoder.feed('new' + SLIP_END), ['new'])
+
+
+if __name__ == '__main__':
+    unittest.main()